@@ -316,7 +316,8 @@ if __name__ == '__main__':
             database_server = WorkflowDatabaseServer(
                 config.get_database_file(),
                 config.get_transfered_file_dir(),
-                remove_orphan_files=config.get_remove_orphan_files())
+                remove_orphan_files=config.get_remove_orphan_files(),
+                wal_mode=config.get_database_wal_mode())
 
             logger.info("workflow_file " + repr(options.workflow_file))
             logger.info("wf_id_to_restart " + repr(options.wf_id_to_restart))
@@ -511,7 +511,48 @@ class WorkflowController(object):
         '''
         wf_status = self._engine_proxy.workflow_elements_status(
             workflow_id, with_drms_id=with_drms_id)
-        # special processing for transfer status:
+        return self._transfer_elements_status(wf_status)
+
+    def workflow_elements_status_changes(self, workflow_id,
+                                         since_revision=None,
+                                         with_drms_id=True):
+        '''
+        Same as workflow_elements_status(), but only gets back the elements
+        which status changed since a previous call, which is much lighter for
+        large workflows when polled regularly.
+
+        Parameters
+        ----------
+        workflow_id: workflow_identifier
+        since_revision: int or None
+            revision returned by a previous call. If None (first call) the
+            status of all the workflow elements is returned.
+        with_drms_id: bool (optional, default=True)
+            see workflow_elements_status()
+
+        Returns
+        -------
+        tuple (revision, full, status):
+            * revision: int, to be passed as since_revision to the next call
+            * full: bool, True if status holds all the workflow elements (on
+              the first call, or if the server cannot tell what changed since
+              since_revision), False if it only holds the elements which
+              changed.
+            * status: same structure as the workflow_elements_status()
+              result. The workflow status and queue are always given.
+
+        Raises *UnknownObjectError* if the workflow_id is not valid
+        '''
+        revision, full, wf_status \
+            = self._engine_proxy.workflow_elements_status_changes(
+                workflow_id, since_revision, with_drms_id=with_drms_id)
+        return (revision, full, self._transfer_elements_status(wf_status))
+
+    def _transfer_elements_status(self, wf_status):
+        '''
+        Special processing for transfer status in the workflow elements status
+        returned by the engine.
+        '''
         new_transfer_status = []
         for transfer_id, engine_path, client_path, client_paths, status, \
                 transfer_type in wf_status[1]:
@@ -812,6 +853,44 @@ class WorkflowController(object):
         '''
         self._engine_proxy.wait_workflow(workflow_id, timeout)
 
+    def wait_status_events(self, workflow_id, since_event_id=None,
+                           timeout=-1):
+        '''
+        Waits for status changes of a workflow or of its elements (jobs,
+        transfers and temporary paths), and gets them back as soon as they
+        are written by the engine. Monitors can call it in a loop, instead
+        of polling the status of the workflow.
+
+        Raises *UnknownObjectError* if the workflow_id is not valid
+
+        Parameters
+        ----------
+        workflow_id: workflow identifier
+        since_event_id: int or None
+            id of the last event already received (first value returned by
+            the previous call). If None, waits for the changes following the
+            call.
+        timeout: int
+            The call exits with no event after timeout seconds.
+            A negative value means that the method will wait indefinetely.
+
+        Returns
+        -------
+        tuple (last_event_id, complete, events):
+            * last_event_id: int, to be passed as since_event_id to the next
+              call
+            * complete: bool, False if some events following since_event_id
+              are not available anymore on the server: the status of the
+              workflow elements should then be read again (see
+              workflow_elements_status()).
+            * events: list of tuples (event_id, date, workflow_id,
+              element_type, element_id, status), where element_type is
+              'workflow', 'job', 'transfer' or 'temporary'. The status is
+              'deleted' when the workflow or a job is deleted.
+        '''
+        return self._engine_proxy.wait_status_events(workflow_id,
+                                                     since_event_id, timeout)
+
     def log_failed_workflow(self, workflow_id, file=sys.stderr):
         '''
         If the workflow has any failed job, log their status and outputs in the
@@ -1277,7 +1356,13 @@ def _embedded_engine_and_server(config):
     # database server
     database_server = WorkflowDatabaseServer(config.get_database_file(),
                                              config.get_transfered_file_dir(),
-                                             remove_orphan_files=config.get_remove_orphan_files())
+                                             remove_orphan_files=config.get_remove_orphan_files(),
+                                             wal_mode=config.get_database_wal_mode())
+    janitor_interval = config.get_database_janitor_interval()
+    if janitor_interval > 0:
+        database_server.start_janitor(
+            janitor_interval, config.get_database_janitor_max_lock_time(),
+            config.get_workflow_archive_dir())
 
     sch = scheduler.build_scheduler(config.get_scheduler_type(), config)
     workflow_engine = ConfiguredWorkflowEngine(database_server,
@@ -180,6 +180,32 @@ class Job(object):
 
     disposal_timeout: int
         Only requiered outside of a workflow
+
+    duration_hint: float
+        New in 3.1.
+        Expected duration of the job, in seconds (optional). It is used by the
+        engine when configured to submit first the jobs on the critical path
+        of workflows (see the SUBMISSION_ORDER configuration option). When not
+        specified, the durations of former jobs with the same name are used.
+
+    memory: float
+        New in 3.1.
+        Memory needed by the job, in megabytes (optional). The local scheduler
+        only starts the job when this amount of memory is available (see the
+        MAX_MEMORY local scheduler option). When not specified, the memory
+        may be given in the native_specification, as a PBS (``-l mem=4gb``,
+        ``pmem=...``) or SLURM (``--mem=4G``, ``--mem-per-cpu=...``) request.
+
+    python_job: bool
+        New in 3.1.
+        The command runs python code: ``python -m module args``,
+        ``python script.py args`` or ``python -c code args``. When the local
+        scheduler uses a pool of workers (see the WORKER_POOL local scheduler
+        option), and when ``python`` is the interpreter of the engine (not
+        run in a container), such a job runs in a process forked from a
+        worker python interpreter which has already started, rather than in
+        a new interpreter. Otherwise, and with other schedulers, the command
+        is run as usual.
     '''
 
     # sequence of sequence of string or/and FileTransfer or/and
@@ -248,6 +274,15 @@ class Job(object):
     # dict (config options)
     configuration = {}
 
+    # float (in seconds)
+    duration_hint = None
+
+    # float (in megabytes)
+    memory = None
+
+    # bool
+    python_job = False
+
     def __init__(self,
                  command,
                  referenced_input_files=None,
@@ -269,36 +304,54 @@ class Job(object):
                  has_outputs=False,
                  input_params_file=None,
                  output_params_file=None,
-                 configuration={}):
+                 configuration={},
+                 duration_hint=None,
+                 memory=None,
+                 python_job=False):
         if not name and len(command) != 0:
             self.name = command[0]
         else:
             self.name = name
         self.command = command
-        if referenced_input_files:
+        # empty lists and dicts which are passed are kept rather than
+        # replaced by new ones, so that engine jobs share them with their
+        # client job
+        if referenced_input_files or isinstance(referenced_input_files, list):
             self.referenced_input_files = referenced_input_files
         else:
             self.referenced_input_files = []
-        if referenced_output_files:
+        if referenced_output_files \
+                or isinstance(referenced_output_files, list):
             self.referenced_output_files = referenced_output_files
         else:
             self.referenced_output_files = []
-        self.stdin = stdin
         self.join_stderrout = join_stderrout
         self.disposal_timeout = disposal_timeout
-        self.stdout_file = stdout_file
-        self.stderr_file = stderr_file
-        self.working_directory = working_directory
-        self.parallel_job_info = parallel_job_info
         self.priority = priority
-        self.native_specification = native_specification
-        self.env = env
-        self.param_dict = param_dict or dict()
-        self.use_input_params_file = use_input_params_file
-        self.has_outputs = has_outputs
-        self.input_params_file = input_params_file
-        self.output_params_file = output_params_file
-        self.configuration = configuration
+        if param_dict is not None:
+            self.param_dict = param_dict
+        else:
+            self.param_dict = {}
+        # other attributes are only stored in the instance when they differ
+        # from the class default, which saves memory in large workflows
+        for attr_name, value in (
+                ('stdin', stdin),
+                ('stdout_file', stdout_file),
+                ('stderr_file', stderr_file),
+                ('working_directory', working_directory),
+                ('parallel_job_info', parallel_job_info),
+                ('native_specification', native_specification),
+                ('env', env),
+                ('use_input_params_file', use_input_params_file),
+                ('has_outputs', has_outputs),
+                ('input_params_file', input_params_file),
+                ('output_params_file', output_params_file),
+                ('configuration', configuration),
+                ('duration_hint', duration_hint),
+                ('memory', memory),
+                ('python_job', python_job)):
+            if value != getattr(type(self), attr_name):
+                setattr(self, attr_name, value)
 
         # this deson't seem to be really hamful.
         # for command_elem in self.command:
@@ -414,6 +467,9 @@ class Job(object):
             "input_params_file",
             "output_params_file",
             "configuration",
+            "duration_hint",
+            "memory",
+            "python_job",
         ]
         for attr_name in attributes:
             attr = getattr(self, attr_name)
@@ -533,6 +589,9 @@ class Job(object):
             "use_input_params_file",
             "has_outputs",
             "configuration",
+            "duration_hint",
+            "memory",
+            "python_job",
             "uuid",
         ]
 
@@ -647,7 +706,8 @@ class Job(object):
             return state_dict
         copied = False
         for attribute in no_picke:
-            if hasattr(self, attribute):
+            # attributes left to their class default are not in the dict
+            if attribute in state_dict:
                 if not copied:
                     state_dict = dict(state_dict)
                     copied = True
@@ -86,6 +86,17 @@ CFG_SERVER_NAME = 'SERVER_NAME'
 # database anymore) at connection time. This mechanism can be really slow if a
 # large number of files exist in the transfered files directory.
 OCFG_REMOVE_ORPHAN_FILES = 'REMOVE_ORPHAN_FILES'
+# Use the SQLite WAL journal mode (0 or 1, default: 0): status queries can
+# run while the database is written.
+OCFG_DATABASE_WAL_MODE = 'DATABASE_WAL_MODE'
+# Background cleanup of the database: interval between two cleanings, in
+# seconds (default: 0, the database is cleaned by the calls which delete
+# workflows, jobs or files), max time during which a cleaning chunk holds the
+# database server lock, in seconds, and directory where the finished
+# workflows are archived before they are removed.
+OCFG_DATABASE_JANITOR_INTERVAL = 'DATABASE_JANITOR_INTERVAL'
+OCFG_DATABASE_JANITOR_MAX_LOCK_TIME = 'DATABASE_JANITOR_MAX_LOCK_TIME'
+OCFG_WORKFLOW_ARCHIVE_DIR = 'WORKFLOW_ARCHIVE_DIR'
 OCFG_SERVER_LOG_FILE = 'SERVER_LOG_FILE'
 OCFG_SERVER_LOG_LEVEL = 'SERVER_LOG_LEVEL'
 OCFG_SERVER_LOG_FORMAT = 'SERVER_LOG_FORMAT'
@@ -134,6 +145,19 @@ OCFG_NATIVE_SPECIFICATION = 'NATIVE_SPECIFICATION'
 # Container (docker / singularity...) prefix prepended to all commands in jobs
 OCFG_CONTAINER_COMMAND = 'CONTAINER_COMMAND'
 
+# Number of threads submitting jobs in the background in the engine, and max
+# number of jobs being submitted at the same time. Defaults depend on the
+# scheduler type.
+OCFG_SUBMISSION_WORKERS = 'SUBMISSION_WORKERS'
+OCFG_SUBMISSION_WINDOW = 'SUBMISSION_WINDOW'
+
+# Order of jobs submission: "priority" (default) or "critical_path"
+OCFG_SUBMISSION_ORDER = 'SUBMISSION_ORDER'
+
+# Interval (in seconds) between two writes of the jobs and workflows status
+# updates to the database by the engine. 0 (default): immediate writes.
+OCFG_DATABASE_FLUSH_INTERVAL = 'DATABASE_FLUSH_INTERVAL'
+
 # Python version filtering
 OCFG_ALLOWED_PYTHON_VERSIONS = 'ALLOWED_PYTHON_VERSIONS'
 OCFG_PYTHON_COMMAND = 'PYTHON_COMMAND'
@@ -143,6 +167,9 @@ OCFG_PYTHON_COMMAND = 'PYTHON_COMMAND'
 OCFG_SCDL_CPU_NB = "CPU_NB"
 OCFG_SCDL_MAX_CPU_NB = "MAX_CPU_NB"
 OCFG_SCDL_INTERVAL = "SCHEDULER_INTERVAL"
+OCFG_SCDL_MAX_MEMORY = "MAX_MEMORY"
+OCFG_SCDL_CPU_AFFINITY = "CPU_AFFINITY"
+OCFG_SCDL_WORKER_POOL = "WORKER_POOL"
 OCFG_SWF_DIR = "SOMA_WORKFLOW_DIR"
 
 
@@ -800,6 +827,59 @@ class Configuration(observer.Observable):
             self._shared_temporary_dir)
         return self._shared_temporary_dir
 
+    def get_database_wal_mode(self):
+        '''
+        Whether the database uses the SQLite WAL journal mode (see
+        :class:`~soma_workflow.database_server.WorkflowDatabaseServer`).
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(self._resource_id,
+                                                   OCFG_DATABASE_WAL_MODE):
+            return bool(int(os.path.expandvars(self._config_parser.get(
+                self._resource_id, OCFG_DATABASE_WAL_MODE))))
+        return False
+
+    def get_database_janitor_interval(self):
+        '''
+        Interval, in seconds, between two background cleanings of the
+        database (see
+        :class:`~soma_workflow.database_server.DatabaseJanitor`). 0 (the
+        default) means that there is no background cleaning.
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(
+                    self._resource_id, OCFG_DATABASE_JANITOR_INTERVAL):
+            return float(self._config_parser.get(
+                self._resource_id, OCFG_DATABASE_JANITOR_INTERVAL))
+        return 0.
+
+    def get_database_janitor_max_lock_time(self):
+        '''
+        Max time, in seconds, during which a chunk of the background cleaning
+        of the database holds the database server lock, or None if not
+        specified in the configuration.
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(
+                    self._resource_id, OCFG_DATABASE_JANITOR_MAX_LOCK_TIME):
+            return float(self._config_parser.get(
+                self._resource_id, OCFG_DATABASE_JANITOR_MAX_LOCK_TIME))
+        return None
+
+    def get_workflow_archive_dir(self):
+        '''
+        Directory where the background cleaning of the database archives the
+        finished workflows before removing them, or None.
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(self._resource_id,
+                                                   OCFG_WORKFLOW_ARCHIVE_DIR):
+            archive_dir = self._config_parser.get(self._resource_id,
+                                                  OCFG_WORKFLOW_ARCHIVE_DIR)
+            if archive_dir:
+                return os.path.expandvars(archive_dir)
+        return None
+
     def get_remove_orphan_files(self):
         '''config that manages orphan files removal at connection time'''
         if self._remove_orphan_files is not None:
@@ -1085,6 +1165,56 @@ class Configuration(observer.Observable):
         else:
             return None
 
+    def get_submission_workers(self):
+        '''
+        Number of job submission threads in the engine, or None if not
+        specified in the configuration (the scheduler default is used then).
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(self._resource_id,
+                                                   OCFG_SUBMISSION_WORKERS):
+            return int(self._config_parser.get(self._resource_id,
+                                               OCFG_SUBMISSION_WORKERS))
+        return None
+
+    def get_database_flush_interval(self):
+        '''
+        Interval, in seconds, between two writes of the status updates to the
+        database by the engine (see
+        :class:`~soma_workflow.database_server.WriteBehindDatabaseServer`).
+        0 (the default) means that the updates are written immediately.
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(
+                    self._resource_id, OCFG_DATABASE_FLUSH_INTERVAL):
+            return float(self._config_parser.get(
+                self._resource_id, OCFG_DATABASE_FLUSH_INTERVAL))
+        return 0.
+
+    def get_submission_window(self):
+        '''
+        Max number of jobs being submitted at the same time by the engine
+        submission threads, or None if not specified in the configuration.
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(self._resource_id,
+                                                   OCFG_SUBMISSION_WINDOW):
+            return int(self._config_parser.get(self._resource_id,
+                                               OCFG_SUBMISSION_WINDOW))
+        return None
+
+    def get_submission_order(self):
+        '''
+        Order of jobs submission ("priority" or "critical_path"), or None if
+        not specified in the configuration.
+        '''
+        if self._config_parser is not None \
+                and self._config_parser.has_option(self._resource_id,
+                                                   OCFG_SUBMISSION_ORDER):
+            return self._config_parser.get(self._resource_id,
+                                           OCFG_SUBMISSION_ORDER).strip()
+        return None
+
     @staticmethod
     def get_allowed_python_versions(config_parser, resource_id):
         if config_parser.has_option(resource_id, OCFG_ALLOWED_PYTHON_VERSIONS):
@@ -1253,27 +1383,54 @@ class LocalSchedulerCfg(observer.Observable):
     # interval (second)
     _interval = None
 
+    # memory which may be used by the jobs (megabytes), 0 for no limit other
+    # than the available memory
+    _max_memory = None
+
+    # pin the jobs to their own CPU cores (bool)
+    _cpu_affinity = None
+
+    # number of worker processes running the jobs, 0 to start a new process
+    # for each job
+    _worker_pool = None
+
     # path of the configuration file
     _config_path = None
 
     PROC_NB_CHANGED = 0
     INTERVAL_CHANGED = 1
     MAX_PROC_NB_CHANGED = 2
+    MAX_MEMORY_CHANGED = 3
+    CPU_AFFINITY_CHANGED = 4
+    WORKER_POOL_CHANGED = 5
 
     def __init__(self, proc_nb=default_cpu_number(), interval=1,
-                 max_proc_nb=0):
+                 max_proc_nb=0, max_memory=0, cpu_affinity=False,
+                 worker_pool=0):
         '''
         * proc_nb *int*
           Number of processus which can run in parallel
 
         * interval *int*
           Update interval in second
+
+        * max_memory *float*
+          Memory budget of the jobs, in megabytes (0: no budget)
+
+        * cpu_affinity *bool*
+          Pin the jobs to their own CPU cores
+
+        * worker_pool *int*
+          Number of worker processes running the jobs (0: no workers)
         '''
 
         super(LocalSchedulerCfg, self).__init__()
         self._proc_nb = proc_nb
         self._max_proc_nb = max_proc_nb
         self._interval = interval
+        self._max_memory = max_memory
+        self._cpu_affinity = cpu_affinity
+        self._worker_pool = worker_pool
 
     @classmethod
     def load_from_file(cls,
@@ -1312,6 +1469,9 @@ class LocalSchedulerCfg(observer.Observable):
         proc_nb = 0
         max_proc_nb = 0
         interval = None
+        max_memory = 0
+        cpu_affinity = False
+        worker_pool = 0
 
         if config_parser.has_option(hostname,
                                     OCFG_SCDL_CPU_NB):
@@ -1328,9 +1488,24 @@ class LocalSchedulerCfg(observer.Observable):
             max_proc_nb_str = config_parser.get(socket.gethostname(),
                                                 OCFG_SCDL_MAX_CPU_NB)
             max_proc_nb = int(max_proc_nb_str)
+        if config_parser.has_option(hostname,
+                                    OCFG_SCDL_MAX_MEMORY):
+            max_memory_str = config_parser.get(hostname,
+                                               OCFG_SCDL_MAX_MEMORY)
+            max_memory = float(max_memory_str)
+        if config_parser.has_option(hostname,
+                                    OCFG_SCDL_CPU_AFFINITY):
+            cpu_affinity = config_parser.getboolean(hostname,
+                                                    OCFG_SCDL_CPU_AFFINITY)
+        if config_parser.has_option(hostname,
+                                    OCFG_SCDL_WORKER_POOL):
+            worker_pool_str = config_parser.get(hostname,
+                                                OCFG_SCDL_WORKER_POOL)
+            worker_pool = int(worker_pool_str)
 
         config = cls(proc_nb=proc_nb, interval=interval,
-                     max_proc_nb=max_proc_nb)
+                     max_proc_nb=max_proc_nb, max_memory=max_memory,
+                     cpu_affinity=cpu_affinity, worker_pool=worker_pool)
         config._config_path = config_path
         return config
 
@@ -1378,6 +1553,15 @@ class LocalSchedulerCfg(observer.Observable):
     def get_interval(self):
         return self._interval
 
+    def get_max_memory(self):
+        return self._max_memory
+
+    def get_cpu_affinity(self):
+        return self._cpu_affinity
+
+    def get_worker_pool(self):
+        return self._worker_pool
+
     def set_proc_nb(self, proc_nb):
         self._proc_nb = proc_nb
         self.notifyObservers(LocalSchedulerCfg.PROC_NB_CHANGED)
@@ -1390,6 +1574,18 @@ class LocalSchedulerCfg(observer.Observable):
         self._interval = interval
         self.notifyObservers(LocalSchedulerCfg.INTERVAL_CHANGED)
 
+    def set_max_memory(self, max_memory):
+        self._max_memory = max_memory
+        self.notifyObservers(LocalSchedulerCfg.MAX_MEMORY_CHANGED)
+
+    def set_cpu_affinity(self, cpu_affinity):
+        self._cpu_affinity = cpu_affinity
+        self.notifyObservers(LocalSchedulerCfg.CPU_AFFINITY_CHANGED)
+
+    def set_worker_pool(self, worker_pool):
+        self._worker_pool = worker_pool
+        self.notifyObservers(LocalSchedulerCfg.WORKER_POOL_CHANGED)
+
     def save_to_file(self, config_path=None):
         hostname = socket.gethostname()
         if not config_path:
@@ -1418,6 +1614,15 @@ class LocalSchedulerCfg(observer.Observable):
         config_parser.set(hostname,
                           OCFG_SCDL_MAX_CPU_NB,
                           str(self._max_proc_nb))
+        config_parser.set(hostname,
+                          OCFG_SCDL_MAX_MEMORY,
+                          str(self._max_memory))
+        config_parser.set(hostname,
+                          OCFG_SCDL_CPU_AFFINITY,
+                          str(bool(self._cpu_affinity)))
+        config_parser.set(hostname,
+                          OCFG_SCDL_WORKER_POOL,
+                          str(self._worker_pool))
         config_file = open(config_path, "w")
         config_parser.write(config_file)
         config_file.close()
@@ -24,6 +24,9 @@ license: `CeCILL-B <http://www.cecill.info/licences/Licence_CeCILL_B-en.html>`_
 from six.moves import range
 import sqlite3
 import threading
+import time
+import atexit
+import weakref
 import os
 import shutil
 import logging
@@ -41,13 +44,23 @@ import ctypes
 import ctypes.util
 import tempfile
 import json
+import gzip
+import base64
+import re
+import uuid
+import collections
 import sys
 
 import soma_workflow.constants as constants
 from soma_workflow.client import FileTransfer, TemporaryPath
 from soma_workflow.errors import UnknownObjectError, DatabaseError
-from soma_workflow.info import DB_VERSION, DB_PICKLE_PROTOCOL
+from soma_workflow.info import DB_VERSION, DB_SCHEMA_REVISION, \
+    DB_PICKLE_PROTOCOL
 from soma_workflow import utils
+from soma_workflow.engine_encoding import (
+    EncodedData, is_encoded, encode_engine_workflow,
+    encode_engine_job, encode_value, decode_engine_workflow,
+    decode_engine_job, decode_value)
 
 import six
 from six.moves import StringIO
@@ -71,6 +84,58 @@ def adapt_datetime(ts):
 
 sqlite3.register_adapter(datetime, adapt_datetime)
 
+# (table, column) storing engine objects (see engine_encoding)
+engine_object_columns = (('workflows', 'pickled_engine_workflow'),
+                         ('jobs', 'pickled_engine_job'),
+                         ('param_links', 'pickled_function'))
+
+
+def dumps_engine_object(encode, obj):
+    '''
+    Encode obj using the encode function of engine_encoding, or pickle it
+    when it holds values which the encoding does not support (user objects
+    in user_storage for instance).
+    '''
+    try:
+        data = encode(obj)
+    except TypeError:
+        data = pickle.dumps(obj, protocol=DB_PICKLE_PROTOCOL)
+    return sqlite3.Binary(data)
+
+
+def loads_engine_object(decode, data):
+    '''
+    Decode data written by dumps_engine_object(): using the decode function
+    of engine_encoding, or unpickling it for pickles (written by
+    dumps_engine_object() or by older versions of soma-workflow).
+    '''
+    if is_encoded(data):
+        return decode(data)
+    if six.PY2:
+        return pickle.loads(data)
+    return pickle.loads(data, encoding='utf-8')
+
+
+def read_workflow_archive(file_path):
+    '''
+    Read a workflow archive written by WorkflowDatabaseServer when it
+    removes a finished workflow (see WorkflowDatabaseServer.start_janitor()).
+
+    Returns
+    -------
+    archive: dict
+        'workflow' (dict of the workflow properties: id, name, status, login,
+        dates...), 'jobs', 'transfers' and 'temporary_paths' (lists of
+        dicts of their status properties), and 'engine_workflow' (the
+        EngineWorkflow, if it could be stored).
+    '''
+    with gzip.open(file_path, 'rb') as f:
+        archive = json.loads(f.read().decode('utf-8'))
+    if 'engine_workflow' in archive:
+        archive['engine_workflow'] = decode_engine_workflow(
+            base64.b64decode(archive['engine_workflow']))
+    return archive
+
 
 #-----------------------------------------------------------------------------
 # Classes and functions
@@ -191,6 +256,8 @@ def create_database(database_file):
         database_file, timeout=5, isolation_level="EXCLUSIVE",
         check_same_thread=False)
     cursor = connection.cursor()
+    # free pages are released by WorkflowDatabaseServer.vacuum_chunk()
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
     cursor.execute(
         '''CREATE TABLE users (
             id    INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -230,7 +297,8 @@ def create_database(database_file):
             resource_usage       TEXT,
             output_params        TEXT,
 
-            pickled_engine_job   TEXT
+            pickled_engine_job   TEXT,
+            revision             INTEGER NOT NULL DEFAULT 0
             )''')
 
     cursor.execute(
@@ -244,7 +312,8 @@ def create_database(database_file):
             workflow_id      INTEGER CONSTRAINT known_workflow REFERENCES workflows (id),
             status           VARCHAR(255) NOT NULL,
             client_paths     TEXT,
-            transfer_type TEXT)''')
+            transfer_type TEXT,
+            revision         INTEGER NOT NULL DEFAULT 0)''')
 
     cursor.execute(
         '''CREATE TABLE temporary_paths (
@@ -253,7 +322,8 @@ def create_database(database_file):
             expiration_date  DATE NOT NULL,
             user_id          INTEGER NOT NULL CONSTRAINT known_user REFERENCES users (id),
             workflow_id      INTEGER CONSTRAINT known_workflow REFERENCES workflows (id),
-            status           VARCHAR(255) NOT NULL)''')
+            status           VARCHAR(255) NOT NULL,
+            revision         INTEGER NOT NULL DEFAULT 0)''')
 
     cursor.execute(
         '''CREATE TABLE ios (
@@ -272,6 +342,10 @@ def create_database(database_file):
     cursor.execute('''CREATE TABLE fileCounter (count INTEGER)''')
     cursor.execute('INSERT INTO fileCounter (count) VALUES (?)', [0])
 
+    create_status_revision_table(cursor)
+    create_status_events_table(cursor)
+    create_job_counters_table(cursor)
+
     cursor.execute(
         '''CREATE TABLE workflows (
             id               INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -300,11 +374,136 @@ def create_database(database_file):
             src_param         TEXT,
             pickled_function  TEXT)''')
 
+    create_indexes(cursor)
+    cursor.execute('PRAGMA user_version=%d' % DB_SCHEMA_REVISION)
+
     cursor.close()
     connection.commit()
     connection.close()
 
 
+def create_status_revision_table(cursor):
+    '''
+    Counter of the status changes: the jobs, transfers and temporary paths
+    rows store the value of the counter when their status last changed
+    (revision column), so that clients can get the changes since a given
+    revision.
+    '''
+    cursor.execute('CREATE TABLE status_revision (revision INTEGER)')
+    cursor.execute('INSERT INTO status_revision (revision) VALUES (?)', [0])
+
+
+def create_status_events_table(cursor):
+    '''
+    Journal of the status changes of the workflows, jobs, transfers and
+    temporary paths, written in the transactions which change the status.
+    Only the last events are kept (see
+    WorkflowDatabaseServer.status_events_retention).
+    '''
+    cursor.execute(
+        '''CREATE TABLE status_events (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            date          DATE NOT NULL,
+            workflow_id   INTEGER,
+            element_type  VARCHAR(255) NOT NULL,
+            element_id    INTEGER NOT NULL,
+            status        VARCHAR(255) NOT NULL)''')
+
+
+def create_job_counters_table(cursor):
+    '''
+    Number of jobs of each user, queue and status, kept up to date by
+    triggers on the jobs table, so that the jobs written by any process
+    using the database are counted. Built from the jobs when the table is
+    created in an existing database.
+    '''
+    cursor.execute(
+        '''CREATE TABLE job_counters (
+            user_id  INTEGER NOT NULL,
+            queue    TEXT,
+            status   TEXT,
+            count    INTEGER NOT NULL)''')
+    cursor.execute(
+        '''INSERT INTO job_counters (user_id, queue, status, count)
+        SELECT user_id, queue, status, count(*) FROM jobs
+        GROUP BY user_id, queue, status''')
+    # queue and status may be NULL: the rows are matched with IS
+    count_new = '''
+        INSERT INTO job_counters (user_id, queue, status, count)
+            SELECT NEW.user_id, NEW.queue, NEW.status, 0
+            WHERE NOT EXISTS (SELECT 1 FROM job_counters
+                WHERE user_id=NEW.user_id AND queue IS NEW.queue
+                AND status IS NEW.status);
+        UPDATE job_counters SET count=count+1
+            WHERE user_id=NEW.user_id AND queue IS NEW.queue
+            AND status IS NEW.status;'''
+    uncount_old = '''
+        UPDATE job_counters SET count=count-1
+            WHERE user_id=OLD.user_id AND queue IS OLD.queue
+            AND status IS OLD.status;'''
+    cursor.execute(
+        '''CREATE TRIGGER job_counters_insert AFTER INSERT ON jobs
+        BEGIN %s
+        END''' % count_new)
+    cursor.execute(
+        '''CREATE TRIGGER job_counters_delete AFTER DELETE ON jobs
+        BEGIN %s
+        END''' % uncount_old)
+    cursor.execute(
+        '''CREATE TRIGGER job_counters_update
+        AFTER UPDATE OF user_id, queue, status ON jobs
+        WHEN OLD.user_id IS NOT NEW.user_id OR OLD.queue IS NOT NEW.queue
+            OR OLD.status IS NOT NEW.status
+        BEGIN %s %s
+        END''' % (uncount_old, count_new))
+
+
+# element type of the status events -> (table, id column, workflow id column)
+status_event_tables = {
+    'workflow': ('workflows', 'id', 'id'),
+    'job': ('jobs', 'id', 'workflow_id'),
+    'transfer': ('transfers', 'id', 'workflow_id'),
+    'temporary': ('temporary_paths', 'temp_path_id', 'workflow_id'),
+}
+
+# status of the event written when a workflow or a job is deleted
+status_event_deleted = 'deleted'
+
+
+# secondary indexes, for the queries of the engine and of the clients
+# (jobs and workflows lists, status, running jobs count, cleaning of
+# expired objects...)
+indexes = (
+    ('jobs_workflow_id_revision', 'jobs (workflow_id, revision)'),
+    ('jobs_user_id_status_queue', 'jobs (user_id, status, queue)'),
+    ('jobs_user_id_workflow_id', 'jobs (user_id, workflow_id)'),
+    ('jobs_expiration_date', 'jobs (expiration_date)'),
+    ('transfers_workflow_id', 'transfers (workflow_id)'),
+    ('transfers_user_id_workflow_id', 'transfers (user_id, workflow_id)'),
+    ('transfers_expiration_date', 'transfers (expiration_date)'),
+    ('temporary_paths_workflow_id', 'temporary_paths (workflow_id)'),
+    ('temporary_paths_user_id_workflow_id',
+     'temporary_paths (user_id, workflow_id)'),
+    ('temporary_paths_expiration_date', 'temporary_paths (expiration_date)'),
+    ('workflows_user_id_status', 'workflows (user_id, status)'),
+    ('workflows_expiration_date', 'workflows (expiration_date)'),
+    ('ios_engine_file_id', 'ios (engine_file_id)'),
+    ('ios_tmp_temp_path_id', 'ios_tmp (temp_path_id)'),
+    ('param_links_dest_job_id', 'param_links (dest_job_id)'),
+    ('param_links_workflow_id', 'param_links (workflow_id)'),
+    ('job_counters_user_id_queue_status',
+     'job_counters (user_id, queue, status)'),
+)
+
+
+def create_indexes(cursor):
+    '''
+    Create the secondary indexes which do not exist in the database
+    '''
+    for name, columns in indexes:
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, columns))
+
+
 # -- this is a copy of the find_library in soma-base soma.utils.find_library
 ctypes_find_library = ctypes.util.find_library
 
@@ -479,10 +678,7 @@ def print_tables(database_file):
         workflow_id, dest_job_id, dest_param, src_job_id, src_param, func \
             = row
         if func is not None:
-            if six.PY2:
-                func = pickle.loads(func)
-            else:
-                func = pickle.loads(func, encoding='utf-8')
+            func = loads_engine_object(decode_value, func)
         print('| workflow_id=', repr(workflow_id).rjust(2), '| dest_job_id=',
               repr(dest_job_id).ljust(2), '| dest_param=',
               repr(dest_param).rjust(25), '| src_job_id=', repr(
@@ -499,14 +695,169 @@ def print_tables(database_file):
     connection.close()
 
 
+class PersistentConnection(object):
+
+    '''
+    Connection to the database kept open between the calls to a
+    :class:`WorkflowDatabaseServer`, one per thread. It is used like a
+    sqlite3 connection, except that close() does not close it: it only
+    discards the unfinished transaction, as closing a sqlite3 connection
+    would do. The connection is set up once (journal mode), and sqlite3
+    keeps its prepared statements cache between calls.
+
+    After a rollback (which is done after an error) the connection is
+    considered broken and is replaced at the next call, as well as when
+    the database file has been replaced or the process has forked.
+    '''
+
+    # max number of prepared statements kept by the sqlite3 module
+    cached_statements = 256
+
+    def __init__(self, database_file, isolation_level="EXCLUSIVE",
+                 wal_mode=False):
+        self.database_file = database_file
+        self.pid = os.getpid()
+        stat = os.stat(database_file)
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.broken = False
+        self.connection = sqlite3.connect(
+            database_file, timeout=10, isolation_level=isolation_level,
+            check_same_thread=False,
+            cached_statements=self.cached_statements)
+        self.setup(self.connection, wal_mode)
+
+    @staticmethod
+    def setup(connection, wal_mode=False):
+        '''
+        Set the journal mode of a new sqlite3 connection.
+        '''
+        if wal_mode:
+            # readers do not block the writer, and are not blocked by it.
+            # With synchronous=NORMAL, the WAL file is only synced at
+            # checkpoints: a power failure may lose the last transactions,
+            # but not corrupt the database.
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+        else:
+            # set journal_mode to TRUNCATE mode. On some systems /
+            # filesystems / python versions (3), using the default DELETE
+            # mode can cause some OperationalError : IO failure when
+            # commiting transactions.
+            connection.execute("PRAGMA journal_mode = TRUNCATE")
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def is_valid(self):
+        '''
+        Tells if the connection can be used for the next call.
+        '''
+        if self.broken or self.pid != os.getpid():
+            return False
+        try:
+            stat = os.stat(self.database_file)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) == self.file_id
+
+    def cursor(self):
+        return self.connection.cursor()
+
+    def execute(self, *args):
+        return self.connection.execute(*args)
+
+    def executemany(self, *args):
+        return self.connection.executemany(*args)
+
+    def commit(self):
+        try:
+            self.connection.commit()
+        except Exception:
+            self.broken = True
+            raise
+
+    def rollback(self):
+        self.broken = True
+        self.connection.rollback()
+
+    def close(self):
+        # python 2 connections do not tell if a transaction is running
+        if getattr(self.connection, 'in_transaction', True):
+            self.connection.rollback()
+
+    def close_connection(self):
+        '''
+        Really close the sqlite3 connection.
+        '''
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class _NoLock(object):
+
+    '''
+    Context manager doing nothing, used instead of a lock
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_no_lock = _NoLock()
+
+
+# name of the directories of the files numbered by a server (see
+# WorkflowDatabaseServer.local_file_numbers): server prefix - block number
+_files_directory_re = re.compile('^[0-9a-f]{16}-[0-9]+$')
+
+
 class WorkflowDatabaseServer(object):
 
+    # keep a connection to the database open in each thread using the
+    # database server, instead of opening one for each call
+    persistent_connections = True
+
+    # number of events kept in the status events journal
+    status_events_retention = 100000
+    # while waiting for status events, the journal is also read at this
+    # interval (in seconds), to get the events written by other processes
+    status_events_poll_interval = 0.2
+
+    # max time (in seconds) during which clean() and vacuum() hold the lock
+    # of the server at once: they work by chunks, and the other calls are
+    # processed between them
+    max_lock_time = 0.1
+    # number of rows deleted at once by clean_chunk()
+    clean_batch_size = 200
+    # number of pages released at once by vacuum_chunk()
+    vacuum_pages = 256
+
+    # the files generated by the server (jobs std out and err, parameters
+    # files, transfers) are numbered by the server itself, after a prefix
+    # which is unique to it, and stored in subdirectories of the user
+    # directory holding files_per_directory numbers each. If False, they are
+    # numbered using the fileCounter table of the database and stored in the
+    # user directory itself, as older versions of soma-workflow do.
+    local_file_numbers = True
+    files_per_directory = 1000
+    # empty files directories of other servers are removed by
+    # remove_orphan_files() when none of their paths is registered in the
+    # database, and when they have not been modified for this time (in
+    # seconds): the paths are generated before they are registered
+    files_directory_grace_time = 3600
+
     def __init__(self,
                  database_file,
                  tmp_file_dir_path,
                  shared_tmp_dir=None,
                  logging_configuration=None,
-                 remove_orphan_files=True):
+                 remove_orphan_files=True,
+                 wal_mode=False):
         '''
         The constructor gets as parameter the database information.
 
@@ -515,6 +866,10 @@ class WorkflowDatabaseServer(object):
         @type  tmp_file_dir_path: string
         @param tmp_file_dir_path: place on the resource file system where
         the files will be transfered
+        @type  wal_mode: bool
+        @param wal_mode: use the SQLite WAL journal mode, which allows
+        status queries to run while the database is written. All the
+        processes using the database should use the same mode.
         '''
 
         # print('WorkflowDatabaseServer::__init__, remove orphan files:',
@@ -522,6 +877,7 @@ class WorkflowDatabaseServer(object):
         self._remove_orphan_files = remove_orphan_files
         self._tmp_file_dir_path = tmp_file_dir_path
         self._database_file = database_file
+        self._wal_mode = wal_mode
         if shared_tmp_dir:
             self._shared_temp_dir = shared_tmp_dir
         else:
@@ -531,11 +887,23 @@ class WorkflowDatabaseServer(object):
         EngineTemporaryPath.temporary_directory = self._shared_temp_dir
 
         self._lock = threading.RLock()
+        # notified after the commit of status events
+        self._status_events_condition = threading.Condition(threading.Lock())
+        self._status_events_generation = 0
+        # PersistentConnection of each thread
+        self._thread_connections = threading.local()
 
         self.logger = logging.getLogger('jobServer')
         self.logger.debug(
             "=> starting database server, within the constructor")
-        self._free_file_counters = []
+        # numbers reserved in the fileCounter table (if local_file_numbers
+        # is False)
+        self._free_file_counters = collections.deque()
+        # local file numbers, see _new_local_file_number()
+        self._new_file_prefix()
+        # set by start_janitor()
+        self._janitor = None
+        self.archive_directory = None
 
         # For some reason logger does not work so we log using logging
         if logging_configuration:
@@ -557,6 +925,7 @@ class WorkflowDatabaseServer(object):
                 connection = self._connect()
                 cursor = connection.cursor()
                 version = None
+                upgrade = False
                 for row in cursor.execute("SELECT * FROM db_version"):
                     try:
                         version, py_ver = row
@@ -582,7 +951,15 @@ class WorkflowDatabaseServer(object):
                         py_ver0 = 2
                     else:
                         py_ver0 = int(py_ver.split('.')[0])
-                    if py_ver0 != sys.version_info[0]:
+                    schema_revision = six.next(
+                        cursor.execute('PRAGMA user_version'))[0]
+                    upgrade = schema_revision < DB_SCHEMA_REVISION
+                    # pickles can only be read by the python version which
+                    # wrote them. Since revision 1, engine objects are
+                    # encoded, and only pickled when they cannot be encoded.
+                    if py_ver0 != sys.version_info[0] \
+                            and (schema_revision < 1
+                                 or self._has_pickled_objects(cursor)):
                         raise Exception('Mismatching python version, the '
                                         'database works with python %d and we '
                                         'are using python %d'
@@ -600,11 +977,126 @@ class WorkflowDatabaseServer(object):
                                         " the file " +
                                         str(database_file) + " \n"
                                         "  3. Clear the content of the directory: " + repr(tmp_file_dir_path))
+                cursor.close()
+                connection.close()
+                if upgrade:
+                    self.upgrade_schema(schema_revision)
 
     def __del__(self):
         # send VACUUM command ?
         pass
 
+    def _has_pickled_objects(self, cursor):
+        '''
+        Tells whether some engine objects of the database are pickled
+        instead of using the engine_encoding format.
+        '''
+        for table, column in engine_object_columns:
+            for row in cursor.execute(
+                    'SELECT substr(%s, 1, 64) FROM %s WHERE %s IS NOT NULL'
+                    % (column, table, column)):
+                if not is_encoded(row[0]):
+                    return True
+        return False
+
+    def upgrade_schema(self, schema_revision):
+        '''
+        Upgrade a database written by an older version of soma-workflow,
+        with the same DB_VERSION, to the schema revision DB_SCHEMA_REVISION.
+
+        Parameters
+        ----------
+        schema_revision: int
+            revision of the database schema (its user_version)
+        '''
+        self.logger.info("Upgrading the database schema from revision %d to "
+                         "%d" % (schema_revision, DB_SCHEMA_REVISION))
+        if schema_revision < 1:
+            self.migrate_pickled_objects()
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                if schema_revision < 3:
+                    for table in ('jobs', 'transfers', 'temporary_paths'):
+                        cursor.execute('ALTER TABLE %s ADD COLUMN revision '
+                                       'INTEGER NOT NULL DEFAULT 0' % table)
+                    create_status_revision_table(cursor)
+                    # replaced by jobs_workflow_id_revision
+                    cursor.execute('DROP INDEX IF EXISTS jobs_workflow_id')
+                if schema_revision < 4:
+                    create_status_events_table(cursor)
+                if schema_revision < 6:
+                    create_job_counters_table(cursor)
+                create_indexes(cursor)
+                cursor.execute('PRAGMA user_version=%d' % DB_SCHEMA_REVISION)
+            except Exception as e:
+                connection.rollback()
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            connection.commit()
+            cursor.close()
+            if schema_revision < 5:
+                # the auto_vacuum mode of an existing database only changes
+                # when it is rebuilt
+                self.logger.info("Rebuilding the database in the incremental "
+                                 "auto_vacuum mode")
+                try:
+                    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                    connection.execute('VACUUM')
+                except Exception as e:
+                    connection.close()
+                    six.reraise(DatabaseError, DatabaseError(e),
+                                sys.exc_info()[2])
+            connection.close()
+
+    def migrate_pickled_objects(self):
+        '''
+        Convert the engine objects pickled by older versions of
+        soma-workflow (workflows, jobs and parameters links functions) to the
+        engine_encoding format, which is smaller, does not depend on the
+        python version, and allows to decode a single job of a workflow.
+
+        Objects which the encoding does not support are kept pickled.
+        '''
+        decoders = {'workflows': decode_engine_workflow,
+                    'jobs': decode_engine_job,
+                    'param_links': decode_value}
+        encoders = {'workflows': encode_engine_workflow,
+                    'jobs': encode_engine_job,
+                    'param_links': encode_value}
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                for table, column in engine_object_columns:
+                    rows = []
+                    for rowid, data in cursor.execute(
+                            'SELECT rowid, %s FROM %s WHERE %s IS NOT NULL'
+                            % (column, table, column)).fetchall():
+                        if is_encoded(data):
+                            continue
+                        obj = loads_engine_object(decoders[table], data)
+                        if table == 'jobs':
+                            obj.job_id = rowid
+                        try:
+                            rows.append((sqlite3.Binary(encoders[table](obj)),
+                                         rowid))
+                        except TypeError:
+                            pass
+                    cursor.executemany(
+                        'UPDATE %s SET %s=? WHERE rowid=?' % (table, column),
+                        rows)
+            except Exception as e:
+                connection.rollback()
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            connection.commit()
+            cursor.close()
+            connection.close()
+
     def test(self):
         self.logger.debug("=======>Dans test")
         logging.info(
@@ -612,21 +1104,74 @@ class WorkflowDatabaseServer(object):
         return True
 
     def _connect(self):
+        '''
+        Connection to the database. Unless persistent_connections is False,
+        this is the PersistentConnection of the current thread, opened
+        again if needed.
+        '''
+        return self._thread_connection('connection', "EXCLUSIVE")
+
+    def _connect_read(self):
+        '''
+        Connection for the methods which only read the database. In WAL
+        mode, this is a separate connection, used without holding the
+        server lock: reads do not wait for the writes of other threads. The
+        queries of the call all see the same state of the database, until
+        close() is called.
+
+        Without WAL mode, this is the same as _connect(), and the lock must
+        be held as for the other methods (see _read_lock()).
+        '''
+        if not self._wal_mode:
+            return self._connect()
+        connection = self._thread_connection('read_connection', None)
+        if getattr(connection, 'in_transaction', False):
+            # left open by an interrupted call
+            connection.close()
+        connection.execute('BEGIN')
+        return connection
+
+    def _read_lock(self):
+        '''
+        Lock to hold while using the connection returned by _connect_read()
+        '''
+        if self._wal_mode:
+            return _no_lock
+        return self._lock
+
+    def _thread_connection(self, name, isolation_level):
+        if not self.persistent_connections:
+            try:
+                connection = sqlite3.connect(
+                    self._database_file, timeout=10,
+                    isolation_level=isolation_level,
+                    check_same_thread=False)
+                PersistentConnection.setup(connection, self._wal_mode)
+            except Exception as e:
+                six.reraise(DatabaseError,
+                            DatabaseError('On database file %s: %s: %s \n'
+                                          % (self._database_file, type(e),
+                                             e)),
+                            sys.exc_info()[2])
+            return connection
+
+        connection = getattr(self._thread_connections, name, None)
+        if connection is not None and connection.is_valid():
+            return connection
+        if connection is not None and connection.pid == os.getpid():
+            # (a connection inherited from the parent process must not
+            # be used at all)
+            connection.close_connection()
         try:
-            connection = sqlite3.connect(
-                self._database_file, timeout=10, isolation_level="EXCLUSIVE",
-                check_same_thread=False)
-            # set journal_mode to TRUNCATE mode. On some systems / filesystems
-            # / python versions (3), using the default DELETE mode can
-            # cause some OperationalError : IO failure when commiting
-            # transactions.
-            cursor = connection.cursor()
-            cursor.execute("PRAGMA journal_mode = TRUNCATE")
+            connection = PersistentConnection(self._database_file,
+                                              isolation_level,
+                                              self._wal_mode)
         except Exception as e:
             six.reraise(DatabaseError,
                         DatabaseError('On database file %s: %s: %s \n'
                                       % (self._database_file, type(e), e)),
                         sys.exc_info()[2])
+        setattr(self._thread_connections, name, connection)
         return connection
 
     def _user_transfer_dir_path(self, login, user_id):
@@ -683,187 +1228,53 @@ class WorkflowDatabaseServer(object):
         '''
         Delete all expired jobs, transfers and workflows, except transfers which are requested
         by valid job.
+
+        The deletion is done by chunks (see clean_chunk()): the lock of the
+        server is released between them.
         '''
         self.logger.debug("=> clean")
+        while self.clean_chunk():
+            pass
+
+    def clean_chunk(self, max_lock_time=None):
+        '''
+        Delete expired elements, in a single transaction which holds the lock
+        of the server for about max_lock_time seconds at most: expired
+        workflows (finished ones are archived first if archive_directory is
+        set), jobs and their files, then transfers and temporary paths which
+        are not used by jobs anymore, and their files. Elements are
+        processed by batches of clean_batch_size rows, and the files are
+        removed once the lock is released.
+
+        Parameters
+        ----------
+        max_lock_time: float (optional)
+            default: the max_lock_time attribute
+
+        Returns
+        -------
+        remaining: bool
+            True if there may be expired elements left to delete
+        '''
+        if max_lock_time is None:
+            max_lock_time = self.max_lock_time
+        files = []
+        remaining = False
         with self._lock:
+            deadline = time.time() + max_lock_time
             connection = self._connect()
             cursor = connection.cursor()
-
+            today = date.today()
             try:
-                #
-                # Jobs and associated files (std out, std err and ressouce
-                # usage file)
-                jobsToDelete = []
-                for row in cursor.execute(
-                        'SELECT id FROM jobs WHERE expiration_date < ?',
-                        [date.today()]):
-                    jobsToDelete.append(row[0])
-
-                maxv = sqlite3_max_variable_number()
-                nmax = maxv
-                if maxv == 0:
-                    nmax = len(jobsToDelete)
-                    if nmax == 0:
-                        nmax = 1
-                nchunks = int(math.ceil(float(len(jobsToDelete)) / nmax))
-
-                for chunk in range(nchunks):
-                    if chunk < nchunks - 1:
-                        n = nmax
-                    else:
-                        n = len(jobsToDelete) - chunk * nmax
-                    job_str = ','.join(['?'] * n)
-                    cursor.execute('DELETE FROM ios WHERE job_id IN (%s)'
-                                   % job_str, jobsToDelete[chunk * nmax:chunk * nmax + n])
-                    cursor.execute(
-                        'DELETE FROM ios_tmp WHERE job_id IN (%s)' % job_str,
-                        jobsToDelete[chunk * nmax:chunk * nmax + n])
-
-                    for stdof, stdef, ipf, opf in cursor.execute(
-                            '''SELECT
-                            stdout_file,
-                            stderr_file,
-                            input_params_file,
-                            output_params_file
-                            FROM jobs
-                            WHERE id IN (%s) AND NOT custom_submission'''
-                            % job_str,
-                            jobsToDelete[chunk * nmax:chunk * nmax + n]):
-                        self.__removeFile(self._string_conversion(stdof))
-                        self.__removeFile(self._string_conversion(stdef))
-                        self.__removeFile(self._string_conversion(ipf))
-                        self.__removeFile(self._string_conversion(opf))
-
-                cursor.execute(
-                    'DELETE FROM jobs WHERE expiration_date < ?',
-                    [date.today()])
-
-                #
-                # Transfers
-
-                # get back the expired transfers
-                transfersToDelete = {}
-                for row in cursor.execute(
-                        'SELECT id, engine_file_path FROM transfers WHERE expiration_date < ?',
-                        [date.today()]):
-                    transfersToDelete[row[0]] = row[1]
-
-                # check that they are not currently used (as an input of output
-                # of a job)
-                if len(transfersToDelete) != 0:
-                    transfers_list = list(transfersToDelete.keys())
-                    nmax = maxv
-                    if nmax == 0:
-                        nmax = len(transfersToDelete)
-                        if nmax == 0:
-                            nmax = 1
-                    nchunks = int(math.ceil(float(len(transfersToDelete))
-                                            / nmax))
-                    for chunk in range(nchunks):
-                        if chunk < nchunks - 1:
-                            n = nmax
-                        else:
-                            n = len(transfersToDelete) - chunk * nmax
-                        for engine_file_id in cursor.execute(
-                                'SELECT DISTINCT engine_file_id FROM ios '
-                                'WHERE engine_file_id IN (%s)'
-                                % ','.join(['?'] * n),
-                                transfers_list[chunk * nmax:chunk * nmax + n]):
-                            transfersToDelete.remove(engine_file_id)
-
-                # delete transfers data and associated engine file
-                if len(transfersToDelete) != 0:
-                    transfers_list = list(transfersToDelete.keys())
-                    nmax = maxv
-                    if nmax == 0:
-                        nmax = len(transfersToDelete)
-                        if nmax == 0:
-                            nmax = 1
-                    nchunks = int(math.ceil(float(len(transfersToDelete))
-                                            / nmax))
-                    for chunk in range(nchunks):
-                        if chunk < nchunks - 1:
-                            n = nmax
-                        else:
-                            n = len(transfersToDelete) - chunk * nmax
-                        cursor.execute(
-                            'DELETE FROM transfers '
-                            'WHERE id IN (%s)' % ','.join(['?'] * n),
-                            transfers_list[chunk * nmax:chunk * nmax + n])
-                    for engine_file_path in six.itervalues(transfersToDelete):
-                        self.__removeFile(engine_file_path)
-
-                #
-                # temporary_paths
-
-                # get back the expired temp_path_id
-                tmpToDelete = {}
-                for row in cursor.execute(
-                        'SELECT temp_path_id, engine_file_path '
-                        'FROM temporary_paths WHERE expiration_date < ?',
-                        [date.today()]):
-                    tmpToDelete[row[0]] = row[1]
-
-                # check that they are not currently used (as an input of output
-                # of a job)
-                if len(tmpToDelete) != 0:
-                    nmax = maxv
-                    if nmax == 0:
-                        nmax = len(tmpToDelete)
-                        if nmax == 0:
-                            nmax = 1
-                    nchunks = int(math.ceil(float(len(tmpToDelete)) / nmax))
-                    tkeys = list(tmpToDelete.keys())
-                    for chunk in range(nchunks):
-                        if chunk < nchunks - 1:
-                            n = nmax
-                        else:
-                            n = len(tmpToDelete) - chunk * nmax
-                        for temp_path_id in cursor.execute(
-                                'SELECT DISTINCT temp_path_id FROM ios_tmp '
-                                'WHERE temp_path_id IN (%s)'
-                                % ','.join(['?'] * n),
-                                tkeys[chunk * nmax:chunk * nmax + n]):
-                            tmpToDelete.remove(temp_path_id)
-
-                # delete temporary_paths data and associated engine file
-                if len(tmpToDelete) != 0:
-                    nmax = maxv
-                    if nmax == 0:
-                        nmax = len(tmpToDelete)
-                        if nmax == 0:
-                            nmax = 1
-                    nchunks = int(math.ceil(float(len(tmpToDelete)) / nmax))
-                    tkeys = list(tmpToDelete.keys())
-                    for chunk in range(nchunks):
-                        if chunk < nchunks - 1:
-                            n = nmax
-                        else:
-                            n = len(tmpToDelete) - chunk * nmax
-                        cursor.execute(
-                            'DELETE FROM temporary_paths '
-                            'WHERE temp_path_id IN (%s)'
-                            % ','.join(['?'] * n),
-                            tkeys[chunk * nmax:chunk * nmax + n])
-                    for engine_file_path in six.itervalues(tmpToDelete):
-                        self.__removeFile(engine_file_path)
-
-                #
-                # Workflows
-
-                wf = cursor.execute(
-                    'SELECT id FROM workflows WHERE expiration_date < ?',
-                    [date.today()])
-                wf = [w[0] for w in wf]
-                cursor.execute(
-                    'DELETE FROM workflows WHERE id IN (%s)'
-                    % ','.join(['?'] * len(wf)),
-                    wf)
-                cursor.execute(
-                    'DELETE FROM param_links WHERE workflow_id IN (%s)'
-                    % ','.join(['?'] * len(wf)),
-                    wf)
-
+                for clean_batch in (self._clean_workflows, self._clean_jobs,
+                                    self._clean_transfers,
+                                    self._clean_temporaries):
+                    while clean_batch(cursor, today, files):
+                        if time.time() >= deadline:
+                            remaining = True
+                            break
+                    if remaining:
+                        break
             except Exception as e:
                 connection.rollback()
                 cursor.close()
@@ -873,18 +1284,167 @@ class WorkflowDatabaseServer(object):
                 traceback.print_exc(file=tb)
                 self.logger.error(tb.getvalue())
                 six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
-
             cursor.close()
             connection.commit()
             connection.close()
 
-            # self.remove_orphan_files()
+        for file_path in files:
+            self.__removeFile(file_path)
+        return remaining
+
+    def _clean_workflows(self, cursor, today, files):
+        '''
+        Delete a batch of expired workflows, see clean_chunk(). Returns True
+        if the batch was full.
+        '''
+        # archives may be big: one workflow at a time, so that the lock time
+        # is checked between them
+        batch_size = 1 if self.archive_directory else self.clean_batch_size
+        rows = cursor.execute(
+            'SELECT id, status FROM workflows WHERE expiration_date < ? '
+            'LIMIT ?', [today, batch_size]).fetchall()
+        if not rows:
+            return False
+        if self.archive_directory:
+            for wf_id, status in rows:
+                if self._string_conversion(status) \
+                        == constants.WORKFLOW_DONE:
+                    self._archive_workflow(cursor, wf_id)
+        wf_ids = [row[0] for row in rows]
+        wf_str = ','.join(['?'] * len(wf_ids))
+        cursor.execute('DELETE FROM param_links WHERE workflow_id IN (%s)'
+                       % wf_str, wf_ids)
+        cursor.execute('DELETE FROM workflows WHERE id IN (%s)' % wf_str,
+                       wf_ids)
+        return len(rows) == batch_size
+
+    def _clean_jobs(self, cursor, today, files):
+        '''
+        Delete a batch of expired jobs, see clean_chunk(). Their std out, std
+        err and parameters files are added to files. Returns True if the
+        batch was full.
+        '''
+        rows = cursor.execute(
+            '''SELECT id,
+            stdout_file,
+            stderr_file,
+            input_params_file,
+            output_params_file,
+            custom_submission
+            FROM jobs WHERE expiration_date < ? LIMIT ?''',
+            [today, self.clean_batch_size]).fetchall()
+        if not rows:
+            return False
+        job_ids = [row[0] for row in rows]
+        job_str = ','.join(['?'] * len(job_ids))
+        cursor.execute('DELETE FROM ios WHERE job_id IN (%s)' % job_str,
+                       job_ids)
+        cursor.execute('DELETE FROM ios_tmp WHERE job_id IN (%s)' % job_str,
+                       job_ids)
+        cursor.execute('DELETE FROM jobs WHERE id IN (%s)' % job_str, job_ids)
+        for row in rows:
+            if not row[5]:
+                files += [self._string_conversion(file_path)
+                          for file_path in row[1:5]]
+        return len(rows) == self.clean_batch_size
+
+    def _clean_transfers(self, cursor, today, files):
+        '''
+        Delete a batch of expired transfers which are not used by jobs, see
+        clean_chunk(). Their engine files are added to files. Returns True
+        if the batch was full.
+        '''
+        rows = cursor.execute(
+            '''SELECT id, engine_file_path FROM transfers
+            WHERE expiration_date < ? AND NOT EXISTS
+            (SELECT 1 FROM ios WHERE ios.engine_file_id=transfers.id)
+            LIMIT ?''', [today, self.clean_batch_size]).fetchall()
+        if not rows:
+            return False
+        cursor.execute('DELETE FROM transfers WHERE id IN (%s)'
+                       % ','.join(['?'] * len(rows)),
+                       [row[0] for row in rows])
+        files += [self._string_conversion(row[1]) for row in rows]
+        return len(rows) == self.clean_batch_size
+
+    def _clean_temporaries(self, cursor, today, files):
+        '''
+        Delete a batch of expired temporary paths which are not used by
+        jobs, see clean_chunk(). Their engine files are added to files.
+        Returns True if the batch was full.
+        '''
+        rows = cursor.execute(
+            '''SELECT temp_path_id, engine_file_path FROM temporary_paths
+            WHERE expiration_date < ? AND NOT EXISTS
+            (SELECT 1 FROM ios_tmp
+             WHERE ios_tmp.temp_path_id=temporary_paths.temp_path_id)
+            LIMIT ?''', [today, self.clean_batch_size]).fetchall()
+        if not rows:
+            return False
+        cursor.execute('DELETE FROM temporary_paths WHERE temp_path_id IN (%s)'
+                       % ','.join(['?'] * len(rows)),
+                       [row[0] for row in rows])
+        files += [self._string_conversion(row[1]) for row in rows]
+        return len(rows) == self.clean_batch_size
+
+    def _archive_workflow(self, cursor, wf_id):
+        '''
+        Write the workflow, and the status of its jobs, transfers and
+        temporary paths, in a compressed file of archive_directory (see
+        read_workflow_archive()), before the workflow is deleted.
+        '''
+        archive = {}
+        columns = ('id', 'user_id', 'name', 'status', 'queue',
+                   'expiration_date', 'last_status_update')
+        row = six.next(cursor.execute(
+            'SELECT %s, pickled_engine_workflow FROM workflows WHERE id=?'
+            % ', '.join(columns), [wf_id]))
+        archive['workflow'] = dict(zip(columns, row[:-1]))
+        if row[-1] is not None and is_encoded(row[-1]):
+            # engine_encoding data, which can be decoded by
+            # decode_engine_workflow()
+            archive['engine_workflow'] = six.ensure_text(
+                base64.b64encode(bytes(row[-1])))
+        login = self.get_user_login(archive['workflow']['user_id'], cursor)
+        archive['workflow']['login'] = login
+        for table, columns in (
+                ('jobs', ('id', 'name', 'status', 'queue', 'drmaa_id',
+                          'command', 'submission_date', 'execution_date',
+                          'ending_date', 'exit_status', 'exit_value',
+                          'terminating_signal', 'resource_usage')),
+                ('transfers', ('id', 'engine_file_path', 'client_file_path',
+                               'client_paths', 'status', 'transfer_type')),
+                ('temporary_paths', ('temp_path_id', 'engine_file_path',
+                                     'status'))):
+            archive[table] = [
+                dict(zip(columns, row)) for row in cursor.execute(
+                    'SELECT %s FROM %s WHERE workflow_id=?'
+                    % (', '.join(columns), table), [wf_id])]
+
+        directory = os.path.join(self.archive_directory, login)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        file_path = os.path.join(directory, 'workflow_%d.json.gz' % wf_id)
+        # written under another name first, so that the archive is either
+        # complete or absent
+        with gzip.open(file_path + '.tmp', 'wb') as f:
+            f.write(six.ensure_binary(json.dumps(archive)))
+        os.rename(file_path + '.tmp', file_path)
+        self.logger.info('workflow %d archived in %s' % (wf_id, file_path))
 
     def vacuum(self):
         '''
         Resize the database file, so that it shrinks to the necessary size, not more.
+
+        Databases in the incremental auto_vacuum mode (all the databases
+        since the schema revision 5) release their free pages by chunks
+        (see vacuum_chunk()). Other databases are rebuilt at once.
         '''
         self.logger.debug('=> vacuum')
+        if self._auto_vacuum_mode() == 2:
+            while self.vacuum_chunk():
+                pass
+            return
         with self._lock:
             connection = self._connect()
             cursor = connection.cursor()
@@ -897,9 +1457,106 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.close()
 
+    def vacuum_chunk(self, max_lock_time=None):
+        '''
+        Release free pages of the database file, vacuum_pages at a time, for
+        about max_lock_time seconds at most (default: the max_lock_time
+        attribute). The database must be in the incremental auto_vacuum
+        mode.
+
+        Returns
+        -------
+        remaining: bool
+            True if there are free pages left
+        '''
+        if max_lock_time is None:
+            max_lock_time = self.max_lock_time
+        with self._lock:
+            deadline = time.time() + max_lock_time
+            connection = self._connect()
+            try:
+                free_pages = six.next(connection.execute(
+                    'PRAGMA freelist_count'))[0]
+                while free_pages:
+                    # execute() would only run the first step of the
+                    # pragma, which releases a single page
+                    connection.executescript('PRAGMA incremental_vacuum(%d);'
+                                             % self.vacuum_pages)
+                    free_pages = six.next(connection.execute(
+                        'PRAGMA freelist_count'))[0]
+                    if time.time() >= deadline:
+                        break
+            except Exception as e:
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            connection.close()
+        return free_pages != 0
+
+    def _auto_vacuum_mode(self):
+        '''
+        auto_vacuum mode of the database: 0 (none), 1 (full) or 2
+        (incremental)
+        '''
+        with self._lock:
+            connection = self._connect()
+            try:
+                mode = six.next(connection.execute('PRAGMA auto_vacuum'))[0]
+            except Exception as e:
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            connection.close()
+        return mode
+
+    def start_janitor(self, interval=3600., max_lock_time=None,
+                      archive_directory=None):
+        '''
+        Start a :class:`DatabaseJanitor`, which cleans the database in the
+        background. From then on, the methods which delete workflows, jobs
+        or files (delete_workflow(), delete_job(), remove_transfer()...) do
+        not clean the database themselves anymore: they wake up the janitor.
+
+        Parameters
+        ----------
+        interval: float
+            time between two cleanings, in seconds
+        max_lock_time: float (optional)
+            max time during which a cleaning chunk holds the lock of the
+            server, in seconds (see the max_lock_time attribute)
+        archive_directory: str (optional)
+            directory where the finished workflows are archived before they
+            are removed (see read_workflow_archive()). If not given, they are
+            not archived.
+
+        Returns
+        -------
+        janitor: DatabaseJanitor
+        '''
+        if max_lock_time is not None:
+            self.max_lock_time = max_lock_time
+        self.archive_directory = archive_directory
+        self._janitor = DatabaseJanitor(self, interval)
+        return self._janitor
+
+    def _clean_expired(self, vacuum=False):
+        '''
+        Clean the database after elements have been set to expire: wake up
+        the janitor, or clean it now if there is no janitor.
+        '''
+        if self._janitor is not None:
+            self._janitor.wake_up()
+            return
+        self.clean()
+        if vacuum:
+            self.vacuum()
+
     def remove_orphan_files(self):
+        '''
+        Remove the files of the users directories which are not registered
+        in the database, and the empty files directories of other servers
+        (see local_file_numbers).
+        '''
         self.logger.debug("=> remove_orphan_files")
-        registered_engine_paths = []
+        registered_engine_paths = set()
         registered_users = []
         with self._lock:
             connection = self._connect()
@@ -907,29 +1564,29 @@ class WorkflowDatabaseServer(object):
             try:
                 for row in cursor.execute('SELECT engine_file_path FROM transfers'):
                     engine_path = row[0]
-                    registered_engine_paths.append(
+                    registered_engine_paths.add(
                         self._string_conversion(engine_path))
                 for row in cursor.execute('SELECT stdout_file FROM jobs'):
                     stdout_file = row[0]
                     if stdout_file:
-                        registered_engine_paths.append(
+                        registered_engine_paths.add(
                             self._string_conversion(stdout_file))
                 for row in cursor.execute('SELECT stderr_file FROM jobs'):
                     stderr_file = row[0]
                     if stderr_file:
-                        registered_engine_paths.append(
+                        registered_engine_paths.add(
                             self._string_conversion(stderr_file))
                 for row in cursor.execute(
                         'SELECT input_params_file FROM jobs'):
                     input_params_file = row[0]
                     if input_params_file:
-                        registered_engine_paths.append(
+                        registered_engine_paths.add(
                             self._string_conversion(input_params_file))
                 for row in cursor.execute(
                         'SELECT output_params_file FROM jobs'):
                     output_params_file = row[0]
                     if output_params_file:
-                        registered_engine_paths.append(
+                        registered_engine_paths.add(
                             self._string_conversion(output_params_file))
                 for row in cursor.execute('SELECT id, login FROM users'):
                     user_id, login = row
@@ -941,16 +1598,58 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.close()
 
+        # prefixes of the files directories in use
+        registered_prefixes = set()
+        for engine_path in registered_engine_paths:
+            name = os.path.basename(os.path.dirname(engine_path))
+            if _files_directory_re.match(name):
+                registered_prefixes.add(name.split('-')[0])
+
         for user_info in registered_users:
             user_id, login = user_info
             directory_path = self._user_transfer_dir_path(login, user_id)
             for name in os.listdir(directory_path):
                 engine_path = os.path.join(directory_path, name)
-                if not engine_path in registered_engine_paths:
+                if _files_directory_re.match(name) \
+                        and engine_path not in registered_engine_paths:
+                    self._remove_orphan_files_in(engine_path,
+                                                 registered_engine_paths,
+                                                 registered_prefixes)
+                elif not engine_path in registered_engine_paths:
                     self.logger.debug(
                         "remove_orphan_files, not registered " + engine_path + " to delete!")
                     self.__removeFile(engine_path)
 
+    def _remove_orphan_files_in(self, directory_path,
+                                registered_engine_paths,
+                                registered_prefixes):
+        '''
+        Remove the unregistered files of a files directory (see
+        local_file_numbers), and the directory itself if it is empty and
+        belongs to a server which is not using it anymore: another server,
+        with no registered paths, and the directory has not been modified
+        for files_directory_grace_time. Jobs write their files in the
+        directory long after their paths are generated.
+        '''
+        for name in os.listdir(directory_path):
+            engine_path = os.path.join(directory_path, name)
+            if engine_path not in registered_engine_paths:
+                self.logger.debug(
+                    "remove_orphan_files, not registered " + engine_path
+                    + " to delete!")
+                self.__removeFile(engine_path)
+        prefix = os.path.basename(directory_path).split('-')[0]
+        if prefix == self._file_prefix or prefix in registered_prefixes:
+            return
+        try:
+            if os.listdir(directory_path) \
+                    or time.time() - os.stat(directory_path).st_mtime \
+                    < self.files_directory_grace_time:
+                return
+            os.rmdir(directory_path)
+        except OSError:
+            pass
+
     def reserve_file_numbers(self, external_cursor=None, num_files=200):
         '''
         Reserve a range of numbers in the fileCounter table, which may be used
@@ -986,8 +1685,8 @@ class WorkflowDatabaseServer(object):
                     # *very* costy... (about 0.1 second per call)
                     cursor.execute(
                         'UPDATE fileCounter SET count=count+%d' % num_files)
-                self._free_file_counters = list(range(count,
-                                                      count + num_files))
+                self._free_file_counters = collections.deque(
+                    range(count, count + num_files))
                 return count
             except Exception as e:
                 if not external_cursor:
@@ -1016,7 +1715,12 @@ class WorkflowDatabaseServer(object):
             is allocated.
         external_cursor: sqlite3 Cursor (optional)
             when reallocation is needed, the database cursor may be used.
+
+        This does nothing if local_file_numbers is True: the file numbers
+        are then not allocated in the database.
         '''
+        if self.local_file_numbers:
+            return
         with self._lock:
             if len(self._free_file_counters) >= num_files:
                 return
@@ -1035,7 +1739,50 @@ class WorkflowDatabaseServer(object):
         '''
         with self._lock:
             self.ensure_file_numbers_available(1, 200, external_cursor)
-            return self._free_file_counters.pop(0)
+            return self._free_file_counters.popleft()
+
+    def _new_file_prefix(self):
+        '''
+        Choose the prefix of the files numbered by this server (see
+        local_file_numbers). It is also changed in a forked process, so that
+        both processes do not generate the same paths.
+        '''
+        self._file_prefix = uuid.uuid4().hex[:16]
+        self._file_prefix_pid = os.getpid()
+        self._file_number = 0
+        # directories of the current block of numbers, by (login, user_id)
+        self._file_block = None
+        self._file_directories = {}
+
+    def _new_local_file_number(self, login, user_id):
+        '''
+        Returns a new file number, and the directory where the file is
+        stored, which is created if needed. The lock must be held.
+        '''
+        if self._file_prefix_pid != os.getpid():
+            self._new_file_prefix()
+        file_num = self._file_number
+        self._file_number += 1
+        block = file_num // self.files_per_directory
+        if block != self._file_block:
+            # the directories of the former numbers are not used anymore
+            self._file_block = block
+            self._file_directories = {}
+        directory = self._file_directories.get((login, user_id))
+        if directory is None or not os.path.isdir(directory):
+            # (the directory may have been removed meanwhile)
+            directory = os.path.join(
+                self._user_transfer_dir_path(login, user_id),
+                '%s-%d' % (self._file_prefix, block))
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                    os.chmod(directory, 0o775)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+            self._file_directories[(login, user_id)] = directory
+        return file_num, directory
 
     def generate_file_path(self,
                            user_id,
@@ -1046,6 +1793,11 @@ class WorkflowDatabaseServer(object):
         Generates file path for transfers.
         The user_id must be valid.
 
+        With local_file_numbers (the default), the path is generated without
+        accessing the database (unless the login is not given), in a files
+        directory of the server. Otherwise a number is reserved in the
+        fileCounter table, and the file is in the user directory.
+
         Parameters
         ----------
         user_id: UserIdentifier
@@ -1081,8 +1833,12 @@ class WorkflowDatabaseServer(object):
                     six.reraise(
                         DatabaseError, DatabaseError(e), sys.exc_info()[2])
 
-            file_num = self.get_new_file_number(external_cursor)
-            userDirPath = self._user_transfer_dir_path(login, user_id)
+            if self.local_file_numbers:
+                file_num, userDirPath = self._new_local_file_number(
+                    login, user_id)
+            else:
+                file_num = self.get_new_file_number(external_cursor)
+                userDirPath = self._user_transfer_dir_path(login, user_id)
             if client_file_path == None:
                 newFilePath = os.path.join(userDirPath, repr(file_num))
                 # newFilePath += repr(file_num)
@@ -1138,116 +1894,16 @@ class WorkflowDatabaseServer(object):
         expiration_date: date
         user_id:  UserIdentifier
         '''
-
-        if isinstance(engine_transfer, TemporaryPath):
-            return self.add_temporary_path(
-                engine_transfer, user_id, expiration_date,
-                external_cursor)
-
-        if expiration_date == None:
-            expiration_date = datetime.now() + timedelta(
-                hours=engine_transfer.disposal_timeout)
-
         with self._lock:
             if not external_cursor:
                 self.logger.debug("=> add_transfer")
                 connection = self._connect()
                 cursor = connection.cursor()
             else:
-                cursor = external_cursor
-
-            if engine_transfer.client_paths:
-                engine_transfer.engine_path \
-                    = self.generate_file_path(user_id, external_cursor=cursor)
-            else:
-                engine_transfer.engine_path \
-                    = self.generate_file_path(user_id,
-                                              engine_transfer.client_path,
-                                              external_cursor=cursor)
-            client_path_std = None
-            if engine_transfer.client_paths:
-                client_path_std = file_separator.join(
-                    engine_transfer.client_paths)
-
-            try:
-                cursor.execute('''INSERT INTO transfers
-                        (engine_file_path,
-                         client_file_path,
-                         transfer_date,
-                         expiration_date,
-                         user_id,
-                         workflow_id,
-                         status,
-                         client_paths)
-                        VALUES (?, ?, ?, ?,
-                                ?, ?, ?, ?)''',
-                               (engine_transfer.engine_path,
-                                engine_transfer.client_path,
-                                date.today(),
-                                expiration_date,
-                                user_id,
-                                engine_transfer.workflow_id,
-                                engine_transfer.status,
-                                client_path_std))
-                engine_transfer.transfer_id = cursor.lastrowid
-            except Exception as e:
-                if not external_cursor:
-                    connection.rollback()
-                    cursor.close()
-                    connection.close()
-                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
-            if not external_cursor:
-                cursor.close()
-                connection.commit()
-                connection.close()
-
-        return engine_transfer
-
-    def add_temporary_path(self,
-                           engine_temp,
-                           user_id,
-                           expiration_date=None,
-                           external_cursor=None):
-        '''
-        Adds a temporary file to the database.
-
-        Parameters
-        ----------
-        engine_temp: EngineTemporaryPath
-        expiration_date: date
-        user_id:  UserIdentifier
-        '''
-
-        if expiration_date == None:
-            expiration_date = datetime.now() + timedelta(
-                hours=engine_temp.disposal_timeout)
-
-        with self._lock:
-            if not external_cursor:
-                self.logger.debug("=> add_temporary_path")
-                connection = self._connect()
-                cursor = connection.cursor()
-            else:
-                cursor = external_cursor
-
-            engine_path = engine_temp.get_engine_path()
-            if engine_path is None:
-                engine_path = ''
-
+                cursor = external_cursor
             try:
-                cursor.execute('''INSERT INTO temporary_paths
-                        (engine_file_path,
-                         expiration_date,
-                         user_id,
-                         workflow_id,
-                         status)
-                        VALUES (?, ?, ?, ?, ?)''',
-                               (engine_path,
-                                expiration_date,
-                                user_id,
-                                engine_temp.workflow_id,
-                                engine_temp.status))
-                engine_temp.temp_path_id = cursor.lastrowid
+                self._add_transfers(user_id, [engine_transfer],
+                                    expiration_date, cursor)
             except Exception as e:
                 if not external_cursor:
                     connection.rollback()
@@ -1259,7 +1915,131 @@ class WorkflowDatabaseServer(object):
                 connection.commit()
                 connection.close()
 
-        return engine_temp
+        return engine_transfer
+
+    def add_temporary_path(self,
+                           engine_temp,
+                           user_id,
+                           expiration_date=None,
+                           external_cursor=None):
+        '''
+        Adds a temporary file to the database.
+
+        Parameters
+        ----------
+        engine_temp: EngineTemporaryPath
+        expiration_date: date
+        user_id:  UserIdentifier
+        '''
+        return self.add_transfer(engine_temp, user_id, expiration_date,
+                                 external_cursor)
+
+    def _reserve_row_ids(self, cursor, table, id_column, number):
+        '''
+        Allocate number consecutive ids for new rows of a table, so that
+        they can be inserted all at once. The transaction is started first,
+        so that other connections cannot allocate the same ids.
+
+        Returns
+        -------
+        first_id: int
+        '''
+        connection = cursor.connection
+        if not getattr(connection, 'in_transaction', True):
+            cursor.execute('BEGIN EXCLUSIVE')
+        last_id = 0
+        # AUTOINCREMENT ids are never reused, even after the rows are deleted
+        for (seq, ) in cursor.execute(
+                'SELECT seq FROM sqlite_sequence WHERE name=?', [table]):
+            last_id = seq or 0
+        for (max_id, ) in cursor.execute(
+                'SELECT max(%s) FROM %s' % (id_column, table)):
+            last_id = max(last_id, max_id or 0)
+        return last_id + 1
+
+    def _add_transfers(self, user_id, engine_transfers, expiration_date,
+                       cursor, login=None):
+        '''
+        Insert transfers and temporary paths at once, using the given
+        cursor. Their ids and engine paths are set.
+        '''
+        transfers = [t for t in engine_transfers
+                     if not isinstance(t, TemporaryPath)]
+        temp_paths = [t for t in engine_transfers
+                      if isinstance(t, TemporaryPath)]
+        if transfers:
+            for engine_transfer in transfers:
+                if engine_transfer.client_paths:
+                    engine_transfer.engine_path = self.generate_file_path(
+                        user_id, external_cursor=cursor, login=login)
+                else:
+                    engine_transfer.engine_path = self.generate_file_path(
+                        user_id, engine_transfer.client_path,
+                        external_cursor=cursor, login=login)
+            transfer_id = self._reserve_row_ids(cursor, 'transfers', 'id',
+                                                len(transfers))
+            rows = []
+            today = date.today()
+            for engine_transfer in transfers:
+                client_path_std = None
+                if engine_transfer.client_paths:
+                    client_path_std = file_separator.join(
+                        engine_transfer.client_paths)
+                transfer_expiration = expiration_date
+                if transfer_expiration is None:
+                    transfer_expiration = datetime.now() + timedelta(
+                        hours=engine_transfer.disposal_timeout)
+                engine_transfer.transfer_id = transfer_id
+                rows.append((transfer_id,
+                             engine_transfer.engine_path,
+                             engine_transfer.client_path,
+                             today,
+                             transfer_expiration,
+                             user_id,
+                             engine_transfer.workflow_id,
+                             engine_transfer.status,
+                             client_path_std))
+                transfer_id += 1
+            cursor.executemany('''INSERT INTO transfers
+                    (id,
+                     engine_file_path,
+                     client_file_path,
+                     transfer_date,
+                     expiration_date,
+                     user_id,
+                     workflow_id,
+                     status,
+                     client_paths)
+                    VALUES (?, ?, ?, ?, ?,
+                            ?, ?, ?, ?)''', rows)
+        if temp_paths:
+            temp_path_id = self._reserve_row_ids(
+                cursor, 'temporary_paths', 'temp_path_id', len(temp_paths))
+            rows = []
+            for engine_temp in temp_paths:
+                engine_path = engine_temp.get_engine_path()
+                if engine_path is None:
+                    engine_path = ''
+                temp_expiration = expiration_date
+                if temp_expiration is None:
+                    temp_expiration = datetime.now() + timedelta(
+                        hours=engine_temp.disposal_timeout)
+                engine_temp.temp_path_id = temp_path_id
+                rows.append((temp_path_id,
+                             engine_path,
+                             temp_expiration,
+                             user_id,
+                             engine_temp.workflow_id,
+                             engine_temp.status))
+                temp_path_id += 1
+            cursor.executemany('''INSERT INTO temporary_paths
+                    (temp_path_id,
+                     engine_file_path,
+                     expiration_date,
+                     user_id,
+                     workflow_id,
+                     status)
+                    VALUES (?, ?, ?, ?, ?, ?)''', rows)
 
     def _check_transfer(self, connection, cursor, transfer_id, user_id):
         try:
@@ -1337,7 +2117,7 @@ class WorkflowDatabaseServer(object):
             connection.commit()
             cursor.close()
             connection.close()
-            self.clean()
+        self._clean_expired()
 
     def remove_temporary(self, temp_path_id, user_id):
         '''
@@ -1369,7 +2149,7 @@ class WorkflowDatabaseServer(object):
             connection.commit()
             cursor.close()
             connection.close()
-            self.clean()
+        self._clean_expired()
 
     def get_transfer_information(self,
                                  transfer_id,
@@ -1541,7 +2321,195 @@ class WorkflowDatabaseServer(object):
 
         return status
 
-    def set_transfer_status(self, transfer_id, status):
+    def _new_status_revision(self, cursor):
+        '''
+        Increment the status revision counter within the transaction of
+        cursor, and return its new value, to be stored in the revision
+        column of the elements which status is changed.
+        '''
+        cursor.execute('UPDATE status_revision SET revision=revision+1')
+        return six.next(cursor.execute(
+            'SELECT revision FROM status_revision'))[0]
+
+    def _add_status_events(self, cursor, element_type, statuses):
+        '''
+        Write status events in the journal, within the transaction of
+        cursor. _notify_status_events() is to be called once the transaction
+        is committed.
+
+        Parameters
+        ----------
+        cursor: sqlite3 Cursor
+        element_type: str
+            'workflow', 'job', 'transfer' or 'temporary'
+        statuses: sequence
+            (element_id, status) for each element which status changed
+        '''
+        if not statuses:
+            return
+        table, id_column, wf_column = status_event_tables[element_type]
+        now = datetime.now()
+        cursor.executemany(
+            '''INSERT INTO status_events
+            (date, workflow_id, element_type, element_id, status)
+            SELECT ?, %s, ?, %s, ? FROM %s WHERE %s=?'''
+            % (wf_column, id_column, table, id_column),
+            [(now, element_type, status, element_id)
+             for element_id, status in statuses])
+        inserted = cursor.rowcount
+        if inserted <= 0:
+            return
+        # the old events are removed by chunks of a tenth of the retention
+        last_event_id = six.next(cursor.execute(
+            'SELECT max(id) FROM status_events'))[0]
+        step = max(1, self.status_events_retention // 10)
+        if last_event_id // step != (last_event_id - inserted) // step:
+            cursor.execute('DELETE FROM status_events WHERE id<=?',
+                           [last_event_id - self.status_events_retention])
+
+    def _notify_status_events(self):
+        '''
+        Wake up the threads waiting for status events (wait_status_events())
+        '''
+        with self._status_events_condition:
+            self._status_events_generation += 1
+            self._status_events_condition.notify_all()
+
+    def get_status_events(self, since_event_id=None, workflow_id=None,
+                          element_type=None, element_ids=None):
+        '''
+        Status events written in the journal after a given event. An event
+        is written each time the status of a workflow, job, transfer or
+        temporary path is changed, and when a workflow or a job is deleted
+        (with the status status_event_deleted, 'deleted').
+
+        Parameters
+        ----------
+        since_event_id: int or None
+            id of the last event known by the caller (the last_event_id
+            returned by a previous call). If None, no event is returned: the
+            call only gives the event id to start from.
+        workflow_id: int (optional)
+            only return the events of this workflow and of its elements
+        element_type: str (optional)
+            only return the events of this type of elements: 'workflow',
+            'job', 'transfer' or 'temporary'
+        element_ids: sequence of int (optional)
+            only return the events of these elements (element_type should
+            be given)
+
+        Returns
+        -------
+        tuple (last_event_id, complete, events)
+            last_event_id is the id of the last event of the journal, to be
+            passed as since_event_id to the next call. complete is False
+            when some events following since_event_id are not in the journal
+            anymore (only the last status_events_retention events are kept,
+            and the database may have been replaced): the caller should then
+            read again the status of the elements it follows. events is a
+            list of tuples (event_id, date, workflow_id, element_type,
+            element_id, status), in the order of the events.
+        '''
+        self.logger.debug("=> get_status_events, since: %s"
+                          % repr(since_event_id))
+        with self._read_lock():
+            connection = self._connect_read()
+            cursor = connection.cursor()
+            try:
+                last_event_id = six.next(cursor.execute(
+                    'SELECT max(id) FROM status_events'))[0] or 0
+                complete = True
+                events = []
+                if since_event_id is not None \
+                        and since_event_id != last_event_id:
+                    first_event_id = six.next(cursor.execute(
+                        'SELECT min(id) FROM status_events'))[0]
+                    complete = since_event_id < last_event_id \
+                        and first_event_id <= since_event_id + 1
+                    query = '''SELECT id,
+                        date,
+                        workflow_id,
+                        element_type,
+                        element_id,
+                        status
+                        FROM status_events WHERE id>?'''
+                    args = [since_event_id]
+                    if workflow_id is not None:
+                        query += ' AND workflow_id=?'
+                        args.append(workflow_id)
+                    if element_type is not None:
+                        query += ' AND element_type=?'
+                        args.append(element_type)
+                    if element_ids is not None:
+                        query += ' AND element_id IN (%s)' \
+                            % ','.join('?' * len(element_ids))
+                        args += list(element_ids)
+                    for row in cursor.execute(query, args):
+                        (event_id, event_date, event_wf_id, event_type,
+                         element_id, status) = row
+                        events.append(
+                            (event_id,
+                             self._str_to_date_conversion(event_date),
+                             event_wf_id,
+                             self._string_conversion(event_type),
+                             element_id,
+                             self._string_conversion(status)))
+            except Exception as e:
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            cursor.close()
+            connection.close()
+        return (last_event_id, complete, events)
+
+    def wait_status_events(self, since_event_id=None, workflow_id=None,
+                           element_type=None, element_ids=None,
+                           timeout=None):
+        '''
+        Same as get_status_events(), but waits until some events match, or
+        until the timeout is reached. Waiters are woken up as soon as the
+        events written by this database server are committed; the events
+        written by other processes are seen within
+        status_events_poll_interval.
+
+        Parameters
+        ----------
+        since_event_id: int or None
+            id of the last event known by the caller. If None, waits for the
+            events following the call.
+        workflow_id, element_type, element_ids:
+            see get_status_events()
+        timeout: float or None
+            max time to wait, in seconds. None means no limit.
+
+        Returns
+        -------
+        tuple (last_event_id, complete, events)
+            see get_status_events(). events is empty if the timeout was
+            reached. The wait also ends when complete is False.
+        '''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            with self._status_events_condition:
+                generation = self._status_events_generation
+            result = self.get_status_events(since_event_id, workflow_id,
+                                            element_type, element_ids)
+            if (since_event_id is not None and result[2]) or not result[1]:
+                return result
+            # events which do not match are skipped
+            since_event_id = result[0]
+            wait = self.status_events_poll_interval
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return result
+                wait = min(wait, remaining)
+            with self._status_events_condition:
+                if self._status_events_generation == generation:
+                    self._status_events_condition.wait(wait)
+
+    def set_transfer_status(self, transfer_id, status, external_cursor=None):
         '''
         Updates the transfer status in the database.
         The status must be valid (ie a string among the transfer status
@@ -1553,26 +2521,37 @@ class WorkflowDatabaseServer(object):
             transfer identifier
         status: string
             transfer status as defined in constants.FILE_TRANSFER_STATUS
+        external_cursor: sqlite3 Cursor (optional)
+            if given, the update is done within its transaction, which is not
+            committed
         '''
         # if type(engine_file_path) is int:
             # return self.set_temporary_status(engine_file_path, status)
         self.logger.debug("=> set_transfer_status")
         with self._lock:
             # TBI if the status is not valid raise an exception ??
-            connection = self._connect()
-            cursor = connection.cursor()
+            if not external_cursor:
+                connection = self._connect()
+                cursor = connection.cursor()
+            else:
+                cursor = external_cursor
             try:
                 cursor.execute(
-                    'UPDATE transfers SET status=? WHERE id=?',
-                    (status, transfer_id))
+                    'UPDATE transfers SET status=?, revision=? WHERE id=?',
+                    (status, self._new_status_revision(cursor), transfer_id))
+                self._add_status_events(cursor, 'transfer',
+                                        [(transfer_id, status)])
             except Exception as e:
-                connection.rollback()
+                if not external_cursor:
+                    connection.rollback()
+                    cursor.close()
+                    connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            if not external_cursor:
+                connection.commit()
                 cursor.close()
                 connection.close()
-                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
-            connection.commit()
-            cursor.close()
-            connection.close()
+                self._notify_status_events()
 
     def set_transfer_paths(self, transfer_id, engine_path, client_path,
                            client_paths):
@@ -1604,9 +2583,11 @@ class WorkflowDatabaseServer(object):
                     '''UPDATE transfers SET
                     engine_file_path=?,
                     client_file_path=?,
-                    client_paths=?
+                    client_paths=?,
+                    revision=?
                     WHERE id=?''',
-                    (engine_path, client_path, client_paths, transfer_id))
+                    (engine_path, client_path, client_paths,
+                     self._new_status_revision(cursor), transfer_id))
             except Exception as e:
                 connection.rollback()
                 cursor.close()
@@ -1616,7 +2597,8 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.close()
 
-    def set_temporary_status(self, temp_path_id, status):
+    def set_temporary_status(self, temp_path_id, status,
+                             external_cursor=None):
         '''
         Updates the temporary path status in the database.
         The status must be valid (ie a string among the transfer status
@@ -1624,24 +2606,37 @@ class WorkflowDatabaseServer(object):
 
         @type  status: string
         @param status: transfer status as defined in constants.FILE_TRANSFER_STATUS
+        @type  external_cursor: sqlite3 Cursor
+        @param external_cursor: if given, the update is done within its
+        transaction, which is not committed
         '''
         self.logger.debug("=> set_temporary_status")
         with self._lock:
             # TBI if the status is not valid raise an exception ??
-            connection = self._connect()
-            cursor = connection.cursor()
+            if not external_cursor:
+                connection = self._connect()
+                cursor = connection.cursor()
+            else:
+                cursor = external_cursor
             try:
                 cursor.execute(
-                    'UPDATE temporary_paths SET status=? WHERE temp_path_id=?',
-                    (status, temp_path_id))
+                    'UPDATE temporary_paths SET status=?, revision=? '
+                    'WHERE temp_path_id=?',
+                    (status, self._new_status_revision(cursor),
+                     temp_path_id))
+                self._add_status_events(cursor, 'temporary',
+                                        [(temp_path_id, status)])
             except Exception as e:
-                connection.rollback()
+                if not external_cursor:
+                    connection.rollback()
+                    cursor.close()
+                    connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            if not external_cursor:
+                connection.commit()
                 cursor.close()
                 connection.close()
-                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
-            connection.commit()
-            cursor.close()
-            connection.close()
+                self._notify_status_events()
 
     def set_transfer_type(self, transfer_id, transfer_type, user_id):
         self.logger.debug("=> set_transfer_type")
@@ -1650,7 +2645,10 @@ class WorkflowDatabaseServer(object):
             cursor = connection.cursor()
             try:
                 cursor.execute(
-                    'UPDATE transfers SET transfer_type=? WHERE id=?', (transfer_type, transfer_id))
+                    'UPDATE transfers SET transfer_type=?, revision=? '
+                    'WHERE id=?',
+                    (transfer_type, self._new_status_revision(cursor),
+                     transfer_id))
             except Exception as e:
                 connection.rollback()
                 cursor.close()
@@ -1776,14 +2774,18 @@ class WorkflowDatabaseServer(object):
 
                 engine_workflow.wf_id = cursor.lastrowid
 
+                if login is None:
+                    login = self.get_user_login(user_id, cursor)
+
                 # the transfers must be registered before the jobs
-                for transfer in six.itervalues(
-                        engine_workflow.transfer_mapping):
+                transfers = list(six.itervalues(
+                    engine_workflow.transfer_mapping))
+                for transfer in transfers:
                     transfer.workflow_id = engine_workflow.wf_id
-                    self.add_transfer(transfer,
-                                      user_id,
-                                      engine_workflow.expiration_date,
-                                      external_cursor=cursor)
+                self._add_transfers(user_id, transfers,
+                                    engine_workflow.expiration_date, cursor,
+                                    login)
+                for transfer in transfers:
                     if isinstance(transfer, FileTransfer):
                         engine_workflow.registered_tr[
                             transfer.transfer_id] = transfer
@@ -1791,31 +2793,23 @@ class WorkflowDatabaseServer(object):
                         engine_workflow.registered_tmp[
                             transfer.temp_path_id] = transfer
 
-                job_info = []
-
-                if login is None:
-                    login = self.get_user_login(cursor)
-
-                for job in six.itervalues(engine_workflow.job_mapping):
+                jobs = list(six.itervalues(engine_workflow.job_mapping))
+                for job in jobs:
                     job.workflow_id = engine_workflow.wf_id
-                    job = self.add_job(user_id,
-                                       job,
-                                       engine_workflow.expiration_date,
-                                       external_cursor=cursor,
-                                       login=login)
-                    job_info.append(
-                        (job.job_id, job.stdout_file, job.stderr_file))
+                self._add_jobs(user_id, jobs,
+                               engine_workflow.expiration_date, cursor, login)
+                for job in jobs:
                     engine_workflow.registered_jobs[job.job_id] = job
 
-                pickled_workflow = pickle.dumps(engine_workflow,
-                                                protocol=DB_PICKLE_PROTOCOL)
+                pickled_workflow = dumps_engine_object(
+                    encode_engine_workflow, engine_workflow)
 
                 cursor.execute('''UPDATE workflows
                           SET pickled_engine_workflow=?
                           WHERE id=?''',
-                               (sqlite3.Binary(pickled_workflow),
-                                engine_workflow.wf_id))
+                               (pickled_workflow, engine_workflow.wf_id))
 
+                param_links = []
                 for dest_job, links \
                         in six.iteritems(engine_workflow.param_links):
                     edest_job = engine_workflow.job_mapping[dest_job]
@@ -1824,18 +2818,21 @@ class WorkflowDatabaseServer(object):
                             esrc_job = engine_workflow.job_mapping[link[0]]
                             func = None
                             if len(link) > 2:
-                                func = sqlite3.Binary(pickle.dumps(link[2]))
-                            cursor.execute(
-                                '''INSERT INTO param_links
-                                (workflow_id,
-                                dest_job_id,
-                                dest_param,
-                                src_job_id,
-                                src_param,
-                                pickled_function)
-                                VALUES (?, ?, ?, ?, ?, ?)''',
+                                func = dumps_engine_object(encode_value,
+                                                           link[2])
+                            param_links.append(
                                 (engine_workflow.wf_id, edest_job.job_id,
                                  dest_param, esrc_job.job_id, link[1], func))
+                if param_links:
+                    cursor.executemany(
+                        '''INSERT INTO param_links
+                        (workflow_id,
+                        dest_job_id,
+                        dest_param,
+                        src_job_id,
+                        src_param,
+                        pickled_function)
+                        VALUES (?, ?, ?, ?, ?, ?)''', param_links)
 
             except Exception as e:
                 connection.rollback()
@@ -1867,6 +2864,8 @@ class WorkflowDatabaseServer(object):
             yesterday = date.today() - timedelta(days=1)
 
             try:
+                self._add_status_events(cursor, 'workflow',
+                                        [(wf_id, status_event_deleted)])
                 cursor.execute(
                     'UPDATE workflows SET expiration_date=? WHERE id=?', (yesterday, wf_id))
                 cursor.execute(
@@ -1885,8 +2884,8 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.commit()
             connection.close()
-            self.clean()
-            self.vacuum()
+        self._notify_status_events()
+        self._clean_expired(vacuum=True)
 
     def change_workflow_expiration_date(self, wf_id, new_date, user_id):
         '''
@@ -1946,16 +2945,15 @@ class WorkflowDatabaseServer(object):
             connection.close()
 
         if pickled_workflow:
-            if six.PY2:
-                workflow = pickle.loads(pickled_workflow)
-            else:
-                workflow = pickle.loads(pickled_workflow, encoding='utf-8')
+            workflow = loads_engine_object(decode_engine_workflow,
+                                           pickled_workflow)
         else:
             workflow = None
 
         return workflow
 
-    def set_workflow_status(self, wf_id, status, force=False):
+    def set_workflow_status(self, wf_id, status, force=False,
+                            external_cursor=None):
         '''
         Updates the workflow status in the database.
         The status must be valid (ie a string among the workflow status
@@ -1966,13 +2964,22 @@ class WorkflowDatabaseServer(object):
         wf_id: int
         status: str
             workflow status as defined in constants.WORKFLOW_STATUS
+        force: bool
+            if False, a workflow with the DELETE_PENDING or KILL_PENDING
+            status keeps it
+        external_cursor: sqlite3 Cursor (optional)
+            if given, the update is done within its transaction, which is not
+            committed
         '''
         self.logger.debug("=> set_workflow_status, wf_id: %s, status: %s"
                           % (wf_id, status))
         with self._lock:
             # TBI if the status is not valid raise an exception ??
-            connection = self._connect()
-            cursor = connection.cursor()
+            if not external_cursor:
+                connection = self._connect()
+                cursor = connection.cursor()
+            else:
+                cursor = external_cursor
             try:
                 prev_status = six.next(cursor.execute(
                     '''SELECT status
@@ -1989,20 +2996,25 @@ class WorkflowDatabaseServer(object):
                                    (status,
                                     datetime.now(),
                                     wf_id))
+                    self._add_status_events(cursor, 'workflow',
+                                            [(wf_id, status)])
                     self.logger.debug("===> workflow_status updated")
                 else:
                     self.logger.debug("===> (workflow_status not updated)")
             except Exception as e:
-                connection.rollback()
-                cursor.close()
-                connection.close()
+                if not external_cursor:
+                    connection.rollback()
+                    cursor.close()
+                    connection.close()
                 self.logger.error(
                     "===> workflow_status update failed, error: %s, : %s"
                     % (str(type(e)), str(e)))
                 six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
-            connection.commit()
-            cursor.close()
-            connection.close()
+            if not external_cursor:
+                connection.commit()
+                cursor.close()
+                connection.close()
+                self._notify_status_events()
 
     def get_workflow_status(self, wf_id, user_id):
         '''
@@ -2011,8 +3023,8 @@ class WorkflowDatabaseServer(object):
         '''
         self.logger.debug("=> get_workflow_status, wf_id: %s, user_id: %s"
                           % (wf_id, user_id))
-        with self._lock:
-            connection = self._connect()
+        with self._read_lock():
+            connection = self._connect_read()
             cursor = connection.cursor()
             self._check_workflow(connection, cursor, wf_id, user_id)
             try:
@@ -2076,114 +3088,13 @@ class WorkflowDatabaseServer(object):
         )
         '''
         self.logger.debug("=> get_detailed_workflow_status, wf_id: %s" % wf_id)
-        with self._lock:
-            connection = self._connect()
+        with self._read_lock():
+            connection = self._connect_read()
             cursor = connection.cursor()
 
             try:
-                # workflow status
-                (wf_status, wf_queue) = six.next(cursor.execute(
-                    '''SELECT
-                    status,
-                    queue
-                    FROM workflows WHERE id=?''',
-                    [wf_id]))  # supposes that the wf_id is valid
-
-                workflow_status = ([], [], wf_status, wf_queue, [])
-                # jobs
-                for row in cursor.execute('''SELECT id,
-                                            status,
-                                            exit_status,
-                                            exit_value,
-                                            terminating_signal,
-                                            resource_usage,
-                                            submission_date,
-                                            execution_date,
-                                            ending_date,
-                                            queue,
-                                            drmaa_id
-                                     FROM jobs WHERE workflow_id=?''',
-                                          [wf_id]):
-                    job_id, status, exit_status, exit_value, term_signal, \
-                        resource_usage, submission_date, execution_date, \
-                        ending_date, queue, drmaa_id = row
-
-                    submission_date = self._str_to_date_conversion(
-                        submission_date)
-                    execution_date = self._str_to_date_conversion(
-                        execution_date)
-                    ending_date = self._str_to_date_conversion(ending_date)
-                    queue = self._string_conversion(queue)
-
-                    if with_drms_id:
-                        workflow_status[0].append(
-                            (job_id, status, queue,
-                             (exit_status, exit_value, term_signal,
-                              resource_usage),
-                             (submission_date, execution_date, ending_date,
-                              queue),
-                             drmaa_id))
-                    else:
-                        workflow_status[0].append(
-                            (job_id, status, queue,
-                             (exit_status, exit_value, term_signal,
-                              resource_usage),
-                             (submission_date, execution_date, ending_date,
-                              queue)))
-
-                # transfers
-                for row in cursor.execute('''SELECT id,
-                                            engine_file_path,
-                                            client_file_path,
-                                            client_paths,
-                                            status,
-                                            transfer_type
-                                     FROM transfers WHERE workflow_id=?''',
-                                          [wf_id]):
-                    (transfer_id,
-                     engine_file_path,
-                     client_file_path,
-                     client_paths,
-                     status,
-                     transfer_type) = row
-
-                    engine_file_path = self._string_conversion(
-                        engine_file_path)
-                    client_file_path = self._string_conversion(
-                        client_file_path)
-                    status = self._string_conversion(status)
-                    transfer_type = self._string_conversion(transfer_type)
-                    if client_paths:
-                        client_paths = self._string_conversion(
-                            client_paths).split(file_separator)
-                    else:
-                        client_paths = None
-
-                    workflow_status[1].append((transfer_id,
-                                               engine_file_path,
-                                               client_file_path,
-                                               client_paths,
-                                               status,
-                                               transfer_type))
-
-                # temporary_paths
-                for row in cursor.execute('''SELECT temp_path_id,
-                                            engine_file_path,
-                                            status
-                                  FROM temporary_paths WHERE workflow_id=?''',
-                                          [wf_id]):
-                    (temp_path_id,
-                     engine_file_path,
-                     status) = row
-
-                    engine_file_path = self._string_conversion(
-                        engine_file_path)
-                    status = self._string_conversion(status)
-
-                    workflow_status[4].append((temp_path_id,
-                                               engine_file_path,
-                                               status))
-
+                workflow_status = self._workflow_elements_status(
+                    cursor, wf_id, with_drms_id)
             except Exception as e:
                 cursor.close()
                 connection.close()
@@ -2191,7 +3102,9 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.close()
 
-        self.logger.debug("===> status: %s, queue: %s" % (wf_status, wf_queue))
+        wf_status = workflow_status[2]
+        self.logger.debug("===> status: %s, queue: %s"
+                          % (wf_status, workflow_status[3]))
         if check_status and wf_status == constants.WORKFLOW_IN_PROGRESS:
             done = []
             not_done = []
@@ -2209,6 +3122,169 @@ class WorkflowDatabaseServer(object):
                 self.set_workflow_status(wf_id, constants.WORKFLOW_DONE, True)
         return workflow_status
 
+    def get_workflow_status_changes(self, wf_id, since_revision=None,
+                                    with_drms_id=True):
+        '''
+        Same as get_detailed_workflow_status(), but only returns the jobs,
+        transfers and temporary paths which status changed after a given
+        status revision, instead of all of them.
+
+        Parameters
+        ----------
+        wf_id: int
+        since_revision: int or None
+            revision returned by a previous call. If None, or if it is not a
+            revision of the database (the database may have been replaced),
+            the status of all the workflow elements is returned.
+        with_drms_id: bool (optional, default=True)
+            see get_detailed_workflow_status()
+
+        Returns
+        -------
+        tuple (revision, full, workflow_status)
+            revision is the status revision of the returned state, to be
+            passed as since_revision to the next call. full is True when
+            workflow_status holds all the workflow elements, False when it
+            only holds the ones which changed. workflow_status has the same
+            structure as in get_detailed_workflow_status().
+        '''
+        self.logger.debug("=> get_workflow_status_changes, wf_id: %s, since "
+                          "revision: %s" % (wf_id, since_revision))
+        with self._read_lock():
+            connection = self._connect_read()
+            cursor = connection.cursor()
+            try:
+                revision = six.next(cursor.execute(
+                    'SELECT revision FROM status_revision'))[0]
+                full = since_revision is None or since_revision < 0 \
+                    or since_revision > revision
+                if full:
+                    since_revision = -1
+                workflow_status = self._workflow_elements_status(
+                    cursor, wf_id, with_drms_id, since_revision)
+            except Exception as e:
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            cursor.close()
+            connection.close()
+        return (revision, full, workflow_status)
+
+    def _workflow_elements_status(self, cursor, wf_id, with_drms_id,
+                                  since_revision=-1):
+        '''
+        Status of the workflow, and of its elements which status changed
+        after since_revision (all of them by default), see
+        get_detailed_workflow_status()
+        '''
+        # workflow status
+        (wf_status, wf_queue) = six.next(cursor.execute(
+            '''SELECT
+            status,
+            queue
+            FROM workflows WHERE id=?''',
+            [wf_id]))  # supposes that the wf_id is valid
+
+        workflow_status = ([], [], wf_status, wf_queue, [])
+        # jobs
+        for row in cursor.execute('''SELECT id,
+                                    status,
+                                    exit_status,
+                                    exit_value,
+                                    terminating_signal,
+                                    resource_usage,
+                                    submission_date,
+                                    execution_date,
+                                    ending_date,
+                                    queue,
+                                    drmaa_id
+                             FROM jobs WHERE workflow_id=?
+                             AND revision>?''',
+                                  [wf_id, since_revision]):
+            job_id, status, exit_status, exit_value, term_signal, \
+                resource_usage, submission_date, execution_date, \
+                ending_date, queue, drmaa_id = row
+
+            submission_date = self._str_to_date_conversion(
+                submission_date)
+            execution_date = self._str_to_date_conversion(
+                execution_date)
+            ending_date = self._str_to_date_conversion(ending_date)
+            queue = self._string_conversion(queue)
+
+            if with_drms_id:
+                workflow_status[0].append(
+                    (job_id, status, queue,
+                     (exit_status, exit_value, term_signal,
+                      resource_usage),
+                     (submission_date, execution_date, ending_date,
+                      queue),
+                     drmaa_id))
+            else:
+                workflow_status[0].append(
+                    (job_id, status, queue,
+                     (exit_status, exit_value, term_signal,
+                      resource_usage),
+                     (submission_date, execution_date, ending_date,
+                      queue)))
+
+        # transfers
+        for row in cursor.execute('''SELECT id,
+                                    engine_file_path,
+                                    client_file_path,
+                                    client_paths,
+                                    status,
+                                    transfer_type
+                             FROM transfers WHERE workflow_id=?
+                             AND revision>?''',
+                                  [wf_id, since_revision]):
+            (transfer_id,
+             engine_file_path,
+             client_file_path,
+             client_paths,
+             status,
+             transfer_type) = row
+
+            engine_file_path = self._string_conversion(
+                engine_file_path)
+            client_file_path = self._string_conversion(
+                client_file_path)
+            status = self._string_conversion(status)
+            transfer_type = self._string_conversion(transfer_type)
+            if client_paths:
+                client_paths = self._string_conversion(
+                    client_paths).split(file_separator)
+            else:
+                client_paths = None
+
+            workflow_status[1].append((transfer_id,
+                                       engine_file_path,
+                                       client_file_path,
+                                       client_paths,
+                                       status,
+                                       transfer_type))
+
+        # temporary_paths
+        for row in cursor.execute('''SELECT temp_path_id,
+                                    engine_file_path,
+                                    status
+                          FROM temporary_paths WHERE workflow_id=?
+                          AND revision>?''',
+                                  [wf_id, since_revision]):
+            (temp_path_id,
+             engine_file_path,
+             status) = row
+
+            engine_file_path = self._string_conversion(
+                engine_file_path)
+            status = self._string_conversion(status)
+
+            workflow_status[4].append((temp_path_id,
+                                       engine_file_path,
+                                       status))
+
+        return workflow_status
+
     #
     # JOBS
     def _check_job(self, connection, cursor, job_id, user_id):
@@ -2312,202 +3388,36 @@ class WorkflowDatabaseServer(object):
                 user_id,
                 engine_job,
                 expiration_date=None,
-                external_cursor=None,
-                login=None):
-        '''
-        Adds a job to the database and returns its identifier.
-
-        Parameters
-        ----------
-        user_id: UserIdentifier
-        engine_job: EngineJob
-
-        Returns
-        -------
-        job_desc: tuple
-            the identifier of the job:
-            (JobIdentifier, stdout_file_path, stderr_file_path)
-        '''
-
-        expiration_date = expiration_date
-        if expiration_date == None:
-            expiration_date = datetime.now() + timedelta(
-                hours=engine_job.disposal_timeout)
-
-        parallel_config_name = None
-        nodes_number = 1
-        cpu_per_node = 1
-        if engine_job.parallel_job_info:
-            parallel_config_name \
-                = engine_job.parallel_job_info.get('config_name')
-            nodes_number = engine_job.parallel_job_info.get('nodes_number', 1)
-            cpu_per_node = engine_job.parallel_job_info.get('cpu_per_node', 1)
-        command_info = []
-        for command_element in engine_job.plain_command():
-            command_info.append(self.shell_param(command_element))
-        command_info = " ".join(command_info)
-
-        with self._lock:
-            if not external_cursor:
-                self.logger.debug("=> add_job")
-                connection = self._connect()
-                cursor = connection.cursor()
-            else:
-                cursor = external_cursor
-
-            if login is None:
-                login = self.get_user_login(user_id, cursor)
-
-            try:
-
-                if not engine_job.plain_stdout():
-                    engine_job.stdout_file = self.generate_file_path(
-                        user_id, external_cursor=cursor, login=login)
-                    engine_job.stderr_file = self.generate_file_path(
-                        user_id, external_cursor=cursor, login=login)
-                    custom_submission = False  # the std out and err file has to be removed with the job
-                else:
-                    custom_submission = True  # the std out and err file won't to be removed with the job
-
-                if engine_job.use_input_params_file \
-                        and not engine_job.plain_input_params_file():
-                    engine_job.input_params_file = self.generate_file_path(
-                        user_id, external_cursor=cursor, login=login)
-
-                if engine_job.has_outputs \
-                        and not engine_job.plain_output_params_file():
-                    engine_job.output_params_file = self.generate_file_path(
-                        user_id, external_cursor=cursor, login=login)
-
-                referenced_input_files = []
-                referenced_input_temp = []
-                for ft in engine_job.referenced_input_files:
-                    eft = engine_job.transfer_mapping[ft]
-                    if isinstance(eft, FileTransfer):
-                        referenced_input_files.append(eft.transfer_id)
-                    else:
-                        referenced_input_temp.append(eft.temp_path_id)
-
-                referenced_output_files = []
-                referenced_output_temp = []
-                for ft in engine_job.referenced_output_files:
-                    eft = engine_job.transfer_mapping[ft]
-                    if isinstance(eft, FileTransfer):
-                        referenced_output_files.append(eft.engine_path)
-                    else:
-                        referenced_output_temp.append(eft.temp_path_id)
-
-                cursor.execute('''INSERT INTO jobs
-                         (user_id,
-
-                          drmaa_id,
-                          expiration_date,
-                          status,
-                          last_status_update,
-                          workflow_id,
-
-                          command,
-                          stdin_file,
-                          join_errout,
-                          stdout_file,
-                          stderr_file,
-                          working_directory,
-                          custom_submission,
-                          parallel_config_name,
-                          nodes_number,
-                          cpu_per_node,
-                          queue,
-                          input_params_file,
-                          output_params_file,
-
-                          name,
-                          submission_date,
-                          execution_date,
-                          ending_date,
+                external_cursor=None,
+                login=None):
+        '''
+        Adds a job to the database and returns its identifier.
 
-                          exit_status,
-                          exit_value,
-                          terminating_signal,
-                          resource_usage,
+        Parameters
+        ----------
+        user_id: UserIdentifier
+        engine_job: EngineJob
 
-                          pickled_engine_job)
-                          VALUES (?, ?, ?, ?, ?,
-                                  ?, ?, ?, ?, ?,
-                                  ?, ?, ?, ?, ?,
-                                  ?, ?, ?, ?, ?,
-                                  ?, ?, ?, ?, ?,
-                                  ?, ?, ?)''',
-                               (user_id,
+        Returns
+        -------
+        job_desc: tuple
+            the identifier of the job:
+            (JobIdentifier, stdout_file_path, stderr_file_path)
+        '''
+        with self._lock:
+            if not external_cursor:
+                self.logger.debug("=> add_job")
+                connection = self._connect()
+                cursor = connection.cursor()
+            else:
+                cursor = external_cursor
 
-                                None,  # drmaa_id
-                                expiration_date,
-                                constants.NOT_SUBMITTED,  # status
-                                datetime.now(),  # last_status_update
-                                engine_job.workflow_id,
-
-                                command_info,
-                                engine_job.plain_stdin(),
-                                engine_job.join_stderrout,
-                                engine_job.plain_stdout(),
-                                engine_job.plain_stderr(),
-                                engine_job.plain_working_directory(),
-                                custom_submission,
-                                parallel_config_name,
-                                nodes_number,
-                                cpu_per_node,
-                                engine_job.queue,
-                                engine_job.plain_input_params_file(),
-                                engine_job.plain_output_params_file(),
-
-                                engine_job.name,
-                                None,  # submission_date,
-                                None,  # execution_date,
-                                None,  # ending_date,
-                                None,  # exit_status,
-                                None,  # exit_value,
-                                None,  # terminating_signal,
-                                None,  # resource_usage,
-
-                                None  # pickled_engine_job
-                                ))
-
-                job_id = cursor.lastrowid
-                engine_job.job_id = job_id
-                if not engine_job.workflow_id or engine_job.workflow_id == -1:
-                    pickled_engine_job = pickle.dumps(
-                        engine_job, protocol=DB_PICKLE_PROTOCOL)
-                    cursor.execute(
-                        'UPDATE jobs SET pickled_engine_job=? WHERE id=?',
-                                  (sqlite3.Binary(pickled_engine_job), job_id))
-
-                for transfer_id in referenced_input_files:
-                    cursor.execute('''INSERT INTO ios (job_id,
-                                             engine_file_id,
-                                             is_input)
-                             VALUES (?, ?, ?)''',
-                                   (job_id, transfer_id, True))
-
-                for transfer_id in referenced_output_files:
-                    cursor.execute('''INSERT INTO ios (job_id,
-                                             engine_file_id,
-                                             is_input)
-                            VALUES (?, ?, ?)''',
-                                   (job_id, transfer_id, False))
-
-                for temp_path_id in referenced_input_temp:
-                    cursor.execute('''INSERT INTO ios_tmp (job_id,
-                                             temp_path_id,
-                                             is_input)
-                             VALUES (?, ?, ?)''',
-                                   (job_id, temp_path_id, True))
-
-                for temp_path_id in referenced_output_temp:
-                    cursor.execute('''INSERT INTO ios_tmp (job_id,
-                                             temp_path_id,
-                                             is_input)
-                             VALUES (?, ?, ?)''',
-                                   (job_id, temp_path_id, False))
+            if login is None:
+                login = self.get_user_login(user_id, cursor)
 
+            try:
+                self._add_jobs(user_id, [engine_job], expiration_date,
+                               cursor, login)
             except Exception as e:
                 if not external_cursor:
                     connection.rollback()
@@ -2521,6 +3431,173 @@ class WorkflowDatabaseServer(object):
 
         return engine_job
 
+    def _add_jobs(self, user_id, engine_jobs, expiration_date, cursor,
+                  login):
+        '''
+        Insert jobs at once, using the given cursor. Their ids and files
+        paths are set. The jobs files, and the transfers and temporary paths
+        they reference, must be registered before.
+        '''
+        if not engine_jobs:
+            return
+        # the files paths are generated first: without local_file_numbers,
+        # this may need to reserve file numbers in the database, which ends
+        # the current transaction
+        custom_submissions = []
+        for engine_job in engine_jobs:
+            if not engine_job.plain_stdout():
+                engine_job.stdout_file = self.generate_file_path(
+                    user_id, external_cursor=cursor, login=login)
+                engine_job.stderr_file = self.generate_file_path(
+                    user_id, external_cursor=cursor, login=login)
+                custom_submissions.append(False)  # the std out and err file has to be removed with the job
+            else:
+                custom_submissions.append(True)  # the std out and err file won't to be removed with the job
+
+            if engine_job.use_input_params_file \
+                    and not engine_job.plain_input_params_file():
+                engine_job.input_params_file = self.generate_file_path(
+                    user_id, external_cursor=cursor, login=login)
+
+            if engine_job.has_outputs \
+                    and not engine_job.plain_output_params_file():
+                engine_job.output_params_file = self.generate_file_path(
+                    user_id, external_cursor=cursor, login=login)
+
+        job_id = self._reserve_row_ids(cursor, 'jobs', 'id',
+                                       len(engine_jobs))
+        now = datetime.now()
+        rows = []
+        ios = []
+        ios_tmp = []
+        for engine_job, custom_submission in zip(engine_jobs,
+                                                 custom_submissions):
+            job_expiration = expiration_date
+            if job_expiration is None:
+                job_expiration = now + timedelta(
+                    hours=engine_job.disposal_timeout)
+
+            parallel_config_name = None
+            nodes_number = 1
+            cpu_per_node = 1
+            if engine_job.parallel_job_info:
+                parallel_config_name \
+                    = engine_job.parallel_job_info.get('config_name')
+                nodes_number = engine_job.parallel_job_info.get(
+                    'nodes_number', 1)
+                cpu_per_node = engine_job.parallel_job_info.get(
+                    'cpu_per_node', 1)
+            command_info = " ".join(
+                [self.shell_param(command_element)
+                 for command_element in engine_job.plain_command()])
+
+            for ft in engine_job.referenced_input_files:
+                eft = engine_job.transfer_mapping[ft]
+                if isinstance(eft, FileTransfer):
+                    ios.append((job_id, eft.transfer_id, True))
+                else:
+                    ios_tmp.append((job_id, eft.temp_path_id, True))
+
+            for ft in engine_job.referenced_output_files:
+                eft = engine_job.transfer_mapping[ft]
+                if isinstance(eft, FileTransfer):
+                    ios.append((job_id, eft.engine_path, False))
+                else:
+                    ios_tmp.append((job_id, eft.temp_path_id, False))
+
+            engine_job.job_id = job_id
+            pickled_engine_job = None
+            if not engine_job.workflow_id or engine_job.workflow_id == -1:
+                pickled_engine_job = dumps_engine_object(encode_engine_job,
+                                                         engine_job)
+
+            rows.append((job_id,
+                         user_id,
+
+                         None,  # drmaa_id
+                         job_expiration,
+                         constants.NOT_SUBMITTED,  # status
+                         now,  # last_status_update
+                         engine_job.workflow_id,
+
+                         command_info,
+                         engine_job.plain_stdin(),
+                         engine_job.join_stderrout,
+                         engine_job.plain_stdout(),
+                         engine_job.plain_stderr(),
+                         engine_job.plain_working_directory(),
+                         custom_submission,
+                         parallel_config_name,
+                         nodes_number,
+                         cpu_per_node,
+                         engine_job.queue,
+                         engine_job.plain_input_params_file(),
+                         engine_job.plain_output_params_file(),
+
+                         engine_job.name,
+                         None,  # submission_date,
+                         None,  # execution_date,
+                         None,  # ending_date,
+                         None,  # exit_status,
+                         None,  # exit_value,
+                         None,  # terminating_signal,
+                         None,  # resource_usage,
+
+                         pickled_engine_job))
+            job_id += 1
+
+        cursor.executemany('''INSERT INTO jobs
+                 (id,
+                  user_id,
+
+                  drmaa_id,
+                  expiration_date,
+                  status,
+                  last_status_update,
+                  workflow_id,
+
+                  command,
+                  stdin_file,
+                  join_errout,
+                  stdout_file,
+                  stderr_file,
+                  working_directory,
+                  custom_submission,
+                  parallel_config_name,
+                  nodes_number,
+                  cpu_per_node,
+                  queue,
+                  input_params_file,
+                  output_params_file,
+
+                  name,
+                  submission_date,
+                  execution_date,
+                  ending_date,
+
+                  exit_status,
+                  exit_value,
+                  terminating_signal,
+                  resource_usage,
+
+                  pickled_engine_job)
+                  VALUES (?, ?, ?, ?, ?,
+                          ?, ?, ?, ?, ?,
+                          ?, ?, ?, ?, ?,
+                          ?, ?, ?, ?, ?,
+                          ?, ?, ?, ?, ?,
+                          ?, ?, ?, ?)''', rows)
+        if ios:
+            cursor.executemany('''INSERT INTO ios (job_id,
+                                     engine_file_id,
+                                     is_input)
+                     VALUES (?, ?, ?)''', ios)
+        if ios_tmp:
+            cursor.executemany('''INSERT INTO ios_tmp (job_id,
+                                     temp_path_id,
+                                     is_input)
+                     VALUES (?, ?, ?)''', ios_tmp)
+
     def update_job_command(self, job_id, commandline):
         self.logger.debug("=> update_job_command " + str(job_id) + ':'
                           + repr(commandline))
@@ -2589,23 +3666,47 @@ class WorkflowDatabaseServer(object):
             connection.close()
 
         if pickled_job:
-            if six.PY2:
-                job = pickle.loads(pickled_job)
-            else:
-                job = pickle.loads(pickled_job, encoding='utf-8')
+            job = loads_engine_object(decode_engine_job, pickled_job)
             job.job_id = job_id
         else:
             job = None
             if workflow_id not in (None, -1):
-                # job is not pickled: get the whole workflow
-                workflow = self.get_engine_workflow(workflow_id, user_id)
-                jobs = [workflow.job_mapping[j] for j in workflow.jobs]
-                jobs = [j for j in jobs if j.job_id == job_id]
-                if len(jobs) != 0:
-                    job = jobs[0]
+                # job is stored in its workflow: only decode this job
+                job = self._get_workflow_engine_job(job_id, workflow_id,
+                                                    user_id)
 
         return (job, workflow_id)
 
+    def _get_workflow_engine_job(self, job_id, workflow_id, user_id):
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                pickled_workflow = six.next(cursor.execute(
+                    'SELECT pickled_engine_workflow FROM workflows WHERE id=?',
+                    [workflow_id]))[0]
+            except Exception as e:
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            cursor.close()
+            connection.close()
+
+        if not pickled_workflow:
+            return None
+        if is_encoded(pickled_workflow):
+            encoded_workflow = EncodedData(pickled_workflow)
+            if job_id not in encoded_workflow.job_ids():
+                return None
+            return encoded_workflow.engine_job(job_id)
+        # legacy pickle: get the whole workflow
+        workflow = self.get_engine_workflow(workflow_id, user_id)
+        jobs = [workflow.job_mapping[j] for j in workflow.jobs]
+        jobs = [j for j in jobs if j.job_id == job_id]
+        if len(jobs) != 0:
+            return jobs[0]
+        return None
+
     def delete_job(self, job_id):
         '''
         Remove the job from the database. Remove all associated transfered files if
@@ -2622,6 +3723,8 @@ class WorkflowDatabaseServer(object):
             yesterday = date.today() - timedelta(days=1)
 
             try:
+                self._add_status_events(cursor, 'job',
+                                        [(job_id, status_event_deleted)])
                 cursor.execute(
                     'UPDATE jobs SET expiration_date=? WHERE id=?', (yesterday, job_id))
 
@@ -2634,7 +3737,8 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.commit()
             connection.close()
-            self.clean()
+        self._notify_status_events()
+        self._clean_expired()
 
     def set_queue(self, queue_name, job_ids, wf_id=None):
         '''
@@ -2653,9 +3757,11 @@ class WorkflowDatabaseServer(object):
                         (queue_name, wf_id))
 
                 cursor.execute(
-                    '''UPDATE jobs SET queue=? WHERE id in (%s)'''
+                    '''UPDATE jobs SET queue=?, revision=? WHERE id in (%s)'''
                     % ','.join(['?'] * len(job_ids)),
-                    list(itertools.chain((queue_name, ), job_ids)))
+                    list(itertools.chain(
+                        (queue_name, self._new_status_revision(cursor)),
+                        job_ids)))
             except Exception as e:
                 connection.rollback()
                 cursor.close()
@@ -2665,14 +3771,19 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.close()
 
-    def set_jobs_status(self, job_status, force=False):
+    def set_jobs_status(self, job_status, force=False, external_cursor=None):
         '''
         job_status: dictionary: job_id -> status
+        external_cursor: if given, the update is done within its transaction,
+        which is not committed
         '''
         self.logger.debug("=> set_jobs_status")
         with self._lock:
             # TBI if the status is not valid raise an exception ??
-            connection = self._connect()
+            if not external_cursor:
+                connection = self._connect()
+            else:
+                connection = external_cursor.connection
             statuses = []
 
             # execute all queries before writing in the database, it's
@@ -2710,9 +3821,14 @@ class WorkflowDatabaseServer(object):
                                      last_update, execution_date,
                                      ending_date))
 
-            cursor = connection.cursor()
+            if not external_cursor:
+                cursor = connection.cursor()
+            else:
+                cursor = external_cursor
             now = datetime.now()
             date_to_update = []
+            revision = None
+            events = []
             try:
                 for (job_id, status, previous_status, last_update,
                      execution_date, ending_date) in statuses:
@@ -2739,12 +3855,17 @@ class WorkflowDatabaseServer(object):
                                 > update_interval:
                             date_to_update.append(job_id)
                     if do_update:
+                        if revision is None:
+                            revision = self._new_status_revision(cursor)
                         cursor.execute('''UPDATE jobs SET status=?,
                                             last_status_update=?,
                                             execution_date=?,
-                                            ending_date=? WHERE id=?''',
+                                            ending_date=?,
+                                            revision=? WHERE id=?''',
                                        (status, now, execution_date,
-                                        ending_date, job_id))
+                                        ending_date, revision, job_id))
+                        events.append((job_id, status))
+                self._add_status_events(cursor, 'job', events)
                 if len(date_to_update) != 0:
                     # update last_status_update for all jobs which may
                     # become outdated
@@ -2764,10 +3885,13 @@ class WorkflowDatabaseServer(object):
                             [now] + date_to_update[chunk * nmax:
                                                    chunk * nmax + n])
             except Exception as e:
-                connection.rollback()
-                cursor.close()
-                connection.close()
+                if not external_cursor:
+                    connection.rollback()
+                    cursor.close()
+                    connection.close()
                 six.raise_from(DatabaseError(e), e)
+            if external_cursor:
+                return
             # connection.commit()
             try:
                 connection.commit()
@@ -2779,6 +3903,7 @@ class WorkflowDatabaseServer(object):
                 raise
             cursor.close()
             connection.close()
+            self._notify_status_events()
 
     def set_job_status(self, job_id, status, force=False):
         '''
@@ -2827,10 +3952,15 @@ class WorkflowDatabaseServer(object):
                     connection.execute('''UPDATE jobs SET status=?,
                                           last_status_update=?,
                                           execution_date=?,
-                                          ending_date=? WHERE id=?''',
+                                          ending_date=?,
+                                          revision=? WHERE id=?''',
                                        (status, datetime.now(),
                                         execution_date, ending_date,
+                                        self._new_status_revision(
+                                            connection.cursor()),
                                         job_id))
+                    self._add_status_events(connection.cursor(), 'job',
+                                            [(job_id, status)])
                 except Exception as e:
                     connection.rollback()
                     connection.close()
@@ -2838,6 +3968,7 @@ class WorkflowDatabaseServer(object):
                         DatabaseError, DatabaseError(e), sys.exc_info()[2])
             connection.commit()
             connection.close()
+            self._notify_status_events()
 
     def get_job_status(self, job_id, user_id):
         '''
@@ -2856,8 +3987,8 @@ class WorkflowDatabaseServer(object):
         other user.
         '''
         self.logger.debug("=> get_jobs_status")
-        with self._lock:
-            connection = self._connect()
+        with self._read_lock():
+            connection = self._connect_read()
             cursor = connection.cursor()
             self._check_jobs(connection, cursor, job_ids, user_id)
 
@@ -2894,7 +4025,8 @@ class WorkflowDatabaseServer(object):
 
         return status
 
-    def set_submission_information(self, drmaa_ids, submission_date):
+    def set_submission_information(self, drmaa_ids, submission_date,
+                                   external_cursor=None):
         '''
         Set the submission information of the job and reset information
         related to the job submission (execution_date, ending_date,
@@ -2902,12 +4034,18 @@ class WorkflowDatabaseServer(object):
 
         *drmaa_ids: dictionary job_id -> drmaa_id
         *submission_date: submission date if the job was submitted
+        *external_cursor: if given, the update is done within its
+        transaction, which is not committed
         '''
         self.logger.debug("=> set_submission_information")
         with self._lock:
-            connection = self._connect()
-            cursor = connection.cursor()
+            if not external_cursor:
+                connection = self._connect()
+                cursor = connection.cursor()
+            else:
+                cursor = external_cursor
             try:
+                revision = self._new_status_revision(cursor)
                 for job_id, drmaa_id in six.iteritems(drmaa_ids):
                     cursor.execute('''UPDATE jobs
                             SET drmaa_id=?,
@@ -2919,7 +4057,8 @@ class WorkflowDatabaseServer(object):
                                 terminating_signal=?,
                                 resource_usage=?,
                                 execution_date=?,
-                                ending_date=?
+                                ending_date=?,
+                                revision=?
                                 WHERE id=?''',
                                    (drmaa_id,
                                     submission_date,
@@ -2931,15 +4070,18 @@ class WorkflowDatabaseServer(object):
                                     None,
                                     None,
                                     None,
+                                    revision,
                                     job_id))
             except Exception as e:
-                connection.rollback()
+                if not external_cursor:
+                    connection.rollback()
+                    cursor.close()
+                    connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            if not external_cursor:
+                connection.commit()
                 cursor.close()
                 connection.close()
-                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
-            connection.commit()
-            cursor.close()
-            connection.close()
 
     def set_job_output_params(self, job_id, param_dict):
         '''
@@ -3002,10 +4144,7 @@ class WorkflowDatabaseServer(object):
                     # print(dst_param, src_job, src_param)
                     # if dest_param in param_dict:
                     if func:
-                        if six.PY2:
-                            func = pickle.loads(func)
-                        else:
-                            func = pickle.loads(func, encoding='utf-8')
+                        func = loads_engine_object(decode_value, func)
                     jdict = jsons.get(src_job)
                     if jdict is None:
                         json_sql = cursor2.execute(
@@ -3226,12 +4365,14 @@ class WorkflowDatabaseServer(object):
                 cursor.execute('''UPDATE jobs SET exit_status=?,
                                       exit_value=?,
                                       terminating_signal=?,
-                                      resource_usage=?
+                                      resource_usage=?,
+                                      revision=?
                                       WHERE id=?''',
                                (exit_status,
                                 exit_value,
                                 terminating_signal,
                                 resource_usage,
+                                self._new_status_revision(cursor),
                                 job_id)
                                )
             except Exception as e:
@@ -3245,6 +4386,80 @@ class WorkflowDatabaseServer(object):
                 cursor.close()
                 connection.close()
 
+    def write_updates(self, submission_info=None, job_status=None,
+                      exit_info=None, workflow_status=None,
+                      transfer_status=None, temporary_status=None):
+        '''
+        Write several kinds of status updates in a single transaction. They
+        are applied in the order of the parameters, with the same semantics
+        as the corresponding set_*() methods. This is used by
+        :class:`WriteBehindDatabaseServer`.
+
+        Parameters
+        ----------
+        submission_info: dict
+            job_id -> (drmaa_id, submission_date), see
+            set_submission_information()
+        job_status: dict
+            job_id -> (status, force)
+        exit_info: dict
+            job_id -> (exit_status, exit_value, terminating_signal,
+            resource_usage)
+        workflow_status: dict
+            wf_id -> (status, force)
+        transfer_status: dict
+            transfer_id -> status
+        temporary_status: dict
+            temp_path_id -> status
+        '''
+        self.logger.debug("=> write_updates")
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                if submission_info:
+                    by_date = {}
+                    for job_id, (drmaa_id, submission_date) \
+                            in six.iteritems(submission_info):
+                        by_date.setdefault(submission_date, {})[job_id] \
+                            = drmaa_id
+                    for submission_date, drmaa_ids in six.iteritems(by_date):
+                        self.set_submission_information(
+                            drmaa_ids, submission_date, cursor)
+                if job_status:
+                    for force in (False, True):
+                        statuses = dict(
+                            [(job_id, status) for job_id, (status, f)
+                             in six.iteritems(job_status) if f == force])
+                        if statuses:
+                            self.set_jobs_status(statuses, force, cursor)
+                if exit_info:
+                    for job_id, info in six.iteritems(exit_info):
+                        self.set_job_exit_info(job_id, *info,
+                                               external_cursor=cursor)
+                if workflow_status:
+                    for wf_id, (status, force) \
+                            in six.iteritems(workflow_status):
+                        self.set_workflow_status(wf_id, status, force,
+                                                 cursor)
+                if transfer_status:
+                    for transfer_id, status in six.iteritems(transfer_status):
+                        self.set_transfer_status(transfer_id, status, cursor)
+                if temporary_status:
+                    for temp_path_id, status \
+                            in six.iteritems(temporary_status):
+                        self.set_temporary_status(temp_path_id, status,
+                                                  cursor)
+            except Exception as e:
+                connection.rollback()
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            connection.commit()
+            cursor.close()
+            connection.close()
+            self._notify_status_events()
+
     def _string_conversion(self, string):
         # return string
         if string:
@@ -3357,7 +4572,13 @@ class WorkflowDatabaseServer(object):
     def nb_jobs(self, user_id, queue_name, status):
         '''
         Returns the number of job of the user with the given statuses
-        in the queue queue_name.
+        in the queue queue_name. Jobs with the status constants.UNDETERMINED
+        (just submitted) are always counted.
+
+        The jobs are not counted in the jobs table: they are read in the
+        job_counters table, which triggers on the jobs table keep up to
+        date in the transactions which write jobs, whichever the process
+        writing them.
 
         Parameters
         ----------
@@ -3371,29 +4592,143 @@ class WorkflowDatabaseServer(object):
         '''
         if not isinstance(status, list) and not isinstance(status, tuple):
             status = [status]
+        status = sorted(set(status) | set([constants.UNDETERMINED]))
         with self._lock:
             connection = self._connect()
             cursor = connection.cursor()
             try:
-                if queue_name != None:
-                    count = six.next(cursor.execute(
-                        "SELECT count(*) FROM jobs WHERE "
-                        "user_id=? and ( status=?"
-                        + " or status=?" * len(status) + ") "
-                        "and queue=?",
-                        [user_id, ]
-                        + status
-                        + [constants.UNDETERMINED,
-                           queue_name]))[0]
-                else:
-                    count = six.next(cursor.execute(
-                        "SELECT count(*) FROM jobs WHERE "
-                        "user_id=? and ( status=?"
-                        + " or status=?" * len(status) + ") "
-                        "and queue ISNULL",
-                        [user_id, ]
-                        + status
-                        + [constants.UNDETERMINED]))[0]
+                count = six.next(cursor.execute(
+                    "SELECT total(count) FROM job_counters WHERE "
+                    "user_id=? AND queue IS ? AND status IN (%s)"
+                    % ','.join(['?'] * len(status)),
+                    [user_id, queue_name] + status))[0]
+            except Exception as e:
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+
+            cursor.close()
+            connection.close()
+            return int(count)
+
+    def rebuild_job_counters(self):
+        '''
+        Count again the jobs of each user, queue and status of the database
+        (see nb_jobs()). The counters are kept up to date by the database
+        itself: this is only a repair, for instance after the jobs table has
+        been edited with the triggers disabled.
+        '''
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                cursor.execute('DELETE FROM job_counters')
+                cursor.execute(
+                    '''INSERT INTO job_counters (user_id, queue, status, count)
+                    SELECT user_id, queue, status, count(*) FROM jobs
+                    GROUP BY user_id, queue, status''')
+            except Exception as e:
+                connection.rollback()
+                cursor.close()
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            connection.commit()
+            cursor.close()
+            connection.close()
+
+    def check_job_counters(self):
+        '''
+        Compare the jobs counters used by nb_jobs() with the jobs of the
+        database. This is a consistency check, used by tests.
+
+        Returns
+        -------
+        differences: dict
+            (user_id, queue, status) -> (counter value, number of jobs in
+            the database), for the counters which do not match. Empty if
+            the counters are right.
+        '''
+        with self._lock:
+            connection = self._connect()
+            try:
+                job_counters = self._read_job_counts(
+                    connection,
+                    '''SELECT user_id, queue, status, count
+                    FROM job_counters WHERE count != 0''')
+                actual = self._read_job_counts(
+                    connection,
+                    '''SELECT user_id, queue, status, count(*) FROM jobs
+                    GROUP BY user_id, queue, status''')
+            except Exception as e:
+                connection.close()
+                six.reraise(DatabaseError, DatabaseError(e), sys.exc_info()[2])
+            connection.close()
+        differences = {}
+        for key in set(job_counters) | set(actual):
+            if job_counters.get(key, 0) != actual.get(key, 0):
+                differences[key] = (job_counters.get(key, 0),
+                                    actual.get(key, 0))
+        return differences
+
+    def _read_job_counts(self, connection, query):
+        '''
+        Returns the number of jobs of each (user_id, queue, status), from a
+        query returning these 4 columns
+        '''
+        job_counts = {}
+        for user_id, queue, status, count in connection.execute(query):
+            key = (user_id, self._string_conversion(queue),
+                   self._string_conversion(status))
+            job_counts[key] = job_counts.get(key, 0) + count
+        return job_counts
+
+    def get_jobs_mean_duration(self, user_id, job_names):
+        '''
+        Returns the mean duration of the jobs of the user which have
+        successfully run, grouped by job name.
+
+        Parameters
+        ----------
+        user_id: UserIdentifier
+        job_names: sequence of str
+            names of the jobs to look for
+
+        Returns
+        -------
+        durations: dict
+            job name -> mean duration in seconds (float), only for the names
+            for which jobs have been found.
+        '''
+        self.logger.debug("=> get_jobs_mean_duration")
+        job_names = list(job_names)
+        durations = {}
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            nmax = sqlite3_max_variable_number() - 3
+            if nmax <= 0:
+                nmax = max(len(job_names), 1)
+            try:
+                for chunk in range(0, len(job_names), nmax):
+                    names = job_names[chunk:chunk + nmax]
+                    for name, execution_date, ending_date in cursor.execute(
+                            "SELECT name, execution_date, ending_date "
+                            "FROM jobs WHERE user_id=? and status=? "
+                            "and exit_status=? and name IN (%s)"
+                            % ','.join(['?'] * len(names)),
+                            [user_id, constants.DONE,
+                             constants.FINISHED_REGULARLY] + names):
+                        execution_date = self._str_to_date_conversion(
+                            execution_date)
+                        ending_date = self._str_to_date_conversion(
+                            ending_date)
+                        if execution_date is None or ending_date is None:
+                            continue
+                        duration = (ending_date
+                                    - execution_date).total_seconds()
+                        durations.setdefault(
+                            self._string_conversion(name), []).append(
+                                duration)
             except Exception as e:
                 cursor.close()
                 connection.close()
@@ -3401,7 +4736,8 @@ class WorkflowDatabaseServer(object):
 
             cursor.close()
             connection.close()
-            return count
+        return dict((name, sum(values) / len(values))
+                    for name, values in six.iteritems(durations))
 
     def jobs_to_delete_and_kill(self, user_id):
         '''
@@ -3616,9 +4952,9 @@ class WorkflowDatabaseServer(object):
             request = request + ")"
             argument = workflow_ids
 
-        with self._lock:
+        with self._read_lock():
             self.logger.debug("=> get_workflows, within lock")
-            connection = self._connect()
+            connection = self._connect_read()
             cursor = connection.cursor()
             result = {}
 
@@ -3677,3 +5013,412 @@ class WorkflowDatabaseServer(object):
             return (wf_to_delete_ids, wf_to_kill_ids)
 
     #
+
+
+class WriteBehindDatabaseServer(object):
+
+    '''
+    Write-behind layer over a :class:`WorkflowDatabaseServer`, used by the
+    workflow engine to keep database writes out of its loop.
+
+    Status updates (jobs, workflows, transfers and temporary paths status,
+    jobs exit info and submission information) are stored in memory,
+    coalesced per job / workflow / file, and written by a background thread
+    in a single transaction every flush_interval seconds.
+
+    The engine reads its own writes: the status queries check the pending
+    updates first. The other methods of the database server can be called on
+    this object, the pending updates are then written first so that the
+    database is up to date, except for the methods which do not depend on
+    them (_no_flush_methods), and for wait_status_events(), which is woken
+    up by the buffered updates instead.
+
+    close() writes the pending updates and stops the thread. It is also
+    called when python exits.
+
+    Parameters
+    ----------
+    database_server: WorkflowDatabaseServer
+    flush_interval: float
+        time between two writes, in seconds
+    '''
+
+    # methods which do not read or write the columns updated in the
+    # background, and thus do not need to flush the pending updates
+    _no_flush_methods = set(['register_user',
+                             'pop_workflow_ended_transfer',
+                             'add_workflow_ended_transfer',
+                             'set_job_output_params',
+                             'get_job_output_params',
+                             'updated_job_parameters',
+                             'set_transfer_paths',
+                             'update_job_command',
+                             'get_job_command',
+                             'test'])
+
+    _pending_statuses = (constants.DELETE_PENDING, constants.KILL_PENDING)
+
+    # interval at which wait_status_events() reads the status events written
+    # by other writers, in seconds
+    status_events_poll_interval = 0.2
+
+    def __init__(self, database_server, flush_interval=1.):
+        self._database_server = database_server
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger('jobServer.write_behind')
+        # protects the pending updates
+        self._lock = threading.RLock()
+        # notified when updates are buffered or written, see
+        # wait_status_events()
+        self._updated = threading.Condition(self._lock)
+        self._updates_generation = 0
+        # only one flush at a time, so that updates are written in order
+        self._flush_lock = threading.Lock()
+        self._pending = self._new_updates()
+        # updates being written by the current flush: they are still used
+        # to answer queries until the transaction is committed
+        self._flushing = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(WriteBehindDatabaseServer._close_ref,
+                        weakref.ref(self))
+
+    @staticmethod
+    def _new_updates():
+        return {'submission_info': {},
+                'job_status': {},
+                'exit_info': {},
+                'workflow_status': {},
+                'transfer_status': {},
+                'temporary_status': {}}
+
+    @staticmethod
+    def _close_ref(ref):
+        database_server = ref()
+        if database_server is not None:
+            database_server.close()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._database_server, name)
+        if name in self._no_flush_methods or not callable(attribute):
+            return attribute
+
+        def flush_and_call(*args, **kwargs):
+            self.flush()
+            return attribute(*args, **kwargs)
+        return flush_and_call
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('write-behind flush failed')
+
+    def flush(self):
+        '''
+        Write the pending updates to the database, in a single transaction.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                updates = self._pending
+                if not [u for u in six.itervalues(updates) if u]:
+                    return
+                self._pending = self._new_updates()
+                self._flushing = updates
+            # status dates are only used to answer queries: the database
+            # sets its own dates when the updates are written
+            args = dict(updates)
+            for kind in ('job_status', 'workflow_status'):
+                args[kind] = dict(
+                    [(key, (status, force)) for key, (status, force, date)
+                     in six.iteritems(updates[kind])])
+            try:
+                self._database_server.write_updates(**args)
+            except Exception:
+                # keep them for the next flush, unless they have been
+                # overridden meanwhile
+                with self._lock:
+                    for kind, values in six.iteritems(updates):
+                        pending = self._pending[kind]
+                        for key, value in six.iteritems(values):
+                            pending.setdefault(key, value)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = None
+                    self._notify_updated()
+
+    def close(self):
+        '''
+        Write the pending updates and stop the background thread.
+        '''
+        if not self._closed.is_set():
+            self._closed.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+        self.flush()
+
+    def _lookup(self, kind, key):
+        '''
+        Pending value of an update, or None
+        '''
+        with self._lock:
+            value = self._pending[kind].get(key)
+            if value is None and self._flushing is not None:
+                value = self._flushing[kind].get(key)
+            return value
+
+    def _set_status(self, kind, key, status, force):
+        # same rule as in the database: the DELETE_PENDING and KILL_PENDING
+        # statuses are only overridden by forced updates
+        date = datetime.now()
+        with self._lock:
+            previous = self._pending[kind].get(key)
+            if previous is not None:
+                if not force and previous[0] in self._pending_statuses:
+                    return
+                force = force or previous[1]
+            self._pending[kind][key] = (status, force, date)
+            self._notify_updated()
+
+    def _notify_updated(self):
+        # the lock must be held
+        self._updates_generation += 1
+        self._updated.notify_all()
+
+    def wait_status_events(self, since_event_id=None, workflow_id=None,
+                           element_type=None, element_ids=None,
+                           timeout=None):
+        '''
+        Same as WorkflowDatabaseServer.wait_status_events(), without writing
+        the pending updates: their events are written by the next flush.
+        The wait also ends, possibly without events, when an update is
+        buffered, so that the caller can read the new statuses (which are
+        answered with the pending updates).
+        '''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._lock:
+            generation = self._updates_generation
+        while True:
+            with self._lock:
+                updated = self._updates_generation != generation
+                generation = self._updates_generation
+            result = self._database_server.get_status_events(
+                since_event_id, workflow_id, element_type, element_ids)
+            if (since_event_id is not None and result[2]) \
+                    or not result[1] or updated:
+                return result
+            since_event_id = result[0]
+            wait = self.status_events_poll_interval
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return result
+                wait = min(wait, remaining)
+            with self._lock:
+                if self._updates_generation == generation:
+                    self._updated.wait(wait)
+
+    # buffered updates
+
+    def set_job_status(self, job_id, status, force=False):
+        self._set_status('job_status', job_id, status, force)
+
+    def set_jobs_status(self, job_status, force=False):
+        for job_id, status in six.iteritems(job_status):
+            self._set_status('job_status', job_id, status, force)
+
+    def set_job_exit_info(self, job_id, exit_status, exit_value,
+                          terminating_signal, resource_usage):
+        with self._lock:
+            self._pending['exit_info'][job_id] = (
+                exit_status, exit_value, terminating_signal, resource_usage)
+            self._notify_updated()
+
+    def set_jobs_exit_info(self, job_dict):
+        for job_id, job in six.iteritems(job_dict):
+            self.set_job_exit_info(job_id, job.exit_status, job.exit_value,
+                                   job.terminating_signal, job.str_rusage)
+
+    def set_submission_information(self, drmaa_ids, submission_date):
+        with self._lock:
+            for job_id, drmaa_id in six.iteritems(drmaa_ids):
+                self._pending['submission_info'][job_id] = (drmaa_id,
+                                                            submission_date)
+                # the submission resets the job status and exit info
+                self._pending['job_status'][job_id] = (
+                    constants.UNDETERMINED, True, datetime.now())
+                self._pending['exit_info'][job_id] = (None, None, None, None)
+            self._notify_updated()
+
+    def set_workflow_status(self, wf_id, status, force=False):
+        self._set_status('workflow_status', wf_id, status, force)
+
+    def set_transfer_status(self, transfer_id, status):
+        with self._lock:
+            self._pending['transfer_status'][transfer_id] = status
+            self._notify_updated()
+
+    def set_temporary_status(self, temp_path_id, status):
+        with self._lock:
+            self._pending['temporary_status'][temp_path_id] = status
+            self._notify_updated()
+
+    # queries answered with the pending updates
+
+    def get_job_status(self, job_id, user_id):
+        value = self._lookup('job_status', job_id)
+        if value is None:
+            return self._database_server.get_job_status(job_id, user_id)
+        return value[0], value[2]
+
+    def get_jobs_status(self, job_ids, user_id):
+        if [job_id for job_id in job_ids
+                if self._lookup('job_status', job_id) is not None]:
+            self.flush()
+        return self._database_server.get_jobs_status(job_ids, user_id)
+
+    def get_job_exit_info(self, job_id, user_id):
+        value = self._lookup('exit_info', job_id)
+        if value is None:
+            return self._database_server.get_job_exit_info(job_id, user_id)
+        return value
+
+    def get_workflow_status(self, wf_id, user_id):
+        value = self._lookup('workflow_status', wf_id)
+        if value is None:
+            return self._database_server.get_workflow_status(wf_id, user_id)
+        return value[0], value[2]
+
+    def get_transfer_status(self, transfer_id, user_id):
+        value = self._lookup('transfer_status', transfer_id)
+        if value is None:
+            return self._database_server.get_transfer_status(transfer_id,
+                                                             user_id)
+        return value
+
+    def get_temporary_status(self, temp_path_id, user_id):
+        value = self._lookup('temporary_status', temp_path_id)
+        if value is None:
+            return self._database_server.get_temporary_status(temp_path_id,
+                                                              user_id)
+        return value
+
+    def _to_delete_and_kill(self, kind, to_delete, to_kill):
+        '''
+        Fix the ids of the elements to delete or kill read in the database
+        with the pending status updates.
+        '''
+        with self._lock:
+            pending = {}
+            if self._flushing is not None:
+                pending.update(self._flushing[kind])
+            pending.update(self._pending[kind])
+        if not pending:
+            return (to_delete, to_kill)
+        to_delete = set(to_delete)
+        to_kill = set(to_kill)
+        for key, (status, force, date) in six.iteritems(pending):
+            if not force and (key in to_delete or key in to_kill):
+                # the database keeps its DELETE_PENDING or KILL_PENDING
+                # status
+                continue
+            to_delete.discard(key)
+            to_kill.discard(key)
+            if status == constants.DELETE_PENDING:
+                to_delete.add(key)
+            elif status == constants.KILL_PENDING:
+                to_kill.add(key)
+        return (list(to_delete), list(to_kill))
+
+    def jobs_to_delete_and_kill(self, user_id):
+        to_delete, to_kill \
+            = self._database_server.jobs_to_delete_and_kill(user_id)
+        return self._to_delete_and_kill('job_status', to_delete, to_kill)
+
+    def workflows_to_delete_and_kill(self, user_id):
+        to_delete, to_kill \
+            = self._database_server.workflows_to_delete_and_kill(user_id)
+        return self._to_delete_and_kill('workflow_status', to_delete,
+                                        to_kill)
+
+
+class DatabaseJanitor(object):
+
+    '''
+    Background cleanup of a :class:`WorkflowDatabaseServer`, started by
+    WorkflowDatabaseServer.start_janitor().
+
+    Every interval seconds, or as soon as it is woken up (wake_up(), called
+    when workflows, jobs or files are deleted), a thread deletes the expired
+    elements of the database and their files (archiving the finished
+    workflows, see WorkflowDatabaseServer.clean_chunk()), then releases the
+    free pages of the database file (WorkflowDatabaseServer.vacuum_chunk()).
+
+    The work is done by chunks, each of them holding the lock of the server
+    for at most WorkflowDatabaseServer.max_lock_time seconds, and the thread
+    pauses between chunks, so that the engine and the clients are not
+    blocked by a large cleanup.
+
+    Parameters
+    ----------
+    database_server: WorkflowDatabaseServer
+    interval: float
+        time between two cleanings, in seconds
+    '''
+
+    # pause between two chunks, in seconds, to let the other threads take
+    # the lock of the server
+    pause = 0.01
+
+    def __init__(self, database_server, interval=3600.):
+        self._database_server = database_server
+        self.interval = interval
+        self.logger = logging.getLogger('jobServer.janitor')
+        self._wake_up = threading.Event()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake_up(self):
+        '''
+        Clean the database now, without waiting for the next interval.
+        '''
+        self._wake_up.set()
+
+    def close(self):
+        '''
+        Stop the thread, after the current chunk.
+        '''
+        self._closed.set()
+        self._wake_up.set()
+        self._thread.join()
+
+    def _loop(self):
+        while not self._closed.is_set():
+            try:
+                self.run()
+            except Exception:
+                self.logger.exception('database cleanup failed')
+            self._wake_up.wait(self.interval)
+            self._wake_up.clear()
+
+    def run(self):
+        '''
+        Clean the database until no expired element and no free page is
+        left, or until the janitor is closed.
+        '''
+        database_server = self._database_server
+        while not self._closed.is_set() and database_server.clean_chunk():
+            time.sleep(self.pause)
+        # without the incremental auto_vacuum mode, a whole VACUUM would
+        # hold the lock much too long
+        if database_server._auto_vacuum_mode() == 2:
+            while not self._closed.is_set() \
+                    and database_server.vacuum_chunk():
+                time.sleep(self.pause)
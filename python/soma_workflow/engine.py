@@ -16,6 +16,7 @@ import stat
 import hashlib
 import operator
 import itertools
+import heapq
 import atexit
 import six
 import weakref
@@ -31,6 +32,7 @@ import soma_workflow.constants as constants
 from soma_workflow.client import WorkflowController, EngineExecutionJob
 from soma_workflow.errors import JobError, UnknownObjectError, EngineError, DRMError
 from soma_workflow.transfer import RemoteFileController
+from soma_workflow.database_server import WriteBehindDatabaseServer
 from soma_workflow.configuration import Configuration
 from soma_workflow.param_link_functions import *
 from soma_workflow import utils
@@ -40,9 +42,23 @@ from soma_workflow import utils
 #-----------------------------------------------------------------------------
 
 refreshment_interval = 1.  # seconds
+# when the scheduler notifies the engine of jobs status changes
+# (Scheduler.can_push_events), the engine loop is woken up by events, and
+# only polls the scheduler and the database at this interval as a fallback.
+event_fallback_interval = 5.  # seconds
+# the engine loop only writes the jobs statuses which have changed. The
+# statuses of the other active jobs are written again at this interval so that
+# their last status update date does not get out of date (see
+# refreshment_timeout)
+status_heartbeat_interval = 20.  # seconds
 # if the last status update is older than the refreshment_timeout
 # the status is changed into WARNING
 refreshment_timeout = 90  # seconds
+# orders in which ready jobs can be submitted:
+# 'priority': by decreasing job priority, then in the order they get ready
+# 'critical_path': by decreasing job priority, then by decreasing critical
+#   path length (see EngineWorkflow.compute_critical_paths())
+SUBMISSION_ORDERS = ('priority', 'critical_path')
 
 
 def _out_to_date(last_status_update):
@@ -115,6 +131,164 @@ class EngineLoopThread(threading.Thread):
             loop_thread.stop_loop()
 
 
+def pending_job_sort_key(job, submission_order='priority'):
+    '''
+    Sort key of a job waiting for submission: jobs with the lowest keys are
+    submitted first.
+
+    Parameters
+    ----------
+    job: EngineJob
+    submission_order: str
+        one of SUBMISSION_ORDERS
+    '''
+    if submission_order == 'critical_path':
+        return (-job.priority, -(job.critical_path or 0.))
+    return (-job.priority, )
+
+
+class PendingJobsQueue(object):
+
+    '''
+    Jobs waiting for submission in a queue, kept in a heap ordered by their
+    sort keys (see pending_job_sort_key()). Jobs with equal keys are popped
+    in the order they have been pushed.
+    '''
+
+    def __init__(self):
+        self._heap = []
+        # dict: EngineJob -> heap entry
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, job):
+        return job in self._entries
+
+    def push(self, job, key):
+        self.remove(job)
+        entry = [key, next(self._counter), job]
+        self._entries[job] = entry
+        heapq.heappush(self._heap, entry)
+
+    def pop(self):
+        '''
+        Remove and return the job with the lowest key. Raises IndexError if
+        the queue is empty.
+        '''
+        while self._heap:
+            job = heapq.heappop(self._heap)[2]
+            if job is not None:
+                del self._entries[job]
+                return job
+        raise IndexError('pop from an empty PendingJobsQueue')
+
+    def remove(self, job):
+        # the heap entry is only marked as removed
+        entry = self._entries.pop(job, None)
+        if entry is not None:
+            entry[2] = None
+
+
+class JobSubmissionPool(object):
+
+    '''
+    Pool of threads submitting jobs to the scheduler on behalf of the engine
+    loop, so that slow submissions (qsub, DRMAA runJob...) do not block the
+    loop while it holds its lock.
+
+    Jobs are handed to the pool using submit(), and the results are fetched
+    by the loop using pop_results(). Each time a submission has completed,
+    the callback is called (typically to wake up the engine loop).
+    '''
+
+    # number of jobs handed to the pool which results have not been popped
+    # yet
+    in_flight = 0
+
+    def __init__(self, scheduler, nb_workers, callback=None):
+        '''
+        Parameters
+        ----------
+        scheduler: Scheduler
+        nb_workers: int
+            number of submission threads, i.e. the maximum number of
+            concurrent calls to scheduler.job_submission()
+        callback: callable
+            called without parameters each time a job submission has
+            completed
+        '''
+        self.logger = logging.getLogger('engine.JobSubmissionPool')
+        self._scheduler = scheduler
+        self._callback = callback
+        self._requests = six.moves.queue.Queue()
+        self._results = []
+        self._results_lock = threading.Lock()
+        self.in_flight = 0
+        self._workers = []
+        for i in range(nb_workers):
+            worker = threading.Thread(target=self._work,
+                                      name='job_submission_%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job, token=None):
+        '''
+        Queue a job for submission. The token is given back with the result.
+        '''
+        self.in_flight += 1
+        self._requests.put((job, token))
+
+    def pop_results(self):
+        '''
+        Returns
+        -------
+        results: list
+            list of (job, token, drmaa_id, error) for each job which
+            submission has completed since the last call. error is None if
+            the submission succeeded, otherwise drmaa_id is None.
+        '''
+        with self._results_lock:
+            results = self._results
+            self._results = []
+        self.in_flight -= len(results)
+        return results
+
+    def stop(self):
+        for worker in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join(timeout=3)
+        self._workers = []
+
+    def _work(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            job, token = request
+            drmaa_id = None
+            error = None
+            try:
+                drmaa_id = self._scheduler.job_submission(job)
+            except Exception as e:
+                if not isinstance(e, DRMError):
+                    self.logger.exception(e)
+                    e = DRMError("Job submission error: %s: %s"
+                                 % (type(e), e))
+                error = e
+            with self._results_lock:
+                self._results.append((job, token, drmaa_id, error))
+            if self._callback is not None:
+                try:
+                    self._callback()
+                except Exception as e:
+                    self.logger.exception(e)
+
+
 class WorkflowEngineLoop(object):
 
     # jobs managed by the current engine process instance.
@@ -146,14 +320,59 @@ class WorkflowEngineLoop(object):
     # Submission pending queues.
     # For each limited queue, a submission pending queue is needed to store the
     # jobs that couldn't be submitted.
-    # Dictionary queue name (str) => pending jobs (list)
+    # Dictionary queue name (str) => pending jobs (PendingJobsQueue)
     _pending_queues = None
+    # order in which the pending jobs are submitted, one of SUBMISSION_ORDERS
+    _submission_order = 'priority'
     # boolean
     _running = None
     # boolean
     _j_wf_ended = None
 
     _lock = None
+    # condition used to wake up the loop when something happens (job
+    # submission, status change notified by the scheduler, kill request...)
+    # It has its own lock (not _lock) so that it can be notified from any
+    # thread, including the scheduler threads, without risking deadlocks.
+    _wakeup = None
+    # boolean: an event has been posted since the last loop iteration
+    _wakeup_pending = None
+    # jobs which status, exit information or submission information has
+    # changed, and has to be written in the database at the end of the loop
+    # iteration. Workflows also record the jobs they abort themselves, see
+    # EngineWorkflow.pop_changed_jobs().
+    # dictionary: job_id -> EngineJob
+    _changed_jobs = None
+    # time (time.time()) of the last write of all active jobs statuses
+    _last_status_heartbeat = None
+    # indexes of all the jobs, transfers and temporary paths managed by the
+    # engine (standalone jobs and workflows elements). They are maintained
+    # when jobs and workflows are added, restarted and removed.
+    # dictionary: job_id -> EngineJob
+    _job_index = None
+    # dictionary: transfer_id -> EngineTransfer
+    _transfer_index = None
+    # dictionary: temp_path_id -> EngineTemporaryPath
+    _tmp_index = None
+    # submitted jobs which have not ended yet, i.e. the jobs which status
+    # has to be polled from the scheduler.
+    # dictionary: job_id -> EngineJob
+    _active_jobs = None
+    # threads submitting the jobs when the scheduler allows it (see
+    # Scheduler.submission_workers), None if jobs are submitted by the loop
+    # itself.
+    # JobSubmissionPool
+    _submission_pool = None
+    # jobs handed to the submission pool which submission result has not been
+    # processed yet. The token identifies the submission request, results of
+    # requests which are not listed here any longer (job stopped meanwhile)
+    # are discarded.
+    # dictionary: job_id -> (EngineJob, token)
+    _submitting_jobs = None
+    # number of job status rows sent to the database during the last loop
+    # iteration, and since the loop started
+    status_rows_written = 0
+    total_status_rows_written = 0
 
     logger = None
 
@@ -218,6 +437,128 @@ class WorkflowEngineLoop(object):
         # counter which may be used to synchronize things
         self._loop_count = 0
 
+        self._wakeup = threading.Condition(threading.Lock())
+        self._wakeup_pending = False
+
+        self._changed_jobs = {}
+        self._last_status_heartbeat = time.time()
+
+        self._job_index = {}
+        self._transfer_index = {}
+        self._tmp_index = {}
+        self._active_jobs = {}
+        self.status_rows_written = 0
+        self.total_status_rows_written = 0
+        # the scheduler holds a weak reference to the loop
+        self._scheduler.set_event_callback(
+            WorkflowEngineLoop._scheduler_event_callback(weakref.ref(self)))
+
+        self._submitting_jobs = {}
+        if self._scheduler.submission_workers:
+            self._submission_pool = JobSubmissionPool(
+                self._scheduler, self._scheduler.submission_workers,
+                WorkflowEngineLoop._scheduler_event_callback(
+                    weakref.ref(self)))
+
+    @staticmethod
+    def _scheduler_event_callback(loop_ref):
+        def wake_up_loop():
+            loop = loop_ref()
+            if loop is not None:
+                loop.wake_up()
+        return wake_up_loop
+
+    def wake_up(self):
+        '''
+        Post an event to the loop: the next iteration will start immediately
+        instead of waiting for the polling interval.
+        '''
+        with self._wakeup:
+            self._wakeup_pending = True
+            self._wakeup.notify_all()
+
+    def _index_job(self, job):
+        '''
+        Add a job to the engine indexes. The job is considered active if it
+        has been submitted to the scheduler and has not ended.
+        '''
+        self._job_index[job.job_id] = job
+        if job.drmaa_id is not None and job.exit_status is None:
+            self._set_job_active(job)
+        else:
+            self._set_job_inactive(job)
+
+    def _unindex_job(self, job_id):
+        job = self._job_index.pop(job_id, None)
+        if job is not None:
+            self._set_job_inactive(job)
+
+    def _set_job_active(self, job):
+        self._active_jobs[job.job_id] = job
+
+    def _set_job_inactive(self, job):
+        self._active_jobs.pop(job.job_id, None)
+
+    def _index_workflow(self, workflow):
+        '''
+        (Re-)index all jobs, transfers and temporary paths of a workflow.
+        '''
+        for job in six.itervalues(workflow.registered_jobs):
+            self._index_job(job)
+        self._transfer_index.update(workflow.registered_tr)
+        self._tmp_index.update(workflow.registered_tmp)
+
+    def _unindex_workflow(self, workflow):
+        for job_id in workflow.registered_jobs:
+            self._unindex_job(job_id)
+        for transfer_id in workflow.registered_tr:
+            self._transfer_index.pop(transfer_id, None)
+        for tmp_id in workflow.registered_tmp:
+            self._tmp_index.pop(tmp_id, None)
+
+    def _job_status_changed(self, job):
+        '''
+        Record that the status of a job has changed: it will be written in
+        the database at the end of the current loop iteration.
+        '''
+        self._changed_jobs[job.job_id] = job
+
+    def _pop_changed_jobs(self):
+        '''
+        Returns the jobs which status has to be written in the database,
+        and clears the changed jobs set. Every status_heartbeat_interval
+        seconds, all jobs which are not finished are included.
+
+        Returns
+        -------
+        changed_jobs: dict
+            job_id -> EngineJob
+        '''
+        changed_jobs = self._changed_jobs
+        self._changed_jobs = {}
+        for workflow in six.itervalues(self._workflows):
+            changed_jobs.update(workflow.pop_changed_jobs())
+        now = time.time()
+        if now - self._last_status_heartbeat >= status_heartbeat_interval:
+            self._last_status_heartbeat = now
+            for job_id, job in six.iteritems(self._job_index):
+                if job.status not in (constants.DONE, constants.FAILED):
+                    changed_jobs[job_id] = job
+        return changed_jobs
+
+    def _wait_for_events(self, time_interval):
+        '''
+        Wait until an event is posted (see wake_up()) or the polling interval
+        has elapsed. If the scheduler notifies jobs status changes itself, the
+        polling interval is only a fallback, and is longer.
+        '''
+        if self._scheduler.can_push_events:
+            time_interval = max(time_interval, event_fallback_interval)
+        with self._wakeup:
+            if not self._wakeup_pending and self._running:
+                self._wakeup.wait(time_interval)
+            self._wakeup_pending = False
+
     def are_jobs_and_workflow_done(self):
         with self._lock:
             ended = len(self._jobs) == 0 and len(self._workflows) == 0
@@ -274,17 +615,7 @@ class WorkflowEngineLoop(object):
                 # Delete and kill properly the jobs and workflows in _jobs and
                 # _workflows
                 for job_id in jobs_to_kill + jobs_to_delete:
-                    job = self._jobs.get(job_id)
-                    if job is None:
-                        # look in workflows
-                        for wf in six.itervalues(self._workflows):
-                            jobs = [j
-                                    for jid, j
-                                    in six.iteritems(wf.registered_jobs)
-                                    if jid == job_id]
-                            if len(jobs) == 1:
-                                job = jobs[0]
-                                break
+                    job = self._job_index.get(job_id)
                     if job is not None:
                     # if job_id in self._jobs:
                         self.logger.debug(" stop job " + repr(job_id))
@@ -298,6 +629,7 @@ class WorkflowEngineLoop(object):
                             self.logger.debug("Delete job : " + repr(job_id))
                             self._database_server.delete_job(job_id)
                             del self._jobs[job_id]
+                            self._unindex_job(job_id)
                         else:
                             self._database_server.set_job_status(job_id,
                                                                  job.status,
@@ -315,6 +647,7 @@ class WorkflowEngineLoop(object):
                             self.logger.debug(
                                 "Delete workflow : " + repr(wf_id))
                             self._database_server.delete_workflow(wf_id)
+                            self._unindex_workflow(self._workflows[wf_id])
                             del self._workflows[wf_id]
                         else:
                             ended_jobs.update(ended_jobs_in_wf)
@@ -323,90 +656,107 @@ class WorkflowEngineLoop(object):
                 # --- 2. Update job status from the scheduler -----------------
                 # get back the termination status and terminate the jobs which
                 # ended
-                wf_jobs = {}
-                wf_transfers = {}
-                wf_tmp = {}
-                for wf in six.itervalues(self._workflows):
-                    # one_wf_processed = True
-                    # TBI add a condition on the workflow status
-                    wf_jobs.update(wf.registered_jobs)
-                    wf_transfers.update(wf.registered_tr)
-                    wf_tmp.update(wf.registered_tmp)
-
-                for job in itertools.chain(six.itervalues(self._jobs),
-                                           six.itervalues(wf_jobs)):
-                    if job.exit_status == None and job.drmaa_id != None:
-                        try:
+                # only the submitted jobs which have not ended are polled, and
+                # the scheduler is queried for all of them at once.
+                active_jobs = list(self._active_jobs.values())
+                polled_jobs = [job for job in active_jobs
+                               if job.exit_status is None
+                               and job.drmaa_id is not None]
+                statuses = None
+                if polled_jobs:
+                    try:
+                        statuses = self._scheduler.get_jobs_status(
+                            list(set([job.drmaa_id for job in polled_jobs])))
+                    except DRMError as e:
+                        # fall back to individual requests, so that only the
+                        # faulty jobs get aborted
+                        self.logger.info(
+                            "!!!ERROR!!! get_jobs_status %s: %s" % (type(e), e))
+                        statuses = None
+                terminated_jobs = []
+                for job in polled_jobs:
+                    previous_status = job.status
+                    try:
+                        if statuses is not None and job.drmaa_id in statuses:
+                            job.status = statuses[job.drmaa_id]
+                        else:
                             job.status = self._scheduler.get_job_status(
                                 job.drmaa_id)
-                        except DRMError as e:
-                            self.logger.info(
-                                "!!!ERROR!!! get_job_status %s: %s" % (type(e), e))
-                            job.status = constants.FAILED
-                            job.exit_status = constants.EXIT_ABORTED
-                            stderr_file = open(job.stderr_file, "wa")
-                            stderr_file.write(
-                                "Error while requesting the job status %s: %s \nWarning: the job may still be running.\n" % (type(e), e))
-                            stderr_file.close()
-                            drms_error_jobs[job.job_id] = job
+                    except DRMError as e:
+                        self.logger.info(
+                            "!!!ERROR!!! get_job_status %s: %s" % (type(e), e))
+                        job.status = constants.FAILED
+                        job.exit_status = constants.EXIT_ABORTED
+                        stderr_file = open(job.stderr_file, "wa")
+                        stderr_file.write(
+                            "Error while requesting the job status %s: %s \nWarning: the job may still be running.\n" % (type(e), e))
+                        stderr_file.close()
+                        drms_error_jobs[job.job_id] = job
+                    if job.status != previous_status:
+                        self._job_status_changed(job)
+                    self.logger.debug(
+                        "job " + repr(job.job_id) + " : " + job.status)
+                    if job.status == constants.DONE \
+                            or job.status == constants.FAILED:
                         self.logger.debug(
-                            "job " + repr(job.job_id) + " : " + job.status)
-                        if job.status == constants.DONE \
-                                or job.status == constants.FAILED:
-                            self.logger.debug(
-                                "End of job %s, drmaaJobId = %s, status= %s",
-                                job.job_id, job.drmaa_id, repr(job.status))
-                            try:
-                                (job.exit_status,
-                                 job.exit_value,
-                                 job.terminating_signal,
-                                 job.str_rusage) \
-                                    = self._scheduler.get_job_exit_info(
-                                        job.drmaa_id)
-                            except Exception as e:
-                                self.logger.error(
-                                    'exception in get_job_exit_info: %s' % repr(e))
-                                raise
-
-                            self.logger.debug("  after get_job_exit_info ")
-                            self.logger.debug(
-                                "  => exit_status " + repr(job.exit_status))
-                            self.logger.debug(
-                                "  => exit_value " + repr(job.exit_value))
-                            self.logger.debug(
-                                "  => signal " + repr(job.terminating_signal))
-                            self.logger.debug(
-                                "  => rusage " + repr(job.str_rusage))
-
-                            if job.workflow_id != -1:
-                                wf_to_inspect.add(job.workflow_id)
-                            if job.status == constants.DONE:
-                                for ft in job.referenced_output_files:
-                                    if isinstance(ft, FileTransfer):
-                                        transfer_id = job.transfer_mapping[
-                                            ft].transfer_id
-                                        self._database_server.set_transfer_status(
-                                            transfer_id,
-                                            constants.FILES_ON_CR)
-                                    else:
-                                        # TemporaryPath
-                                        temp_path_id = job.transfer_mapping[
-                                            ft].temp_path_id
-                                        self._database_server.set_temporary_status(
-                                            temp_path_id,
-                                            constants.FILES_ON_CR)
-                                self.read_job_output_dict(job)
-
-                            ended_jobs[job.job_id] = job
-                            self.logger.debug(
-                                "  => exit_status " + repr(job.exit_status))
-                            self.logger.debug(
-                                "  => exit_value " + repr(job.exit_value))
-                            self.logger.debug(
-                                "  => signal " + repr(job.terminating_signal))
+                            "End of job %s, drmaaJobId = %s, status= %s",
+                            job.job_id, job.drmaa_id, repr(job.status))
+                        terminated_jobs.append(job)
+
+                if terminated_jobs:
+                    try:
+                        exit_info = self._scheduler.get_jobs_exit_info(
+                            list(set([job.drmaa_id
+                                      for job in terminated_jobs])))
+                    except Exception as e:
+                        self.logger.error(
+                            'exception in get_jobs_exit_info: %s' % repr(e))
+                        raise
+
+                for job in terminated_jobs:
+                    (job.exit_status,
+                     job.exit_value,
+                     job.terminating_signal,
+                     job.str_rusage) = exit_info[job.drmaa_id]
+
+                    self.logger.debug("  after get_job_exit_info ")
+                    self.logger.debug(
+                        "  => exit_status " + repr(job.exit_status))
+                    self.logger.debug(
+                        "  => exit_value " + repr(job.exit_value))
+                    self.logger.debug(
+                        "  => signal " + repr(job.terminating_signal))
+                    self.logger.debug(
+                        "  => rusage " + repr(job.str_rusage))
+
+                    if job.workflow_id != -1:
+                        wf_to_inspect.add(job.workflow_id)
+                    if job.status == constants.DONE:
+                        for ft in job.referenced_output_files:
+                            if isinstance(ft, FileTransfer):
+                                transfer_id = job.transfer_mapping[
+                                    ft].transfer_id
+                                self._database_server.set_transfer_status(
+                                    transfer_id,
+                                    constants.FILES_ON_CR)
+                            else:
+                                # TemporaryPath
+                                temp_path_id = job.transfer_mapping[
+                                    ft].temp_path_id
+                                self._database_server.set_temporary_status(
+                                    temp_path_id,
+                                    constants.FILES_ON_CR)
+                        self.read_job_output_dict(job)
+
+                    ended_jobs[job.job_id] = job
+
+                for job in active_jobs:
+                    if job.exit_status is not None:
+                        self._set_job_inactive(job)
 
                 # --- 3. Get back transfered status ---------------------------
-                for transfer_id, transfer in six.iteritems(wf_transfers):
+                for transfer_id, transfer in six.iteritems(
+                        self._transfer_index):
                     try:
                         status = self._database_server.get_transfer_status(
                             transfer_id,
@@ -414,7 +764,7 @@ class WorkflowEngineLoop(object):
                         transfer.status = status
                     except Exception:
                         self.logger.exception('WorkflowEngineLoop')
-                for tmp_id, tmp in six.iteritems(wf_tmp):
+                for tmp_id, tmp in six.iteritems(self._tmp_index):
                     try:
                         status = self._database_server.get_temporary_status(
                             tmp_id,
@@ -446,71 +796,76 @@ class WorkflowEngineLoop(object):
                         self._pend_for_submission(job)
 
                 # --- 5. Check if pending jobs can now be submitted -----------
+                # get back the jobs submitted in the background first: they
+                # leave room in the submission window.
+                drmaa_id_for_db_up = {}
+                max_nb_jobs = None
+                if self._submission_pool is not None:
+                    self._process_submission_results(drmaa_id_for_db_up,
+                                                     drms_error_jobs)
+                    max_nb_jobs = max(0, self._scheduler.submission_window
+                                      - self._submission_pool.in_flight)
                 self.logger.debug("Check pending jobs")
-                jobs_to_run = self._get_pending_job_to_submit()
+                jobs_to_run = self._get_pending_job_to_submit(max_nb_jobs)
                 self.logger.debug("jobs_to_run=" + repr(jobs_to_run))
                 self.logger.debug("len(jobs_to_run)=" + repr(len(jobs_to_run)))
 
                 # --- 6. Submit jobs ------------------------------------------
-                drmaa_id_for_db_up = {}
                 for job in jobs_to_run:
                     # set dynamic paramters from upstream outputs
                     self.update_job_parameters(job)
+                    if self._submission_pool is not None \
+                            and not job.is_engine_execution:
+                        # the result will be processed in a next iteration
+                        token = object()
+                        self._submitting_jobs[job.job_id] = (job, token)
+                        self._submission_pool.submit(job, token)
+                        continue
+                    drmaa_id = None
+                    error = None
                     try:
-                        job.drmaa_id = self._scheduler.job_submission(job)
+                        drmaa_id = self._scheduler.job_submission(job)
                     except DRMError as e:
-                        # Resubmission ?
-                        # if job.queue in self._pending_queues:
-                        #  self._pending_queues[job.queue].insert(0, job)
-                        # else:
-                        #  self._pending_queues[job.queue] = [job]
-                        # job.status = constants.SUBMISSION_PENDING
-                        self.logger.debug(
-                            "job %s !!!ERROR!!! %s: %s" % (repr(job.command),
-                                                           type(e), e))
-                        job.status = constants.FAILED
-                        job.exit_status = constants.EXIT_ABORTED
-                        stderr_file = open(job.stderr_file, "a")
-                        self.logger.debug('Job fail, stderr opened')
-                        stderr_file.write(
-                            "Error while submitting the job %s:\n%s\n"
-                            % (type(e), e))
-                        stderr_file.close()
-                        drms_error_jobs[job.job_id] = job
-                    else:
-                        drmaa_id_for_db_up[job.job_id] = job.drmaa_id
-                        if job.is_engine_execution:
-                            # Engine execution jobs immediately get the status
-                            # DONE to avoid losing one time cycle
-                            job.status = constants.DONE
-                        else:
-                            job.status = constants.UNDETERMINED
+                        error = e
+                    self._job_submitted(job, drmaa_id, error,
+                                        drmaa_id_for_db_up, drms_error_jobs)
 
                 if drmaa_id_for_db_up:
                     self._database_server.set_submission_information(
                         drmaa_id_for_db_up,
                         datetime.now())
 
+                if drms_error_jobs \
+                        or [job for job in jobs_to_run
+                            if job.is_engine_execution]:
+                    # these jobs are already done: process them in the next
+                    # iteration without waiting
+                    self.wake_up()
+
                 # --- 7. Update the workflow and jobs status to the database_server -
                 ended_job_ids = []
                 ended_wf_ids = []
                 self.logger.debug("update job and wf status ~~~~~~~~~~~~~~~ ")
                 job_status_for_db_up = {}
-                for job_id, job in itertools.chain(six.iteritems(self._jobs),
-                                                   six.iteritems(wf_jobs)):
+                # only write the jobs which status has changed
+                for job_id, job in six.iteritems(self._pop_changed_jobs()):
                     job_status_for_db_up[job_id] = job.status
                     self._j_wf_ended = self._j_wf_ended and \
                         (job.status == constants.DONE or
                          job.status == constants.FAILED)
-                    if job_id in self._jobs and \
-                        (job.status == constants.DONE or
-                         job.status == constants.FAILED):
-                        ended_job_ids.append(job_id)
                     self.logger.debug(
                         "job " + repr(job_id) + " " + repr(job.status))
+                for job_id, job in six.iteritems(self._jobs):
+                    if job.status == constants.DONE or \
+                            job.status == constants.FAILED:
+                        ended_job_ids.append(job_id)
 
                 if job_status_for_db_up:
                     self._database_server.set_jobs_status(job_status_for_db_up)
+                self.status_rows_written = len(job_status_for_db_up)
+                self.total_status_rows_written += self.status_rows_written
+                self.logger.debug("job status rows written: %d"
+                                  % self.status_rows_written)
 
                 if len(ended_jobs):
                     self._database_server.set_jobs_exit_info(ended_jobs)
@@ -532,13 +887,97 @@ class WorkflowEngineLoop(object):
 
                 for job_id in ended_job_ids:
                     del self._jobs[job_id]
+                    self._unindex_job(job_id)
                 for wf_id in ended_wf_ids:
+                    self._unindex_workflow(self._workflows[wf_id])
                     del self._workflows[wf_id]
 
+                if ended_jobs and [queue for queue
+                                   in six.itervalues(self._pending_queues)
+                                   if len(queue) != 0]:
+                    # ended jobs may leave room in limited queues
+                    self.wake_up()
+
             # if len(self._workflows) == 0 and one_wf_processed:
             #  break
             self._loop_count += 1
-            time.sleep(time_interval)
+            self._wait_for_events(time_interval)
+
+        if self._submission_pool is not None:
+            self._submission_pool.stop()
+        if isinstance(self._database_server, WriteBehindDatabaseServer):
+            self._database_server.close()
+
+    def _job_submitted(self, job, drmaa_id, error, drmaa_id_for_db_up,
+                       drms_error_jobs):
+        '''
+        Update a job after its submission to the scheduler.
+
+        Parameters
+        ----------
+        job: EngineJob
+        drmaa_id: str
+            scheduler job id, None if the submission failed
+        error: DRMError
+            submission error, None if the submission succeeded
+        drmaa_id_for_db_up: dict
+            job_id -> drmaa_id, updated with the submitted job
+        drms_error_jobs: dict
+            job_id -> EngineJob, updated if the submission failed
+        '''
+        self._job_status_changed(job)
+        if error is not None:
+            # Resubmission ?
+            # if job.queue in self._pending_queues:
+            #  self._pending_queues[job.queue].insert(0, job)
+            # else:
+            #  self._pending_queues[job.queue] = [job]
+            # job.status = constants.SUBMISSION_PENDING
+            self.logger.debug(
+                "job %s !!!ERROR!!! %s: %s" % (repr(job.command),
+                                               type(error), error))
+            job.status = constants.FAILED
+            job.exit_status = constants.EXIT_ABORTED
+            stderr_file = open(job.stderr_file, "a")
+            self.logger.debug('Job fail, stderr opened')
+            stderr_file.write(
+                "Error while submitting the job %s:\n%s\n"
+                % (type(error), error))
+            stderr_file.close()
+            drms_error_jobs[job.job_id] = job
+        else:
+            job.drmaa_id = drmaa_id
+            drmaa_id_for_db_up[job.job_id] = job.drmaa_id
+            self._set_job_active(job)
+            if job.is_engine_execution:
+                # Engine execution jobs immediately get the status
+                # DONE to avoid losing one time cycle
+                job.status = constants.DONE
+            else:
+                job.status = constants.UNDETERMINED
+
+    def _process_submission_results(self, drmaa_id_for_db_up,
+                                    drms_error_jobs):
+        '''
+        Process the jobs submitted by the submission pool since the last call.
+        Jobs which have been stopped in the meantime are killed.
+        '''
+        for job, token, drmaa_id, error \
+                in self._submission_pool.pop_results():
+            submitting = self._submitting_jobs.get(job.job_id)
+            if submitting is None or submitting[1] is not token:
+                if drmaa_id is not None:
+                    self.logger.debug("Kill job " + repr(job.job_id)
+                                      + " stopped during its submission")
+                    try:
+                        self._scheduler.kill_job(drmaa_id)
+                    except DRMError as e:
+                        self.logger.error(
+                            "!!!ERROR!!! %s:%s" % (type(e), e))
+                continue
+            del self._submitting_jobs[job.job_id]
+            self._job_submitted(job, drmaa_id, error, drmaa_id_for_db_up,
+                                drms_error_jobs)
 
     def read_job_output_dict(self, job):
         if job.has_outputs:
@@ -628,6 +1067,7 @@ class WorkflowEngineLoop(object):
     def stop_loop(self):
         with self._lock:
             self._running = False
+        self.wake_up()
 
     def wait_one_loop(self):
         # wait one full loop. The counter is incremented at the end of
@@ -644,6 +1084,7 @@ class WorkflowEngineLoop(object):
             return
         next_count = current_count
         while next_count < current_count + 2:
+            self.wake_up()
             with self._lock:
                 next_count = self._loop_count
             if next_count < current_count + 2:
@@ -653,6 +1094,20 @@ class WorkflowEngineLoop(object):
         with self._lock:
             self._queue_limits = queue_limits
 
+    def set_submission_order(self, submission_order):
+        '''
+        Parameters
+        ----------
+        submission_order: str
+            one of SUBMISSION_ORDERS. Only applies to jobs which get ready
+            after the call.
+        '''
+        if submission_order not in SUBMISSION_ORDERS:
+            raise EngineError("Unknown submission order: %s"
+                              % repr(submission_order))
+        with self._lock:
+            self._submission_order = submission_order
+
     def set_running_jobs_limits(self, running_jobs_limits):
         with self._lock:
             self._running_jobs_limits = running_jobs_limits
@@ -700,6 +1155,8 @@ class WorkflowEngineLoop(object):
         # add to the engine managed job list
         with self._lock:
             self._jobs[engine_job.job_id] = engine_job
+            self._index_job(engine_job)
+        self.wake_up()
 
         return engine_job
 
@@ -710,60 +1167,97 @@ class WorkflowEngineLoop(object):
         first stored in _pending_queues waiting to be submitted.
         '''
         with self._lock:
-            if engine_job.queue in self._pending_queues:
-                self._pending_queues[engine_job.queue].append(engine_job)
-                self._pending_queues[engine_job.queue].sort(
-                    key=lambda job: job.priority,
-                    reverse=True)
-            else:
-                self._pending_queues[engine_job.queue] = [engine_job]
+            pending_queue = self._pending_queues.get(engine_job.queue)
+            if pending_queue is None:
+                pending_queue = PendingJobsQueue()
+                self._pending_queues[engine_job.queue] = pending_queue
+            pending_queue.push(
+                engine_job,
+                pending_job_sort_key(engine_job, self._submission_order))
             engine_job.status = constants.SUBMISSION_PENDING
+            self._job_status_changed(engine_job)
 
-    def _get_pending_job_to_submit(self):
+    def _get_pending_job_to_submit(self, max_nb_jobs=None):
         '''
+        Parameters
+        ----------
+        max_nb_jobs: int or None
+            maximum number of jobs to return (no limit if None)
+
         @rtype: list of EngineJob
         @return: the list of job to be submitted
         '''
         to_run = []
+        # jobs being submitted are not known as queued in the database yet,
+        # they still count in queue limits.
+        nb_submitting_jobs = {}
+        for job, token in six.itervalues(self._submitting_jobs):
+            nb_submitting_jobs[job.queue] \
+                = nb_submitting_jobs.get(job.queue, 0) + 1
         for queue_name, jobs in six.iteritems(self._pending_queues):
+            if max_nb_jobs is not None:
+                nb_allowed_jobs = max_nb_jobs - len(to_run)
+            else:
+                nb_allowed_jobs = len(jobs)
             if jobs and queue_name in self._running_jobs_limits:
                 self.logger.debug("queue " + repr(queue_name) + " is limited: " + repr(
                     self._running_jobs_limits[queue_name]))
                 nb_running_jobs = self._database_server.nb_running_jobs(
                     self._user_id,
-                    queue_name)
+                    queue_name) + nb_submitting_jobs.get(queue_name, 0)
                 nb_jobs_to_run = self._running_jobs_limits[
                     queue_name] - nb_running_jobs
                 # limit also queue length
                 if queue_name in self._queue_limits:
                     nb_jobs_to_run = min(nb_jobs_to_run,
                                          self._queue_limits[queue_name])
+                nb_jobs_to_run = min(nb_jobs_to_run, nb_allowed_jobs)
                 self.logger.debug("queue " + repr(queue_name)
                                   + " nb_running_jobs "
                                   + repr(nb_running_jobs) + " nb_jobs_to_run "
                                   + repr(nb_jobs_to_run))
                 while nb_jobs_to_run > 0 and \
                         len(self._pending_queues[queue_name]) > 0:
-                    to_run.append(self._pending_queues[queue_name].pop(0))
+                    to_run.append(self._pending_queues[queue_name].pop())
                     nb_jobs_to_run = nb_jobs_to_run - 1
             elif jobs and queue_name in self._queue_limits:
                 nb_queued_jobs = self._database_server.nb_queued_jobs(
                     self._user_id,
-                    queue_name)
+                    queue_name) + nb_submitting_jobs.get(queue_name, 0)
                 nb_jobs_to_run = self._queue_limits[
                     queue_name] - nb_queued_jobs
+                nb_jobs_to_run = min(nb_jobs_to_run, nb_allowed_jobs)
                 self.logger.debug("queue " + repr(queue_name) + " nb_queued_jobs " + repr(
                     nb_queued_jobs) + " nb_jobs_to_run " + repr(nb_jobs_to_run))
                 while nb_jobs_to_run > 0 and \
                         len(self._pending_queues[queue_name]) > 0:
-                    to_run.append(self._pending_queues[queue_name].pop(0))
+                    to_run.append(self._pending_queues[queue_name].pop())
                     nb_jobs_to_run = nb_jobs_to_run - 1
             else:
-                to_run.extend(jobs)
-                self._pending_queues[queue_name] = []
+                while nb_allowed_jobs > 0 and len(jobs) > 0:
+                    to_run.append(jobs.pop())
+                    nb_allowed_jobs -= 1
         # self.logger.debug("to_run " + repr(to_run))
         return to_run
 
+    def _compute_critical_paths(self, engine_workflow):
+        '''
+        Compute the critical paths of a workflow jobs, using their
+        duration hints or the durations of former jobs with the same names.
+        '''
+        names = set([job.name
+                     for job in six.itervalues(engine_workflow.job_mapping)
+                     if job.duration_hint is None])
+        durations = {}
+        if names:
+            try:
+                durations = self._database_server.get_jobs_mean_duration(
+                    self._user_id, names)
+            except Exception as e:
+                self.logger.error("could not get former jobs durations: %s"
+                                  % repr(e))
+        engine_workflow.compute_critical_paths(durations)
+
     def add_workflow(self, client_workflow, expiration_date, name, queue,
                      container_command=None):
         '''
@@ -783,6 +1277,8 @@ class WorkflowEngineLoop(object):
                                          expiration_date,
                                          name,
                                          container_command=container_command)
+        if self._submission_order == 'critical_path':
+            self._compute_critical_paths(engine_workflow)
 
         engine_workflow = self._database_server.add_workflow(
             self._user_id, engine_workflow, login=self._user_login)
@@ -836,6 +1332,8 @@ class WorkflowEngineLoop(object):
         # add to the engine managed workflow list
         with self._lock:
             self._workflows[engine_workflow.wf_id] = engine_workflow
+            self._index_workflow(engine_workflow)
+        self.wake_up()
 
         return engine_workflow.wf_id
 
@@ -855,6 +1353,10 @@ class WorkflowEngineLoop(object):
                 elif job.queue in self._pending_queues and \
                         job in self._pending_queues[job.queue]:
                     self._pending_queues[job.queue].remove(job)
+                elif self._submitting_jobs.pop(job_id, None) is not None:
+                    # it will be killed as soon as its submission completes
+                    self.logger.debug("Stop job " + repr(job_id)
+                                      + " during its submission")
                 if job.status in (
                     constants.RUNNING, constants.SYSTEM_SUSPENDED,
                     constants.USER_SUSPENDED,
@@ -868,6 +1370,13 @@ class WorkflowEngineLoop(object):
                 job.exit_value = None
                 job.terminating_signal = None
                 job.str_rusage = None
+                self._set_job_inactive(job)
+                self._job_status_changed(job)
+                workflow = self._workflows.get(job.workflow_id)
+                if workflow is not None:
+                    # the job may not have been ready: the workflow
+                    # readiness cache does not know about it.
+                    workflow.cache = None
 
                 return True
 
@@ -892,6 +1401,7 @@ class WorkflowEngineLoop(object):
                 (jobs_to_run, status) \
                     = workflow.restart(self._database_server, queue)
                 workflow.status = status
+                self._index_workflow(workflow)
                 for job in jobs_to_run:
                     self._pend_for_submission(job)
             else:
@@ -905,6 +1415,8 @@ class WorkflowEngineLoop(object):
                 # add to the engine managed workflow list
                 with self._lock:
                     self._workflows[wf_id] = workflow
+                    self._index_workflow(workflow)
+            self.wake_up()
             return status
 
     def force_stop(self, wf_id):
@@ -916,6 +1428,8 @@ class WorkflowEngineLoop(object):
             workflow.force_stop(self._database_server)
             with self._lock:
                 self._workflows[wf_id] = workflow
+                self._index_workflow(workflow)
+            self.wake_up()
 
     def restart_job(self, job_id, status):
         (job, workflow_id) = self._database_server.get_engine_job(
@@ -927,6 +1441,8 @@ class WorkflowEngineLoop(object):
             # add to the engine managed job list
             with self._lock:
                 self._jobs[job.job_id] = job
+                self._index_job(job)
+            self.wake_up()
         else:
             self._database_server.set_job_status(
                 job_id, constants.NOT_SUBMITTED)
@@ -939,6 +1455,7 @@ class WorkflowEngineLoop(object):
         if status != constants.WORKFLOW_DONE:
             self._database_server.set_jobs_status(
                 dict([(job_id, constants.KILL_PENDING) for job_id in job_ids]))
+            self.wake_up()
 
     def restart_jobs(self, wf_id, job_ids):
         with self._lock:
@@ -955,16 +1472,15 @@ class WorkflowEngineLoop(object):
         with self._lock:
             jobs_to_run = workflow.restart_jobs(
                 self._database_server, extended_job_ids, check_deps=False)
+            self._index_workflow(workflow)
             print('can re-run immediately:', [j.job_id for j in jobs_to_run])
             for job in jobs_to_run:
                 self._pend_for_submission(job)
+        self.wake_up()
 
     def drms_job_id(self, wf_id, job_id):
-        engine_wf = self._workflows.get(wf_id)
-        if engine_wf is None:
-            return None
-        engine_job = engine_wf.registered_jobs.get(job_id)
-        if engine_job is None:
+        engine_job = self._job_index.get(job_id)
+        if engine_job is None or engine_job.workflow_id != wf_id:
             return None
         return engine_job.drmaa_id
 
@@ -1090,6 +1606,7 @@ class WorkflowEngine(RemoteFileController):
         if workflow_id != -1:
             self._database_server.add_workflow_ended_transfer(
                 workflow_id, transfer_id)
+            self.engine_loop.wake_up()
 
     # JOB SUBMISSION ##################################################
     def submit_job(self, job, queue):
@@ -1116,6 +1633,7 @@ class WorkflowEngine(RemoteFileController):
         else:
             self._database_server.set_job_status(
                 job_id, constants.DELETE_PENDING)
+            self.engine_loop.wake_up()
             if force and not self._wait_for_job_deletion(job_id):
                 self.logger.critical(
                     "!! The job may not be properly deleted !!")
@@ -1173,6 +1691,7 @@ class WorkflowEngine(RemoteFileController):
 
             self._database_server.set_workflow_status(workflow_id,
                                                       constants.DELETE_PENDING)
+            self.engine_loop.wake_up()
             if force and not self._wait_for_wf_deletion(workflow_id):
                 self.logger.critical(
                     "The workflow may not be properly deleted.")
@@ -1192,6 +1711,7 @@ class WorkflowEngine(RemoteFileController):
             else:
                 self._database_server.set_workflow_status(
                     workflow_id, constants.KILL_PENDING)
+                self.engine_loop.wake_up()
                 self._wait_wf_status_update(
                     workflow_id, expected_status=constants.WORKFLOW_DONE)
 
@@ -1353,6 +1873,34 @@ class WorkflowEngine(RemoteFileController):
 
         return wf_status
 
+    def workflow_elements_status_changes(self, wf_id, since_revision=None,
+                                         with_drms_id=True):
+        '''
+        Implementation of soma_workflow.client.WorkflowController API
+
+        Parameters
+        ----------
+        wf_id: int
+            workflow id
+        since_revision: int or None
+            status revision returned by a previous call
+        with_drms_id: bool (optional, default=True)
+            see workflow_elements_status()
+        '''
+        (status,
+         last_status_update) = self._database_server.get_workflow_status(
+            wf_id, self._user_id)
+
+        (revision, full,
+         wf_status) = self._database_server.get_workflow_status_changes(
+            wf_id, since_revision, with_drms_id=with_drms_id)
+        if status and \
+                status != constants.WORKFLOW_DONE and \
+                _out_to_date(last_status_update):
+            wf_status = wf_status[:2] + (constants.WARNING, ) + wf_status[3:]
+
+        return (revision, full, wf_status)
+
     def transfer_status(self, transfer_id):
         '''
         Implementation of soma_workflow.client.WorkflowController API
@@ -1388,6 +1936,8 @@ class WorkflowEngine(RemoteFileController):
         waitForever = timeout < 0
         startTime = datetime.now()
         for jid in job_ids:
+            # status changes are notified by the status events journal
+            event_id = self._database_server.get_status_events()[0]
             (status,
              last_status_update) = self._database_server.get_job_status(jid,
                                                                         self._user_id)
@@ -1395,7 +1945,9 @@ class WorkflowEngine(RemoteFileController):
                 self.logger.debug("wait        job %s status: %s", jid, status)
                 delta = datetime.now() - startTime
                 while status and not status == constants.DONE and not status == constants.FAILED and (waitForever or delta < timedelta(seconds=timeout)):
-                    time.sleep(refreshment_interval)
+                    event_id = self._wait_status_events(
+                        event_id, startTime, timeout, element_type='job',
+                        element_ids=[jid])
                     (status, last_status_update) = self._database_server.get_job_status(
                         jid, self._user_id)
                     self.logger.debug("wait        job %s status: %s last update %s,"
@@ -1417,6 +1969,7 @@ class WorkflowEngine(RemoteFileController):
 
         waitForever = timeout < 0
         startTime = datetime.now()
+        event_id = self._database_server.get_status_events()[0]
         (status,
          last_status_update) = self._database_server.get_workflow_status(
              workflow_id, self._user_id)
@@ -1429,7 +1982,9 @@ class WorkflowEngine(RemoteFileController):
             delta = datetime.now() - startTime
             while status and not status == constants.WORKFLOW_DONE \
                     and (waitForever or delta < timedelta(seconds=timeout)):
-                time.sleep(refreshment_interval)
+                event_id = self._wait_status_events(
+                    event_id, startTime, timeout, element_type='workflow',
+                    element_ids=[workflow_id])
                 (status, last_status_update) \
                     = self._database_server.get_workflow_status(
                         workflow_id, self._user_id)
@@ -1453,6 +2008,34 @@ class WorkflowEngine(RemoteFileController):
                            initial_status, repr(initial_date), count))
                 count += 1
 
+    def wait_status_events(self, workflow_id, since_event_id=None,
+                           timeout=-1):
+        '''
+        Implementation of soma_workflow.client.WorkflowController API
+        '''
+        # raises UnknownObjectError if the workflow is not valid
+        self._database_server.get_workflow_status(workflow_id, self._user_id)
+        if timeout < 0:
+            timeout = None
+        return self._database_server.wait_status_events(
+            since_event_id, workflow_id=workflow_id, timeout=timeout)
+
+    def _wait_status_events(self, event_id, start_time, timeout, **kwargs):
+        '''
+        Wait for the status events following event_id which match kwargs
+        (see WorkflowDatabaseServer.wait_status_events()), at most
+        refreshment_interval seconds, so that the status update dates can be
+        checked, and within the timeout counted from start_time (no limit if
+        timeout is negative). Returns the id of the last event.
+        '''
+        wait = refreshment_interval
+        if timeout >= 0:
+            remaining = timedelta(seconds=timeout) \
+                - (datetime.now() - start_time)
+            wait = max(0., min(wait, remaining.total_seconds()))
+        return self._database_server.wait_status_events(
+            event_id, timeout=wait, **kwargs)[0]
+
     def restart_job(self, job_id):
         '''
         Implementation of soma_workflow.client.WorkflowController API
@@ -1484,23 +2067,28 @@ class WorkflowEngine(RemoteFileController):
             else:
                 self._database_server.set_job_status(job_id,
                                                      constants.KILL_PENDING)
+                self.engine_loop.wake_up()
 
             self._wait_job_status_update(job_id)
 
     def _wait_job_status_update(self, job_id):
-        return self._wait_jobs_status_update([job_ids])
+        return self._wait_jobs_status_update([job_id])
 
     def _wait_jobs_status_update(self, job_ids,
                                  statuses=(constants.DONE, constants.FAILED)):
         self.logger.debug(">> _wait_jobs_status_update")
+        start_time = datetime.now()
         try:
+            event_id = self._database_server.get_status_events()[0]
             status_date = self._database_server.get_jobs_status(
                 job_ids, self._user_id)
             while not all([not status
                            or status in statuses
                            or _out_to_date(last_status_update)
                            for status, last_status_update in status_date]):
-                time.sleep(refreshment_interval)
+                event_id = self._wait_status_events(
+                    event_id, start_time, -1, element_type='job',
+                    element_ids=job_ids)
                 status_date = self._database_server.get_jobs_status(
                     job_ids, self._user_id)
         except UnknownObjectError as e:
@@ -1509,11 +2097,15 @@ class WorkflowEngine(RemoteFileController):
 
     def _wait_for_job_deletion(self, job_id):
         self.logger.debug(">> _wait_for_job_deletion")
+        start_time = datetime.now()
+        event_id = self._database_server.get_status_events()[0]
         (is_valid_job,
          last_status_update) = self._database_server.is_valid_job(job_id,
                                                                   self._user_id)
         while is_valid_job and not _out_to_date(last_status_update):
-            time.sleep(refreshment_interval)
+            event_id = self._wait_status_events(
+                event_id, start_time, -1, element_type='job',
+                element_ids=[job_id])
             (is_valid_job,
              last_status_update) = self._database_server.is_valid_job(job_id,
                                                                       self._user_id)
@@ -1523,41 +2115,49 @@ class WorkflowEngine(RemoteFileController):
         return True
 
     def _wait_wf_status_update(self, wf_id, expected_status):
+        '''
+        Wait until the workflow gets the expected status. A done workflow
+        only stops the wait once its status has changed, or after two
+        refreshment intervals: the engine loop may not have processed the
+        request yet.
+        '''
         self.logger.debug(">> _wait_wf_status_update")
+        start_time = datetime.now()
+        settle_time = timedelta(seconds=2 * refreshment_interval)
         try:
+            event_id = self._database_server.get_status_events()[0]
             (status,
              last_status_update) = self._database_server.get_workflow_status(wf_id,
                                                                              self._user_id)
-            if status != None and status != expected_status:
-                time.sleep(refreshment_interval)
+            initial_status = status
+            while status != None and status != expected_status:
+                if status != initial_status \
+                        or datetime.now() - start_time >= settle_time:
+                    if status == constants.WORKFLOW_DONE \
+                            or _out_to_date(last_status_update):
+                        break
+                event_id = self._wait_status_events(
+                    event_id, start_time, -1, element_type='workflow',
+                    element_ids=[wf_id])
                 (status,
                  last_status_update) = self._database_server.get_workflow_status(wf_id,
                                                                                  self._user_id)
-                if status != None and status != expected_status:
-                    time.sleep(refreshment_interval)
-                    (status,
-                     last_status_update) = self._database_server.get_workflow_status(wf_id,
-                                                                                     self._user_id)
-                    while status != None and \
-                        status != expected_status and \
-                        status != constants.WORKFLOW_DONE and \
-                            not _out_to_date(last_status_update):
-                        time.sleep(refreshment_interval)
-                        (status,
-                         last_status_update) = self._database_server.get_workflow_status(wf_id,
-                                                                                         self._user_id)
         except UnknownObjectError as e:
             pass
         self.logger.debug("<< _wait_wf_status_update")
 
     def _wait_for_wf_deletion(self, wf_id):
         self.logger.debug(">> _wait_for_wf_deletion")
+        start_time = datetime.now()
+        event_id = self._database_server.get_status_events()[0]
         (is_valid_wf,
          last_status_update) = self._database_server.is_valid_workflow(wf_id,
                                                                        self._user_id)
         while is_valid_wf and \
                 not _out_to_date(last_status_update):
-            time.sleep(refreshment_interval)
+            event_id = self._wait_status_events(
+                event_id, start_time, -1, element_type='workflow',
+                element_ids=[wf_id])
             (is_valid_wf,
              last_status_update) = self._database_server.is_valid_workflow(wf_id,
                                                                            self._user_id)
@@ -1585,6 +2185,18 @@ class ConfiguredWorkflowEngine(WorkflowEngine):
         '''
         * config *configuration.Configuration*
         '''
+        # submission settings have to be known before the engine loop is
+        # built
+        submission_workers = config.get_submission_workers()
+        if submission_workers is not None:
+            scheduler.submission_workers = submission_workers
+        submission_window = config.get_submission_window()
+        if submission_window is not None:
+            scheduler.submission_window = submission_window
+        flush_interval = config.get_database_flush_interval()
+        if flush_interval > 0:
+            database_server = WriteBehindDatabaseServer(database_server,
+                                                        flush_interval)
         super(ConfiguredWorkflowEngine, self).__init__(
             database_server,
             scheduler,
@@ -1592,6 +2204,9 @@ class ConfiguredWorkflowEngine(WorkflowEngine):
             queue_limits=config.get_queue_limits(),
             running_jobs_limits=config.get_running_jobs_limits(),
             container_command=config.get_container_command())
+        submission_order = config.get_submission_order()
+        if submission_order is not None:
+            self.engine_loop.set_submission_order(submission_order)
 
         self.config = config
 
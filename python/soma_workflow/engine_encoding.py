@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+'''
+Compact encoding of the engine objects (:obj:`EngineWorkflow` and
+:obj:`EngineJob`) stored in the database.
+
+The encoding replaces the pickles formerly stored in the
+``workflows.pickled_engine_workflow`` and ``jobs.pickled_engine_job``
+columns. It does not depend on the python version, and can be decoded
+partially: a single job of a workflow, or a single workflow attribute, can
+be read without decoding the rest.
+
+Format (version 1)::
+
+    HEADER zlib(line \\n line \\n ...)
+
+Each line is a JSON document (JSON never contains raw newlines):
+
+* main line: ``{"jobs": [job_id, ...], "fields": [name, ...]}``, the jobs
+  and the workflow attributes stored in the following lines. For a single
+  job, there is no workflow attribute.
+* one line per workflow attribute, in the order of "fields".
+* the jobs, in the order of "jobs", by blocks of JOBS_PER_LINE jobs per
+  line (a JSON list). Each job is ``{"class", "state"}`` for the engine
+  job, and for workflow jobs ``"client": {"class", "same", "state"}``: the
+  client job attributes which differ from the engine job ones, and the
+  names of the attributes which are the same.
+* one line per shared object (file transfers and other special paths,
+  groups...): ``module.Class {state}``.
+
+Objects states are their ``__getstate__()`` / ``__dict__`` values. Values
+which are not plain JSON values are tagged using single key dicts::
+
+    {"<t>": [...]}          tuple
+    {"<s>": [...]}          set
+    {"<d>": [[k, v], ...]}  dict which keys are not all strings
+    {"<dt>": [y, m, d, H, M, S, us]}  datetime
+    {"<date>": [y, m, d]}   date
+    {"<c>": "module.Class"} class
+    {"<o>": index}          shared object
+    {"<j>": job_id}         client job
+    {"<e>": job_id}         engine job
+    {"<w>": name}           workflow attribute, shared by a job
+'''
+
+from __future__ import absolute_import
+
+import datetime
+import importlib
+import json
+import zlib
+
+import six
+
+from soma_workflow.client_types import Job, Workflow, Group, SpecialPath
+
+
+ENCODING_VERSION = 1
+
+_HEADER_PREFIX = b'soma-workflow-encoding:'
+_HEADER = _HEADER_PREFIX + str(ENCODING_VERSION).encode('ascii') + b'\n'
+
+# jobs are decoded by blocks of JOBS_PER_LINE jobs
+JOBS_PER_LINE = 64
+
+# classes which instances can be encoded (as well as their subclasses)
+_object_classes = (Job, SpecialPath, Group, Workflow)
+
+_plain_types = frozenset((bool, float, type(None)) + six.integer_types
+                         + six.string_types)
+
+# workflow attributes which are caches built at runtime, stored as None
+_workflow_runtime_attributes = ('cache', '_graph', '_changed_jobs')
+
+# workflow attributes rebuilt from the jobs when the workflow is decoded
+_workflow_jobs_attributes = ('job_mapping', 'registered_jobs')
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+# module.Class -> class, and class -> module.Class
+_classes = {}
+_class_names = {}
+
+
+def is_encoded(data):
+    '''
+    Tells whether data (read from the database) uses the compact encoding,
+    or is a legacy pickle.
+    '''
+    return data is not None \
+        and bytes(data[:len(_HEADER_PREFIX)]) == _HEADER_PREFIX
+
+
+def encode_engine_workflow(engine_workflow, compress_level=1):
+    '''
+    Encode a registered EngineWorkflow (its jobs have their job_id).
+
+    Raises
+    ------
+    TypeError
+        if the workflow holds values which cannot be encoded (user objects
+        in user_storage or in jobs parameters for instance)
+    '''
+    engine_jobs = list(six.itervalues(engine_workflow.job_mapping))
+    state = dict(_get_state(engine_workflow))
+    for attribute in _workflow_runtime_attributes:
+        if attribute in state:
+            state[attribute] = None
+    for attribute in _workflow_jobs_attributes:
+        state.pop(attribute, None)
+    encoder = _Encoder(engine_workflow.job_mapping)
+    fields = list(state.keys())
+    main = {'jobs': [job.job_id for job in engine_jobs],
+            'fields': fields,
+            'class': _class_name(type(engine_workflow))}
+    field_lines = [_dumps(encoder.encode(state[name])) for name in fields]
+    # containers shared by the workflow and its jobs (transfer_mapping,
+    # path_translation...) are stored once
+    shared = dict((id(value), name) for name, value in six.iteritems(state)
+                  if isinstance(value, (dict, list)))
+    job_lines = [[encoder.encode_job(job, shared)
+                  for job in engine_jobs[i:i + JOBS_PER_LINE]]
+                 for i in range(0, len(engine_jobs), JOBS_PER_LINE)]
+    return _pack([main] + field_lines + job_lines + encoder.objects,
+                  compress_level)
+
+
+def encode_engine_job(engine_job, compress_level=1):
+    '''
+    Encode an EngineJob which does not belong to a workflow.
+
+    Raises
+    ------
+    TypeError
+        if the job holds values which cannot be encoded
+    '''
+    encoder = _Encoder({})
+    main = {'jobs': [engine_job.job_id], 'fields': []}
+    job_line = [encoder.encode_job(engine_job, {})]
+    return _pack([main, job_line] + encoder.objects, compress_level)
+
+
+def encode_value(value):
+    '''
+    Encode a plain value (numbers, strings, and lists, tuples or dicts of
+    them), such as a parameters link function.
+
+    Raises
+    ------
+    TypeError
+        if value cannot be encoded
+    '''
+    encoder = _Encoder({})
+    value = encoder.encode(value)
+    if encoder.objects:
+        raise TypeError('objects cannot be encoded as plain values')
+    return _pack([{'jobs': [], 'fields': ['value']}, value], 0)
+
+
+def decode_engine_workflow(data):
+    '''
+    Decode a whole EngineWorkflow encoded by encode_engine_workflow()
+    '''
+    return EncodedData(data).engine_workflow()
+
+
+def decode_engine_job(data, job_id=None):
+    '''
+    Decode a single EngineJob, from an encoded job or workflow. Only the
+    job, and the objects and workflow attributes it uses, are decoded.
+    '''
+    return EncodedData(data).engine_job(job_id)
+
+
+def decode_value(data):
+    '''
+    Decode a value encoded by encode_value()
+    '''
+    return EncodedData(data).value()
+
+
+class EncodedData(object):
+
+    '''
+    Lazy decoder of encoded data: jobs, objects and workflow attributes are
+    decoded on demand, and only once.
+    '''
+
+    def __init__(self, data):
+        data = bytes(data)
+        if not is_encoded(data):
+            raise ValueError('The data is not in the soma-workflow encoding')
+        header_end = data.index(b'\n') + 1
+        version = int(data[len(_HEADER_PREFIX):header_end - 1])
+        if version > ENCODING_VERSION:
+            raise ValueError('Unsupported encoding version %d (the maximum '
+                             'supported version is %d)'
+                             % (version, ENCODING_VERSION))
+        body = data[header_end:]
+        if body[:1] != b'{':
+            body = zlib.decompress(body)
+        self._lines = body.split(b'\n')
+        self._main = json.loads(self._lines[0].decode('ascii'))
+        fields = self._main['fields']
+        job_ids = self._main['jobs']
+        self._field_lines = dict((name, i + 1)
+                                 for i, name in enumerate(fields))
+        # job_id -> index in the jobs list
+        self._job_indices = dict((job_id, i)
+                                 for i, job_id in enumerate(job_ids))
+        self._jobs_start = 1 + len(fields)
+        self._objects_start = self._jobs_start \
+            + (len(job_ids) + JOBS_PER_LINE - 1) // JOBS_PER_LINE
+        self._fields = {}
+        self._objects = {}
+        self._engine_jobs = {}
+        self._client_jobs = {}
+        self._decoder = json.JSONDecoder(object_hook=self._decode_tagged)
+
+    def job_ids(self):
+        return list(self._main['jobs'])
+
+    def value(self):
+        return self.workflow_field('value')
+
+    def workflow_field(self, name):
+        '''
+        Decoded value of a workflow attribute
+        '''
+        if name not in self._fields:
+            if name not in self._field_lines:
+                raise KeyError('%s is not a workflow attribute' % name)
+            self._fields[name] = self._loads(self._field_lines[name])
+        return self._fields[name]
+
+    def engine_workflow(self):
+        workflow = _new_object(self._main['class'])
+        # all the jobs are parsed first, at once
+        self._decode_jobs(self._main['jobs'])
+        state = dict((name, self.workflow_field(name))
+                     for name in self._main['fields'])
+        job_mapping = {}
+        registered_jobs = {}
+        for job_id in self._main['jobs']:
+            engine_job = self.engine_job(job_id)
+            job_mapping[self.client_job(job_id)] = engine_job
+            registered_jobs[job_id] = engine_job
+        state['job_mapping'] = job_mapping
+        state['registered_jobs'] = registered_jobs
+        _set_state(workflow, state)
+        return workflow
+
+    def engine_job(self, job_id=None):
+        if job_id is None:
+            job_id = self._main['jobs'][0]
+        if job_id not in self._engine_jobs:
+            self._decode_jobs([job_id])
+        return self._engine_jobs[job_id]
+
+    def client_job(self, job_id):
+        if job_id not in self._engine_jobs:
+            self._decode_jobs([job_id])
+        return self._client_jobs[job_id]
+
+    def _decode_jobs(self, job_ids):
+        '''
+        Decode the given jobs, and the other jobs of their lines
+        '''
+        blocks = []
+        for job_id in job_ids:
+            if job_id not in self._job_indices:
+                raise KeyError('job %s is not in the encoded data' % job_id)
+            block = self._job_indices[job_id] // JOBS_PER_LINE
+            if job_id not in self._engine_jobs \
+                    and (not blocks or blocks[-1] != block):
+                blocks.append(block)
+        if not blocks:
+            return
+        # parsed at once, as a JSON list
+        lines = [self._lines[self._jobs_start + block] for block in blocks]
+        jobs_data = self._decoder.decode(
+            (b'[' + b','.join(lines) + b']').decode('ascii'))
+        job_ids = self._main['jobs']
+        for block, block_data in zip(blocks, jobs_data):
+            start = block * JOBS_PER_LINE
+            self._set_jobs(job_ids[start:start + len(block_data)],
+                           block_data)
+
+    def _set_jobs(self, job_ids, jobs_data):
+        for job_id, job_data in zip(job_ids, jobs_data):
+            if job_id in self._engine_jobs:
+                # already decoded while parsing, as referenced by another
+                # job
+                continue
+            state = job_data['state']
+            engine_job = _new_object(job_data['class'])
+            _set_state(engine_job, state)
+            self._engine_jobs[job_id] = engine_job
+            client_data = job_data.get('client')
+            if client_data is not None:
+                client_job = _new_object(client_data['class'])
+                client_state = dict((name, state[name])
+                                    for name in client_data['same'])
+                client_state.update(client_data['state'])
+                _set_state(client_job, client_state)
+                self._client_jobs[job_id] = client_job
+
+    def _object(self, index):
+        obj = self._objects.get(index)
+        if obj is None:
+            line = self._lines[self._objects_start + index]
+            class_name, state = line.split(b' ', 1)
+            obj = _new_object(class_name.decode('ascii'))
+            # registered before its state is decoded, for cyclic references
+            self._objects[index] = obj
+            _set_state(obj, self._decoder.decode(state.decode('ascii')))
+        return obj
+
+    def _loads(self, line_index):
+        return self._decoder.decode(self._lines[line_index].decode('ascii'))
+
+    def _decode_tagged(self, value):
+        if len(value) != 1:
+            return value
+        tag = next(iter(value))
+        if tag[:1] != '<':
+            return value
+        item = value[tag]
+        if tag == '<o>':
+            return self._object(item)
+        if tag == '<j>':
+            return self.client_job(item)
+        if tag == '<e>':
+            return self.engine_job(item)
+        if tag == '<w>':
+            return self.workflow_field(item)
+        if tag == '<t>':
+            return tuple(item)
+        if tag == '<d>':
+            return dict((key, element) for key, element in item)
+        if tag == '<s>':
+            return set(item)
+        if tag == '<dt>':
+            return datetime.datetime(*item)
+        if tag == '<date>':
+            return datetime.date(*item)
+        if tag == '<c>':
+            return _import_class(item)
+        raise ValueError('Unknown encoded value tag: %s' % tag)
+
+
+class _Encoder(object):
+
+    def __init__(self, job_mapping):
+        # encoded lines of the shared objects
+        self.objects = []
+        self._object_indices = {}
+        # keep the encoded objects alive, so that their id is not reused
+        self._encoded = []
+        self._client_jobs = {}
+        self._engine_jobs = {}
+        self._job_clients = {}
+        for client_job, engine_job in six.iteritems(job_mapping):
+            self._client_jobs[id(client_job)] = engine_job.job_id
+            self._engine_jobs[id(engine_job)] = engine_job.job_id
+            self._job_clients[id(engine_job)] = client_job
+
+    def encode_job(self, engine_job, shared):
+        engine_state = _get_state(engine_job)
+        state = {}
+        for name, value in six.iteritems(engine_state):
+            if type(value) in _plain_types:
+                state[name] = value
+            elif id(value) in shared:
+                state[name] = {'<w>': shared[id(value)]}
+            else:
+                state[name] = self.encode(value)
+        job_data = {'class': _class_name(type(engine_job)), 'state': state}
+        client_job = self._job_clients.get(id(engine_job))
+        if client_job is not None:
+            same = []
+            client_state = {}
+            engine_value = engine_state.get
+            for name, value in six.iteritems(_get_state(client_job)):
+                if engine_value(name, same) is value:
+                    same.append(name)
+                else:
+                    value = self.encode(value)
+                    if state.get(name, same) == value:
+                        same.append(name)
+                    else:
+                        client_state[name] = value
+            job_data['client'] = {'class': _class_name(type(client_job)),
+                                  'same': same,
+                                  'state': client_state}
+        return job_data
+
+    def encode(self, value):
+        value_type = type(value)
+        if value_type in _plain_types:
+            return value
+        if value_type is list:
+            for item in value:
+                if type(item) not in _plain_types:
+                    return [self.encode(item) for item in value]
+            # plain values are serialized as they are
+            return value
+        if value_type is dict and not value:
+            return value
+        if value_type is type:
+            return {'<c>': _class_name(value)}
+        if isinstance(value, dict):
+            if all(isinstance(key, six.string_types) and key[:1] != '<'
+                   for key in value):
+                return dict((key, self.encode(item))
+                            for key, item in six.iteritems(value))
+            return {'<d>': [[self.encode(key), self.encode(item)]
+                            for key, item in six.iteritems(value)]}
+        if isinstance(value, tuple):
+            return {'<t>': [self.encode(item) for item in value]}
+        if isinstance(value, (set, frozenset)):
+            return {'<s>': [self.encode(item) for item in value]}
+        if isinstance(value, datetime.datetime):
+            return {'<dt>': [value.year, value.month, value.day, value.hour,
+                             value.minute, value.second,
+                             value.microsecond]}
+        if isinstance(value, datetime.date):
+            return {'<date>': [value.year, value.month, value.day]}
+        if isinstance(value, type):
+            return {'<c>': _class_name(value)}
+        if id(value) in self._engine_jobs:
+            return {'<e>': self._engine_jobs[id(value)]}
+        if id(value) in self._client_jobs:
+            return {'<j>': self._client_jobs[id(value)]}
+        if isinstance(value, _object_classes):
+            return {'<o>': self._object_index(value)}
+        if isinstance(value, six.string_types):
+            return six.text_type(value)
+        raise TypeError('%s objects cannot be encoded'
+                        % type(value).__name__)
+
+    def _object_index(self, obj):
+        index = self._object_indices.get(id(obj))
+        if index is None:
+            index = len(self.objects)
+            self._object_indices[id(obj)] = index
+            self._encoded.append(obj)
+            self.objects.append(None)
+            state = dict((name, self.encode(value))
+                         for name, value in six.iteritems(_get_state(obj)))
+            self.objects[index] = _class_name(type(obj)).encode('ascii') \
+                + b' ' + _dumps(state)
+        return index
+
+
+def _get_state(obj):
+    getstate = getattr(obj, '__getstate__', None)
+    state = None
+    if getstate is not None:
+        state = getstate()
+    if state is None:
+        state = obj.__dict__
+    return state
+
+
+def _set_state(obj, state):
+    setstate = getattr(obj, '__setstate__', None)
+    if setstate is not None:
+        setstate(state)
+    else:
+        obj.__dict__.update(state)
+
+
+def _class_name(cls):
+    name = _class_names.get(cls)
+    if name is None:
+        name = '%s.%s' % (cls.__module__, getattr(cls, '__qualname__',
+                                                  cls.__name__))
+        _class_names[cls] = name
+    return name
+
+
+def _import_class(name):
+    cls = _classes.get(name)
+    if cls is None:
+        module_name, class_name = name.rsplit('.', 1)
+        # nested classes
+        while True:
+            try:
+                module = importlib.import_module(module_name)
+                break
+            except ImportError:
+                if '.' not in module_name:
+                    raise
+                module_name, parent = module_name.rsplit('.', 1)
+                class_name = parent + '.' + class_name
+        cls = module
+        for part in class_name.split('.'):
+            cls = getattr(cls, part)
+        _classes[name] = cls
+    return cls
+
+
+def _new_object(class_name):
+    cls = _import_class(class_name)
+    if not isinstance(cls, type) or not issubclass(cls, _object_classes):
+        raise ValueError('%s objects cannot be decoded' % class_name)
+    return cls.__new__(cls)
+
+
+def _dumps(value):
+    return _json_encoder.encode(value).encode('ascii')
+
+
+def _pack(lines, compress_level):
+    body = b'\n'.join(line if isinstance(line, bytes) else _dumps(line)
+                      for line in lines)
+    if compress_level:
+        body = zlib.compress(body, compress_level)
+    return _HEADER + body
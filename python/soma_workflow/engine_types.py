@@ -23,6 +23,8 @@ uses on the client side (in the GUI for example) without importing
 module required in the engine module.
 '''
 
+import array
+import collections
 import io
 import os
 import logging
@@ -128,6 +130,15 @@ class EngineJob(Job):
     # job class
     job_class = None
 
+    # True for jobs which are executed by the engine itself, see
+    # EngineExecutionJob
+    is_engine_execution = False
+
+    # expected duration of the job plus the longest expected duration of the
+    # chains of jobs depending on it (float), see
+    # EngineWorkflow.compute_critical_paths()
+    critical_path = None
+
     def __init__(self,
                  client_job,
                  queue,
@@ -157,31 +168,33 @@ class EngineJob(Job):
             has_outputs=client_job.has_outputs,
             input_params_file=client_job.input_params_file,
             output_params_file=client_job.output_params_file,
-            configuration=client_job.configuration)
+            configuration=client_job.configuration,
+            duration_hint=client_job.duration_hint,
+            memory=client_job.memory,
+            python_job=client_job.python_job)
 
         self.job_id = -1
 
-        self.drmaa_id = None
+        # drmaa_id, exit_status, exit_value and terminating_signal are left
+        # to their class default (None) until the job runs
         self.status = constants.NOT_SUBMITTED
-        self.exit_status = None
-        self.exit_value = None
-        self.terminating_signal = None
 
         self.workflow_id = workflow_id
-        self.queue = queue
+        if queue is not None:
+            self.queue = queue
 
-        self.path_translation = path_translation
-        self.container_command = container_command
+        if path_translation is not None:
+            self.path_translation = path_translation
+        if container_command is not None:
+            self.container_command = container_command
 
-        if not transfer_mapping:
+        # the workflow transfer mapping is shared by its jobs, the path
+        # mapping is only allocated for jobs which use SpecialPath objects
+        if transfer_mapping is None:
             self.transfer_mapping = {}
         else:
             self.transfer_mapping = transfer_mapping
-        self.path_mapping = {}
-        if isinstance(client_job, EngineExecutionJob):
-            self.is_engine_execution = True
-        else:
-            self.is_engine_execution = False
+        self.is_engine_execution = isinstance(client_job, EngineExecutionJob)
 
         if wf_env:
             # use workflow env, then update with self.env
@@ -221,6 +234,14 @@ class EngineJob(Job):
                 # potential bug should configuration_name be
                 # parallel_config_name
 
+        def registered(path):
+            return self.path_mapping is not None and path in self.path_mapping
+
+        def register_path(path, engine_path):
+            if self.path_mapping is None:
+                self.path_mapping = {}
+            self.path_mapping[path] = engine_path
+
         def map_and_register(file, mode=None, addTo=[]):
             '''
             Helper function to register SpecialPath objects and map them
@@ -247,9 +268,10 @@ class EngineJob(Job):
                 return
             if file:
                 if isinstance(file, OptionPath):
-                    if not file in self.path_mapping:
-                        self.path_mapping[file] = EngineOptionPath(
-                            file, self.transfer_mapping, self.path_translation)
+                    if not registered(file):
+                        register_path(file, EngineOptionPath(
+                            file, self.transfer_mapping,
+                            self.path_translation))
                         true_file = file.parent_path
                     else:
                         return
@@ -273,18 +295,21 @@ class EngineJob(Job):
                         elif isinstance(true_file, TemporaryPath):
                             engine = get_EngineTemporaryPath(true_file)
                         self.transfer_mapping[true_file] = engine
+                    # the lists may be shared with the client job: copy them
+                    # rather than appending
                     if "Input" in addTo and not true_file in self.referenced_input_files:
-                        self.referenced_input_files.append(true_file)
+                        self.referenced_input_files \
+                            = list(self.referenced_input_files) + [true_file]
                     if "Output" in addTo and not true_file in self.referenced_output_files:
-                        self.referenced_output_files.append(true_file)
-                    if not true_file in self.path_mapping:
-                        self.path_mapping[
-                            true_file] = self.transfer_mapping[true_file]
+                        self.referenced_output_files \
+                            = list(self.referenced_output_files) + [true_file]
+                    if not registered(true_file):
+                        register_path(true_file,
+                                      self.transfer_mapping[true_file])
                 elif isinstance(true_file, SharedResourcePath) \
-                        and not true_file in self.path_mapping:
-                    self.path_mapping[true_file] \
-                        = EngineSharedResourcePath(
-                            true_file, path_translation=self.path_translation)
+                        and not registered(true_file):
+                    register_path(true_file, EngineSharedResourcePath(
+                        true_file, path_translation=self.path_translation))
                 else:
                     if six.PY3 and isinstance(true_file, bytes):
                         true_file = true_file.decode('utf-8')
@@ -496,6 +521,124 @@ class EngineJob(Job):
             return func(self.job_class, self)
 
 
+class WorkflowGraph(object):
+
+    '''
+    Compact representation of the dependencies of a workflow, used by the
+    engine to walk the jobs graph.
+
+    Jobs are designated by their index in the jobs list. The successors and
+    the predecessors of each job are stored in flat integer arrays, in the
+    CSR (compressed sparse row) layout: the successors of the job i are
+    ``succ[succ_offsets[i]:succ_offsets[i + 1]]``. A dependency thus takes
+    a few bytes, instead of several Python objects.
+
+    Parameters
+    ----------
+    jobs: sequence
+        workflow jobs
+    dependencies: sequence
+        (job, job) tuples: the second job depends on the first one
+    '''
+
+    # jobs, in the order of their indices
+    jobs = None
+
+    # successors of each job, see the class documentation
+    # array of int
+    succ_offsets = None
+    succ = None
+
+    # predecessors of each job, same layout
+    # array of int
+    pred_offsets = None
+    pred = None
+
+    def __init__(self, jobs, dependencies):
+        self.jobs = list(jobs)
+        index = dict((job, i) for i, job in enumerate(self.jobs))
+        src = array.array('i', [index[dep[0]] for dep in dependencies])
+        dst = array.array('i', [index[dep[1]] for dep in dependencies])
+        self.succ_offsets, self.succ = self._compress(len(self.jobs), src, dst)
+        self.pred_offsets, self.pred = self._compress(len(self.jobs), dst, src)
+
+    @staticmethod
+    def _compress(nb_jobs, src, dst):
+        '''
+        CSR arrays (offsets, targets) of the edges src[k] -> dst[k]
+        '''
+        offsets = array.array('i', [0]) * (nb_jobs + 1)
+        for i in src:
+            offsets[i + 1] += 1
+        for i in range(nb_jobs):
+            offsets[i + 1] += offsets[i]
+        targets = array.array('i', [0]) * len(src)
+        pos = offsets[:-1]
+        for i, j in zip(src, dst):
+            targets[pos[i]] = j
+            pos[i] += 1
+        return offsets, targets
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def successors(self, i):
+        '''
+        Indices of the jobs which depend on the job i.
+        '''
+        return self.succ[self.succ_offsets[i]:self.succ_offsets[i + 1]]
+
+    def predecessors(self, i):
+        '''
+        Indices of the jobs the job i depends on.
+        '''
+        return self.pred[self.pred_offsets[i]:self.pred_offsets[i + 1]]
+
+    def nb_predecessors(self, i):
+        return self.pred_offsets[i + 1] - self.pred_offsets[i]
+
+    def descendants(self, indices):
+        '''
+        Indices of all the jobs which depend, directly or not, on the given
+        jobs. The given jobs are not included, unless they depend on each
+        other.
+        '''
+        visited = bytearray(len(self.jobs))
+        descendants = []
+        to_visit = []
+        for i in indices:
+            to_visit.extend(self.successors(i))
+        while to_visit:
+            i = to_visit.pop()
+            if visited[i]:
+                continue
+            visited[i] = 1
+            descendants.append(i)
+            to_visit.extend(self.successors(i))
+        return descendants
+
+    def reverse_topological_order(self):
+        '''
+        Jobs indices ordered so that each job comes after all the jobs
+        depending on it. Jobs which are part of dependency cycles, or which
+        depend on such jobs, are omitted.
+        '''
+        nb_jobs = len(self.jobs)
+        nb_succ = array.array('i', [self.succ_offsets[i + 1]
+                                    - self.succ_offsets[i]
+                                    for i in range(nb_jobs)])
+        ends = [i for i in range(nb_jobs) if nb_succ[i] == 0]
+        order = []
+        while ends:
+            i = ends.pop()
+            order.append(i)
+            for pred in self.predecessors(i):
+                nb_succ[pred] -= 1
+                if nb_succ[pred] == 0:
+                    ends.append(pred)
+        return order
+
+
 class EngineWorkflow(Workflow):
 
     '''
@@ -546,13 +689,18 @@ class EngineWorkflow(Workflow):
     # commandlines
     container_command = None
 
-    # for each job: list of all the jobs which have to end before a job can start
-    # dictionary: job_id -> list of job id
-    _dependency_dict = None
+    # jobs dependencies, built on first use (see get_graph())
+    # WorkflowGraph
+    _graph = None
 
     # A workflow object. For serialisation purposes with serpent
     _client_workflow = None
 
+    # jobs which status has been changed by the workflow itself (aborted
+    # jobs) and has not been written in the database yet
+    # dictionary: job_id -> EngineJob
+    _changed_jobs = None
+
     logger = None
 
     def to_dict(self):
@@ -592,14 +740,26 @@ class EngineWorkflow(Workflow):
 
     class WorkflowCache(object):
 
-        def __init__(self):
-            self.waiting_jobs = set()
+        '''
+        Readiness state of the workflow jobs, see find_out_jobs_to_process()
+        '''
+
+        def __init__(self, jobs):
+            # engine jobs, in the order of the workflow graph indices
+            self.jobs = jobs
+            # for each job, number of dependencies which have not ended with
+            # success. array: job index -> int
+            self.nb_unmet_deps = array.array('i', [0]) * len(jobs)
+            # indices of the jobs which dependencies are met, and which have
+            # not been submitted yet
             self.to_run = set()
-            self.dependencies = {}
-            self.done = set()
+            # indices of the submitted jobs which have not ended yet
             self.running = set()
-            self.to_abort = set()
-            self.has_new_failed_jobs = False
+            # flags of the jobs visited by the abortion of failed workflow
+            # branches
+            self.aborted = bytearray(len(jobs))
+            # number of ended jobs (including aborted ones)
+            self.nb_done = 0
 
     def __init__(self,
                  client_workflow,
@@ -643,15 +803,48 @@ class EngineWorkflow(Workflow):
         self.registered_tmp = {}
         self.registered_jobs = {}
 
-        self._dependency_dict = {}
-        for dep in self.dependencies:
-            if dep[1] in self._dependency_dict:
-                self._dependency_dict[dep[1]].append(dep[0])
-            else:
-                self._dependency_dict[dep[1]] = [dep[0]]
         self.cache = None
-        # begin without cache because it also has an overhead
-        self.use_cache = False
+        self.use_cache = True
+
+    def get_graph(self):
+        '''
+        Compact representation of the workflow dependencies, on which the
+        engine walks the jobs graph. It is built on first use, the
+        dependencies list being kept as is for the clients.
+
+        Returns
+        -------
+        graph: WorkflowGraph
+            its jobs are the client jobs, in the order of the jobs list
+        '''
+        if self._graph is None:
+            self._graph = WorkflowGraph(self.jobs, self.dependencies)
+        return self._graph
+
+    def job_status_changed(self, job):
+        '''
+        Record that the status of a job of the workflow has changed and has to
+        be written in the database.
+        '''
+        if self._changed_jobs is None:
+            self._changed_jobs = {}
+        self._changed_jobs[job.job_id] = job
+
+    def pop_changed_jobs(self):
+        '''
+        Returns the jobs which status has changed since the last call, and
+        clears the changed jobs set.
+
+        Returns
+        -------
+        changed_jobs: dict
+            job_id -> EngineJob
+        '''
+        changed_jobs = self._changed_jobs
+        self._changed_jobs = None
+        if changed_jobs is None:
+            return {}
+        return changed_jobs
 
     def get_environ(self):
         ''' Get environment variables dict for the workflow. This environment
@@ -776,9 +969,55 @@ class EngineWorkflow(Workflow):
                       " Objects of type Job or Group are required." %
                       (repr(elem)))
 
+    def compute_critical_paths(self, durations=None):
+        '''
+        Compute the critical path length of each job, i.e. its expected
+        duration plus the longest expected duration of the chains of jobs
+        which depend on it, and store it in the critical_path attribute of
+        engine jobs.
+
+        The expected duration of a job is its duration_hint if it has one,
+        otherwise the historical duration of jobs with the same name in the
+        durations dict, otherwise the mean of the known durations (1. if no
+        duration is known).
+
+        Parameters
+        ----------
+        durations: dict
+            job name -> duration (float), typically former jobs durations.
+        '''
+        if durations is None:
+            durations = {}
+        graph = self.get_graph()
+        jobs = [self.job_mapping[client_job] for client_job in graph.jobs]
+        expected = []
+        for job in jobs:
+            duration = job.duration_hint
+            if duration is None:
+                duration = durations.get(job.name)
+            expected.append(duration)
+        known = [d for d in expected if d is not None]
+        if known:
+            default_duration = float(sum(known)) / len(known)
+        else:
+            default_duration = 1.
+        expected = [default_duration if d is None else d for d in expected]
+
+        # jobs in dependency cycles never run, they just get their own
+        # duration
+        critical_path = list(expected)
+        # walk the graph from its ends
+        for i in graph.reverse_topological_order():
+            critical_path[i] = expected[i] + max(
+                [critical_path[succ] for succ in graph.successors(i)]
+                or [0.])
+        for i, job in enumerate(jobs):
+            job.critical_path = critical_path[i]
+
     def find_out_independant_jobs(self):
+        graph = self.get_graph()
         independant_jobs = []
-        for job in self.jobs:
+        for i, job in enumerate(graph.jobs):
             to_run = True
             for ft in job.referenced_input_files:
                 if not self.transfer_mapping[ft].files_exist_on_server():
@@ -788,10 +1027,8 @@ class EngineWorkflow(Workflow):
                         pass
                     to_run = False
                     break
-            if to_run:
-                deps = self._dependency_dict.get(job)
-                if deps is not None and len(deps) != 0:
-                    to_run = False
+            if to_run and graph.nb_predecessors(i) != 0:
+                to_run = False
             if to_run:
                 independant_jobs.append(self.job_mapping[job])
         if independant_jobs:
@@ -806,6 +1043,16 @@ class EngineWorkflow(Workflow):
         '''
         Workflow exploration to find out new node to process.
 
+        The cached version keeps, for each job, the number of its
+        dependencies which have not ended with success yet. Only the jobs
+        which have been submitted or are ready to be are inspected: when one
+        of them ends, the counters of its successors are decremented, and the
+        jobs which counter drops to 0 get ready. The cost of an inspection
+        thus does not depend on the number of waiting jobs.
+
+        The cache has to be reset (cache = None) when the status of jobs
+        which are not ready changes from outside (restart, kill).
+
         @rtype: tuple (sequence of EngineJob,
                        sequence of EngineJob,
                        constants.WORKFLOW_STATUS)
@@ -818,150 +1065,42 @@ class EngineWorkflow(Workflow):
             return self.find_out_jobs_to_process_nocache()
 
         self.logger = logging.getLogger('engine.EngineWorkflow')
-        self.logger.debug("self.jobs=" + repr(self.jobs))
+        ended_jobs = {}
         if self.cache is None:
-            self.cache = EngineWorkflow.WorkflowCache()
-            self.cache.waiting_jobs = set(self.jobs)
-            self.cache.dependencies = dict(
-                (k, set(v)) for k, v in six.iteritems(self._dependency_dict))
-            self.cache.has_new_failed_jobs = False
+            self._build_cache(ended_jobs)
         cache = self.cache
-        to_run = set()
-        to_abort = set()
-        done = set()
-        running = set()
-        rmap = {}
-        # jcount = 0
-        # dcount = 0
-        # fcount = 0
-        has_failed_jobs = self.cache.has_new_failed_jobs
-        self.cache.has_new_failed_jobs = False
-        # import time
-        # t0 = time.clock()
-        for client_job in cache.waiting_jobs:
-            self.logger.debug("client_job=" + repr(client_job))
-            job = self.job_mapping[client_job]
-            # jcount += 1
-            if job.is_done():
-                done.add(job)
-                rmap[job] = client_job
-                if job.failed():
-                    has_failed_jobs = True
-                    self.has_new_failed_jobs = True
-            elif job.is_running():
-                running.add(job)
-                rmap[job] = client_job
-            elif job.status == constants.NOT_SUBMITTED:
-                job_to_run = True
-                job_to_abort = False
-                for ft in job.referenced_input_files:
-                    # fcount += 1
-                    eft = job.transfer_mapping[ft]
-                    if not eft.files_exist_on_server():
-                        if eft.status == constants.TRANSFERING_FROM_CR_TO_CLIENT:
-                        # TBI stop the transfer
-                            pass
-                        job_to_run = False
-                        break
-                deps = cache.dependencies.get(client_job)
-                if deps is not None:
-                    remove_deps = []
-                    for dep_client_job in deps:
-                        # dcount += 1
-                        dep_job = self.job_mapping[dep_client_job]
-                        if not dep_job.ended_with_success():
-                            job_to_run = False
-                            if dep_job.failed():
-                                job_to_abort = True
-                                has_failed_jobs = True
-                                self.has_new_failed_jobs = True
-                                break
-                            if not has_failed_jobs:
-                                # if no new failed jobs have been encountered,
-                                # no need to scan every dep to propagate
-                                # abort.
-                                break
-                        else:
-                            remove_deps.append(dep_client_job)
-                        # TO DO to abort
-                    for dep_client_job in remove_deps:
-                        deps.remove(dep_client_job)
-                if job_to_run:
-                    to_run.add(job)
-                if job_to_abort:
-                    to_abort.add(job)
-                if job_to_run or job_to_abort:
-                    rmap[job] = client_job
 
-        # update status of former cache
-        to_remove = []
-        for job in cache.to_run:
+        # look for ended jobs among the submitted and ready ones
+        for i in list(cache.running) + list(cache.to_run):
+            job = cache.jobs[i]
             if job.is_done():
-                done.add(job)
-                to_remove.append(job)
+                cache.running.discard(i)
+                cache.to_run.discard(i)
+                self._job_ended(i, ended_jobs)
             elif job.is_running():
-                running.add(job)
-                to_remove.append(job)
-        cache.to_run.difference_update(to_remove)
-        to_remove = []
-        for job in cache.running:
-            if job.is_done():
-                done.add(job)
-                to_remove.append(job)
-        cache.running.difference_update(to_remove)
-        to_remove = []
-        for job in cache.to_abort:
-            if job.is_done():
-                done.add(job)
-                to_remove.append(job)
-        cache.to_abort.difference_update(to_remove)
+                cache.to_run.discard(i)
+                cache.running.add(i)
 
-        cache.waiting_jobs.difference_update(rmap.values())
-
-        cache.to_run.update(to_run)
-        cache.running.update(running)
-        cache.to_abort.update(to_abort)
-        to_run = cache.to_run
-        running = cache.running
-
-        # if a job fails the whole workflow branch has to be stopped
-        # look for the node in the branch to abort
-        previous_size = 0
-        while previous_size != len(to_abort):
-            previous_size = len(to_abort)
-            for dep in self.dependencies:
-                job_a = self.job_mapping[dep[0]]
-                job_b = self.job_mapping[dep[1]]
-                if job_a in to_abort and not job_b in to_abort:
-                    to_abort.add(job_b)
+        to_run = []
+        for i in cache.to_run:
+            job = cache.jobs[i]
+            job_to_run = True
+            for ft in job.referenced_input_files:
+                eft = job.transfer_mapping[ft]
+                if not eft.files_exist_on_server():
+                    if eft.status == constants.TRANSFERING_FROM_CR_TO_CLIENT:
+                        # TBI stop the transfer
+                        pass
+                    job_to_run = False
                     break
+            if job_to_run:
+                to_run.append(job)
 
-        # stop the whole branch
-        ended_jobs = {}
-        for job in to_abort:
-            if job.job_id and job.status != constants.FAILED:
-                self.logger.debug("  ---- Failure: job to abort " + job.name)
-                assert(job.status == constants.NOT_SUBMITTED)
-                ended_jobs[job.job_id] = job
-                job.status = constants.FAILED
-                job.exit_status = constants.EXIT_NOTRUN
-                # remove job from to_run and running sets otherwise the
-                # workflow status could be wrong
-                to_run.discard(job)
-                running.discard(job)
-
-        # counts
-        to_run.difference_update(done)
-        to_abort.difference_update(done)
-        running.difference_update(done)
-        cache.done.update(done)
-        done = cache.done
-
-        if len(running) + len(to_run) > 0:
+        if len(cache.running) + len(to_run) > 0:
             status = constants.WORKFLOW_IN_PROGRESS
-        elif len(done) + len(to_abort) == len(self.jobs):
+        elif cache.nb_done == len(cache.jobs):
             status = constants.WORKFLOW_DONE
-        elif len(done) > 0:
+        elif cache.nb_done > 0:
             # set it to DONE to avoid hangout
             status = constants.WORKFLOW_DONE
             # !!!! the workflow may be stuck !!!!
@@ -969,19 +1108,86 @@ class EngineWorkflow(Workflow):
             self.logger.error("!!!! The workflow status is not clear. "
                               "Stopping it !!!!")
             self.logger.error(
-                "total jobs: %d, done/aborted: %d, to abort: %d, running: %d, "
-                "to run: %d"
-                % (len(self.jobs), len(done), len(to_abort), len(running),
-                   len(to_run)))
+                "total jobs: %d, done/aborted: %d, running: %d, to run: %d"
+                % (len(cache.jobs), cache.nb_done, len(cache.running),
+                   len(cache.to_run)))
         else:
             status = constants.WORKFLOW_NOT_STARTED
 
-        # t1 = time.clock()
-        # print('jcount:', jcount, ', dcount:', dcount, ', fcount:', fcount, ',
-        # time:', t1 - t0, ', to_run:', len(to_run), ', ended:',
-        # len(ended_jobs), ', done:', len(done), ', running:', len(running))
+        return (to_run, ended_jobs, status)
 
-        return (list(to_run), ended_jobs, status)
+    def _build_cache(self, ended_jobs):
+        '''
+        Build the readiness cache from the current jobs status. Jobs depending
+        on failed jobs are aborted, and added to the ended_jobs dict.
+        '''
+        graph = self.get_graph()
+        cache = EngineWorkflow.WorkflowCache(
+            [self.job_mapping[client_job] for client_job in graph.jobs])
+        self.cache = cache
+        jobs = cache.jobs
+        failed = []
+        for i, job in enumerate(jobs):
+            nb_unmet = 0
+            for dep in graph.predecessors(i):
+                if not jobs[dep].ended_with_success():
+                    nb_unmet += 1
+            cache.nb_unmet_deps[i] = nb_unmet
+            if job.is_done():
+                cache.nb_done += 1
+                if job.failed():
+                    failed.append(i)
+            elif job.is_running():
+                cache.running.add(i)
+            elif nb_unmet == 0:
+                cache.to_run.add(i)
+        for i in failed:
+            self._abort_successors(i, ended_jobs)
+
+    def _job_ended(self, i, ended_jobs):
+        '''
+        Update the readiness cache after the job of index i has ended: its
+        successors get ready if it has succeeded, or are aborted if it has
+        failed.
+        '''
+        cache = self.cache
+        cache.nb_done += 1
+        if cache.jobs[i].ended_with_success():
+            for succ in self._graph.successors(i):
+                cache.nb_unmet_deps[succ] -= 1
+                if cache.nb_unmet_deps[succ] == 0 \
+                        and cache.jobs[succ].status \
+                        == constants.NOT_SUBMITTED:
+                    cache.to_run.add(succ)
+        else:
+            self._abort_successors(i, ended_jobs)
+
+    def _abort_successors(self, i, ended_jobs):
+        '''
+        If a job fails the whole workflow branch has to be stopped: abort all
+        the jobs depending on the job of index i, directly or not, which have
+        not run.
+        '''
+        cache = self.cache
+        graph = self._graph
+        to_visit = list(graph.successors(i))
+        while to_visit:
+            succ = to_visit.pop()
+            if cache.aborted[succ]:
+                continue
+            cache.aborted[succ] = 1
+            to_visit.extend(graph.successors(succ))
+            job = cache.jobs[succ]
+            if job.status != constants.NOT_SUBMITTED:
+                continue
+            self.logger.debug("  ---- Failure: job to abort " + job.name)
+            job.status = constants.FAILED
+            job.exit_status = constants.EXIT_NOTRUN
+            self.job_status_changed(job)
+            cache.to_run.discard(succ)
+            cache.nb_done += 1
+            if job.job_id:
+                ended_jobs[job.job_id] = job
 
     def find_out_jobs_to_process_nocache(self):
         '''
@@ -997,6 +1203,7 @@ class EngineWorkflow(Workflow):
 
         self.logger = logging.getLogger('engine.EngineWorkflow')
         self.logger.debug("self.jobs=" + repr(self.jobs))
+        graph = self.get_graph()
         to_run = set()
         to_abort = set()
         done = []
@@ -1010,7 +1217,7 @@ class EngineWorkflow(Workflow):
         # has_failed_jobs = getattr(self, 'has_new_failed_jobs', False)
         # self.has_new_failed_jobs = False
         # t0 = time.clock()
-        for client_job in self.jobs:
+        for i, client_job in enumerate(graph.jobs):
             # jcount += 1
             self.logger.debug("client_job=" + repr(client_job))
             job = self.job_mapping[client_job]
@@ -1039,35 +1246,29 @@ class EngineWorkflow(Workflow):
                         job_to_run = False
                         break
                 self.logger.debug("job_to_run: " + repr(job_to_run))
-                if client_job in self._dependency_dict:
-                    for dep_client_job in self._dependency_dict[client_job]:
-                        # dcount += 1
-                        dep_job = self.job_mapping[dep_client_job]
-                        if not dep_job.ended_with_success():
-                            job_to_run = False
-                            if dep_job.failed():
-                                job_to_abort = True
-                                break
-                        # else: d_to_discard += 1
-                        # TO DO to abort
+                for dep in graph.predecessors(i):
+                    # dcount += 1
+                    dep_job = self.job_mapping[graph.jobs[dep]]
+                    if not dep_job.ended_with_success():
+                        job_to_run = False
+                        if dep_job.failed():
+                            job_to_abort = True
+                            break
+                    # else: d_to_discard += 1
+                    # TO DO to abort
                 if job_to_run:
                     to_run.add(job)
                     j_to_discard += 1
                 if job_to_abort:
                     j_to_discard += 1
-                    to_abort.add(job)
+                    to_abort.add(i)
         # if a job fails the whole workflow branch has to be stopped
         # look for the node in the branch to abort
-        previous_size = 0
-        while previous_size != len(to_abort):
-            previous_size = len(to_abort)
-            for dep in self.dependencies:
-                job_a = self.job_mapping[dep[0]]
-                job_b = self.job_mapping[dep[1]]
-                if job_a in to_abort and not job_b in to_abort:
-                    to_abort.add(job_b)
-                    j_to_discard += 1
-                    break
+        for i in graph.descendants(to_abort):
+            if i not in to_abort:
+                to_abort.add(i)
+                j_to_discard += 1
+        to_abort = set([self.job_mapping[graph.jobs[i]] for i in to_abort])
 
         # stop the whole branch
         ended_jobs = {}
@@ -1078,6 +1279,7 @@ class EngineWorkflow(Workflow):
                 ended_jobs[job.job_id] = job
                 job.status = constants.FAILED
                 job.exit_status = constants.EXIT_NOTRUN
+                self.job_status_changed(job)
                 # remove job from to_run and running sets otherwise the
                 # workflow status could be wrong
                 to_run.discard(job)
@@ -1107,10 +1309,6 @@ class EngineWorkflow(Workflow):
         # to_run:', len(to_run), ', done:', len(done), ', running:',
         # len(running), 'j_to_discard:', j_to_discard, ', d_to_discard:',
         # d_to_discard)
-        if j_to_discard >= 2000:
-            self.use_cache = True
-            self.logger.debug('enabling cache.')
-
         return (list(to_run), ended_jobs, status)
 
     def _update_state_from_database_server(self, database_server):
@@ -1185,7 +1383,8 @@ class EngineWorkflow(Workflow):
         new_status = {}
         jobs_queue_changed = []
         self.cache = None
-        for client_job in self.jobs:
+        graph = self.get_graph()
+        for i, client_job in enumerate(graph.jobs):
             job = self.job_mapping[client_job]
             undone = False
             if job.failed():
@@ -1209,7 +1408,7 @@ class EngineWorkflow(Workflow):
 
             if undone or (self.status != constants.WORKFLOW_IN_PROGRESS
                           and not job.ended_with_success()):
-                undone_jobs.append(job)
+                undone_jobs.append(i)
                 job.queue = self.queue
                 jobs_queue_changed.append(job.job_id)
 
@@ -1220,7 +1419,8 @@ class EngineWorkflow(Workflow):
         to_run = []
         if undone_jobs:
             # look for jobs to run
-            for job in undone_jobs:
+            for i in undone_jobs:
+                job = self.job_mapping[graph.jobs[i]]
                 job_to_run = True  # a node is run when all its dependencies succeed
                 for ft in job.referenced_input_files:
                     eft = self.transfer_mapping[ft]
@@ -1231,11 +1431,9 @@ class EngineWorkflow(Workflow):
                         job_to_run = False
                         break
                 if job_to_run:
-                    for dep in self.dependencies:
-                        job_a = self.job_mapping[dep[0]]
-                        job_b = self.job_mapping[dep[1]]
-
-                        if job_b == job and not job_a.ended_with_success():
+                    for dep in graph.predecessors(i):
+                        if not self.job_mapping[
+                                graph.jobs[dep]].ended_with_success():
                             job_to_run = False
                             break
 
@@ -1253,34 +1451,33 @@ class EngineWorkflow(Workflow):
         ''' Check jobs depending on jobs from the job_ids list, and include
         them in an extended list if they should re-run if job_ids are restarted.
         '''
+        graph = self.get_graph()
+        jobs = [self.job_mapping[client_job] for client_job in graph.jobs]
         ext_job_ids = set(job_ids)
-        to_test = []
-        jobsdeps_f = {}
-        jobsdeps_t = {}
-        for dep in self.dependencies:
-            j1 = self.job_mapping[dep[0]]  # get engine jobs
-            j2 = self.job_mapping[dep[1]]
-            # if j2.status == constants.FAILED \
-                    # and j2.job_id not in ext_job_ids:
-            if j2.job_id not in ext_job_ids:
-                # dep[1] may change state
-                jobsdeps_f.setdefault(j2, set()).add(j1)
-                if j1.job_id in ext_job_ids \
-                        and j2.job_id not in ext_job_ids:
-                    to_test.append(j2)
-            # if j1.status == constants.FAILED \
-                    # and j1.job_id not in ext_job_ids:
-            if j1.job_id not in ext_job_ids:
-                jobsdeps_t.setdefault(j1, set()).add(j2)
+        to_test = collections.deque()
+        queued = bytearray(len(jobs))
+        for i, job in enumerate(jobs):
+            if job.job_id in ext_job_ids:
+                for succ in graph.successors(i):
+                    if not queued[succ]:
+                        queued[succ] = 1
+                        to_test.append(succ)
+        # a job can rerun if none of its dependencies has failed, or if they
+        # rerun themselves
         while to_test:
-            job = to_test.pop(0)
+            i = to_test.popleft()
+            queued[i] = 0
+            job = jobs[i]
             if job.job_id in ext_job_ids:
                 continue
-            if all([j.status != constants.FAILED or j.job_id in ext_job_ids
-                    for j in jobsdeps_f[job]]):
+            if all([jobs[dep].status != constants.FAILED
+                    or jobs[dep].job_id in ext_job_ids
+                    for dep in graph.predecessors(i)]):
                 ext_job_ids.add(job.job_id)
-                to_test += [j for j in jobsdeps_t.get(job, set())
-                            if j not in to_test]
+                for succ in graph.successors(i):
+                    if not queued[succ]:
+                        queued[succ] = 1
+                        to_test.append(succ)
         return ext_job_ids
 
     def restart_jobs(self, database_server, job_ids, check_deps=True):
@@ -1305,6 +1502,7 @@ class EngineWorkflow(Workflow):
             directly in the engine.
         '''
         self._update_state_from_database_server(database_server)
+        self.cache = None
 
         if check_deps:
             extended_job_ids = self.job_ids_which_can_rerun(job_ids)
@@ -1313,8 +1511,9 @@ class EngineWorkflow(Workflow):
         print('restart_jobs:', extended_job_ids)
         sub_info_to_resert = {}
         new_status = {}
-        jobs_to_run = set()
-        for client_job in self.jobs:
+        graph = self.get_graph()
+        jobs_to_run = []
+        for i, client_job in enumerate(graph.jobs):
             job = self.job_mapping[client_job]
             job_id = job.job_id
             if job_id not in extended_job_ids:
@@ -1323,7 +1522,7 @@ class EngineWorkflow(Workflow):
                 print('job', job_id, 'is not ready for restart:', job.status)
                 continue
 
-            jobs_to_run.add(job)
+            jobs_to_run.append(i)
             # clear all the information related to the previous job
             # submission
             job.status = constants.NOT_SUBMITTED
@@ -1343,15 +1542,11 @@ class EngineWorkflow(Workflow):
         database_server.set_submission_information(sub_info_to_resert, None)
         database_server.set_jobs_status(new_status)
 
-        extended_jobs = set(jobs_to_run)
         # look for jobs which can restart immediately (all deps met)
-        for dep in self.dependencies:
-            j1 = self.job_mapping[dep[0]]  # get engine jobs
-            j2 = self.job_mapping[dep[1]]
-            if j2 in jobs_to_run and j1.status != constants.DONE:
-                jobs_to_run.remove(j2)
-
-        return jobs_to_run
+        return set([self.job_mapping[graph.jobs[i]] for i in jobs_to_run
+                    if all([self.job_mapping[graph.jobs[dep]].status
+                            == constants.DONE
+                            for dep in graph.predecessors(i)])])
 
 
 class EngineTransfer(FileTransfer):
@@ -4334,11 +4334,16 @@ class ApplicationModel(QtCore.QObject):
 
                             # wf_complete_status =
                             # self.current_connection.workflow_elements_status(self.current_wf_id)
-                            wf_complete_status = self.connection_timeout(
-                                WorkflowController.workflow_elements_status,
+                            # only the elements which changed since the
+                            # last update are transmitted
+                            (revision, full,
+                             wf_complete_status) = self.connection_timeout(
+                                WorkflowController.workflow_elements_status_changes,
                                 args=(
-                                    self.current_connection, self.current_wf_id),
+                                    self.current_connection, self.current_wf_id,
+                                    self._current_workflow.status_revision),
                                 timeout_duration=self._timeout_duration[self.current_resource_id])
+                            self._current_workflow.status_revision = revision
                             wf_status = wf_complete_status[2]
                             # end = datetime.now() - begining
                             # print(" <== end communication" + repr(self.wf_id)
@@ -4749,6 +4754,9 @@ class GuiWorkflow(object):
     server_temporary = None
     # dict: Job id => gui item job id
     server_jobs = None
+    # status revision of the last update from the server, see
+    # WorkflowController.workflow_elements_status_changes()
+    status_revision = None
 
     queue = None
 
@@ -67,4 +67,13 @@ EXTRA_REQUIRES = {
 #-----------------------------------------------------------------------------
 
 DB_VERSION = '3.1'
+# revision of the schema of the DB_VERSION databases (stored in their
+# user_version). Older databases are upgraded when they are opened:
+# 1: engine objects encoded (engine_encoding) instead of pickled
+# 2: secondary indexes
+# 3: status revisions (WorkflowDatabaseServer.get_workflow_status_changes())
+# 4: status events journal (WorkflowDatabaseServer.wait_status_events())
+# 5: incremental auto_vacuum (WorkflowDatabaseServer.vacuum_chunk())
+# 6: job counters (WorkflowDatabaseServer.nb_jobs())
+DB_SCHEMA_REVISION = 6
 DB_PICKLE_PROTOCOL = 2  # python 2/3 compatible (should be, but is not)
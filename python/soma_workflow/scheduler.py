@@ -32,9 +32,28 @@ class Scheduler(object):
 
     is_sleeping = None
 
+    # True if the scheduler calls the event callback whenever a job status
+    # changes. In this case the engine loop does not need to poll the
+    # scheduler often, and only falls back to periodic polling.
+    can_push_events = False
+
+    # callable (without parameters) called when jobs states change
+    _event_callback = None
+
+    # number of threads used by the engine to submit jobs in the background,
+    # without blocking its loop. 0 means that the engine loop submits the jobs
+    # itself, one after the other. DRMS which do not support concurrent
+    # submissions should use 1 at most.
+    submission_workers = 0
+
+    # maximum number of jobs handed to the submission threads which
+    # submission has not completed yet
+    submission_window = 100
+
     def __init__(self):
         self.parallel_job_submission_info = None
         self.is_sleeping = False
+        self._event_callback = None
 
     def sleep(self):
         self.is_sleeping = True
@@ -42,6 +61,36 @@ class Scheduler(object):
     def wake(self):
         self.is_sleeping = False
 
+    def set_event_callback(self, callback):
+        '''
+        Register a function which will be called when the status of a job
+        changes, in order to wake up the engine loop without waiting for its
+        next polling iteration.
+
+        Only schedulers with the :attr:`can_push_events` attribute set to True
+        actually call it.
+
+        Parameters
+        ----------
+        callback: callable or None
+            function called without parameters. None unregisters the current
+            callback.
+        '''
+        self._event_callback = callback
+
+    def notify_event(self):
+        '''
+        Called by scheduler implementations when jobs states have changed.
+        Calls the event callback, if any.
+        '''
+        callback = self._event_callback
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.exception(e)
+
     def clean(self):
         pass
 
@@ -108,6 +157,45 @@ class Scheduler(object):
         '''
         raise Exception("Scheduler is an abstract class!")
 
+    def get_jobs_status(self, scheduler_job_ids):
+        '''
+        Get the status of several jobs at once. The default implementation
+        calls :meth:`get_job_status` for each job. Schedulers which can query
+        the DRMS for many jobs in a single request should overload it.
+
+        Parameters
+        ----------
+        scheduler_job_ids: list
+            Jobs ids for the scheduling system (DRMAA for example)
+
+        Returns
+        -------
+        statuses: dict
+            scheduler_job_id -> status, as defined in constants.JOB_STATUS
+        '''
+        return dict([(scheduler_job_id, self.get_job_status(scheduler_job_id))
+                     for scheduler_job_id in scheduler_job_ids])
+
+    def get_jobs_exit_info(self, scheduler_job_ids):
+        '''
+        Get the exit info of several ended jobs at once. The default
+        implementation calls :meth:`get_job_exit_info` for each job.
+
+        Parameters
+        ----------
+        scheduler_job_ids: list
+            Jobs ids for the scheduling system (DRMAA for example)
+
+        Returns
+        -------
+        exit_info: dict
+            scheduler_job_id -> exit info tuple (exit_status, exit_value,
+            term_sig, resource_usage), see :meth:`get_job_exit_info`
+        '''
+        return dict([(scheduler_job_id,
+                      self.get_job_exit_info(scheduler_job_id))
+                     for scheduler_job_id in scheduler_job_ids])
+
     def kill_job(self, scheduler_job_id):
         '''
         Parameters
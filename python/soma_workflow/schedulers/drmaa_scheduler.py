@@ -68,6 +68,10 @@ if DRMAA_LIB_FOUND:
         is_sleeping = False
         FAKE_JOB = -167
 
+        # jobs are submitted in the background, but one at a time, in the
+        # DRMAA session
+        submission_workers = 1
+
         def __init__(self,
                      drmaa_implementation,
                      parallel_job_submission_info,
@@ -398,6 +402,26 @@ if DRMAA_LIB_FOUND:
                 raise DRMError("%s" % (e))
             return status
 
+        def get_jobs_status(self, scheduler_job_ids):
+            '''
+            Get the status of several jobs. The session is woken up only
+            once, and the DRMAA library is queried directly for each job.
+            '''
+            if self.is_sleeping:
+                self.wake()
+            statuses = {}
+            for scheduler_job_id in scheduler_job_ids:
+                if scheduler_job_id == self.FAKE_JOB:
+                    statuses[scheduler_job_id] = constants.DONE
+                    continue
+                try:
+                    statuses[scheduler_job_id] \
+                        = self._drmaa.jobStatus(scheduler_job_id)
+                except DrmaaException as e:
+                    self.logger.error("%s" % (e))
+                    raise DRMError("%s" % (e))
+            return statuses
+
         def get_job_exit_info(self, scheduler_job_id):
             if self.is_sleeping:
                 self.wake()
@@ -410,52 +434,75 @@ if DRMAA_LIB_FOUND:
                 return (res_status, res_exitValue, res_termSignal,
                         res_resourceUsage)
 
-            res_resourceUsage = []
-            res_status = constants.EXIT_UNDETERMINED
-            res_exitValue = 0
-            res_termSignal = None
-
             try:
                 self.logger.debug(
                     "  ==> Start to find info of job %s" % (scheduler_job_id))
-                jid_out, exit_value, signaled, term_sig, coredumped, aborted, exit_status, resource_usage = self._drmaa.wait(
+                job_info = self._drmaa.wait(
                     scheduler_job_id, self._drmaa.TIMEOUT_NO_WAIT)
-
-                self.logger.debug("  ==> jid_out=" + repr(jid_out))
-                self.logger.debug("  ==> exit_value=" + repr(exit_value))
-                self.logger.debug("  ==> signaled=" + repr(signaled))
-                self.logger.debug("  ==> term_sig=" + repr(term_sig))
-                self.logger.debug("  ==> coredumped=" + repr(coredumped))
-                self.logger.debug("  ==> aborted=" + repr(aborted))
-                self.logger.debug("  ==> exit_status=" + repr(exit_status))
-                self.logger.debug(
-                    "  ==> resource_usage=" + repr(resource_usage))
-
-                if aborted:
-                    res_status = constants.EXIT_ABORTED
-                else:
-                    if exit_value:
-                        res_status = constants.FINISHED_REGULARLY
-                        res_exitValue = exit_status
-                    else:
-                        if signaled:
-                            res_status = constants.FINISHED_TERM_SIG
-                            res_termSignal = term_sig
-                        else:
-                            res_status = constants.FINISHED_UNCLEAR_CONDITIONS
-
-                self.logger.debug("  ==> res_status=" + repr(res_status))
-                res_resourceUsage = b''
-                for k, v in six.iteritems(resource_usage):
-                    res_resourceUsage = res_resourceUsage + k + b'=' + v + b' '
-
+                exit_info = self._exit_info_from_job_info(job_info)
             except ExitTimeoutException:
-                res_status = constants.EXIT_UNDETERMINED
+                exit_info = (constants.EXIT_UNDETERMINED, 0, None, [])
                 self.logger.debug("  ==> self._drmaa.wait time out")
 
             # DRMAA may leave files in ~/.drmaa
             self.cleanup_drmaa_files(scheduler_job_id)
 
+            return exit_info
+
+        def get_jobs_exit_info(self, scheduler_job_ids):
+            '''
+            Get the exit info of several ended jobs. The session is woken up
+            only once, and each requested job is waited for: jobs are never
+            reaped for any ended job (JOB_IDS_SESSION_ANY), since DRMAA
+            releases the information of a reaped job, which the engine may
+            not have seen ended yet.
+            '''
+            if self.is_sleeping:
+                self.wake()
+            exit_info = {}
+            for scheduler_job_id in scheduler_job_ids:
+                exit_info[scheduler_job_id] \
+                    = self.get_job_exit_info(scheduler_job_id)
+            return exit_info
+
+        def _exit_info_from_job_info(self, job_info):
+            '''
+            Build the exit info tuple from a DRMAA JobInfo
+            '''
+            res_status = constants.EXIT_UNDETERMINED
+            res_exitValue = 0
+            res_termSignal = None
+
+            jid_out, exit_value, signaled, term_sig, coredumped, aborted, exit_status, resource_usage = job_info
+
+            self.logger.debug("  ==> jid_out=" + repr(jid_out))
+            self.logger.debug("  ==> exit_value=" + repr(exit_value))
+            self.logger.debug("  ==> signaled=" + repr(signaled))
+            self.logger.debug("  ==> term_sig=" + repr(term_sig))
+            self.logger.debug("  ==> coredumped=" + repr(coredumped))
+            self.logger.debug("  ==> aborted=" + repr(aborted))
+            self.logger.debug("  ==> exit_status=" + repr(exit_status))
+            self.logger.debug(
+                "  ==> resource_usage=" + repr(resource_usage))
+
+            if aborted:
+                res_status = constants.EXIT_ABORTED
+            else:
+                if exit_value:
+                    res_status = constants.FINISHED_REGULARLY
+                    res_exitValue = exit_status
+                else:
+                    if signaled:
+                        res_status = constants.FINISHED_TERM_SIG
+                        res_termSignal = term_sig
+                    else:
+                        res_status = constants.FINISHED_UNCLEAR_CONDITIONS
+
+            self.logger.debug("  ==> res_status=" + repr(res_status))
+            res_resourceUsage = b''
+            for k, v in six.iteritems(resource_usage):
+                res_resourceUsage = res_resourceUsage + k + b'=' + v + b' '
+
             return (res_status, res_exitValue, res_termSignal, res_resourceUsage)
 
         def cleanup_drmaa_files(self, scheduler_job_id):
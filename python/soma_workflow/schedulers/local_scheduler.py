@@ -40,10 +40,20 @@ from .. import subprocess
 import threading
 import time
 import os
+import collections
+import errno
+import glob
+import inspect
+import itertools
+import json
+import math
+import re
+import select
 import signal
 import ctypes
 import atexit
 import six
+from six.moves import queue
 import logging
 
 try:
@@ -70,7 +80,7 @@ class LocalScheduler(Scheduler):
 
     * _proc_nb *int*
 
-    * _queue *list of scheduler jobs ids*
+    * _queue *JobQueue*
 
     * _jobs *dictionary job_id -> soma_workflow.engine_types.EngineJob*
 
@@ -80,16 +90,74 @@ class LocalScheduler(Scheduler):
 
     * _exit_info * dictionay job_id -> exit info*
 
+    * _start_times *dictionary job_id -> start time of the process*
+
+    * _running_cpus *int*
+        number of CPUs used by the running jobs
+
+    * _max_memory *float*
+        memory budget of the jobs, in megabytes (0: no budget)
+
+    * _running_memory *int*
+        memory needed by the running jobs, in megabytes
+
+    * _reserved_memory *dictionary job_id -> memory reserved by the running
+      job*
+
+    * _cpu_affinity *bool*
+        pin the jobs processes to their own CPU cores
+
+    * _placement *CorePlacement or None*
+        cores given to the running jobs, created when cpu_affinity is first
+        set
+
+    * _job_cores *dictionary job_id -> cores of the running job*
+
+    * _worker_pool *WorkerPool or None*
+
     * _loop *thread*
 
     * _interval *int*
 
     * _lock *threading.RLock*
+
+    * _wake_up *threading.Event*
+        wakes up the scheduler loop before the end of the interval
+
+    * _reaper *ProcessReaper or None*
+
+    The end of the jobs processes is detected by a :class:`ProcessReaper`
+    thread as soon as it happens, when the system supports it (Linux >= 5.3
+    with python >= 3.9). Otherwise the scheduler loop polls the processes
+    every interval seconds. The resource usage of the processes is recorded
+    in their exit info where os.wait4() is available.
+
+    Jobs may declare the memory they need (Job.memory, or a memory request in
+    their native_specification): such a job only starts when its memory fits
+    in the memory budget (max_memory) besides the memory of the running jobs,
+    and is available on the machine (when psutil is installed). A job is
+    always started when no other job which declares its memory is running,
+    so that jobs needing more than the budget still run, alone.
+
+    In the cpu_affinity mode (Linux only), each job process is pinned to its
+    own set of CPU cores, taken on a single NUMA node when possible (see
+    :class:`CorePlacement`), and gets the OMP_NUM_THREADS, MKL_NUM_THREADS
+    and OPENBLAS_NUM_THREADS environment variables set to its number of
+    cores, unless the job sets them. A job which gets no free cores (more
+    jobs than cores are running) is not pinned.
+
+    With a worker pool (worker_pool > 0, Unix only), the jobs are run by
+    long-lived worker processes (see :class:`WorkerPool`) rather than
+    started as new processes, which saves the python interpreter startup
+    time of python jobs (Job.python_job).
     '''
     parallel_job_submission_info = None
 
     # logger = None
 
+    # the scheduler loop notifies job status changes
+    can_push_events = True
+
     _proc_nb = None
 
     _max_proc_nb = None
@@ -112,31 +180,60 @@ class LocalScheduler(Scheduler):
 
     _lasttime = None
     _lastidle = None
+    _last_memory_time = None
+    _last_available_memory = None
+
+    # use a ProcessReaper when the system supports it
+    use_process_reaper = True
 
     def __init__(self, proc_nb=default_cpu_number(), interval=1,
-                 max_proc_nb=0):
+                 max_proc_nb=0, max_memory=0, cpu_affinity=False,
+                 worker_pool=0):
         super(LocalScheduler, self).__init__()
 
         self.parallel_job_submission_info = None
 
         self._proc_nb = proc_nb
         self._max_proc_nb = max_proc_nb
+        self._max_memory = max_memory
         self._interval = interval
-        self._queue = []
+        self._queue = JobQueue()
         self._jobs = {}
         self._processes = {}
         self._status = {}
         self._exit_info = {}
+        self._start_times = {}
+        self._running_cpus = 0
+        self._running_memory = 0
+        self._reserved_memory = {}
+        self._cpu_affinity = False
+        self._placement = None
+        self._job_cores = {}
+        self._worker_pool = None
 
         self._lock = threading.RLock()
+        self._wake_up = threading.Event()
+        # set by the reaper when processes have ended
+        self._ended_processes = False
 
         self.stop_thread_loop = False
+        if cpu_affinity:
+            self.change_cpu_affinity(cpu_affinity)
+        if worker_pool:
+            self.change_worker_pool(worker_pool)
+
+        self._reaper = None
+        if self.use_process_reaper and ProcessReaper.is_supported():
+            self._reaper = ProcessReaper(self._process_ended)
 
         def loop(self):
             while not self.stop_thread_loop:
+                self._wake_up.clear()
                 with self._lock:
-                    self._iterate()
-                time.sleep(self._interval)
+                    changed = self._iterate()
+                if changed:
+                    self.notify_event()
+                self._wake_up.wait(self._interval)
 
         self._loop = threading.Thread(name="scheduler_loop",
                                       target=loop,
@@ -160,74 +257,208 @@ class LocalScheduler(Scheduler):
         with self._lock:
             self._interval = interval
 
+    def change_max_memory(self, max_memory):
+        with self._lock:
+            self._max_memory = max_memory
+        # jobs may fit now
+        self._wake_up.set()
+
+    def change_cpu_affinity(self, cpu_affinity):
+        '''
+        Enable or disable the cpu_affinity mode for the jobs started from
+        now on. It is ignored where the processes affinity can't be set.
+        '''
+        with self._lock:
+            if cpu_affinity and not CorePlacement.is_supported():
+                LocalScheduler.logger.warning(
+                    'the CPU affinity of processes is not supported on this '
+                    'system')
+                cpu_affinity = False
+            if cpu_affinity and self._placement is None:
+                self._placement = CorePlacement()
+            self._cpu_affinity = bool(cpu_affinity)
+
+    def change_worker_pool(self, worker_pool):
+        '''
+        Change the number of worker processes running the jobs, 0 to start
+        a new process for each job. The running jobs are not affected.
+        '''
+        if worker_pool and not WorkerPool.is_supported():
+            LocalScheduler.logger.warning(
+                'worker pools are not supported on this system')
+            worker_pool = 0
+        with self._lock:
+            if self._worker_pool is not None:
+                # busy workers end after their job
+                self._worker_pool.close()
+                self._worker_pool = None
+            if worker_pool:
+                self._worker_pool = WorkerPool(worker_pool,
+                                               self._process_ended)
+
     def end_scheduler_thread(self):
         with self._lock:
             self.stop_thread_loop = True
-            self._loop.join()
-            # print("Soma scheduler thread ended nicely.")
+            reaper = self._reaper
+            worker_pool = self._worker_pool
+        self._wake_up.set()
+        self._loop.join()
+        if reaper is not None:
+            reaper.close()
+        if worker_pool is not None:
+            worker_pool.close()
+        # print("Soma scheduler thread ended nicely.")
+
+    def _process_ended(self, job_id):
+        '''
+        Called by the reaper or the worker pool when the process of a job
+        has ended: collect it, and wake up the scheduler loop so that it
+        starts the next jobs and notifies the engine.
+        '''
+        with self._lock:
+            process = self._processes.get(job_id)
+            if process is None:
+                # killed meanwhile
+                return
+            if self._collect_process(job_id, process):
+                self._ended_processes = True
+        self._wake_up.set()
+
+    def _collect_process(self, job_id, process):
+        '''
+        If the process of the job has ended, reap it, record its exit info
+        and status, and return True. The lock must be held.
+        '''
+        rusage = None
+        if isinstance(process, WorkerProcess):
+            # reaped by the worker
+            rusage = process.rusage
+        elif hasattr(os, 'wait4'):
+            try:
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # already reaped
+                pid = None
+                rusage = None
+            if pid == 0:
+                return False
+            if pid is not None:
+                if os.WIFSIGNALED(status):
+                    process.returncode = -os.WTERMSIG(status)
+                else:
+                    process.returncode = os.WEXITSTATUS(status)
+        ret_value = process.poll()
+        if ret_value is None:
+            return False
+        start_time = self._start_times.pop(job_id, None)
+        if rusage is not None and start_time is not None:
+            rusage = format_resource_usage(rusage, start_time, time.time())
+        else:
+            rusage = None
+        self._exit_info[job_id] = (constants.FINISHED_REGULARLY,
+                                   ret_value,
+                                   None,
+                                   rusage)
+        self._status[job_id] = constants.DONE
+        del self._processes[job_id]
+        self._running_cpus -= self._cpu_for_job(self._jobs[job_id])
+        self._running_memory -= self._reserved_memory.pop(job_id, 0)
+        self._release_cores(job_id)
+        return True
 
     def _iterate(self):
+        '''
+        Returns True if some jobs status have changed
+        '''
+        # the reaper has collected ended processes
+        changed = self._ended_processes
+        self._ended_processes = False
         # Nothing to do if the queue is empty and nothing is running
         if not self._queue and not self._processes:
-            return
+            return changed
         # print("#############################")
         # Control the running jobs
-        ended_jobs = []
-        for job_id, process in six.iteritems(self._processes):
-            ret_value = process.poll()
-            # print("job_id " + repr(job_id) + " ret_value " + repr(ret_value))
-            if ret_value != None:
-                ended_jobs.append(job_id)
-                self._exit_info[job_id] = (constants.FINISHED_REGULARLY,
-                                           ret_value,
-                                           None,
-                                           None)
-
-        # update for the ended job
-        for job_id in ended_jobs:
-            # print("updated job_id " + repr(job_id) + " status DONE")
-            self._status[job_id] = constants.DONE
-            del self._processes[job_id]
+        if self._reaper is None:
+            for job_id, process in list(self._processes.items()):
+                if self._collect_process(job_id, process):
+                    changed = True
 
         # run new jobs
-        skipped_jobs = []
-        # print('processing queue:', len(self._queue), file=sys.stderr)
-        while self._queue:
-            job_id = self._queue.pop(0)
+        # numbers of CPUs, and queue buckets, for which no job can be
+        # started in this iteration
+        blocked = set()
+        blocked_keys = set()
+        while True:
+            key = self._queue.first(blocked, blocked_keys)
+            if key is None:
+                break
+            ncpu, memory = key[1:]
+            # barrier jobs (ncpu == 0) are not actually run using Popen:
+            # they succeed immediately.
+            if ncpu != 0 and not self._can_submit_new_job(ncpu):
+                # print('cannot submit.', file=sys.stderr)
+                if ncpu == 1:  # no other job will be able to run now
+                    break
+                blocked.add(ncpu)
+                continue
+            if memory and not self._can_reserve_memory(memory):
+                # jobs needing less memory may run meanwhile
+                blocked_keys.add(key)
+                continue
+            job_id = self._queue.popleft(key)
             job = self._jobs[job_id]
             # print("new job " + repr(job.job_id))
-            if job.is_engine_execution:
-                # barrier jobs are not actually run using Popen:
-                # they succeed immediately.
-                self._exit_info[job.drmaa_id] = (constants.FINISHED_REGULARLY,
-                                                 0,
-                                                 None,
-                                                 None)
-                self._status[job.drmaa_id] = constants.DONE
+            if ncpu == 0:
+                self._exit_info[job_id] = (constants.FINISHED_REGULARLY,
+                                           0,
+                                           None,
+                                           None)
+                self._status[job_id] = constants.DONE
             else:
-                ncpu = self._cpu_for_job(job)
-                # print('job:', job.command, ', cpus:', ncpu, file=sys.stderr)
-                if not self._can_submit_new_job(ncpu):
-                    # print('cannot submit.', file=sys.stderr)
-                    skipped_jobs.append(job_id)  # postponed
-                    if ncpu == 1:  # no other job will be able to run now
-                        break
-                    else:
-                        continue
                 # print('submitting.', file=sys.stderr)
-                process = LocalScheduler.create_process(job)
+                cores = None
+                if self._cpu_affinity:
+                    cores = self._placement.allocate(ncpu)
+                process = None
+                if self._worker_pool is not None:
+                    process = self._worker_pool.submit(job_id, job, cores)
+                if process is None:
+                    process = self.create_process(job, cores)
                 if process == None:
+                    if cores:
+                        self._placement.release(cores)
                     LocalScheduler.logger.error(
                         'command process is None:' + job.name)
-                    self._exit_info[job.drmaa_id] = (constants.EXIT_ABORTED,
-                                                     None,
-                                                     None,
-                                                     None)
-                    self._status[job.drmaa_id] = constants.FAILED
+                    self._exit_info[job_id] = (constants.EXIT_ABORTED,
+                                               None,
+                                               None,
+                                               None)
+                    self._status[job_id] = constants.FAILED
                 else:
-                    self._processes[job.drmaa_id] = process
-                    self._status[job.drmaa_id] = constants.RUNNING
-        self._queue = skipped_jobs + self._queue
+                    self._processes[job_id] = process
+                    if cores:
+                        self._job_cores[job_id] = cores
+                    self._running_cpus += ncpu
+                    if memory:
+                        self._running_memory += memory
+                        self._reserved_memory[job_id] = memory
+                    self._start_times[job_id] = time.time()
+                    self._status[job_id] = constants.RUNNING
+                    if self._reaper is not None \
+                            and not isinstance(process, WorkerProcess):
+                        try:
+                            self._reaper.add(job_id, process.pid)
+                        except OSError as e:
+                            # (too many open files...) the loop polls the
+                            # processes from now on
+                            LocalScheduler.logger.warning(
+                                'process reaper disabled: ' + repr(e))
+                            self._reaper.close()
+                            self._reaper = None
+            changed = True
+        return changed
 
     def _cpu_for_job(self, job):
         parallel_job_info = job.parallel_job_info
@@ -237,10 +468,53 @@ class LocalScheduler(Scheduler):
             * parallel_job_info.get('cpu_per_node', 1)
         return ncpu
 
+    def _release_cores(self, job_id):
+        cores = self._job_cores.pop(job_id, None)
+        if cores:
+            self._placement.release(cores)
+
+    def _memory_for_job(self, job):
+        '''
+        Memory needed by the job, in whole megabytes, 0 if it is not declared
+        '''
+        memory = job.memory
+        if memory is None:
+            memory = native_memory_request(job.native_specification,
+                                           self._cpu_for_job(job))
+            if memory is None:
+                return 0
+        return int(math.ceil(memory))
+
+    def _can_reserve_memory(self, memory):
+        if self._running_memory <= 0:
+            # run alone, whatever it needs
+            return True
+        if self._max_memory \
+                and self._running_memory + memory > self._max_memory:
+            return False
+        return self.is_available_memory(memory)
+
+    @staticmethod
+    def is_available_memory(memory):
+        '''
+        Tells if the memory (in megabytes) is available on the machine.
+        The available memory is measured at most every 0.1 second, and the
+        memory of the jobs started meanwhile is deduced from it.
+        '''
+        if not have_psutil:
+            return True
+        if LocalScheduler._last_memory_time is None \
+                or time.time() - LocalScheduler._last_memory_time > 0.1:
+            LocalScheduler._last_memory_time = time.time()
+            LocalScheduler._last_available_memory \
+                = psutil.virtual_memory().available / (1024. * 1024.)
+        if memory <= LocalScheduler._last_available_memory:
+            LocalScheduler._last_available_memory -= memory
+            return True
+        return False
+
     def _can_submit_new_job(self, ncpu=1):
-        n = sum([self._cpu_for_job(self._jobs[j])
-                 for j in self._processes])
-        n += ncpu
+        n = self._running_cpus + ncpu
         if n <= self._proc_nb:
             return True
         max_proc_nb = self._max_proc_nb
@@ -281,11 +555,31 @@ class LocalScheduler(Scheduler):
         # no psutil: get to the upper limit.
         return True
 
+    # environment variables giving the number of threads of the usual
+    # parallel libraries, set in the cpu_affinity mode
+    threads_number_variables = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                                'OPENBLAS_NUM_THREADS')
+
     @staticmethod
-    def create_process(engine_job):
+    def threads_environment(env, cores):
+        '''
+        Environment variables of a job pinned to cores: the job env (dict or
+        None), and the threads_number_variables, unless the job sets them
+        '''
+        threads_env = dict((name, str(len(cores)))
+                           for name in LocalScheduler.threads_number_variables)
+        if env is not None:
+            threads_env.update(env)
+        return threads_env
+
+    @staticmethod
+    def create_process(engine_job, cores=None):
         '''
         * engine_job *EngineJob*
 
+        * cores *list of int*
+            CPU cores the process is pinned to (optional)
+
         * returns: *Subprocess process*
         '''
 
@@ -331,7 +625,15 @@ class LocalScheduler(Scheduler):
         working_directory = engine_job.plain_working_directory()
 
         try:
-            if not have_psutil and sys.platform != 'win32':
+            setsid = not have_psutil and sys.platform != 'win32'
+            if cores:
+                def preexec_fn():
+                    if setsid:
+                        os.setsid()
+                    os.sched_setaffinity(0, cores)
+                kwargs = {'preexec_fn': preexec_fn}
+                env = LocalScheduler.threads_environment(env, cores)
+            elif setsid:
                 # if psutil is not here, use process group/session, to allow killing
                 # children processes as well. see
                 # http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
@@ -389,11 +691,17 @@ class LocalScheduler(Scheduler):
         with self._lock:
             # print("job submission " + repr(job.job_id))
             drmaa_id = str(job.job_id)
-            self._queue.append(drmaa_id)
             self._jobs[drmaa_id] = job
             self._status[drmaa_id] = constants.QUEUED_ACTIVE
-            self._queue.sort(key=lambda job_id: self._jobs[drmaa_id].priority,
-                             reverse=True)
+            if job.is_engine_execution:
+                ncpu = 0
+                memory = 0
+            else:
+                ncpu = self._cpu_for_job(job)
+                memory = self._memory_for_job(job)
+            self._queue.append(drmaa_id, job.priority or 0, ncpu, memory)
+        # start it now
+        self._wake_up.set()
         return drmaa_id
 
     def get_job_status(self, scheduler_job_id):
@@ -433,7 +741,10 @@ class LocalScheduler(Scheduler):
             if scheduler_job_id in self._processes:
                 # print("    => kill the process ")
                 process = self._processes[scheduler_job_id]
-                if have_psutil:
+                if isinstance(process, WorkerProcess):
+                    process.kill()
+                    process.communicate()
+                elif have_psutil:
                     kill_process_tree(process.pid)
                     # wait for actual termination, to avoid process writing files after
                     # we return from here.
@@ -455,6 +766,12 @@ class LocalScheduler(Scheduler):
                     process.communicate()
 
                 del self._processes[scheduler_job_id]
+                self._running_cpus -= self._cpu_for_job(
+                    self._jobs[scheduler_job_id])
+                self._running_memory -= self._reserved_memory.pop(
+                    scheduler_job_id, 0)
+                self._release_cores(scheduler_job_id)
+                self._start_times.pop(scheduler_job_id, None)
                 self._status[scheduler_job_id] = constants.FAILED
                 self._exit_info[scheduler_job_id] = (constants.USER_KILLED,
                                                      None,
@@ -471,6 +788,664 @@ class LocalScheduler(Scheduler):
                                                      None)
 
 
+_memory_request_re = re.compile(
+    r'(?:^|[\s,:])(--mem-per-cpu|--mem|pmem|mem)=([0-9.]+)([kmgt]?)b?'
+    r'(?=$|[\s,:])', re.IGNORECASE)
+
+
+def native_memory_request(native_specification, ncpu=1):
+    '''
+    Memory requested in a PBS (``-l mem=4gb``, ``pmem=1gb``) or SLURM
+    (``--mem=4G``, ``--mem-per-cpu=1G``) native specification
+
+    Parameters
+    ----------
+    native_specification: str
+    ncpu: int
+        number of CPUs of the job, the per CPU requests are multiplied by it
+
+    Returns
+    -------
+    memory: float
+        in megabytes, None if the native specification has no memory request
+    '''
+    if not isinstance(native_specification, six.string_types):
+        return None
+    memory = None
+    for option, value, unit in _memory_request_re.findall(
+            native_specification):
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        unit = unit.lower()
+        if not unit:
+            # PBS sizes are in bytes by default, SLURM ones in megabytes
+            unit = 'm' if option.startswith('--') else ''
+        value *= {'': 1. / (1024 * 1024), 'k': 1. / 1024, 'm': 1.,
+                  'g': 1024., 't': 1024. * 1024}[unit]
+        if option in ('pmem', '--mem-per-cpu'):
+            value *= ncpu
+        memory = max(memory or 0, value)
+    return memory
+
+
+def parse_cpu_list(cpu_list):
+    '''
+    Parse a list of CPUs in the format of the Linux sysfs (``'0-3,8,10-11'``)
+    and return it as a list of int
+    '''
+    cpus = []
+    for item in cpu_list.strip().split(','):
+        if not item:
+            continue
+        if '-' in item:
+            first, last = item.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(item))
+    return cpus
+
+
+class CorePlacement(object):
+
+    '''
+    Allocation of disjoint sets of CPU cores to jobs.
+
+    A set of cores is taken on a single NUMA node when one has enough free
+    cores (the one with the fewest free cores, to keep large free blocks for
+    larger jobs), otherwise on several nodes, starting with the nodes with
+    the most free cores.
+
+    Parameters
+    ----------
+    nodes: list of lists of int
+        cores of each NUMA node. By default, the nodes of the machine read in
+        /sys/devices/system/node, restricted to the cores this process may
+        use (all of them on a single node if the nodes can't be read).
+    '''
+
+    numa_nodes_pattern = '/sys/devices/system/node/node[0-9]*/cpulist'
+
+    def __init__(self, nodes=None):
+        if nodes is None:
+            nodes = self.numa_nodes()
+        self._nodes = [frozenset(node) for node in nodes if node]
+        # free cores of each node
+        self._free = [set(node) for node in self._nodes]
+
+    @staticmethod
+    def is_supported():
+        return hasattr(os, 'sched_setaffinity')
+
+    @staticmethod
+    def numa_nodes():
+        '''
+        Cores of the NUMA nodes of the machine, which this process may use
+        '''
+        allowed = os.sched_getaffinity(0)
+        nodes = []
+        for cpu_list_file in sorted(
+                glob.glob(CorePlacement.numa_nodes_pattern)):
+            try:
+                with open(cpu_list_file) as f:
+                    node = parse_cpu_list(f.read())
+            except (IOError, ValueError):
+                continue
+            node = [core for core in node if core in allowed]
+            if node:
+                nodes.append(node)
+        if not nodes:
+            nodes = [sorted(allowed)]
+        return nodes
+
+    def free_cores_number(self):
+        return sum(len(free) for free in self._free)
+
+    def allocate(self, ncpu):
+        '''
+        Take ncpu free cores.
+
+        Returns
+        -------
+        cores: list of int, or None if there are not enough free cores
+        '''
+        candidates = [free for free in self._free if len(free) >= ncpu]
+        if candidates:
+            free = min(candidates, key=len)
+            cores = sorted(free)[:ncpu]
+        else:
+            if self.free_cores_number() < ncpu:
+                return None
+            cores = []
+            for free in sorted(self._free, key=len, reverse=True):
+                cores += sorted(free)[:ncpu - len(cores)]
+                if len(cores) == ncpu:
+                    break
+        for free in self._free:
+            free.difference_update(cores)
+        return cores
+
+    def release(self, cores):
+        '''
+        Give back cores returned by allocate()
+        '''
+        cores = set(cores)
+        for node, free in zip(self._nodes, self._free):
+            free.update(cores.intersection(node))
+
+
+def format_resource_usage(rusage, start_time, end_time):
+    '''
+    Resource usage of a process, in the format of the exit info of the
+    schedulers (see Scheduler.get_job_exit_info())
+
+    Parameters
+    ----------
+    rusage: resource.struct_rusage
+        as returned by os.wait4()
+    start_time, end_time: float
+        start and end times of the process (see time.time())
+
+    Returns
+    -------
+    resource_usage: str
+        ``'cput=00:00:12 mem=13530kb walltime=00:00:20 start_time=...
+        end_time=...'``
+    '''
+    def duration(seconds):
+        seconds = int(round(seconds))
+        return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
+
+    # ru_maxrss is in bytes on MacOS, in kilobytes on Linux
+    mem = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        mem //= 1024
+    return 'cput=%s mem=%dkb walltime=%s start_time=%f end_time=%f' \
+        % (duration(rusage.ru_utime + rusage.ru_stime), mem,
+           duration(end_time - start_time), start_time, end_time)
+
+
+class JobQueue(object):
+
+    '''
+    Queued jobs of a LocalScheduler.
+
+    The jobs are held in buckets of jobs of the same priority using the same
+    number of CPUs and the same memory, in submission order. The next job to
+    run is the oldest one of the highest priority, and the jobs using a given
+    number of CPUs can be skipped as a whole when there are not enough free
+    CPUs for them: finding the next job costs a look at the first job of each
+    bucket, whatever the number of queued jobs.
+    '''
+
+    def __init__(self):
+        # (priority, ncpu, memory) -> deque of (submission number, job_id)
+        self._buckets = {}
+        # job_id -> (priority, ncpu, memory)
+        self._keys = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, job_id):
+        return job_id in self._keys
+
+    def append(self, job_id, priority, ncpu, memory=0):
+        key = (priority, ncpu, memory)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = collections.deque()
+            self._buckets[key] = bucket
+        bucket.append((next(self._counter), job_id))
+        self._keys[job_id] = key
+
+    def remove(self, job_id):
+        key = self._keys.pop(job_id)
+        bucket = self._buckets[key]
+        for item in bucket:
+            if item[1] == job_id:
+                bucket.remove(item)
+                break
+        if not bucket:
+            del self._buckets[key]
+
+    def first(self, excluded_ncpus=(), excluded_keys=()):
+        '''
+        Bucket of the next job to run, ignoring the jobs using a number of
+        CPUs in excluded_ncpus, and the buckets in excluded_keys.
+
+        Returns
+        -------
+        key: tuple (priority, ncpu, memory), or None if there is no such job
+        '''
+        first_key = None
+        first_order = None
+        for key, bucket in six.iteritems(self._buckets):
+            if key[1] in excluded_ncpus or key in excluded_keys:
+                continue
+            order = (-key[0], bucket[0][0])
+            if first_order is None or order < first_order:
+                first_key = key
+                first_order = order
+        return first_key
+
+    def popleft(self, key):
+        '''
+        Remove the first job of the bucket key (see first()) and return its
+        id.
+        '''
+        bucket = self._buckets[key]
+        job_id = bucket.popleft()[1]
+        if not bucket:
+            del self._buckets[key]
+        del self._keys[job_id]
+        return job_id
+
+
+WorkerResourceUsage = collections.namedtuple(
+    'WorkerResourceUsage', ['ru_utime', 'ru_stime', 'ru_maxrss'])
+
+
+class WorkerProcess(object):
+
+    '''
+    Process of a job run by a worker of a :class:`WorkerPool`. It looks like
+    a subprocess.Popen object to the LocalScheduler, but the process is not
+    a child of the scheduler: it is reaped by the worker, which gives its
+    exit code and resource usage (rusage attribute).
+    '''
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.pid = None
+        self.returncode = None
+        self.rusage = None
+        self._started = threading.Event()
+        self._ended = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def communicate(self):
+        self._ended.wait()
+        return (None, None)
+
+    def kill(self):
+        '''
+        Kill the job process with its children processes, unless it has
+        ended (it may have been reaped by the worker already)
+        '''
+        if self.returncode is not None:
+            return
+        try:
+            if have_psutil:
+                try:
+                    kill_process_tree(self.pid)
+                except psutil.NoSuchProcess:
+                    pass
+            else:
+                # the job has its own process group
+                os.killpg(self.pid, signal.SIGKILL)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+class WorkerPool(object):
+
+    '''
+    Long-lived worker processes running the jobs of a LocalScheduler, to
+    avoid the startup cost of a new process for each short job (see
+    :mod:`soma_workflow.schedulers.local_worker`).
+
+    The workers are started when needed, up to size workers, and each one
+    runs one job at a time, in a process of its own: python jobs are run by
+    the already started interpreter of the worker, in a forked process,
+    other commands are started as usual by the worker.
+
+    Parameters
+    ----------
+    size: int
+        maximum number of workers
+    callback: callable
+        called with the job id given to submit() when the job process has
+        ended, in a thread of the pool. The worker is available for other
+        jobs meanwhile.
+    '''
+
+    # seconds to wait for a worker to start a job process
+    start_timeout = 10
+
+    def __init__(self, size, callback):
+        self.size = size
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._workers = []
+        self._idle = []
+        self._closed = False
+        # ended jobs, notified by a thread of their own, so that the replies
+        # of the workers are always read: the scheduler waits for them
+        # while its lock is held, and the callback needs this lock
+        self._ended_jobs = queue.Queue()
+        self._callbacks_thread = threading.Thread(
+            name='worker_pool_callbacks', target=self._call_callbacks)
+        self._callbacks_thread.daemon = True
+        self._callbacks_thread.start()
+
+    @staticmethod
+    def is_supported():
+        '''
+        Tells if worker pools can be used on this system. Workers are
+        started with the pass_fds argument of subprocess.Popen(), which
+        python 2 only has with subprocess32.
+        '''
+        if sys.platform == 'win32' or not hasattr(os, 'fork') \
+                or not hasattr(os, 'wait4'):
+            return False
+        if six.PY3:
+            return True
+        try:
+            args = inspect.getargspec(subprocess.Popen.__init__).args
+        except TypeError:
+            return False
+        return 'pass_fds' in args
+
+    def submit(self, job_id, job, cores=None):
+        '''
+        Run the job on an idle worker.
+
+        Parameters
+        ----------
+        job_id: str
+        job: EngineJob
+        cores: list of int
+            CPU cores the job process is pinned to (optional)
+
+        Returns
+        -------
+        process: WorkerProcess
+            None if no worker is available, or if the job process could not
+            be started: the job should then be started as usual.
+        '''
+        with self._lock:
+            if self._closed:
+                return None
+            if self._idle:
+                worker = self._idle.pop()
+            elif len(self._workers) < self.size:
+                try:
+                    worker = self._start_worker()
+                except Exception as e:
+                    LocalScheduler.logger.error(
+                        'cannot start a worker: ' + repr(e))
+                    return None
+                self._workers.append(worker)
+            else:
+                return None
+        env = job.env
+        if cores:
+            env = LocalScheduler.threads_environment(env, cores)
+        request = {'job_id': job_id,
+                   'command': job.plain_command(),
+                   # the command of a container is not run by the worker
+                   # interpreter
+                   'python': bool(job.python_job)
+                   and job.container_command is None,
+                   'stdin': job.plain_stdin(),
+                   'stdout': job.plain_stdout(),
+                   'stderr': job.plain_stderr(),
+                   'cwd': job.plain_working_directory(),
+                   'env': env,
+                   'cores': list(cores) if cores else None}
+        process = WorkerProcess(job_id)
+        worker.process = process
+        try:
+            worker.stdin.write(
+                json.dumps(request).encode('utf-8') + b'\n')
+            worker.stdin.flush()
+        except (IOError, OSError, TypeError, ValueError) as e:
+            LocalScheduler.logger.error(
+                'cannot send a job to a worker: ' + repr(e))
+            self._stop_worker(worker)
+            return None
+        if not process._started.wait(self.start_timeout):
+            LocalScheduler.logger.error(
+                'the worker did not start the job ' + job_id)
+            self._stop_worker(worker)
+            return None
+        if process.pid is None:
+            return None
+        return process
+
+    def close(self):
+        '''
+        Stop the workers: idle workers exit now, busy ones when their job
+        has ended.
+        '''
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+            self._idle = []
+            if not workers:
+                self._ended_jobs.put(None)
+        for worker in workers:
+            try:
+                worker.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def _start_worker(self):
+        # the worker imports local_worker from the soma_workflow package
+        # used here
+        package_dir = os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))
+        code = 'import sys; sys.path[0] = %r; ' \
+            'from soma_workflow.schedulers.local_worker import main; ' \
+            'main()' % package_dir
+        read_fd, write_fd = os.pipe()
+        try:
+            worker = subprocess.Popen([sys.executable, '-c', code,
+                                       str(write_fd)],
+                                      stdin=subprocess.PIPE,
+                                      pass_fds=(write_fd, ))
+        except Exception:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        worker.replies = os.fdopen(read_fd, 'rb')
+        worker.process = None
+        thread = threading.Thread(name='local_worker_%d' % worker.pid,
+                                  target=self._read_replies, args=(worker, ))
+        thread.daemon = True
+        thread.start()
+        return worker
+
+    def _stop_worker(self, worker):
+        # the job was not started
+        worker.process = None
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+            if worker in self._idle:
+                self._idle.remove(worker)
+        try:
+            worker.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            worker.kill()
+        except OSError:
+            pass
+
+    def _release_worker(self, worker):
+        with self._lock:
+            worker.process = None
+            if not self._closed and worker in self._workers:
+                self._idle.append(worker)
+
+    def _call_callbacks(self):
+        while True:
+            job_id = self._ended_jobs.get()
+            if job_id is None:
+                break
+            self._callback(job_id)
+
+    def _read_replies(self, worker):
+        '''
+        Thread reading the answers of a worker
+        '''
+        for line in worker.replies:
+            reply = json.loads(line.decode('utf-8'))
+            process = worker.process
+            if process is None or process.job_id != reply['job_id']:
+                continue
+            if 'pid' in reply:
+                process.pid = reply['pid']
+                if process.pid is None:
+                    # not started: the worker waits for another job
+                    self._release_worker(worker)
+                process._started.set()
+            else:
+                process.rusage = WorkerResourceUsage(*reply['rusage'])
+                process.returncode = reply['returncode']
+                process._ended.set()
+                self._release_worker(worker)
+                self._ended_jobs.put(process.job_id)
+        worker.replies.close()
+        worker.wait()
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+            if worker in self._idle:
+                self._idle.remove(worker)
+            closed = self._closed
+            last_worker = closed and not self._workers
+        process = worker.process
+        if process is not None:
+            if not closed:
+                LocalScheduler.logger.error(
+                    'worker %d ended while running the job %s'
+                    % (worker.pid, process.job_id))
+            process._started.set()
+            if process.pid is not None and process.returncode is None:
+                process.kill()
+                process.returncode = -signal.SIGKILL
+                process._ended.set()
+                self._ended_jobs.put(process.job_id)
+        if last_worker:
+            self._ended_jobs.put(None)
+
+
+class ProcessReaper(object):
+
+    '''
+    Thread waiting for the end of processes, using Linux pidfds
+    (os.pidfd_open()): the callback is called with the id of a process as
+    soon as it has ended. The process is not reaped: the callback should
+    do it.
+
+    Parameters
+    ----------
+    callback: callable
+        called with the job id given to add(), in the reaper thread
+    '''
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._lock = threading.Lock()
+        # (pidfd, job_id) to watch, added by other threads
+        self._added = []
+        self._closed = False
+        self._read_fd, self._write_fd = os.pipe()
+        # add() must not block when the pipe is full
+        os.set_blocking(self._write_fd, False)
+        self._thread = threading.Thread(name='process_reaper',
+                                        target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def is_supported():
+        '''
+        Tells if pidfds can be used on this system
+        '''
+        if not hasattr(os, 'pidfd_open') or not hasattr(select, 'poll'):
+            return False
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+        except OSError:
+            return False
+        return True
+
+    def add(self, job_id, pid):
+        '''
+        Watch the process pid, which must be a child process which has not
+        been reaped yet.
+        '''
+        pidfd = os.pidfd_open(pid)
+        with self._lock:
+            if self._closed:
+                os.close(pidfd)
+                return
+            self._added.append((pidfd, job_id))
+            self._wake_up()
+
+    def _wake_up(self):
+        # the lock must be held
+        try:
+            os.write(self._write_fd, b'.')
+        except BlockingIOError:
+            # the thread has not read the former ones yet
+            pass
+
+    def close(self):
+        '''
+        Stop the reaper thread. The callback may still be called for
+        processes which have already ended.
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wake_up()
+
+    def _loop(self):
+        poller = select.poll()
+        poller.register(self._read_fd, select.POLLIN)
+        job_ids = {}
+        while True:
+            for fd, event in poller.poll():
+                if fd == self._read_fd:
+                    os.read(self._read_fd, 4096)
+                    with self._lock:
+                        added = self._added
+                        self._added = []
+                        closed = self._closed
+                    for pidfd, job_id in added:
+                        job_ids[pidfd] = job_id
+                        poller.register(pidfd, select.POLLIN)
+                    if closed:
+                        for pidfd in job_ids:
+                            os.close(pidfd)
+                        with self._lock:
+                            os.close(self._read_fd)
+                            os.close(self._write_fd)
+                        return
+                else:
+                    job_id = job_ids.pop(fd)
+                    poller.unregister(fd)
+                    os.close(fd)
+                    try:
+                        self._callback(job_id)
+                    except Exception as e:
+                        if LocalScheduler.logger is not None:
+                            LocalScheduler.logger.exception(e)
+
+
 def kill_process_tree(pid):
     """
     Kill a process with its children.
@@ -497,14 +1472,20 @@ class ConfiguredLocalScheduler(LocalScheduler):
         super(ConfiguredLocalScheduler, self).__init__(
             config.get_proc_nb(),
             config.get_interval(),
-            config.get_max_proc_nb())
+            config.get_max_proc_nb(),
+            config.get_max_memory(),
+            config.get_cpu_affinity(),
+            config.get_worker_pool())
         self._config = config
 
         self._config.addObserver(self,
                                  "update_from_config",
                                  [LocalSchedulerCfg.PROC_NB_CHANGED,
                                   LocalSchedulerCfg.INTERVAL_CHANGED,
-                                  LocalSchedulerCfg.MAX_PROC_NB_CHANGED, ])
+                                  LocalSchedulerCfg.MAX_PROC_NB_CHANGED,
+                                  LocalSchedulerCfg.MAX_MEMORY_CHANGED,
+                                  LocalSchedulerCfg.CPU_AFFINITY_CHANGED,
+                                  LocalSchedulerCfg.WORKER_POOL_CHANGED, ])
 
     def update_from_config(self, observable, event, msg):
         if event == LocalSchedulerCfg.PROC_NB_CHANGED:
@@ -513,6 +1494,12 @@ class ConfiguredLocalScheduler(LocalScheduler):
             self.change_interval(self._config.get_interval())
         elif event == LocalSchedulerCfg.MAX_PROC_NB_CHANGED:
             self.change_max_proc_nb(self._config.get_max_proc_nb())
+        elif event == LocalSchedulerCfg.MAX_MEMORY_CHANGED:
+            self.change_max_memory(self._config.get_max_memory())
+        elif event == LocalSchedulerCfg.CPU_AFFINITY_CHANGED:
+            self.change_cpu_affinity(self._config.get_cpu_affinity())
+        elif event == LocalSchedulerCfg.WORKER_POOL_CHANGED:
+            self.change_worker_pool(self._config.get_worker_pool())
         self._config.save_to_file()
 
     @classmethod
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+'''
+Worker process of the LocalScheduler worker pool
+(see :class:`soma_workflow.schedulers.local_scheduler.WorkerPool`).
+
+A worker is a long-lived python interpreter which runs the jobs sent by the
+scheduler, one at a time. The command of a python job (see the python_job
+attribute of :class:`~soma_workflow.client.Job`) is run by the already
+started interpreter, in a process forked for the job, once its working
+directory, environment and standard streams are set: ``python -m module
+args``, ``python script.py args`` and ``python -c code args`` commands are
+supported, when ``python`` is the interpreter of the worker. Other commands
+are started as usual (subprocess.Popen()), which is cheaper than forking
+the worker, then executing the command.
+
+Jobs thus never share a process: one job can't change the state of another
+one, or of the worker.
+
+The jobs are received on the standard input of the worker, and the worker
+answers on the file descriptor given as argument. Messages are JSON
+objects, one per line:
+
+* request: ``{"job_id", "command", "python", "stdin", "stdout", "stderr",
+  "cwd", "env", "cores"}``
+* answer when the job process is started: ``{"job_id", "pid"}``, pid being
+  null if the process could not be started
+* answer when it has ended: ``{"job_id", "returncode", "rusage"}`` where
+  rusage is ``[ru_utime, ru_stime, ru_maxrss]``
+
+The worker exits when its standard input is closed.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import atexit
+import io
+import json
+import os
+import runpy
+import sys
+import traceback
+try:
+    from shutil import which
+except ImportError:
+    # python 2
+    from distutils.spawn import find_executable as which
+
+from soma_workflow import subprocess
+
+
+def worker_loop(requests, replies):
+    '''
+    Run the jobs read on requests (binary file object), and write the
+    answers on replies (binary file object).
+    '''
+    base_env = dict(os.environ)
+    while True:
+        line = requests.readline()
+        if not line:
+            break
+        request = json.loads(line.decode('utf-8'))
+        env = request.get('env') or {}
+        if request.get('python') and python_command_supported(
+                request['command'], env.get('PATH', base_env.get('PATH')),
+                request.get('cwd')):
+            pid = os.fork()
+            if pid == 0:
+                run_job(request, base_env, (requests, replies))
+        else:
+            pid = start_command(request, base_env)
+        send(replies, {'job_id': request['job_id'], 'pid': pid})
+        if pid is None:
+            continue
+        status, rusage = os.wait4(pid, 0)[1:]
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        send(replies, {'job_id': request['job_id'],
+                       'returncode': returncode,
+                       'rusage': [rusage.ru_utime, rusage.ru_stime,
+                                  rusage.ru_maxrss]})
+
+
+def send(replies, message):
+    replies.write(json.dumps(message).encode('utf-8') + b'\n')
+    replies.flush()
+
+
+def start_command(request, base_env):
+    '''
+    Start the command of a job which is not run by the worker interpreter,
+    and return its pid (None if it could not be started).
+    '''
+    files = [None, None, None]
+    try:
+        for i, (path, mode) in enumerate(((request.get('stdin'), 'rb'),
+                                          (request.get('stdout'), 'wb'),
+                                          (request.get('stderr'), 'wb'))):
+            if path:
+                files[i] = open(path, mode)
+        if files[0] is None:
+            files[0] = open(os.devnull, 'rb')
+        env = dict(base_env)
+        if request.get('env'):
+            env.update(request['env'])
+        cores = request.get('cores')
+
+        def preexec_fn():
+            # a session of its own, as jobs started by the LocalScheduler
+            os.setsid()
+            if cores:
+                os.sched_setaffinity(0, cores)
+        process = subprocess.Popen(request['command'], stdin=files[0],
+                                   stdout=files[1], stderr=files[2],
+                                   cwd=request.get('cwd') or None, env=env,
+                                   preexec_fn=preexec_fn)
+        # reaped by the worker loop, not by subprocess
+        process.returncode = 0
+        return process.pid
+    except Exception as e:
+        message = '%s: %s \n' % (type(e), e)
+        output = files[2] or files[1]
+        if output is not None:
+            output.write(message.encode('utf-8'))
+        else:
+            sys.stderr.write(message)
+        return None
+    finally:
+        for f in files:
+            if f is not None:
+                f.close()
+
+
+def run_job(request, base_env, worker_files):
+    '''
+    Run the python job in the forked process, and exit.
+    '''
+    returncode = 127
+    try:
+        for f in worker_files:
+            f.close()
+        # a process group of its own, as jobs started by the LocalScheduler,
+        # so that the job can be killed with its children processes
+        os.setsid()
+        redirect(request.get('stdout'), 1, os.O_WRONLY | os.O_CREAT
+                 | os.O_TRUNC)
+        redirect(request.get('stderr'), 2, os.O_WRONLY | os.O_CREAT
+                 | os.O_TRUNC)
+        redirect(request.get('stdin') or os.devnull, 0, os.O_RDONLY)
+        sys.stdin = io.open(0, 'r', closefd=False)
+        if request.get('cwd'):
+            os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(base_env)
+        if request.get('env'):
+            os.environ.update(request['env'])
+        if request.get('cores'):
+            os.sched_setaffinity(0, request['cores'])
+        returncode = run_python(request['command'], base_env)
+    except SystemExit as e:
+        returncode = exit_code(e)
+    except BaseException:
+        traceback.print_exc()
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(returncode)
+
+
+def redirect(path, fd, flags):
+    if path is None:
+        return
+    file_fd = os.open(path, flags, 0o666)
+    if file_fd != fd:
+        os.dup2(file_fd, fd)
+        os.close(file_fd)
+
+
+def python_command_supported(command, path=None, cwd=None):
+    '''
+    Tells if the command is a ``python -m``, ``python -c`` or
+    ``python script.py`` command which can be run in the worker interpreter:
+    ``python`` must be the worker interpreter (looked for in path, the PATH
+    of the job, unless it is a path, relative to cwd).
+    '''
+    if len(command) < 2:
+        return False
+    executable = command[0]
+    if not os.path.dirname(executable):
+        executable = which(executable, path=path)
+    elif cwd:
+        executable = os.path.join(cwd, executable)
+    if not executable or not same_interpreter(executable, sys.executable):
+        return False
+    if command[1] in ('-m', '-c'):
+        return len(command) >= 3
+    return not command[1].startswith('-')
+
+
+def same_interpreter(executable, other_executable):
+    '''
+    Tells if both executables are the same python interpreter, in the same
+    virtual environment if any.
+    '''
+    def venv_dir(path):
+        # the python of a virtual environment is often a link to the base
+        # interpreter
+        directory = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+        if os.path.exists(os.path.join(directory, 'pyvenv.cfg')):
+            return directory
+        return None
+
+    return os.path.realpath(executable) == os.path.realpath(other_executable) \
+        and venv_dir(executable) == venv_dir(other_executable)
+
+
+def run_python(command, base_env):
+    '''
+    Run the python command in this interpreter, as a new interpreter would,
+    and return its exit code.
+    '''
+    args = command[1:]
+    if args[0] == '-m':
+        sys.argv = ['-m'] + args[2:]
+        sys.path[0] = os.getcwd()
+    elif args[0] == '-c':
+        sys.argv = ['-c'] + args[2:]
+        sys.path[0] = ''
+    else:
+        sys.argv = args
+        sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+    # PYTHONPATH entries of the job which the worker did not get
+    python_path = os.environ.get('PYTHONPATH')
+    if python_path and python_path != base_env.get('PYTHONPATH'):
+        sys.path[1:1] = [path for path in python_path.split(os.pathsep)
+                         if path and path not in sys.path]
+    returncode = 0
+    try:
+        if args[0] == '-m':
+            runpy.run_module(args[1], run_name='__main__', alter_sys=True)
+        elif args[0] == '-c':
+            exec(compile(args[1], '<string>', 'exec'),
+                 {'__name__': '__main__', '__builtins__': __builtins__})
+        else:
+            runpy.run_path(args[0], run_name='__main__')
+    except SystemExit as e:
+        returncode = exit_code(e)
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    if hasattr(atexit, '_run_exitfuncs'):
+        atexit._run_exitfuncs()
+    return returncode
+
+
+def exit_code(system_exit):
+    code = system_exit.code
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xff
+    print(code, file=sys.stderr)
+    return 1
+
+
+def main():
+    replies_fd = int(sys.argv[1])
+    if hasattr(sys.stdin, 'buffer'):
+        requests = sys.stdin.buffer
+    else:
+        requests = sys.stdin
+    replies = os.fdopen(replies_fd, 'wb')
+    worker_loop(requests, replies)
+
+
+if __name__ == '__main__':
+    main()
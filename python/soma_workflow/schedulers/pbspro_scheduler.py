@@ -136,6 +136,17 @@ class PBSProScheduler(Scheduler):
     is_sleeping = False
     FAKE_JOB = -167
 
+    # max number of jobs queried in a single qstat command
+    qstat_max_jobs = 2000
+
+    # qsub commands are independent processes: they can run concurrently
+    submission_workers = 4
+
+    # extended status of jobs obtained during the last get_jobs_status()
+    # call, reused by get_jobs_exit_info() to avoid another qstat call
+    # dict: scheduler_job_id -> extended status dict
+    _extended_status_cache = None
+
     def __init__(self,
                  parallel_job_submission_info,
                  tmp_file_path=None,
@@ -147,6 +158,8 @@ class PBSProScheduler(Scheduler):
 
         self.wake()
 
+        self._extended_status_cache = {}
+
         # self.hostname = socket.gethostname()
         # use full qualified hostname, because of a probable bug on our
         # cluster.
@@ -448,28 +461,9 @@ class PBSProScheduler(Scheduler):
                 super_status = json.loads(json_str)
 
             else:  # torque/pbs
-                import xml.etree.cElementTree as ET
                 cmd = ['qstat', '-x', scheduler_job_id]
                 xml_str = subprocess.check_output(cmd).decode('utf-8')
-                super_status = {}
-                s_xml = ET.fromstring(xml_str)
-                xjob = s_xml[0]
-                job = {}
-                parsing = [(xjob, job)]
-                while parsing:
-                    element, parent = parsing.pop(0)
-                    for child in element:
-                        tag = child.tag
-                        if tag == 'Job_Id':
-                            super_status['Jobs'] = {child.text: job}
-                        else:
-                            if len(child) != 0:
-                                current = {}
-                                parsing.append((child, current))
-                            else:
-                                current = child.text
-                            parent[tag] = current
-                    current = None
+                super_status = self._parse_torque_xml_status(xml_str)
         except Exception as e:
             self.logger.critical("%s: %s" % (type(e), e))
             raise
@@ -478,6 +472,81 @@ class PBSProScheduler(Scheduler):
                           + ': ' + repr(status))
         return status
 
+    @staticmethod
+    def _parse_torque_xml_status(xml_str):
+        '''
+        Parse the XML output of torque "qstat -x" into a dict similar to the
+        JSON output of PBS Pro "qstat -F json": {'Jobs': {job_id: status}}
+        '''
+        import xml.etree.cElementTree as ET
+        jobs = {}
+        super_status = {'Jobs': jobs}
+        s_xml = ET.fromstring(xml_str)
+        for xjob in s_xml:
+            job = {}
+            parsing = [(xjob, job)]
+            while parsing:
+                element, parent = parsing.pop(0)
+                for child in element:
+                    tag = child.tag
+                    if tag == 'Job_Id':
+                        jobs[child.text] = job
+                    else:
+                        if len(child) != 0:
+                            current = {}
+                            parsing.append((child, current))
+                        else:
+                            current = child.text
+                        parent[tag] = current
+                current = None
+        return super_status
+
+    def get_jobs_extended_status(self, scheduler_job_ids):
+        '''
+        Get full status of several jobs using a single qstat command (or a
+        few ones for a very large number of jobs).
+
+        Jobs unknown to the DRMS are not included in the result.
+
+        Returns
+        -------
+        statuses: dict
+            scheduler_job_id -> extended status dict
+        '''
+        if self.is_sleeping:
+            self.wake()
+        statuses = {}
+        scheduler_job_ids = [job_id for job_id in scheduler_job_ids
+                             if job_id != self.FAKE_JOB]
+        for i in range(0, len(scheduler_job_ids), self.qstat_max_jobs):
+            chunk = scheduler_job_ids[i:i + self.qstat_max_jobs]
+            if self._pbs_impl == 'pbspro':
+                cmd = ['qstat', '-x', '-f', '-F', 'json'] + chunk
+            else:  # torque/pbs
+                cmd = ['qstat', '-x'] + chunk
+            # qstat returns an error code if one of the jobs is unknown, but
+            # still prints the status of the other ones.
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            output, errors = process.communicate()
+            output = output.decode('utf-8')
+            if process.returncode != 0:
+                self.logger.debug('qstat returned %d: %s'
+                                  % (process.returncode, errors))
+            if not output.strip():
+                continue
+            try:
+                if self._pbs_impl == 'pbspro':
+                    super_status = json.loads(output)
+                else:
+                    super_status = self._parse_torque_xml_status(output)
+            except Exception as e:
+                self.logger.critical("%s: %s" % (type(e), e))
+                raise DRMError('could not parse qstat output: %s: %s'
+                               % (type(e), e))
+            statuses.update(super_status.get('Jobs', {}))
+        return statuses
+
     def get_pbs_status_codes(self):
         if self._pbs_impl == 'pbspro':
             class codes(object):
@@ -524,7 +593,6 @@ class PBSProScheduler(Scheduler):
         if scheduler_job_id == self.FAKE_JOB:
             # it's a barrier job, doesn't exist in DRMS, and it's always done.
             return constants.DONE
-        codes = self.get_pbs_status_codes()
         try:
             status = self.get_job_extended_status(scheduler_job_id)
             state = status['job_state']
@@ -532,6 +600,43 @@ class PBSProScheduler(Scheduler):
                 'get_job_status for: ' + repr(scheduler_job_id) + ': ', repr(state))
         except Exception:
             return constants.UNDETERMINED
+        return self._status_from_extended_status(status)
+
+    def get_jobs_status(self, scheduler_job_ids):
+        '''
+        Get the status of several jobs using a single qstat command.
+
+        Parameters
+        ----------
+        scheduler_job_ids: list
+            Jobs ids for the scheduling system
+
+        Returns
+        -------
+        statuses: dict
+            scheduler_job_id -> status, as defined in constants.JOB_STATUS
+        '''
+        ext_statuses = self.get_jobs_extended_status(scheduler_job_ids)
+        self._extended_status_cache = ext_statuses
+        statuses = {}
+        for scheduler_job_id in scheduler_job_ids:
+            if scheduler_job_id == self.FAKE_JOB:
+                statuses[scheduler_job_id] = constants.DONE
+                continue
+            status = ext_statuses.get(scheduler_job_id)
+            if status is None or 'job_state' not in status:
+                statuses[scheduler_job_id] = constants.UNDETERMINED
+            else:
+                statuses[scheduler_job_id] \
+                    = self._status_from_extended_status(status)
+        return statuses
+
+    def _status_from_extended_status(self, status):
+        '''
+        Convert a qstat job status dict into a constants.JOB_STATUS value
+        '''
+        codes = self.get_pbs_status_codes()
+        state = status['job_state']
         if state == codes.ARRAY_STARTED:
             return constants.RUNNING
         elif state == codes.EXITING:
@@ -603,66 +708,113 @@ class PBSProScheduler(Scheduler):
             return (res_status, res_exitValue, res_termSignal,
                     res_resourceUsage)
 
-        res_resourceUsage = []
-        res_status = constants.EXIT_UNDETERMINED
-        res_exitValue = 0
-        res_termSignal = None
-
         try:
             self.logger.debug(
                 "  ==> Start to find info of job %s" % (scheduler_job_id))
             status = self.get_job_extended_status(scheduler_job_id)
-            jid_out = status['Output_Path']
-            exit_value = status.get('Exit_status', -1)
-            signaled = False
-            term_sig = 0
-            if exit_value >= 256:
-                signaled = True
-                term_sig = exit_value % 256
-            coredumped = (term_sig == 2)
-            aborted = (exit_value <= -4 and exit_value >= -6)
-            exit_status = exit_value
-            resource_usage = status.get('resources_used', {})
-            # jid_out, exit_value, signaled, term_sig, coredumped, aborted, exit_status, resource_usage = self._drmaa.wait(
-            #     scheduler_job_id, self._drmaa.TIMEOUT_NO_WAIT)
-
-            self.logger.debug("  ==> jid_out=" + repr(jid_out))
-            self.logger.debug("  ==> exit_value=" + repr(exit_value))
-            self.logger.debug("  ==> signaled=" + repr(signaled))
-            self.logger.debug("  ==> term_sig=" + repr(term_sig))
-            self.logger.debug("  ==> coredumped=" + repr(coredumped))
-            self.logger.debug("  ==> aborted=" + repr(aborted))
-            self.logger.debug("  ==> exit_status=" + repr(exit_status))
-            self.logger.debug(
-                "  ==> resource_usage=" + repr(resource_usage))
+        except ExitTimeoutException:
+            self.logger.debug("  ==> wait time out")
+            return (constants.EXIT_UNDETERMINED, 0, None, [])
+        return self._exit_info_from_extended_status(status)
+
+    def get_jobs_exit_info(self, scheduler_job_ids):
+        '''
+        Get the exit info of several jobs. The status obtained during the
+        last :meth:`get_jobs_status` call is used when available, the other
+        jobs are queried using a single qstat command.
+
+        Parameters
+        ----------
+        scheduler_job_ids: list
+            Jobs ids for the scheduling system
+
+        Returns
+        -------
+        exit_info: dict
+            scheduler_job_id -> exit info tuple (exit_status, exit_value,
+            term_sig, resource_usage)
+        '''
+        cache = self._extended_status_cache
+        self._extended_status_cache = {}
+        ext_statuses = {}
+        missing = []
+        for scheduler_job_id in scheduler_job_ids:
+            if scheduler_job_id == self.FAKE_JOB:
+                continue
+            status = cache.get(scheduler_job_id)
+            if status is None:
+                missing.append(scheduler_job_id)
+            else:
+                ext_statuses[scheduler_job_id] = status
+        if missing:
+            ext_statuses.update(self.get_jobs_extended_status(missing))
+        exit_info = {}
+        for scheduler_job_id in scheduler_job_ids:
+            status = ext_statuses.get(scheduler_job_id)
+            if status is None:
+                # FAKE_JOB or unknown job: use the single job method
+                exit_info[scheduler_job_id] \
+                    = self.get_job_exit_info(scheduler_job_id)
+            else:
+                exit_info[scheduler_job_id] \
+                    = self._exit_info_from_extended_status(status)
+        return exit_info
 
-            if aborted:
-                res_status = constants.EXIT_ABORTED
+    def _exit_info_from_extended_status(self, status):
+        '''
+        Build the exit info tuple from a qstat job status dict
+        '''
+        res_status = constants.EXIT_UNDETERMINED
+        res_exitValue = 0
+        res_termSignal = None
+
+        jid_out = status['Output_Path']
+        exit_value = status.get('Exit_status', -1)
+        signaled = False
+        term_sig = 0
+        if exit_value >= 256:
+            signaled = True
+            term_sig = exit_value % 256
+        coredumped = (term_sig == 2)
+        aborted = (exit_value <= -4 and exit_value >= -6)
+        exit_status = exit_value
+        resource_usage = status.get('resources_used', {})
+        # jid_out, exit_value, signaled, term_sig, coredumped, aborted, exit_status, resource_usage = self._drmaa.wait(
+        #     scheduler_job_id, self._drmaa.TIMEOUT_NO_WAIT)
+
+        self.logger.debug("  ==> jid_out=" + repr(jid_out))
+        self.logger.debug("  ==> exit_value=" + repr(exit_value))
+        self.logger.debug("  ==> signaled=" + repr(signaled))
+        self.logger.debug("  ==> term_sig=" + repr(term_sig))
+        self.logger.debug("  ==> coredumped=" + repr(coredumped))
+        self.logger.debug("  ==> aborted=" + repr(aborted))
+        self.logger.debug("  ==> exit_status=" + repr(exit_status))
+        self.logger.debug(
+            "  ==> resource_usage=" + repr(resource_usage))
+
+        if aborted:
+            res_status = constants.EXIT_ABORTED
+        else:
+            if exit_value == 0:
+                res_status = constants.FINISHED_REGULARLY
+                res_exitValue = exit_status
             else:
-                if exit_value == 0:
-                    res_status = constants.FINISHED_REGULARLY
-                    res_exitValue = exit_status
+                res_exitValue = exit_status
+                if signaled:
+                    res_status = constants.FINISHED_TERM_SIG
+                    res_termSignal = term_sig
                 else:
-                    res_exitValue = exit_status
-                    if signaled:
-                        res_status = constants.FINISHED_TERM_SIG
-                        res_termSignal = term_sig
-                    else:
-                        # in soma-workflow a job with a non-zero exit code
-                        # has still finished regularly (ran without being
-                        # interrupted)
-                        # res_status = constants.EXIT_ABORTED
-                        res_status = constants.FINISHED_REGULARLY
-
-            self.logger.info("  ==> res_status=" + repr(res_status))
-            res_resourceUsage = u''
-            for k, v in six.iteritems(resource_usage):
-                res_resourceUsage = res_resourceUsage + \
-                    k + u'=' + str(v) + u' '
+                    # in soma-workflow a job with a non-zero exit code
+                    # has still finished regularly (ran without being
+                    # interrupted)
+                    # res_status = constants.EXIT_ABORTED
+                    res_status = constants.FINISHED_REGULARLY
 
-        except ExitTimeoutException:
-            res_status = constants.EXIT_UNDETERMINED
-            self.logger.debug("  ==> wait time out")
+        self.logger.info("  ==> res_status=" + repr(res_status))
+        res_resourceUsage = u''
+        for k, v in six.iteritems(resource_usage):
+            res_resourceUsage = res_resourceUsage + \
+                k + u'=' + str(v) + u' '
 
         return (res_status, res_exitValue, res_termSignal, res_resourceUsage)
 
@@ -35,14 +35,16 @@ if __name__ == '__main__':
                      tmp_file_dir_path,
                      shared_tmp_dir=None,
                      logging_configuration=None,
-                     remove_orphan_files=True):
+                     remove_orphan_files=True,
+                     wal_mode=False):
             soma_workflow.database_server.WorkflowDatabaseServer.__init__(
                 self,
                 database_file,
                 tmp_file_dir_path,
                 shared_tmp_dir,
                 logging_configuration,
-                remove_orphan_files)
+                remove_orphan_files,
+                wal_mode)
 
     if not len(sys.argv) == 2:
         sys.stdout.write(
@@ -83,7 +85,13 @@ if __name__ == '__main__':
                                     config.get_transfered_file_dir(),
                                     config.get_shared_temporary_directory(),
                                     config.get_server_log_info(),
-                                    config.get_remove_orphan_files())
+                                    config.get_remove_orphan_files(),
+                                    config.get_database_wal_mode())
+    janitor_interval = config.get_database_janitor_interval()
+    if janitor_interval > 0:
+        server.start_janitor(janitor_interval,
+                             config.get_database_janitor_max_lock_time(),
+                             config.get_workflow_archive_dir())
 
     logging.debug("The server has been instantiated ")
 
@@ -304,7 +304,8 @@ if __name__ == "__main__":
             database_server = WorkflowDatabaseServer(
                 config.get_database_file(),
                 config.get_transfered_file_dir(),
-                remove_orphan_files=config.get_remove_orphan_files())
+                remove_orphan_files=config.get_remove_orphan_files(),
+                wal_mode=config.get_database_wal_mode())
         else:
             database_server = get_database_server_proxy(config, logger)
             logger.debug("database_server launched")
@@ -13,6 +13,21 @@ if '--debug' in sys.argv[1:]:
 
 res = True
 
+import soma_workflow.test.test_engine_loop
+res &= soma_workflow.test.test_engine_loop.test()
+
+import soma_workflow.test.test_workflow_readiness
+res &= soma_workflow.test.test_workflow_readiness.test()
+
+import soma_workflow.test.test_database_server
+res &= soma_workflow.test.test_database_server.test()
+
+import soma_workflow.test.test_local_scheduler
+res &= soma_workflow.test.test_local_scheduler.test()
+
+import soma_workflow.test.test_engine_encoding
+res &= soma_workflow.test.test_engine_encoding.test()
+
 import soma_workflow.test.job_tests.test_workflow_api
 res &= soma_workflow.test.job_tests.test_workflow_api.test()
 
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of the workflow engine internals.
+
+They are not part of the tests suite. Each module can be run as a script,
+for instance::
+
+    python -m soma_workflow.test.benchmarks.critical_path
+'''
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+Latency of the status queries while the database is cleaned.
+
+The database holds many expired workflows, and a running one which status is
+queried in a loop by another thread (as the engine and the clients do),
+while WorkflowDatabaseServer.clean() and vacuum() remove the expired ones.
+The cleaning is done in a single chunk (which is what clean() used to do), or
+by chunks holding the lock at most max_lock_time seconds.
+
+For each mode: the duration of the cleaning, and the mean and max duration
+of the status queries during the cleaning.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine_types import EngineWorkflow
+
+
+def add_workflow(database_server, user_id, nb_jobs):
+    workflow = Workflow(jobs=[Job(command=['true'], name='job %d' % i)
+                              for i in range(nb_jobs)])
+    engine_workflow = EngineWorkflow(workflow, {}, None,
+                                     datetime.now() + timedelta(days=1),
+                                     'bench')
+    return database_server.add_workflow(user_id, engine_workflow)
+
+
+def measure(tmp_dir, args, max_lock_time):
+    transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+    os.mkdir(transfer_dir)
+    database_server = WorkflowDatabaseServer(
+        os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+        remove_orphan_files=False)
+    user_id = database_server.register_user('bench')
+    wf_ids = [add_workflow(database_server, user_id,
+                           args.jobs // args.workflows).wf_id
+              for i in range(args.workflows)]
+    wf_id = add_workflow(database_server, user_id, 10).wf_id
+    connection = database_server._connect()
+    yesterday = datetime.now() - timedelta(days=1)
+    for table in ('workflows', 'jobs'):
+        connection.execute(
+            'UPDATE %s SET expiration_date=? WHERE %s IN (%s)'
+            % (table, 'id' if table == 'workflows' else 'workflow_id',
+               ','.join(['?'] * len(wf_ids))),
+            [yesterday] + wf_ids)
+    connection.commit()
+
+    durations = []
+    done = threading.Event()
+
+    def query():
+        while not done.is_set():
+            t0 = time.time()
+            database_server.get_workflow_status(wf_id, user_id)
+            durations.append(time.time() - t0)
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=query)
+    thread.start()
+    time.sleep(0.1)
+    del durations[:]
+    t0 = time.time()
+    database_server.max_lock_time = max_lock_time
+    database_server.clean()
+    database_server.vacuum()
+    clean_time = time.time() - t0
+    done.set()
+    thread.join()
+    return (clean_time, sum(durations) / max(len(durations), 1),
+            max(durations + [0.]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=200000,
+                        help='number of expired jobs (default: 200000)')
+    parser.add_argument('-w', '--workflows', type=int, default=20,
+                        help='number of expired workflows (default: 20)')
+    parser.add_argument('-l', '--max-lock-time', type=float, default=0.1,
+                        help='max lock time of the chunks, in seconds '
+                        '(default: 0.1)')
+    args = parser.parse_args()
+
+    print('%d expired jobs, %d expired workflows'
+          % (args.jobs, args.workflows))
+    print('%-20s %12s %16s %16s' % ('mode', 'clean (s)', 'mean query (ms)',
+                                    'max query (ms)'))
+    for name, max_lock_time in (('single chunk', 1e9),
+                                ('chunks of %g s' % args.max_lock_time,
+                                 args.max_lock_time)):
+        tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+        try:
+            clean_time, mean_query, max_query = measure(tmp_dir, args,
+                                                        max_lock_time)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print('%-20s %12.2f %16.2f %16.2f'
+              % (name, clean_time, mean_query * 1000, max_query * 1000))
+
+
+if __name__ == '__main__':
+    main()
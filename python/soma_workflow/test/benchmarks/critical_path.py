@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+Makespan of synthetic workflows when the number of simultaneously running
+jobs is limited, depending on the jobs submission order used by the engine
+('priority', the former behaviour, or 'critical_path').
+
+The execution is simulated: jobs are queued and popped using the engine
+PendingJobsQueue and sort keys, and critical paths are computed by
+EngineWorkflow, but nothing is actually run.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import heapq
+import random
+import six
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow
+from soma_workflow import engine
+
+
+def wide_then_deep(width=200, depth=50):
+    '''
+    Many independent jobs, followed (in the submission order) by a long
+    chain of jobs.
+    '''
+    wide = [Job(command=['true'], name='wide %d' % i, duration_hint=1.)
+            for i in range(width)]
+    chain = [Job(command=['true'], name='chain %d' % i, duration_hint=1.)
+             for i in range(depth)]
+    return Workflow(jobs=wide + chain,
+                    dependencies=list(zip(chain[:-1], chain[1:])),
+                    name='wide_then_deep')
+
+
+def fork_join(nb_branches=20, max_length=30, rng=random):
+    '''
+    Branches of various lengths between a source and a sink job.
+    '''
+    source = Job(command=['true'], name='source', duration_hint=1.)
+    sink = Job(command=['true'], name='sink', duration_hint=1.)
+    jobs = [source, sink]
+    dependencies = []
+    for b in range(nb_branches):
+        length = rng.randint(1, max_length)
+        branch = [Job(command=['true'], name='branch %d.%d' % (b, i),
+                      duration_hint=rng.uniform(0.5, 2.))
+                  for i in range(length)]
+        jobs += branch
+        dependencies += [(source, branch[0]), (branch[-1], sink)]
+        dependencies += list(zip(branch[:-1], branch[1:]))
+    return Workflow(jobs=jobs, dependencies=dependencies, name='fork_join')
+
+
+def random_layered(nb_jobs=1000, nb_layers=20, max_deps=3, rng=random):
+    '''
+    Random DAG: jobs are spread in layers, and depend on a few jobs of
+    former layers. Durations follow a log-normal distribution.
+    '''
+    layers = [[] for i in range(nb_layers)]
+    jobs = []
+    dependencies = []
+    for i in range(nb_jobs):
+        job = Job(command=['true'], name='job %d' % i,
+                  duration_hint=rng.lognormvariate(0., 1.))
+        layer = rng.randrange(nb_layers)
+        if layer != 0:
+            former = [j for l in layers[:layer] for j in l]
+            if former:
+                for dep in rng.sample(former,
+                                      min(len(former),
+                                          rng.randint(1, max_deps))):
+                    dependencies.append((dep, job))
+        layers[layer].append(job)
+        jobs.append(job)
+    return Workflow(jobs=jobs, dependencies=dependencies,
+                    name='random_layered')
+
+
+def simulate(workflow, nb_slots, submission_order):
+    '''
+    Simulate the execution of a workflow with at most nb_slots jobs running
+    at the same time. Jobs last their duration_hint.
+
+    Returns
+    -------
+    makespan: float
+    '''
+    engine_workflow = EngineWorkflow(workflow, {}, None, None, workflow.name)
+    if submission_order == 'critical_path':
+        engine_workflow.compute_critical_paths()
+    successors = {}
+    nb_deps = dict((job, 0) for job in engine_workflow.jobs)
+    for dep in engine_workflow.dependencies:
+        successors.setdefault(dep[0], []).append(dep[1])
+        nb_deps[dep[1]] += 1
+
+    pending = engine.PendingJobsQueue()
+
+    def pend(client_job):
+        job = engine_workflow.job_mapping[client_job]
+        pending.push(job, engine.pending_job_sort_key(job, submission_order))
+
+    client_jobs = dict((job, client_job) for client_job, job
+                       in six.iteritems(engine_workflow.job_mapping))
+    for client_job in engine_workflow.jobs:
+        if nb_deps[client_job] == 0:
+            pend(client_job)
+    running = []
+    now = 0.
+    seq = 0
+    while pending or running:
+        while pending and len(running) < nb_slots:
+            job = pending.pop()
+            seq += 1
+            heapq.heappush(running, (now + job.duration_hint, seq,
+                                     client_jobs[job]))
+        now, s, client_job = heapq.heappop(running)
+        for succ in successors.get(client_job, []):
+            nb_deps[succ] -= 1
+            if nb_deps[succ] == 0:
+                pend(succ)
+    return now
+
+
+def lower_bound(workflow, nb_slots):
+    engine_workflow = EngineWorkflow(workflow, {}, None, None, workflow.name)
+    engine_workflow.compute_critical_paths()
+    jobs = list(engine_workflow.job_mapping.values())
+    return max(max([job.critical_path for job in jobs]),
+               sum([job.duration_hint for job in jobs]) / nb_slots)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--slots', type=int, default=16,
+                        help='max number of running jobs (default: 16)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workflows = [wide_then_deep(),
+                 fork_join(rng=rng),
+                 random_layered(rng=rng)]
+    print('%-16s %6s %10s %14s %12s'
+          % ('workflow', 'jobs', 'priority', 'critical_path', 'lower bound'))
+    for workflow in workflows:
+        makespans = [simulate(workflow, args.slots, order)
+                     for order in ('priority', 'critical_path')]
+        print('%-16s %6d %10.1f %14.1f %12.1f'
+              % ((workflow.name, len(workflow.jobs)) + tuple(makespans)
+                 + (lower_bound(workflow, args.slots), )))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''
+Number of calls per second of a few frequent WorkflowDatabaseServer
+methods, with a new connection opened for each call (the former behaviour)
+and with persistent connections.
+
+A workflow of simple jobs is registered in a temporary database, then
+get_job_status(), set_jobs_status() and get_detailed_workflow_status() are
+called repeatedly.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine_types import EngineWorkflow
+import soma_workflow.constants as constants
+
+
+def calls_per_second(function, duration):
+    nb_calls = 0
+    t0 = time.time()
+    elapsed = 0.
+    while elapsed < duration:
+        function(nb_calls)
+        nb_calls += 1
+        elapsed = time.time() - t0
+    return nb_calls / elapsed
+
+
+def run(database_server, nb_jobs, duration):
+    user_id = database_server.register_user('bench')
+    workflow = Workflow(jobs=[Job(command=['true'], name='job %d' % i)
+                              for i in range(nb_jobs)])
+    engine_workflow = EngineWorkflow(workflow, {}, None,
+                                     datetime.now() + timedelta(days=1),
+                                     'bench')
+    engine_workflow = database_server.add_workflow(user_id, engine_workflow)
+    wf_id = engine_workflow.wf_id
+    job_ids = list(engine_workflow.registered_jobs.keys())
+    statuses = [constants.QUEUED_ACTIVE, constants.RUNNING]
+
+    def get_job_status(i):
+        database_server.get_job_status(job_ids[i % nb_jobs], user_id)
+
+    def set_jobs_status(i):
+        status = statuses[i % 2]
+        database_server.set_jobs_status(
+            dict((job_id, status) for job_id in job_ids[:10]))
+
+    def get_detailed_workflow_status(i):
+        database_server.get_detailed_workflow_status(wf_id)
+
+    return [(function.__name__, calls_per_second(function, duration))
+            for function in (get_job_status, set_jobs_status,
+                             get_detailed_workflow_status)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=100,
+                        help='number of jobs in the workflow (default: 100)')
+    parser.add_argument('-t', '--time', type=float, default=2.,
+                        help='duration of each measure, in seconds '
+                        '(default: 2)')
+    args = parser.parse_args()
+
+    results = {}
+    for persistent in (False, True):
+        tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+        try:
+            transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+            os.mkdir(transfer_dir)
+            database_server = WorkflowDatabaseServer(
+                os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+                remove_orphan_files=False)
+            database_server.persistent_connections = persistent
+            results[persistent] = run(database_server, args.jobs, args.time)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print('%-30s %12s %12s' % ('calls/s', 'connect', 'persistent'))
+    for (name, before), (name2, after) in zip(results[False],
+                                              results[True]):
+        print('%-30s %12.0f %12.0f' % (name, before, after))
+
+
+if __name__ == '__main__':
+    main()
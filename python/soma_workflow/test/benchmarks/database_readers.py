@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''
+Latency of the status queries of clients (get_detailed_workflow_status and
+get_workflows) while the engine writes jobs status, with the default
+journal mode and with the WAL mode of the database.
+
+Reader threads poll the status of a workflow while a writer thread
+updates the status of its jobs continuously, as the engine does. The
+median and 99th percentile of the read latency are reported.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine_types import EngineWorkflow
+import soma_workflow.constants as constants
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1,
+                int(round(p / 100. * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(database_server, nb_jobs, nb_readers, duration):
+    user_id = database_server.register_user('bench')
+    workflow = Workflow(jobs=[Job(command=['true'], name='job %d' % i)
+                              for i in range(nb_jobs)])
+    engine_workflow = EngineWorkflow(workflow, {}, None,
+                                     datetime.now() + timedelta(days=1),
+                                     'bench')
+    engine_workflow = database_server.add_workflow(user_id, engine_workflow)
+    wf_id = engine_workflow.wf_id
+    job_ids = list(engine_workflow.registered_jobs.keys())
+
+    stop = threading.Event()
+    latencies = []
+    writes = [0]
+
+    def write():
+        statuses = [constants.QUEUED_ACTIVE, constants.RUNNING]
+        while not stop.is_set():
+            status = statuses[writes[0] % 2]
+            database_server.set_jobs_status(
+                dict((job_id, status) for job_id in job_ids))
+            writes[0] += 1
+
+    def read():
+        thread_latencies = []
+        while not stop.is_set():
+            t0 = time.time()
+            database_server.get_detailed_workflow_status(wf_id)
+            database_server.get_workflows(user_id)
+            thread_latencies.append(time.time() - t0)
+        latencies.extend(thread_latencies)
+
+    threads = [threading.Thread(target=write)] \
+        + [threading.Thread(target=read) for i in range(nb_readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return (len(latencies) / duration, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, writes[0] / duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=1000,
+                        help='number of jobs in the workflow (default: 1000)')
+    parser.add_argument('-r', '--readers', type=int, default=4,
+                        help='number of reader threads (default: 4)')
+    parser.add_argument('-t', '--time', type=float, default=5.,
+                        help='duration of each measure, in seconds '
+                        '(default: 5)')
+    args = parser.parse_args()
+
+    print('%d jobs, %d readers' % (args.jobs, args.readers))
+    print('%-10s %10s %10s %10s %10s'
+          % ('mode', 'reads/s', 'p50 (ms)', 'p99 (ms)', 'writes/s'))
+    for wal_mode in (False, True):
+        tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+        try:
+            transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+            os.mkdir(transfer_dir)
+            database_server = WorkflowDatabaseServer(
+                os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+                remove_orphan_files=False, wal_mode=wal_mode)
+            result = run(database_server, args.jobs, args.readers, args.time)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print('%-10s %10.0f %10.2f %10.2f %10.0f'
+              % (('wal' if wal_mode else 'truncate', ) + result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Size and speed of the encoding of the engine workflows stored in the
+database (soma_workflow.engine_encoding), compared to pickle, depending on
+the workflow size.
+
+For each format: the size of the stored data, the time to encode the
+workflow, to decode the whole workflow, and to decode a single job (what
+get_engine_job() does). Times are the best of several runs.
+
+Workflows are made of chains of simple jobs.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine_types import EngineWorkflow
+from soma_workflow.info import DB_PICKLE_PROTOCOL
+from soma_workflow import engine_encoding
+
+
+def chain_workflow(nb_jobs, chain_length=10):
+    '''
+    Chains of chain_length jobs.
+    '''
+    jobs = [Job(command=['echo', str(i)], name='job %d' % i)
+            for i in range(nb_jobs)]
+    dependencies = [(jobs[i - 1], jobs[i]) for i in range(nb_jobs)
+                    if i % chain_length != 0]
+    return Workflow(jobs=jobs, dependencies=dependencies)
+
+
+def best_time(function, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        result = function()
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+def measure(engine_workflow, repeat):
+    job_ids = sorted(engine_workflow.registered_jobs.keys())
+    job_id = job_ids[len(job_ids) // 2]
+    results = []
+
+    encode_time, data = best_time(
+        lambda: engine_encoding.encode_engine_workflow(engine_workflow),
+        repeat)
+    decode_time = best_time(
+        lambda: engine_encoding.decode_engine_workflow(data), repeat)[0]
+    job_time = best_time(
+        lambda: engine_encoding.decode_engine_job(data, job_id), repeat)[0]
+    results.append(('encoding', len(data), encode_time, decode_time,
+                    job_time))
+
+    encode_time, data = best_time(
+        lambda: pickle.dumps(engine_workflow, protocol=DB_PICKLE_PROTOCOL),
+        repeat)
+    decode_time = best_time(lambda: pickle.loads(data), repeat)[0]
+    # a single job is read by unpickling the whole workflow
+    results.append(('pickle', len(data), encode_time, decode_time,
+                    decode_time))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help='workflow sizes, in number of jobs '
+                        '(default: 100 1000 10000)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of runs of each measure (default: 5)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+    try:
+        transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+        os.mkdir(transfer_dir)
+        database_server = WorkflowDatabaseServer(
+            os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+            remove_orphan_files=False)
+        user_id = database_server.register_user('bench')
+        print('%10s %-10s %12s %12s %12s %12s'
+              % ('jobs', 'format', 'size (kB)', 'encode (s)', 'decode (s)',
+                 'job (ms)'))
+        for nb_jobs in args.sizes:
+            engine_workflow = EngineWorkflow(
+                chain_workflow(nb_jobs), {}, None,
+                datetime.now() + timedelta(days=1), 'bench')
+            engine_workflow = database_server.add_workflow(
+                user_id, engine_workflow, login='bench')
+            for name, size, encode_time, decode_time, job_time \
+                    in measure(engine_workflow, args.repeat):
+                print('%10d %-10s %12.1f %12.3f %12.3f %12.2f'
+                      % (nb_jobs, name, size / 1024., encode_time,
+                         decode_time, job_time * 1000))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+Cost of the files paths generation (jobs std out / err files) when jobs are
+submitted one by one (WorkflowDatabaseServer.add_job) and in workflows,
+with the file numbers allocated locally by the server
+(WorkflowDatabaseServer.local_file_numbers) or in the fileCounter table of
+the database.
+
+For each mode: the jobs submission rate, the number of statements which
+access the fileCounter table, and the largest number of files in a
+directory.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine_types import EngineJob, EngineWorkflow
+
+
+def measure(tmp_dir, args, local_file_numbers):
+    transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+    os.mkdir(transfer_dir)
+    database_server = WorkflowDatabaseServer(
+        os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+        remove_orphan_files=False)
+    database_server.local_file_numbers = local_file_numbers
+    user_id = database_server.register_user('bench')
+    statements = []
+    database_server._connect().set_trace_callback(statements.append)
+
+    t0 = time.time()
+    for i in range(args.jobs):
+        database_server.add_job(
+            user_id, EngineJob(Job(command=['true'], name='job %d' % i),
+                               None),
+            login='bench')
+    jobs_rate = args.jobs / (time.time() - t0)
+
+    workflow = Workflow(jobs=[Job(command=['true'], name='job %d' % i)
+                              for i in range(args.workflow_jobs)])
+    t0 = time.time()
+    engine_workflow = database_server.add_workflow(
+        user_id,
+        EngineWorkflow(workflow, {}, None,
+                       datetime.now() + timedelta(days=1), 'bench'),
+        login='bench')
+    workflow_rate = args.workflow_jobs / (time.time() - t0)
+
+    # the files are created, as the jobs would do
+    for engine_job in engine_workflow.job_mapping.values():
+        for path in (engine_job.stdout_file, engine_job.stderr_file):
+            open(path, 'w').close()
+    max_files = max(len(files) for directory, dirs, files
+                    in os.walk(transfer_dir))
+    counter_statements = len([statement for statement in statements
+                              if 'fileCounter' in statement])
+    return jobs_rate, workflow_rate, counter_statements, max_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=5000,
+                        help='number of jobs submitted one by one '
+                        '(default: 5000)')
+    parser.add_argument('-w', '--workflow-jobs', type=int, default=20000,
+                        help='number of jobs of the workflow '
+                        '(default: 20000)')
+    args = parser.parse_args()
+
+    print('%-18s %10s %14s %18s %10s'
+          % ('file numbers', 'add_job/s', 'workflow job/s',
+             'fileCounter stmts', 'max files'))
+    for name, local_file_numbers in (('database', False), ('local', True)):
+        tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+        try:
+            results = measure(tmp_dir, args, local_file_numbers)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print('%-18s %10.0f %14.0f %18d %10d' % ((name, ) + results))
+
+
+if __name__ == '__main__':
+    main()
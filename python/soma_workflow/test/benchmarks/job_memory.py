@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''
+Memory used per job by the client (Job) and engine (EngineJob)
+representations of a large workflow of simple jobs.
+
+Memory is measured using tracemalloc (python 3 only).
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import tracemalloc
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=100000,
+                        help='number of jobs (default: 100000)')
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    jobs = [Job(command=['echo', str(i)], name='job %d' % i)
+            for i in range(args.jobs)]
+    client_size = tracemalloc.get_traced_memory()[0]
+    workflow = Workflow(jobs=jobs)
+    engine_workflow = EngineWorkflow(workflow, {}, None, None, 'jobs')
+    engine_size = tracemalloc.get_traced_memory()[0] - client_size
+    tracemalloc.stop()
+
+    print('jobs: %d' % args.jobs)
+    print('Job:       %6.0f bytes/job' % (float(client_size) / args.jobs))
+    print('EngineJob: %6.0f bytes/job' % (float(engine_size) / args.jobs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''
+Cost of the jobs dispatching in the LocalScheduler, when many jobs are
+queued.
+
+The jobs are submitted all at once, then the scheduler iterations
+(LocalScheduler._iterate) are run until all the jobs are done. The processes
+are not actually started: the jobs get a stub process which has ended when
+the next iteration looks at it, so that only the scheduler bookkeeping (the
+queue, the count of used CPUs) is measured. A part of the jobs are parallel
+jobs using several CPUs.
+
+Prints the submission and dispatching rates, and the duration of the
+slowest iteration.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import os
+import time
+
+from soma_workflow.client import Job
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.schedulers.local_scheduler import LocalScheduler
+
+
+class StubProcess(object):
+
+    '''
+    Looks like a subprocess.Popen of a process which has ended
+    '''
+
+    # not a child process: os.wait4() fails with ECHILD, as for an already
+    # reaped process
+    pid = os.getpid()
+    returncode = 0
+
+    def poll(self):
+        return 0
+
+
+class DispatchScheduler(LocalScheduler):
+
+    use_process_reaper = False
+
+    @staticmethod
+    def create_process(engine_job, cores=None):
+        return StubProcess()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=100000,
+                        help='number of jobs (default: 100000)')
+    parser.add_argument('-p', '--proc-nb', type=int, default=8,
+                        help='number of CPUs of the scheduler (default: 8)')
+    parser.add_argument('--parallel', type=int, default=10,
+                        help='one job out of PARALLEL uses 2 CPUs '
+                        '(default: 10)')
+    args = parser.parse_args()
+
+    scheduler = DispatchScheduler(proc_nb=args.proc_nb,
+                                  max_proc_nb=args.proc_nb, interval=1)
+    # the iterations are run here
+    scheduler.end_scheduler_thread()
+
+    jobs = []
+    for i in range(args.jobs):
+        if args.parallel and i % args.parallel == 0:
+            parallel_job_info = {'config_name': 'native', 'nodes_number': 1,
+                                 'cpu_per_node': 2}
+        else:
+            parallel_job_info = None
+        job = EngineJob(Job(command=['true'], name='job %d' % i,
+                            parallel_job_info=parallel_job_info), None)
+        job.job_id = i + 1
+        jobs.append(job)
+
+    t0 = time.time()
+    for job in jobs:
+        scheduler.job_submission(job)
+    submission_time = time.time() - t0
+
+    iterations = 0
+    max_iteration = 0.
+    t0 = time.time()
+    while scheduler._queue or scheduler._processes:
+        t1 = time.time()
+        scheduler._iterate()
+        max_iteration = max(max_iteration, time.time() - t1)
+        iterations += 1
+    dispatch_time = time.time() - t0
+
+    print('%d jobs, %d CPUs, %d iterations' % (args.jobs, args.proc_nb,
+                                               iterations))
+    print('submission:    %10.0f jobs/s' % (args.jobs / submission_time))
+    print('dispatching:   %10.0f jobs/s' % (args.jobs / dispatch_time))
+    print('max iteration: %10.3f ms' % (max_iteration * 1000))
+
+
+if __name__ == '__main__':
+    main()
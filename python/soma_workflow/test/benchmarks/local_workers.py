@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''
+Startup cost of short local jobs, with and without the worker pool of the
+LocalScheduler (see LocalScheduler.change_worker_pool()).
+
+Short python jobs (``python -c "import <modules>"``, flagged as python jobs)
+and shell jobs (``true``) are submitted all at once to a LocalScheduler,
+then the time until they are all done is measured, each job starting a new
+process (no pool), or running in a worker of the pool. The workers are
+started before the measure, as in a long-running scheduler.
+
+Prints the jobs rates, and the time per job on each CPU: the startup
+overhead saved by the pool is the difference of these times.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import itertools
+import sys
+import threading
+import time
+
+from soma_workflow.client import Job
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.schedulers.local_scheduler import LocalScheduler
+import soma_workflow.constants as constants
+
+
+job_ids = itertools.count(1)
+
+
+def make_jobs(number, command, python_job):
+    jobs = []
+    for i in range(number):
+        job = EngineJob(Job(command=command, name='job %d' % i,
+                            python_job=python_job), None)
+        job.job_id = next(job_ids)
+        jobs.append(job)
+    return jobs
+
+
+def run_jobs(scheduler, events, jobs):
+    '''
+    Submit the jobs, wait for them, and return the number of failed jobs
+    '''
+    drmaa_ids = [scheduler.job_submission(job) for job in jobs]
+    failed = 0
+    for drmaa_id in drmaa_ids:
+        while scheduler.get_job_status(drmaa_id) not in (constants.DONE,
+                                                         constants.FAILED):
+            events.wait(0.1)
+            events.clear()
+        if scheduler.get_job_exit_info(drmaa_id)[:2] \
+                != (constants.FINISHED_REGULARLY, 0):
+            failed += 1
+    return failed
+
+
+def measure(args, command, python_job, worker_pool):
+    scheduler = LocalScheduler(proc_nb=args.proc_nb,
+                               max_proc_nb=args.proc_nb, interval=1,
+                               worker_pool=worker_pool)
+    events = threading.Event()
+    scheduler.set_event_callback(events.set)
+    try:
+        run_jobs(scheduler, events,
+                 make_jobs(args.proc_nb * 2, command, python_job))
+        jobs = make_jobs(args.jobs, command, python_job)
+        t0 = time.time()
+        failed = run_jobs(scheduler, events, jobs)
+        duration = time.time() - t0
+    finally:
+        scheduler.end_scheduler_thread()
+    return args.jobs / duration, duration * args.proc_nb / args.jobs, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=1000,
+                        help='number of jobs of each kind (default: 1000)')
+    parser.add_argument('-p', '--proc-nb', type=int, default=4,
+                        help='number of CPUs of the scheduler, and of '
+                        'workers (default: 4)')
+    parser.add_argument('-i', '--imports', default='json',
+                        help='modules imported by the python jobs, comma '
+                        'separated (default: json)')
+    args = parser.parse_args()
+
+    code = 'import %s' % args.imports if args.imports else 'pass'
+    print('%-8s %-8s %10s %12s %8s'
+          % ('jobs', 'pool', 'jobs/s', 'ms/job/CPU', 'failed'))
+    for name, command, python_job in (
+            ('python', [sys.executable, '-c', code], True),
+            ('shell', ['true'], False)):
+        times = []
+        for worker_pool in (0, args.proc_nb):
+            rate, job_time, failed = measure(args, command, python_job,
+                                             worker_pool)
+            times.append(job_time)
+            print('%-8s %-8d %10.0f %12.2f %8d'
+                  % (name, worker_pool, rate, job_time * 1000, failed))
+        print('%-8s startup overhead saved: %.2f ms/job'
+              % (name, (times[0] - times[1]) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+'''
+Duration of the frequent queries of the engine and of the clients in a
+database holding many jobs, with and without the secondary indexes of the
+database schema.
+
+The database holds several workflows, and the queries concern a small
+workflow among them (get_detailed_workflow_status) or all the jobs of the
+user (nb_running_jobs, jobs_to_delete_and_kill...).
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer, indexes
+from soma_workflow.engine_types import EngineWorkflow
+
+
+def mean_time(function, repeat):
+    t0 = time.time()
+    for i in range(repeat):
+        function()
+    return (time.time() - t0) / repeat
+
+
+def add_workflow(database_server, user_id, nb_jobs):
+    workflow = Workflow(jobs=[Job(command=['true'], name='job %d' % i)
+                              for i in range(nb_jobs)])
+    engine_workflow = EngineWorkflow(workflow, {}, None,
+                                     datetime.now() + timedelta(days=1),
+                                     'bench')
+    return database_server.add_workflow(user_id, engine_workflow)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=100000,
+                        help='number of jobs in the database '
+                        '(default: 100000)')
+    parser.add_argument('-w', '--workflows', type=int, default=10,
+                        help='number of workflows (default: 10)')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='number of calls of each query (default: 20)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+    try:
+        transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+        os.mkdir(transfer_dir)
+        database_server = WorkflowDatabaseServer(
+            os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+            remove_orphan_files=False)
+        user_id = database_server.register_user('bench')
+        for i in range(args.workflows):
+            add_workflow(database_server, user_id,
+                         args.jobs // args.workflows)
+        wf_id = add_workflow(database_server, user_id, 10).wf_id
+
+        queries = [
+            ('get_detailed_workflow_status',
+             lambda: database_server.get_detailed_workflow_status(wf_id)),
+            ('get_workflows',
+             lambda: database_server.get_workflows(user_id)),
+            ('nb_running_jobs',
+             lambda: database_server.nb_running_jobs(user_id)),
+            ('jobs_to_delete_and_kill',
+             lambda: database_server.jobs_to_delete_and_kill(user_id)),
+            ('workflows_to_delete_and_kill',
+             lambda: database_server.workflows_to_delete_and_kill(user_id)),
+        ]
+        print('%d jobs, %d workflows' % (args.jobs, args.workflows + 1))
+        print('%-30s %14s %14s' % ('query', 'indexes (ms)',
+                                   'no index (ms)'))
+        with_indexes = [mean_time(function, args.repeat)
+                        for name, function in queries]
+        connection = database_server._connect()
+        for name, columns in indexes:
+            connection.execute('DROP INDEX %s' % name)
+        connection.commit()
+        without_indexes = [mean_time(function, args.repeat)
+                           for name, function in queries]
+        for (name, function), t1, t2 in zip(queries, with_indexes,
+                                            without_indexes):
+            print('%-30s %14.3f %14.3f' % (name, t1 * 1000, t2 * 1000))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
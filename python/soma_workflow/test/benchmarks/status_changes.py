@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''
+Cost of polling the status of a large workflow: the full status
+(get_detailed_workflow_status) compared to the status changes since the
+previous poll (get_workflow_status_changes), when a few jobs change between
+two polls.
+
+For each method: the size of the pickled result (what is sent to the
+clients) and the duration of the query.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine_types import EngineWorkflow
+import soma_workflow.constants as constants
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=80000,
+                        help='number of jobs of the workflow '
+                        '(default: 80000)')
+    parser.add_argument('-c', '--changes', type=int, default=50,
+                        help='number of jobs changing between two polls '
+                        '(default: 50)')
+    parser.add_argument('-p', '--polls', type=int, default=10,
+                        help='number of polls (default: 10)')
+    args = parser.parse_args()
+
+    rng = random.Random(16)
+    tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+    try:
+        transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+        os.mkdir(transfer_dir)
+        database_server = WorkflowDatabaseServer(
+            os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+            remove_orphan_files=False)
+        user_id = database_server.register_user('bench')
+        workflow = Workflow(jobs=[Job(command=['true'], name='job %d' % i)
+                                  for i in range(args.jobs)])
+        engine_workflow = database_server.add_workflow(
+            user_id, EngineWorkflow(workflow, {}, None,
+                                    datetime.now() + timedelta(days=1),
+                                    'bench'))
+        wf_id = engine_workflow.wf_id
+        job_ids = list(engine_workflow.registered_jobs.keys())
+
+        revision = database_server.get_workflow_status_changes(wf_id)[0]
+        sizes = {'full': 0, 'changes': 0}
+        times = {'full': 0., 'changes': 0.}
+        for poll in range(args.polls):
+            database_server.set_jobs_status(
+                dict((job_id, constants.RUNNING)
+                     for job_id in rng.sample(job_ids, args.changes)))
+            t0 = time.time()
+            status = database_server.get_detailed_workflow_status(wf_id)
+            times['full'] += time.time() - t0
+            sizes['full'] += len(pickle.dumps(status))
+            t0 = time.time()
+            revision, full, status \
+                = database_server.get_workflow_status_changes(wf_id,
+                                                              revision)
+            times['changes'] += time.time() - t0
+            sizes['changes'] += len(pickle.dumps(status))
+
+        print('%d jobs, %d changes per poll' % (args.jobs, args.changes))
+        print('%-10s %12s %12s' % ('method', 'size (kB)', 'time (ms)'))
+        for name in ('full', 'changes'):
+            print('%-10s %12.1f %12.2f'
+                  % (name, sizes[name] / 1024. / args.polls,
+                     times[name] * 1000 / args.polls))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
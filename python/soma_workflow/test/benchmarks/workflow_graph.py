@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Memory used by the engine representation of the dependencies of a large
+workflow (WorkflowGraph), compared to the former dict of lists of jobs, and
+time needed to walk the whole workflow with find_out_jobs_to_process().
+
+Memory is measured using tracemalloc (python 3 only).
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import random
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow, WorkflowGraph
+import soma_workflow.constants as constants
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def parameter_sweep(nb_jobs, nb_deps, rng=random):
+    '''
+    Jobs depending on nb_deps random former jobs.
+    '''
+    jobs = [Job(command=['true'], name='job %d' % i) for i in range(nb_jobs)]
+    dependencies = []
+    for i in range(1, nb_jobs):
+        for j in set([rng.randrange(i) for k in range(nb_deps)]):
+            dependencies.append((jobs[j], jobs[i]))
+    return Workflow(jobs=jobs, dependencies=dependencies)
+
+
+def dependency_dict(workflow):
+    ''' Former representation: job -> list of jobs it depends on '''
+    deps = {}
+    for dep in workflow.dependencies:
+        deps.setdefault(dep[1], []).append(dep[0])
+    return deps
+
+
+def allocated(builder, *args):
+    if tracemalloc is None:
+        return builder(*args), None
+    tracemalloc.start()
+    obj = builder(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size
+
+
+def run_all(engine_workflow):
+    ''' Mark jobs as done as soon as they are ready, until the end '''
+    nb_calls = 0
+    status = None
+    while status != constants.WORKFLOW_DONE:
+        to_run, ended, status = engine_workflow.find_out_jobs_to_process()
+        for job in to_run:
+            job.status = constants.DONE
+            job.exit_status = constants.FINISHED_REGULARLY
+            job.exit_value = 0
+        nb_calls += 1
+    return nb_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--jobs', type=int, default=100000,
+                        help='number of jobs (default: 100000)')
+    parser.add_argument('-d', '--deps', type=int, default=3,
+                        help='dependencies per job (default: 3)')
+    args = parser.parse_args()
+
+    workflow = parameter_sweep(args.jobs, args.deps, random.Random(0))
+    print('jobs: %d, dependencies: %d'
+          % (len(workflow.jobs), len(workflow.dependencies)))
+    graph, graph_size = allocated(WorkflowGraph, workflow.jobs,
+                                  workflow.dependencies)
+    deps, dict_size = allocated(dependency_dict, workflow)
+    if graph_size is not None:
+        print('dependency dict: %10d bytes' % dict_size)
+        print('WorkflowGraph:   %10d bytes' % graph_size)
+
+    engine_workflow = EngineWorkflow(workflow, {}, None, None, 'sweep')
+    t0 = time.time()
+    nb_calls = run_all(engine_workflow)
+    print('readiness: %d calls, %.2f s' % (nb_calls, time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+Workflow registration throughput of the database server
+(WorkflowDatabaseServer.add_workflow), in jobs per second, depending on
+the workflow size.
+
+Workflows are made of chains of simple jobs.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine_types import EngineWorkflow
+
+
+def chain_workflow(nb_jobs, chain_length=10):
+    '''
+    Chains of chain_length jobs.
+    '''
+    jobs = [Job(command=['echo', str(i)], name='job %d' % i)
+            for i in range(nb_jobs)]
+    dependencies = [(jobs[i - 1], jobs[i]) for i in range(nb_jobs)
+                    if i % chain_length != 0]
+    return Workflow(jobs=jobs, dependencies=dependencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help='workflow sizes, in number of jobs '
+                        '(default: 100 1000 10000)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='swf_bench_')
+    try:
+        transfer_dir = os.path.join(tmp_dir, 'transfered_files')
+        os.mkdir(transfer_dir)
+        database_server = WorkflowDatabaseServer(
+            os.path.join(tmp_dir, 'soma_workflow.db'), transfer_dir,
+            remove_orphan_files=False)
+        user_id = database_server.register_user('bench')
+        print('%10s %10s %12s' % ('jobs', 'time (s)', 'jobs/s'))
+        for nb_jobs in args.sizes:
+            workflow = chain_workflow(nb_jobs)
+            engine_workflow = EngineWorkflow(
+                workflow, {}, None, datetime.now() + timedelta(days=1),
+                'bench')
+            t0 = time.time()
+            database_server.add_workflow(user_id, engine_workflow,
+                                         login='bench')
+            elapsed = time.time() - t0
+            print('%10d %10.2f %12.0f' % (nb_jobs, elapsed,
+                                          nb_jobs / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,898 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of WorkflowDatabaseServer internals, on a temporary database.
+'''
+from __future__ import print_function
+
+from __future__ import absolute_import
+import os
+import pickle
+import sqlite3
+import tempfile
+import shutil
+import threading
+import time
+import unittest
+from datetime import date, datetime, timedelta
+
+import six
+
+from soma_workflow.client import Job, Workflow, TemporaryPath, FileTransfer
+from soma_workflow.database_server import WorkflowDatabaseServer, indexes, \
+    read_workflow_archive, status_event_deleted
+from soma_workflow.engine_encoding import is_encoded
+from soma_workflow.engine_types import EngineWorkflow, EngineJob
+from soma_workflow.errors import DatabaseError
+from soma_workflow.info import DB_SCHEMA_REVISION
+import soma_workflow.constants as constants
+
+
+class DatabaseServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='swf_db_')
+        self.transfer_dir = os.path.join(self.tmp_dir, 'transfered_files')
+        os.mkdir(self.transfer_dir)
+        self.database_file = os.path.join(self.tmp_dir, 'soma_workflow.db')
+        self.database_server = WorkflowDatabaseServer(
+            self.database_file, self.transfer_dir, remove_orphan_files=False)
+        self.user_id = self.database_server.register_user('test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def add_workflow(self, njobs=3):
+        workflow = Workflow(jobs=[Job(command=['true'], name='job %d' % i)
+                                  for i in range(njobs)])
+        engine_workflow = EngineWorkflow(
+            workflow, {}, None, datetime.now() + timedelta(days=1), 'test')
+        return self.database_server.add_workflow(self.user_id,
+                                                 engine_workflow)
+
+    def set_schema_revision(self, connection, schema_revision):
+        '''
+        Turn the database into one written by an older version of
+        soma-workflow, with the given schema revision
+        '''
+        if sqlite3.sqlite_version_info < (3, 35):
+            self.skipTest('DROP COLUMN needs sqlite >= 3.35')
+        for name, columns in indexes:
+            if schema_revision < 2 or 'revision' in columns:
+                connection.execute('DROP INDEX %s' % name)
+        if schema_revision < 3:
+            for table in ('jobs', 'transfers', 'temporary_paths'):
+                connection.execute('ALTER TABLE %s DROP COLUMN revision'
+                                   % table)
+            connection.execute('DROP TABLE status_revision')
+        if schema_revision < 4:
+            connection.execute('DROP TABLE status_events')
+        if schema_revision < 6:
+            for trigger in ('insert', 'delete', 'update'):
+                connection.execute('DROP TRIGGER job_counters_%s' % trigger)
+            connection.execute('DROP TABLE job_counters')
+        connection.execute('PRAGMA user_version=%d' % schema_revision)
+        connection.commit()
+        if schema_revision < 5:
+            connection.execute('PRAGMA auto_vacuum = NONE')
+            connection.execute('VACUUM')
+
+    def test_persistent_connections(self):
+        engine_workflow = self.add_workflow()
+        job_id = list(engine_workflow.registered_jobs.keys())[0]
+        connection = self.database_server._connect()
+        self.database_server.set_jobs_status({job_id: constants.RUNNING})
+        self.assertEqual(
+            self.database_server.get_job_status(job_id, self.user_id)[0],
+            constants.RUNNING)
+        self.assertTrue(self.database_server._connect() is connection)
+        self.assertFalse(connection.in_transaction)
+
+        # each thread has its own connection
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(
+                self.database_server._connect()))
+        thread.start()
+        thread.join()
+        self.assertFalse(connections[0] is connection)
+
+        # the connection is replaced after an error
+        self.assertRaises(DatabaseError,
+                          self.database_server.get_user_login, -1)
+        new_connection = self.database_server._connect()
+        self.assertFalse(new_connection is connection)
+        self.assertEqual(
+            self.database_server.get_job_status(job_id, self.user_id)[0],
+            constants.RUNNING)
+
+    def test_replaced_database_file(self):
+        self.add_workflow()
+        connection = self.database_server._connect()
+        os.unlink(self.database_file)
+        # a new database is created at the same place
+        WorkflowDatabaseServer(self.database_file, self.transfer_dir,
+                               remove_orphan_files=False)
+        self.assertFalse(self.database_server._connect() is connection)
+        self.assertEqual(
+            self.database_server.get_workflows(self.user_id), {})
+
+    def test_add_workflow(self):
+        temp = TemporaryPath()
+        transfer = FileTransfer(True, os.path.join(self.tmp_dir, 'input'))
+        jobs = [Job(command=['cp', transfer, temp], name='job 0',
+                    referenced_input_files=[transfer],
+                    referenced_output_files=[temp]),
+                Job(command=['cat', temp], name='job 1',
+                    referenced_input_files=[temp])]
+        jobs += [Job(command=['true'], name='job %d' % i)
+                 for i in range(2, 10)]
+        workflow = Workflow(
+            jobs=jobs, dependencies=[(jobs[0], jobs[1])],
+            param_links={jobs[2]: {'a': [(jobs[0], 'b')]}})
+        engine_workflow = self.database_server.add_workflow(
+            self.user_id,
+            EngineWorkflow(workflow, {}, None,
+                           datetime.now() + timedelta(days=1), 'test'))
+        job_ids = sorted(engine_workflow.registered_jobs.keys())
+        self.assertEqual(len(job_ids), len(jobs))
+        self.assertEqual(len(engine_workflow.registered_tr), 1)
+        self.assertEqual(len(engine_workflow.registered_tmp), 1)
+        ejobs = [engine_workflow.job_mapping[job] for job in jobs]
+        engine_temp = engine_workflow.transfer_mapping[temp]
+
+        connection = self.database_server._connect()
+        self.assertEqual(
+            sorted(row[0] for row in connection.execute(
+                'SELECT id FROM jobs WHERE workflow_id=?',
+                [engine_workflow.wf_id])),
+            job_ids)
+        for ejob in ejobs:
+            self.assertEqual(
+                list(connection.execute(
+                    'SELECT name, stdout_file FROM jobs WHERE id=?',
+                    [ejob.job_id])),
+                [(ejob.name, ejob.stdout_file)])
+        self.assertEqual(
+            sorted(connection.execute(
+                'SELECT job_id, temp_path_id, is_input FROM ios_tmp')),
+            sorted([(ejobs[0].job_id, engine_temp.temp_path_id, 0),
+                    (ejobs[1].job_id, engine_temp.temp_path_id, 1)]))
+        self.assertEqual(
+            list(connection.execute(
+                'SELECT dest_job_id, dest_param, src_job_id, src_param '
+                'FROM param_links')),
+            [(ejobs[2].job_id, 'a', ejobs[0].job_id, 'b')])
+        connection.close()
+
+        # ids of deleted jobs are not reused
+        self.database_server.delete_workflow(engine_workflow.wf_id)
+        engine_workflow = self.add_workflow()
+        self.assertTrue(min(engine_workflow.registered_jobs.keys())
+                        > job_ids[-1])
+
+    def test_workflow_status_changes(self):
+        temp = TemporaryPath()
+        transfer = FileTransfer(True, os.path.join(self.tmp_dir, 'input'))
+        jobs = [Job(command=['cp', transfer, temp], name='job %d' % i,
+                    referenced_input_files=[transfer],
+                    referenced_output_files=[temp])
+                for i in range(5)]
+        engine_workflow = self.database_server.add_workflow(
+            self.user_id,
+            EngineWorkflow(Workflow(jobs=jobs), {}, None,
+                           datetime.now() + timedelta(days=1), 'test'))
+        wf_id = engine_workflow.wf_id
+        other_workflow = self.add_workflow()
+        job_ids = sorted(engine_workflow.registered_jobs.keys())
+        transfer_id = list(engine_workflow.registered_tr.keys())[0]
+        temp_path_id = list(engine_workflow.registered_tmp.keys())[0]
+        changes = self.database_server.get_workflow_status_changes
+
+        revision, full, status = changes(wf_id)
+        self.assertTrue(full)
+        self.assertEqual(sorted(job[0] for job in status[0]), job_ids)
+        self.assertEqual(len(status[1]), 1)
+        self.assertEqual(len(status[4]), 1)
+        self.assertEqual(
+            status, self.database_server.get_detailed_workflow_status(wf_id))
+
+        # nothing changed
+        new_revision, full, status = changes(wf_id, revision)
+        self.assertEqual(new_revision, revision)
+        self.assertFalse(full)
+        self.assertEqual((status[0], status[1], status[4]), ([], [], []))
+
+        self.database_server.set_jobs_status({job_ids[2]: constants.RUNNING})
+        # changes of other workflows are not returned
+        self.database_server.set_jobs_status(
+            dict((job_id, constants.RUNNING)
+                 for job_id in other_workflow.registered_jobs))
+        revision, full, status = changes(wf_id, new_revision)
+        self.assertFalse(full)
+        self.assertEqual([(job[0], job[1]) for job in status[0]],
+                         [(job_ids[2], constants.RUNNING)])
+        self.assertEqual((status[1], status[4]), ([], []))
+
+        self.database_server.set_job_exit_info(
+            job_ids[3], constants.FINISHED_REGULARLY, 0, None, None)
+        self.database_server.set_transfer_status(transfer_id,
+                                                 constants.FILES_ON_CR)
+        self.database_server.set_temporary_status(temp_path_id,
+                                                  constants.FILES_ON_CR)
+        new_revision, full, status = changes(wf_id, revision)
+        self.assertTrue(new_revision > revision)
+        self.assertEqual([job[0] for job in status[0]], [job_ids[3]])
+        self.assertEqual([(tr[0], tr[4]) for tr in status[1]],
+                         [(transfer_id, constants.FILES_ON_CR)])
+        self.assertEqual([(tmp[0], tmp[2]) for tmp in status[4]],
+                         [(temp_path_id, constants.FILES_ON_CR)])
+
+        # unknown revision (replaced database): full status
+        revision, full, status = changes(wf_id, new_revision + 10)
+        self.assertEqual(revision, new_revision)
+        self.assertTrue(full)
+        self.assertEqual(len(status[0]), len(job_ids))
+
+    def test_status_events(self):
+        server = self.database_server
+        engine_workflow = self.add_workflow()
+        wf_id = engine_workflow.wf_id
+        job_ids = sorted(engine_workflow.registered_jobs.keys())
+        other_workflow = self.add_workflow()
+
+        event_id, complete, events = server.get_status_events()
+        self.assertTrue(complete)
+        self.assertEqual(events, [])
+        server.set_jobs_status(dict((job_id, constants.RUNNING)
+                                    for job_id in job_ids))
+        server.set_job_status(job_ids[0], constants.DONE)
+        server.set_workflow_status(wf_id, constants.WORKFLOW_IN_PROGRESS)
+        server.set_workflow_status(other_workflow.wf_id,
+                                   constants.WORKFLOW_IN_PROGRESS)
+        last_event_id, complete, events = server.get_status_events(event_id)
+        self.assertTrue(complete)
+        self.assertEqual(last_event_id, event_id + len(job_ids) + 3)
+        self.assertEqual(
+            [event[2:] for event in events],
+            [(wf_id, 'job', job_id, constants.RUNNING)
+             for job_id in job_ids]
+            + [(wf_id, 'job', job_ids[0], constants.DONE),
+               (wf_id, 'workflow', wf_id, constants.WORKFLOW_IN_PROGRESS),
+               (other_workflow.wf_id, 'workflow', other_workflow.wf_id,
+                constants.WORKFLOW_IN_PROGRESS)])
+        self.assertEqual([event[0] for event in events],
+                         list(range(event_id + 1, last_event_id + 1)))
+
+        # filters
+        self.assertEqual(
+            len(server.get_status_events(event_id, wf_id)[2]),
+            len(job_ids) + 2)
+        self.assertEqual(
+            [event[4:] for event in server.get_status_events(
+                event_id, element_type='job', element_ids=[job_ids[0]])[2]],
+            [(job_ids[0], constants.RUNNING), (job_ids[0], constants.DONE)])
+        self.assertEqual(server.get_status_events(last_event_id),
+                         (last_event_id, True, []))
+        # events of a replaced database
+        self.assertFalse(server.get_status_events(last_event_id + 1)[1])
+
+        # only the last events are kept
+        server.status_events_retention = 10
+        for i in range(5):
+            for status in (constants.QUEUED_ACTIVE, constants.RUNNING):
+                server.set_jobs_status(dict((job_id, status)
+                                            for job_id in job_ids))
+        connection = server._connect()
+        self.assertTrue(six.next(connection.execute(
+            'SELECT count(*) FROM status_events'))[0] <= 11)
+        new_event_id, complete, events = server.get_status_events(
+            last_event_id)
+        self.assertFalse(complete)
+        self.assertEqual(events[-1][0], new_event_id)
+        self.assertTrue(server.get_status_events(new_event_id - 5)[1])
+
+    def test_wait_status_events(self):
+        server = self.database_server
+        # the wait does not depend on the polling of the journal
+        server.status_events_poll_interval = 30.
+        engine_workflow = self.add_workflow()
+        job_ids = sorted(engine_workflow.registered_jobs.keys())
+        event_id = server.get_status_events()[0]
+
+        t0 = time.time()
+        self.assertEqual(server.wait_status_events(event_id, timeout=0.1),
+                         (event_id, True, []))
+        self.assertTrue(time.time() - t0 >= 0.1)
+
+        def write():
+            time.sleep(0.2)
+            # not waited for
+            server.set_job_status(job_ids[1], constants.RUNNING)
+            time.sleep(0.2)
+            server.set_job_status(job_ids[0], constants.RUNNING)
+
+        thread = threading.Thread(target=write)
+        t0 = time.time()
+        thread.start()
+        try:
+            last_event_id, complete, events = server.wait_status_events(
+                event_id, element_type='job', element_ids=[job_ids[0]],
+                timeout=20)
+        finally:
+            thread.join()
+        self.assertTrue(time.time() - t0 < 5)
+        self.assertTrue(complete)
+        self.assertEqual([event[4:] for event in events],
+                         [(job_ids[0], constants.RUNNING)])
+        self.assertEqual(last_event_id, event_id + 2)
+
+    def test_deletion_events(self):
+        server = self.database_server
+        engine_workflow = self.add_workflow()
+        wf_id = engine_workflow.wf_id
+        job_ids = sorted(engine_workflow.registered_jobs.keys())
+        event_id = server.get_status_events()[0]
+
+        # the deletion wakes up the waiters of the deleted element
+        def delete():
+            time.sleep(0.2)
+            server.delete_job(job_ids[0])
+
+        thread = threading.Thread(target=delete)
+        t0 = time.time()
+        thread.start()
+        try:
+            last_event_id, complete, events = server.wait_status_events(
+                event_id, element_type='job', element_ids=[job_ids[0]],
+                timeout=20)
+        finally:
+            thread.join()
+        self.assertTrue(time.time() - t0 < 5)
+        self.assertEqual([event[2:] for event in events],
+                         [(wf_id, 'job', job_ids[0],
+                           status_event_deleted)])
+        self.assertFalse(server.is_valid_job(job_ids[0], self.user_id)[0])
+
+        server.delete_workflow(wf_id)
+        self.assertEqual(
+            [event[2:] for event in server.get_status_events(
+                last_event_id, element_type='workflow')[2]],
+            [(wf_id, 'workflow', wf_id,
+              status_event_deleted)])
+        self.assertFalse(server.is_valid_workflow(wf_id, self.user_id)[0])
+
+    def test_clean_chunks(self):
+        server = self.database_server
+        server.clean_batch_size = 10
+        temp = TemporaryPath()
+        transfer = FileTransfer(True, os.path.join(self.tmp_dir, 'input'))
+        jobs = [Job(command=['cp', transfer, temp], name='job 0',
+                    referenced_input_files=[transfer],
+                    referenced_output_files=[temp])]
+        jobs += [Job(command=['true'], name='job %d' % i)
+                 for i in range(1, 45)]
+        engine_workflow = server.add_workflow(
+            self.user_id,
+            EngineWorkflow(Workflow(jobs=jobs), {}, None,
+                           datetime.now() + timedelta(days=1), 'test'))
+        other_workflow = self.add_workflow()
+        job_files = []
+        for job in engine_workflow.registered_jobs.values():
+            with open(job.stdout_file, 'w') as f:
+                f.write('output')
+            job_files.append(job.stdout_file)
+        engine_transfer = engine_workflow.transfer_mapping[transfer]
+        with open(engine_transfer.engine_path, 'w') as f:
+            f.write('input')
+
+        connection = server._connect()
+        yesterday = date.today() - timedelta(days=1)
+        for table in ('workflows', 'jobs', 'transfers', 'temporary_paths'):
+            connection.execute(
+                'UPDATE %s SET expiration_date=? WHERE %s=?'
+                % (table, 'id' if table == 'workflows' else 'workflow_id'),
+                (yesterday, engine_workflow.wf_id))
+        connection.commit()
+        # a single batch of jobs per chunk
+        chunks = 1
+        while server.clean_chunk(max_lock_time=0):
+            chunks += 1
+        self.assertTrue(chunks >= 5)
+        for table, count in (('workflows', 1), ('jobs', 3), ('transfers', 0),
+                             ('temporary_paths', 0), ('ios', 0),
+                             ('ios_tmp', 0)):
+            self.assertEqual(
+                six.next(connection.execute(
+                    'SELECT count(*) FROM %s' % table))[0], count)
+        self.assertEqual(
+            list(server.get_workflows(self.user_id).keys()),
+            [other_workflow.wf_id])
+        self.assertEqual([path for path in job_files if os.path.exists(path)],
+                         [])
+        self.assertFalse(os.path.exists(engine_transfer.engine_path))
+        self.assertFalse(server.clean_chunk())
+
+    def test_archive_workflows(self):
+        server = self.database_server
+        server.archive_directory = os.path.join(self.tmp_dir, 'archive')
+        engine_workflow = self.add_workflow()
+        wf_id = engine_workflow.wf_id
+        job_ids = sorted(engine_workflow.registered_jobs.keys())
+        server.set_jobs_status(dict((job_id, constants.DONE)
+                                    for job_id in job_ids))
+        server.set_job_exit_info(job_ids[0], constants.FINISHED_REGULARLY,
+                                 0, None, None)
+        server.set_workflow_status(wf_id, constants.WORKFLOW_DONE)
+        unfinished_workflow = self.add_workflow()
+        server.delete_workflow(wf_id)
+        server.delete_workflow(unfinished_workflow.wf_id)
+        self.assertEqual(server.get_workflows(self.user_id), {})
+
+        archive_files = os.listdir(
+            os.path.join(server.archive_directory, 'test'))
+        self.assertEqual(archive_files, ['workflow_%d.json.gz' % wf_id])
+        archive = read_workflow_archive(os.path.join(
+            server.archive_directory, 'test', archive_files[0]))
+        self.assertEqual(
+            (archive['workflow']['id'], archive['workflow']['login'],
+             archive['workflow']['status']),
+            (wf_id, 'test', constants.WORKFLOW_DONE))
+        self.assertEqual(
+            sorted((job['id'], job['status']) for job in archive['jobs']),
+            [(job_id, constants.DONE) for job_id in job_ids])
+        self.assertEqual(
+            [job['exit_status'] for job in archive['jobs']
+             if job['id'] == job_ids[0]],
+            [constants.FINISHED_REGULARLY])
+        self.assertEqual(
+            sorted(archive['engine_workflow'].registered_jobs.keys()),
+            job_ids)
+
+    def test_vacuum_chunks(self):
+        server = self.database_server
+        self.assertEqual(server._auto_vacuum_mode(), 2)
+        server.vacuum_pages = 8
+        for i in range(5):
+            self.add_workflow(njobs=200)
+        connection = server._connect()
+        size = os.path.getsize(self.database_file)
+        for wf_id in list(server.get_workflows(self.user_id).keys()):
+            server.delete_workflow(wf_id)
+        # delete_workflow() releases the free pages
+        self.assertEqual(
+            six.next(connection.execute('PRAGMA freelist_count'))[0], 0)
+        self.assertTrue(os.path.getsize(self.database_file) < size / 2)
+
+        for i in range(5):
+            self.add_workflow(njobs=200)
+        connection.execute('DELETE FROM jobs')
+        connection.commit()
+        chunks = 1
+        while server.vacuum_chunk(max_lock_time=0):
+            chunks += 1
+        self.assertTrue(chunks > 1)
+        self.assertEqual(
+            six.next(connection.execute('PRAGMA freelist_count'))[0], 0)
+
+    def test_janitor(self):
+        server = self.database_server
+        janitor = server.start_janitor(
+            interval=3600, max_lock_time=0.01,
+            archive_directory=os.path.join(self.tmp_dir, 'archive'))
+        self.addCleanup(janitor.close)
+        engine_workflow = self.add_workflow()
+        other_workflow = self.add_workflow()
+        self.assertEqual(server.max_lock_time, 0.01)
+        server.delete_workflow(engine_workflow.wf_id)
+        # woken up by the deletion
+        for i in range(100):
+            if list(server.get_workflows(self.user_id).keys()) \
+                    == [other_workflow.wf_id]:
+                break
+            time.sleep(0.05)
+        self.assertEqual(list(server.get_workflows(self.user_id).keys()),
+                         [other_workflow.wf_id])
+        janitor.close()
+        self.assertFalse(janitor._thread.is_alive())
+
+    def test_engine_objects_encoding(self):
+        engine_workflow = self.add_workflow(njobs=200)
+        wf_id = engine_workflow.wf_id
+        job_id = sorted(engine_workflow.registered_jobs.keys())[150]
+        connection = self.database_server._connect()
+        pickled_workflow = list(connection.execute(
+            'SELECT pickled_engine_workflow FROM workflows'))[0][0]
+        self.assertTrue(is_encoded(pickled_workflow))
+        self.assertFalse(self.database_server._has_pickled_objects(
+            connection.cursor()))
+        job, workflow_id = self.database_server.get_engine_job(
+            job_id, self.user_id)
+        self.assertEqual(
+            (job.job_id, job.name, workflow_id),
+            (job_id, engine_workflow.registered_jobs[job_id].name, wf_id))
+
+        # values which cannot be encoded are pickled
+        engine_workflow = EngineWorkflow(
+            Workflow(jobs=[Job(command=['true'])]), {}, None,
+            datetime.now() + timedelta(days=1), 'test')
+        engine_workflow.user_storage = os.path.join
+        wf_id = self.database_server.add_workflow(
+            self.user_id, engine_workflow).wf_id
+        pickled_workflow = list(connection.execute(
+            'SELECT pickled_engine_workflow FROM workflows WHERE id=?',
+            [wf_id]))[0][0]
+        self.assertFalse(is_encoded(pickled_workflow))
+        self.assertTrue(self.database_server.get_engine_workflow(
+            wf_id, self.user_id).user_storage is os.path.join)
+
+    def test_migrate_pickled_objects(self):
+        engine_workflow = self.add_workflow()
+        wf_id = engine_workflow.wf_id
+        job_id = list(engine_workflow.registered_jobs.keys())[0]
+        workflow = self.database_server.get_engine_workflow(
+            wf_id, self.user_id)
+        # database written by an older version of soma-workflow
+        connection = self.database_server._connect()
+        connection.execute(
+            'UPDATE workflows SET pickled_engine_workflow=?',
+            [sqlite3.Binary(pickle.dumps(workflow))])
+        self.set_schema_revision(connection, 0)
+        self.assertTrue(self.database_server._has_pickled_objects(
+            connection.cursor()))
+        self.assertEqual(
+            self.database_server.get_engine_job(job_id, self.user_id)[0].name,
+            'job 0')
+
+        database_server = WorkflowDatabaseServer(
+            self.database_file, self.transfer_dir, remove_orphan_files=False)
+        connection = database_server._connect()
+        self.assertFalse(database_server._has_pickled_objects(
+            connection.cursor()))
+        self.assertEqual(
+            list(connection.execute('PRAGMA user_version'))[0][0],
+            DB_SCHEMA_REVISION)
+        workflow = database_server.get_engine_workflow(wf_id, self.user_id)
+        self.assertEqual(sorted(workflow.registered_jobs.keys()),
+                         sorted(engine_workflow.registered_jobs.keys()))
+        self.assertEqual(
+            database_server.get_engine_job(job_id, self.user_id)[0].name,
+            'job 0')
+
+    def test_upgrade_schema(self):
+        self.add_workflow()
+        connection = self.database_server._connect()
+        # database written before the secondary indexes
+        self.set_schema_revision(connection, 1)
+
+        database_server = WorkflowDatabaseServer(
+            self.database_file, self.transfer_dir, remove_orphan_files=False)
+        connection = database_server._connect()
+        self.assertEqual(
+            list(connection.execute('PRAGMA user_version'))[0][0],
+            DB_SCHEMA_REVISION)
+        self.assertEqual(
+            sorted(row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' "
+                "AND sql IS NOT NULL")),
+            sorted(name for name, columns in indexes))
+        self.assertEqual(database_server._auto_vacuum_mode(), 2)
+        # the job counters are built from the existing jobs
+        self.assertEqual(database_server.nb_jobs(
+            self.user_id, None, constants.NOT_SUBMITTED), 3)
+        self.assertEqual(database_server.check_job_counters(), {})
+
+    def test_query_plans(self):
+        '''
+        The queries issued by the server use indexes, instead of scanning
+        whole tables.
+        '''
+        connection = self.database_server._connect()
+        statements = []
+        connection.set_trace_callback(statements.append)
+        try:
+            self.run_queries()
+        finally:
+            connection.set_trace_callback(None)
+
+        # tables which hold a single row
+        small_tables = ('fileCounter', 'sqlite_sequence', 'status_revision')
+        checked = set()
+        for statement in statements:
+            statement = ' '.join(statement.split())
+            if statement in checked \
+                    or statement.split(' ')[0].upper() not in (
+                        'SELECT', 'UPDATE', 'DELETE') \
+                    or 'IN ()' in statement:
+                continue
+            checked.add(statement)
+            for row in connection.execute('EXPLAIN QUERY PLAN '
+                                          + statement):
+                detail = row[3]
+                if detail.startswith('SCAN ') \
+                        and detail.split(' ')[1] not in small_tables:
+                    self.fail('full table scan (%s) in query: %s'
+                              % (detail, statement))
+        self.assertTrue(len(checked) > 50)
+
+    def run_queries(self):
+        server = self.database_server
+        # old status events are removed
+        server.status_events_retention = 2
+        user_id = self.user_id
+        temp = TemporaryPath()
+        transfer = FileTransfer(True, os.path.join(self.tmp_dir, 'input'))
+        jobs = [Job(command=['cp', transfer, temp], name='job 0',
+                    referenced_input_files=[transfer],
+                    referenced_output_files=[temp]),
+                Job(command=['cat', temp], name='job 1',
+                    referenced_input_files=[temp])]
+        workflow = Workflow(
+            jobs=jobs, dependencies=[(jobs[0], jobs[1])],
+            param_links={jobs[1]: {'a': [(jobs[0], 'b')]}})
+        engine_workflow = server.add_workflow(
+            user_id,
+            EngineWorkflow(workflow, {}, None,
+                           datetime.now() + timedelta(days=1), 'test'))
+        wf_id = engine_workflow.wf_id
+        job_ids = sorted(engine_workflow.registered_jobs.keys())
+        transfer_id = list(engine_workflow.registered_tr.keys())[0]
+        temp_id = list(engine_workflow.registered_tmp.keys())[0]
+        job_id = server.add_job(
+            user_id, EngineJob(Job(command=['true'], name='job'),
+                               None)).job_id
+
+        # engine
+        server.set_queue('queue', job_ids, wf_id)
+        server.nb_running_jobs(user_id)
+        server.nb_running_jobs(user_id, 'queue')
+        server.nb_queued_jobs(user_id)
+        server.nb_queued_jobs(user_id, 'queue')
+        server.jobs_to_delete_and_kill(user_id)
+        server.workflows_to_delete_and_kill(user_id)
+        server.set_submission_information({job_ids[0]: '12'}, datetime.now())
+        server.set_jobs_status({job_ids[0]: constants.RUNNING})
+        server.set_job_status(job_ids[1], constants.QUEUED_ACTIVE)
+        server.get_drmaa_job_id(job_ids[0])
+        server.set_job_exit_info(job_ids[0], constants.FINISHED_REGULARLY,
+                                 0, None, None)
+        server.set_job_output_params(job_ids[0], {'b': 1})
+        server.updated_job_parameters(job_ids[1])
+        server.update_job_command(job_ids[1], ['cat', 'file'])
+        server.get_job_command(job_ids[1])
+        server.set_workflow_status(wf_id, constants.WORKFLOW_IN_PROGRESS)
+        server.set_transfer_status(transfer_id, constants.FILES_ON_CR)
+        server.set_temporary_status(temp_id, constants.FILES_ON_CR)
+        server.add_workflow_ended_transfer(wf_id, transfer_id)
+        server.pop_workflow_ended_transfer(wf_id)
+        server.get_engine_job(job_ids[0], user_id)
+        server.get_engine_job(job_id, user_id)
+        server.get_engine_workflow(wf_id, user_id)
+
+        # clients
+        server.get_detailed_workflow_status(wf_id)
+        server.get_workflow_status_changes(wf_id, 1)
+        server.get_status_events(0)
+        server.get_status_events(0, wf_id, 'job', job_ids)
+        server.wait_status_events(0, wf_id, timeout=0)
+        server.get_workflow_status(wf_id, user_id)
+        server.get_workflows(user_id)
+        server.get_workflows(user_id, [wf_id])
+        server.get_jobs(user_id)
+        server.get_jobs(user_id, job_ids)
+        server.get_transfers(user_id)
+        server.get_transfers(user_id, [transfer_id])
+        server.get_job_status(job_ids[0], user_id)
+        server.get_jobs_status(job_ids, user_id)
+        server.get_job_exit_info(job_ids[0], user_id)
+        server.get_job_output_params(job_ids[0])
+        server.get_std_out_err_file_path(job_ids[0], user_id)
+        server.get_job_output_params_file_path(job_ids[0], user_id)
+        server.get_jobs_mean_duration(user_id, ['job 0'])
+        server.get_transfer_status(transfer_id, user_id)
+        server.get_temporary_status(temp_id, user_id)
+        server.get_transfer_information(transfer_id, user_id)
+        server.get_temporary_information(temp_id, user_id)
+        server.change_workflow_expiration_date(
+            wf_id, datetime.now() + timedelta(days=2), user_id)
+
+        # deletion
+        server.clean()
+        server.delete_job(job_id)
+        server.delete_workflow(wf_id)
+        server.clean()
+
+    def test_job_counters(self):
+        server = self.database_server
+        user_id = self.user_id
+        job_ids = sorted(self.add_workflow(4).registered_jobs.keys())
+        self.assertEqual(server.check_job_counters(), {})
+        self.assertEqual(server.nb_jobs(user_id, None,
+                                        constants.NOT_SUBMITTED), 4)
+
+        server.set_queue('queue', job_ids[:3])
+        server.set_submission_information(
+            dict((job_id, str(job_id)) for job_id in job_ids[:3]),
+            datetime.now())
+        # submitted jobs count as running and queued
+        self.assertEqual(server.nb_running_jobs(user_id, 'queue'), 3)
+        self.assertEqual(server.nb_queued_jobs(user_id, 'queue'), 3)
+        self.assertEqual(server.nb_running_jobs(user_id), 0)
+        server.set_jobs_status({job_ids[0]: constants.RUNNING,
+                                job_ids[1]: constants.QUEUED_ACTIVE})
+        server.set_job_status(job_ids[2], constants.DONE)
+        self.assertEqual(server.nb_running_jobs(user_id, 'queue'), 2)
+        self.assertEqual(server.nb_queued_jobs(user_id, 'queue'), 1)
+        server.write_updates(job_status={job_ids[1]: (constants.RUNNING,
+                                                      False)})
+        self.assertEqual(server.nb_queued_jobs(user_id, 'queue'), 0)
+        self.assertEqual(server.check_job_counters(), {})
+
+        # a failed transaction does not change the counters
+        self.assertRaises(
+            DatabaseError, server.write_updates,
+            job_status={job_ids[0]: (constants.FAILED, False)},
+            workflow_status={-1: (None, True)})
+        self.assertEqual(server.nb_running_jobs(user_id, 'queue'), 2)
+        self.assertEqual(server.check_job_counters(), {})
+
+        # the counters are kept in the database, other servers using it
+        # see the jobs written by each other at once
+        other_server = WorkflowDatabaseServer(
+            self.database_file, self.transfer_dir, remove_orphan_files=False)
+        self.assertEqual(other_server.nb_running_jobs(user_id, 'queue'), 2)
+        other_server.set_jobs_status({job_ids[0]: constants.DONE})
+        self.assertEqual(server.nb_running_jobs(user_id, 'queue'), 1)
+        server.set_queue(None, [job_ids[1]])
+        self.assertEqual(other_server.nb_running_jobs(user_id, 'queue'), 0)
+        self.assertEqual(other_server.nb_running_jobs(user_id), 1)
+        other_server.add_workflow(
+            user_id, EngineWorkflow(
+                Workflow(jobs=[Job(command=['true'], name='other job')]),
+                {}, None, datetime.now() + timedelta(days=1), 'test'))
+        self.assertEqual(server.nb_jobs(user_id, None,
+                                        constants.NOT_SUBMITTED), 2)
+        self.assertEqual(server.check_job_counters(), {})
+
+        # repair of counters out of sync with the jobs
+        connection = server._connect()
+        connection.execute('UPDATE job_counters SET count=count+1')
+        connection.commit()
+        self.assertNotEqual(server.check_job_counters(), {})
+        server.rebuild_job_counters()
+        self.assertEqual(server.check_job_counters(), {})
+        self.assertEqual(server.nb_running_jobs(user_id), 1)
+
+        self.run_queries()
+        self.assertEqual(server.check_job_counters(), {})
+
+    def test_file_paths(self):
+        server = self.database_server
+        server.files_per_directory = 4
+        connection = server._connect()
+        statements = []
+        connection.set_trace_callback(statements.append)
+        try:
+            engine_workflow = self.add_workflow(5)
+        finally:
+            connection.set_trace_callback(None)
+        # the files are numbered without writing in the database
+        self.assertFalse([statement for statement in statements
+                          if 'fileCounter' in statement])
+        paths = []
+        for engine_job in engine_workflow.job_mapping.values():
+            paths += [engine_job.stdout_file, engine_job.stderr_file]
+        self.assertEqual(len(set(paths)), 10)
+        directories = set(os.path.dirname(path) for path in paths)
+        self.assertEqual(len(directories), 3)
+        for directory in directories:
+            self.assertTrue(os.path.isdir(directory))
+            self.assertEqual(os.path.dirname(directory),
+                             server._user_transfer_dir_path('test',
+                                                            self.user_id))
+
+        # another server uses other directories
+        database_server = WorkflowDatabaseServer(
+            self.database_file, self.transfer_dir, remove_orphan_files=False)
+        engine_workflow = database_server.add_workflow(
+            self.user_id,
+            EngineWorkflow(Workflow(jobs=[Job(command=['true'])]), {}, None,
+                           datetime.now() + timedelta(days=1), 'test'))
+        engine_job = list(engine_workflow.job_mapping.values())[0]
+        self.assertFalse(os.path.dirname(engine_job.stdout_file)
+                         in directories)
+
+        # files numbered in the database, as older versions do
+        database_server.local_file_numbers = False
+        engine_workflow = database_server.add_workflow(
+            self.user_id,
+            EngineWorkflow(Workflow(jobs=[Job(command=['true'])]), {}, None,
+                           datetime.now() + timedelta(days=1), 'test'))
+        engine_job = list(engine_workflow.job_mapping.values())[0]
+        self.assertEqual(os.path.dirname(engine_job.stdout_file),
+                         server._user_transfer_dir_path('test',
+                                                        self.user_id))
+        self.assertTrue(list(connection.execute(
+            'SELECT count FROM fileCounter'))[0][0] > 0)
+
+        # orphan files are removed in the files directories, and old empty
+        # directories of other servers too
+        for path in paths[:2] + [engine_job.stdout_file]:
+            open(path, 'w').close()
+        orphan = os.path.join(os.path.dirname(paths[0]), 'orphan')
+        open(orphan, 'w').close()
+        user_dir = server._user_transfer_dir_path('test', self.user_id)
+        empty_directory = os.path.join(user_dir, '0123456789abcdef-0')
+        os.mkdir(empty_directory)
+        new_directory = os.path.join(user_dir, '0123456789abcdef-1')
+        os.mkdir(new_directory)
+        old_time = time.time() - server.files_directory_grace_time - 10
+        os.utime(empty_directory, (old_time, old_time))
+        server.remove_orphan_files()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(empty_directory))
+        self.assertTrue(os.path.exists(new_directory))
+        for path in paths[:2] + [engine_job.stdout_file]:
+            self.assertTrue(os.path.exists(path))
+
+        # the directory of a server is empty until its jobs write their
+        # files: another server does not remove it
+        engine_workflow = self.add_workflow(1)
+        directory = os.path.dirname(
+            list(engine_workflow.job_mapping.values())[0].stdout_file)
+        self.assertEqual(os.listdir(directory), [])
+        os.utime(directory, (old_time, old_time))
+        other_server = WorkflowDatabaseServer(
+            self.database_file, self.transfer_dir)
+        other_server.register_user('bob')
+        self.assertTrue(os.path.isdir(directory))
+        # if it is removed anyway, the server creates it again
+        path = other_server.generate_file_path(self.user_id)
+        os.rmdir(os.path.dirname(path))
+        new_path = other_server.generate_file_path(self.user_id)
+        self.assertEqual(os.path.dirname(new_path), os.path.dirname(path))
+        open(new_path, 'w').close()
+
+    def test_wal_reads_during_write(self):
+        database_server = WorkflowDatabaseServer(
+            self.database_file, self.transfer_dir, remove_orphan_files=False,
+            wal_mode=True)
+        self.database_server = database_server
+        engine_workflow = self.add_workflow()
+        wf_id = engine_workflow.wf_id
+        job_ids = list(engine_workflow.registered_jobs.keys())
+        database_server.set_jobs_status(
+            dict((job_id, constants.RUNNING) for job_id in job_ids))
+
+        results = []
+
+        def read():
+            results.append(
+                database_server.get_detailed_workflow_status(wf_id))
+            results.append(database_server.get_workflows(self.user_id))
+
+        # a write transaction is running, and holds the server lock
+        with database_server._lock:
+            connection = database_server._connect()
+            connection.execute('UPDATE jobs SET status=? WHERE workflow_id=?',
+                               (constants.DONE, wf_id))
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive())
+            connection.commit()
+        # readers see the last committed state
+        self.assertEqual(set(job[1] for job in results[0][0]),
+                         set([constants.RUNNING]))
+        self.assertEqual(list(results[1].keys()), [wf_id])
+        status = database_server.get_detailed_workflow_status(wf_id)
+        self.assertEqual(set(job[1] for job in status[0]),
+                         set([constants.DONE]))
+
+
+def test():
+    suite = unittest.TestLoader().loadTestsFromTestCase(DatabaseServerTest)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the encoding of the engine objects stored in the database
+(soma_workflow.engine_encoding).
+'''
+from __future__ import print_function
+
+from __future__ import absolute_import
+import os
+import pickle
+import random
+import tempfile
+import shutil
+import unittest
+from datetime import datetime, date, timedelta
+
+import six
+
+from soma_workflow.client import Job, Workflow, Group, TemporaryPath, \
+    FileTransfer
+from soma_workflow.engine_types import EngineWorkflow, EngineJob
+from soma_workflow import engine_encoding
+
+
+class EngineEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='swf_encoding_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def engine_workflow(self, njobs=3):
+        temp = TemporaryPath()
+        transfer = FileTransfer(True, os.path.join(self.tmp_dir, 'input'))
+        jobs = [Job(command=['cp', transfer, temp + '.nii', ('a', 1)],
+                    name='job 0', referenced_input_files=[transfer],
+                    referenced_output_files=[temp],
+                    param_dict={'x': [1, 2], 'y': temp}),
+                Job(command=['cat', temp], name='job 1',
+                    referenced_input_files=[temp], env={'A': 'b'},
+                    has_outputs=True)]
+        jobs += [Job(command=['echo', str(i)], name='job %d' % i)
+                 for i in range(2, njobs)]
+        group = Group(jobs[1:], 'group')
+        workflow = Workflow(
+            jobs=jobs, dependencies=[(jobs[0], jobs[1])],
+            root_group=[jobs[0], group], env={'W': '1'},
+            param_links={jobs[1]: {'a': [(jobs[0], 'b', ('f', 1))]}})
+        engine_workflow = EngineWorkflow(
+            workflow, {}, None, datetime.now() + timedelta(days=1), 'test')
+        # ids given by the database server
+        engine_workflow.wf_id = 1
+        for job_id, client_job in enumerate(jobs):
+            engine_job = engine_workflow.job_mapping[client_job]
+            engine_job.job_id = job_id + 1
+            engine_job.workflow_id = 1
+            engine_workflow.registered_jobs[job_id + 1] = engine_job
+        engine_workflow.transfer_mapping[temp].engine_path = os.path.join(
+            self.tmp_dir, 'temp')
+        return engine_workflow
+
+    def assert_same_job(self, engine_job, decoded_job):
+        self.assertEqual(type(decoded_job), type(engine_job))
+        for name in ('job_id', 'name', 'env', 'has_outputs',
+                     'workflow_id'):
+            self.assertEqual(getattr(decoded_job, name),
+                             getattr(engine_job, name))
+        self.assertEqual(decoded_job.plain_command(),
+                         engine_job.plain_command())
+
+    def test_workflow(self):
+        engine_workflow = self.engine_workflow()
+        data = engine_encoding.encode_engine_workflow(engine_workflow)
+        self.assertTrue(engine_encoding.is_encoded(data))
+        self.assertFalse(engine_encoding.is_encoded(
+            pickle.dumps(engine_workflow)))
+        self.assertTrue(len(data) < len(pickle.dumps(engine_workflow)))
+
+        decoded = engine_encoding.decode_engine_workflow(data)
+        self.assertEqual(type(decoded), EngineWorkflow)
+        self.assertEqual(decoded.wf_id, engine_workflow.wf_id)
+        self.assertEqual(decoded.name, engine_workflow.name)
+        self.assertEqual(decoded.env, engine_workflow.env)
+        self.assertEqual(decoded.expiration_date,
+                         engine_workflow.expiration_date)
+        self.assertEqual(sorted(decoded.registered_jobs.keys()),
+                         sorted(engine_workflow.registered_jobs.keys()))
+        for job_id, engine_job in six.iteritems(
+                engine_workflow.registered_jobs):
+            self.assert_same_job(engine_job, decoded.registered_jobs[job_id])
+
+        # references between objects are kept
+        jobs = decoded.jobs
+        self.assertEqual(len(decoded.job_mapping), len(jobs))
+        ejobs = [decoded.job_mapping[job] for job in jobs]
+        self.assertEqual(
+            [job.job_id for job in ejobs],
+            [engine_workflow.job_mapping[job].job_id
+             for job in engine_workflow.jobs])
+        self.assertEqual(decoded.dependencies, [(jobs[0], jobs[1])])
+        self.assertTrue(decoded.root_group[0] is jobs[0])
+        self.assertTrue(decoded.root_group[1].elements[0] is jobs[1])
+        self.assertEqual(decoded.param_links,
+                         {jobs[1]: {'a': [(jobs[0], 'b', ('f', 1))]}})
+        self.assertTrue(ejobs[0].transfer_mapping
+                        is decoded.transfer_mapping)
+        temp = jobs[0].referenced_output_files[0]
+        self.assertTrue(jobs[1].referenced_input_files[0] is temp)
+        self.assertTrue(ejobs[1].referenced_input_files[0] is temp)
+        self.assertEqual(ejobs[1].plain_command(),
+                         ['cat', os.path.join(self.tmp_dir, 'temp')])
+
+    def test_single_job(self):
+        engine_workflow = self.engine_workflow(
+            njobs=engine_encoding.JOBS_PER_LINE * 3)
+        data = engine_encoding.encode_engine_workflow(engine_workflow)
+        job_id = engine_encoding.JOBS_PER_LINE * 2 + 5
+        encoded = engine_encoding.EncodedData(data)
+        self.assert_same_job(engine_workflow.registered_jobs[job_id],
+                             encoded.engine_job(job_id))
+        # only the line of the job has been decoded
+        self.assertEqual(len(encoded._engine_jobs),
+                         engine_encoding.JOBS_PER_LINE)
+        self.assertRaises(KeyError, encoded.engine_job, 10000)
+
+        job = engine_encoding.decode_engine_job(data, 2)
+        self.assert_same_job(engine_workflow.registered_jobs[2], job)
+
+        # job outside of a workflow
+        engine_job = EngineJob(Job(command=['echo', 'a'], name='alone'),
+                               'queue')
+        engine_job.job_id = 12
+        self.assert_same_job(engine_job, engine_encoding.decode_engine_job(
+            engine_encoding.encode_engine_job(engine_job)))
+
+    def test_values(self):
+        rng = random.Random(14)
+        leaves = [None, True, False, 0, -3, 2 ** 40, 1.5, u'', u'abc',
+                  u'<t>', u'é', datetime(2020, 1, 2, 3, 4, 5, 6),
+                  date(2021, 3, 4)]
+
+        def hashable(value):
+            try:
+                hash(value)
+            except TypeError:
+                return False
+            return True
+
+        def random_value(depth):
+            if depth == 0 or rng.random() < 0.3:
+                return rng.choice(leaves)
+            items = [random_value(depth - 1)
+                     for i in range(rng.randint(0, 4))]
+            kind = rng.randint(0, 4)
+            if kind == 0:
+                return items
+            if kind == 1:
+                return tuple(items)
+            if kind == 2:
+                return set(item for item in items if hashable(item))
+            if kind == 3:
+                return dict((u'<k%d' % i, item)
+                            for i, item in enumerate(items))
+            return dict((i if i % 2 else (i, u'x'), item)
+                        for i, item in enumerate(items))
+
+        for i in range(200):
+            value = random_value(4)
+            self.assertEqual(
+                engine_encoding.decode_value(
+                    engine_encoding.encode_value(value)),
+                value)
+        self.assertEqual(
+            engine_encoding.decode_value(engine_encoding.encode_value(Job)),
+            Job)
+
+    def test_unsupported_values(self):
+        engine_workflow = self.engine_workflow()
+        engine_workflow.user_storage = object()
+        self.assertRaises(TypeError, engine_encoding.encode_engine_workflow,
+                          engine_workflow)
+        self.assertRaises(TypeError, engine_encoding.encode_value,
+                          lambda x: x)
+        data = engine_encoding.encode_value(1)
+        version = str(engine_encoding.ENCODING_VERSION + 1).encode('ascii')
+        self.assertRaises(ValueError, engine_encoding.decode_value,
+                          data.replace(b':1\n', b':' + version + b'\n', 1))
+        self.assertRaises(ValueError, engine_encoding.decode_value,
+                          pickle.dumps(1))
+
+
+def test():
+    suite = unittest.TestLoader().loadTestsFromTestCase(EngineEncodingTest)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the workflow engine loop internals, using an in-memory fake
+scheduler and a temporary database.
+'''
+from __future__ import print_function
+
+from __future__ import absolute_import
+import os
+import tempfile
+import shutil
+import time
+import threading
+import unittest
+import six
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.scheduler import Scheduler
+from soma_workflow.database_server import WorkflowDatabaseServer, \
+    WriteBehindDatabaseServer
+from soma_workflow import engine
+import soma_workflow.constants as constants
+
+
+class FakeScheduler(Scheduler):
+
+    '''
+    Scheduler which does not run anything: jobs succeed as soon as they are
+    submitted, and the engine is notified immediately. Jobs which name is in
+    the held_jobs set keep running until they are killed.
+    '''
+
+    can_push_events = True
+
+    def __init__(self):
+        super(FakeScheduler, self).__init__()
+        self._lock = threading.RLock()
+        self._status = {}
+        self._exit_info = {}
+        self.submitted = []
+        self.submitted_names = []
+        self.held_jobs = set()
+        self.status_requests = 0
+        self.bulk_status_requests = 0
+
+    def job_submission(self, job):
+        with self._lock:
+            drmaa_id = str(job.job_id)
+            self.submitted.append(drmaa_id)
+            self.submitted_names.append(job.name)
+            if job.name in self.held_jobs:
+                self._status[drmaa_id] = constants.RUNNING
+            else:
+                self._status[drmaa_id] = constants.DONE
+                self._exit_info[drmaa_id] = (constants.FINISHED_REGULARLY, 0,
+                                             None, None)
+        self.notify_event()
+        return drmaa_id
+
+    def get_job_status(self, scheduler_job_id):
+        with self._lock:
+            self.status_requests += 1
+            return self._status[scheduler_job_id]
+
+    def get_jobs_status(self, scheduler_job_ids):
+        with self._lock:
+            self.bulk_status_requests += 1
+            return dict([(scheduler_job_id, self._status[scheduler_job_id])
+                         for scheduler_job_id in scheduler_job_ids])
+
+    def get_job_exit_info(self, scheduler_job_id):
+        with self._lock:
+            return self._exit_info.pop(scheduler_job_id)
+
+    def kill_job(self, scheduler_job_id):
+        with self._lock:
+            self._status[scheduler_job_id] = constants.FAILED
+            self._exit_info[scheduler_job_id] = (constants.USER_KILLED, None,
+                                                 None, None)
+
+
+class SlowSubmissionScheduler(FakeScheduler):
+
+    '''
+    FakeScheduler which submissions take some time, and which records the
+    max number of concurrent submissions.
+    '''
+
+    delay = 0.5
+
+    def __init__(self):
+        super(SlowSubmissionScheduler, self).__init__()
+        self.concurrent_submissions = 0
+        self.max_concurrent_submissions = 0
+
+    def job_submission(self, job):
+        with self._lock:
+            self.concurrent_submissions += 1
+            self.max_concurrent_submissions = max(
+                self.max_concurrent_submissions, self.concurrent_submissions)
+        time.sleep(self.delay)
+        with self._lock:
+            self.concurrent_submissions -= 1
+        return super(SlowSubmissionScheduler, self).job_submission(job)
+
+
+class EngineLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='swf_engine_')
+        transfer_dir = os.path.join(self.tmp_dir, 'transfered_files')
+        os.mkdir(transfer_dir)
+        self.database_server = WorkflowDatabaseServer(
+            os.path.join(self.tmp_dir, 'soma_workflow.db'), transfer_dir,
+            remove_orphan_files=False)
+        self.scheduler = FakeScheduler()
+        self.engine = engine.WorkflowEngine(self.database_server,
+                                            self.scheduler)
+
+    def tearDown(self):
+        self.engine.stop()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def chain_workflow(njobs):
+        jobs = [Job(command=['true'], name='job %d' % i)
+                for i in range(njobs)]
+        dependencies = list(zip(jobs[:-1], jobs[1:]))
+        return Workflow(jobs=jobs, dependencies=dependencies,
+                        name='chain')
+
+    def test_events_wake_up_loop(self):
+        # each job of the chain only becomes ready when its predecessor is
+        # done: without events the loop would wait for at least one polling
+        # interval per job.
+        njobs = 10
+        self.engine.engine_loop.wait_one_loop()
+        t0 = time.time()
+        wf_id = self.engine.submit_workflow(self.chain_workflow(njobs),
+                                            None, 'chain', None)
+        self.engine.wait_workflow(wf_id, timeout=60)
+        elapsed = time.time() - t0
+        status = self.database_server.get_workflow_status(
+            wf_id, self.engine._user_id)[0]
+        self.assertEqual(status, constants.WORKFLOW_DONE)
+        self.assertEqual(len(self.scheduler.submitted), njobs)
+        self.assertTrue(elapsed < njobs * engine.refreshment_interval,
+                        'workflow took %f s' % elapsed)
+
+    def test_wait_woken_up_by_status_events(self):
+        # without the status events journal, the waits would last at least
+        # refreshment_interval
+        self.addCleanup(setattr, engine, 'refreshment_interval',
+                        engine.refreshment_interval)
+        engine.refreshment_interval = 30.
+        self.engine.engine_loop.wait_one_loop()
+        t0 = time.time()
+        wf_id = self.engine.submit_workflow(self.chain_workflow(3),
+                                            None, 'chain', None)
+        job_ids = [job[0] for job in
+                   self.database_server.get_detailed_workflow_status(
+                       wf_id)[0]]
+        self.engine.wait_job(job_ids, timeout=60)
+        self.engine.wait_workflow(wf_id, timeout=60)
+        elapsed = time.time() - t0
+        self.assertEqual(
+            self.database_server.get_workflow_status(
+                wf_id, self.engine._user_id)[0],
+            constants.WORKFLOW_DONE)
+        self.assertTrue(elapsed < 10, 'waits took %f s' % elapsed)
+
+        last_event_id, complete, events = self.engine.wait_status_events(
+            wf_id, 0, timeout=0)
+        self.assertTrue(complete)
+        self.assertEqual(events[-1][3:],
+                         ('workflow', wf_id, constants.WORKFLOW_DONE))
+
+    def test_only_changed_statuses_written(self):
+        self.scheduler.held_jobs.add('held')
+        jobs = [Job(command=['true'], name='job %d' % i) for i in range(5)]
+        held_job = Job(command=['true'], name='held')
+        workflow = Workflow(jobs=jobs + [held_job], name='held')
+        wf_id = self.engine.submit_workflow(workflow, None, 'held', None)
+        loop = self.engine.engine_loop
+        loop.wait_one_loop()
+        loop.wait_one_loop()
+        # nothing happens any longer: nothing should be written.
+        self.assertEqual(loop.status_rows_written, 0)
+        self.assertTrue(loop.total_status_rows_written >= len(jobs) + 1)
+        statuses = dict(
+            (job_info[0], job_info[1]) for job_info in
+            self.database_server.get_detailed_workflow_status(wf_id)[0])
+        engine_wf = loop._workflows[wf_id]
+        for job_id, status in six.iteritems(statuses):
+            self.assertEqual(status, engine_wf.registered_jobs[job_id].status)
+            if engine_wf.registered_jobs[job_id].name == 'held':
+                self.assertEqual(status, constants.RUNNING)
+            else:
+                self.assertEqual(status, constants.DONE)
+
+    def test_indexes(self):
+        self.scheduler.held_jobs.add('held')
+        jobs = [Job(command=['true'], name='job %d' % i) for i in range(5)]
+        held_job = Job(command=['true'], name='held')
+        workflow = Workflow(jobs=jobs + [held_job], name='held')
+        wf_id = self.engine.submit_workflow(workflow, None, 'held', None)
+        loop = self.engine.engine_loop
+        loop.wait_one_loop()
+        engine_wf = loop._workflows[wf_id]
+        self.assertEqual(set(loop._job_index),
+                         set(engine_wf.registered_jobs))
+        self.assertEqual([job.name for job in loop._active_jobs.values()],
+                         ['held'])
+        held_engine_job = list(loop._active_jobs.values())[0]
+        self.assertEqual(
+            self.engine.drms_job_id(wf_id, held_engine_job.job_id),
+            held_engine_job.drmaa_id)
+
+        self.engine.stop_workflow(wf_id)
+        loop.wait_one_loop()
+        self.assertEqual(loop._active_jobs, {})
+        self.assertEqual(loop._job_index, {})
+        self.assertEqual(held_engine_job.status, constants.FAILED)
+
+    def test_bulk_status_requests(self):
+        self.scheduler.held_jobs.update(['held %d' % i for i in range(5)])
+        jobs = [Job(command=['true'], name='held %d' % i) for i in range(5)]
+        wf_id = self.engine.submit_workflow(Workflow(jobs=jobs, name='held'),
+                                            None, 'held', None)
+        loop = self.engine.engine_loop
+        loop.wait_one_loop()
+        bulk_requests = self.scheduler.bulk_status_requests
+        loop.wait_one_loop()
+        # running jobs are polled together, never one by one
+        self.assertTrue(self.scheduler.bulk_status_requests > bulk_requests)
+        self.assertEqual(self.scheduler.status_requests, 0)
+        self.engine.stop_workflow(wf_id)
+        loop.wait_one_loop()
+        self.assertEqual(loop._active_jobs, {})
+
+    def test_submission_pool(self):
+        self.engine.stop()
+        scheduler = SlowSubmissionScheduler()
+        scheduler.submission_workers = 3
+        scheduler.submission_window = 4
+        self.scheduler = scheduler
+        self.engine = engine.WorkflowEngine(self.database_server, scheduler)
+        loop = self.engine.engine_loop
+        self.assertTrue(loop._submission_pool is not None)
+        njobs = 12
+        jobs = [Job(command=['true'], name='job %d' % i)
+                for i in range(njobs)]
+        wf_id = self.engine.submit_workflow(Workflow(jobs=jobs, name='wide'),
+                                            None, 'wide', None)
+        t0 = time.time()
+        # the loop must keep running while submissions are blocked
+        loop.wait_one_loop()
+        loop.wait_one_loop()
+        self.assertTrue(time.time() - t0 < scheduler.delay)
+        with loop._lock:
+            self.assertTrue(len(loop._submitting_jobs)
+                            <= scheduler.submission_window)
+        self.engine.wait_workflow(wf_id, timeout=60)
+        status = self.database_server.get_workflow_status(
+            wf_id, self.engine._user_id)[0]
+        self.assertEqual(status, constants.WORKFLOW_DONE)
+        self.assertEqual(len(scheduler.submitted), njobs)
+        self.assertTrue(scheduler.max_concurrent_submissions
+                        <= scheduler.submission_workers)
+        self.assertTrue(scheduler.max_concurrent_submissions > 1)
+        self.assertEqual(loop._submitting_jobs, {})
+        statuses = [job_info[1] for job_info in
+                    self.database_server.get_detailed_workflow_status(
+                        wf_id)[0]]
+        self.assertEqual(statuses, [constants.DONE] * njobs)
+
+    def test_critical_paths(self):
+        jobs = [Job(command=['true'], name='job %d' % i, duration_hint=d)
+                for i, d in enumerate([1., 2., 5., None])]
+        # diamond: 0 -> (1, 2) -> 3
+        dependencies = [(jobs[0], jobs[1]), (jobs[0], jobs[2]),
+                        (jobs[1], jobs[3]), (jobs[2], jobs[3])]
+        workflow = engine.EngineWorkflow(
+            Workflow(jobs=jobs, dependencies=dependencies), {}, None, None,
+            'diamond')
+        workflow.compute_critical_paths({'job 3': 4.})
+        critical_paths = [workflow.job_mapping[job].critical_path
+                          for job in jobs]
+        self.assertEqual(critical_paths, [10., 6., 9., 4.])
+        # unknown durations get the mean known duration
+        workflow.compute_critical_paths()
+        critical_paths = [workflow.job_mapping[job].critical_path
+                          for job in jobs]
+        self.assertEqual(critical_paths, [1. + 5. + 8. / 3, 2. + 8. / 3,
+                                          5. + 8. / 3, 8. / 3])
+
+    def test_critical_path_submission_order(self):
+        self.engine.stop()
+        self.engine = engine.WorkflowEngine(self.database_server,
+                                            self.scheduler,
+                                            running_jobs_limits={None: 1})
+        loop = self.engine.engine_loop
+        loop.set_submission_order('critical_path')
+        wide_jobs = [Job(command=['true'], name='wide %d' % i,
+                         duration_hint=0.5) for i in range(5)]
+        chain = [Job(command=['true'], name='chain %d' % i,
+                     duration_hint=1.) for i in range(3)]
+        workflow = Workflow(jobs=wide_jobs + chain,
+                            dependencies=list(zip(chain[:-1], chain[1:])),
+                            name='wide and deep')
+        wf_id = self.engine.submit_workflow(workflow, None, 'wide and deep',
+                                            None)
+        self.engine.wait_workflow(wf_id, timeout=60)
+        submitted = self.scheduler.submitted_names
+        # the head of the chain is submitted first, and the chain is not
+        # delayed by the wide jobs
+        self.assertEqual(submitted[:3], ['chain 0', 'chain 1', 'chain 2'])
+        self.assertTrue('chain 0' in self.database_server.
+                        get_jobs_mean_duration(self.engine._user_id,
+                                               ['chain 0', 'unknown']))
+
+    def test_pending_jobs_queue(self):
+        jobs = [Job(command=['true'], name='job %d' % i) for i in range(4)]
+        queue = engine.PendingJobsQueue()
+        for job, key in zip(jobs, [(0, ), (-1, ), (0, ), (-1, )]):
+            queue.push(job, key)
+        queue.remove(jobs[3])
+        self.assertEqual(len(queue), 3)
+        self.assertFalse(jobs[3] in queue)
+        self.assertEqual([queue.pop() for i in range(3)],
+                         [jobs[1], jobs[0], jobs[2]])
+        self.assertRaises(IndexError, queue.pop)
+
+    def test_stop_loop_is_immediate(self):
+        t0 = time.time()
+        self.engine.stop()
+        elapsed = time.time() - t0
+        self.assertFalse(self.engine.engine_loop_thread.is_alive())
+        self.assertTrue(elapsed < engine.event_fallback_interval)
+
+
+class CountingDatabaseServer(WorkflowDatabaseServer):
+
+    '''
+    Database server counting the write-behind transactions.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(CountingDatabaseServer, self).__init__(*args, **kwargs)
+        self.nb_write_updates = 0
+
+    def write_updates(self, **kwargs):
+        self.nb_write_updates += 1
+        return super(CountingDatabaseServer, self).write_updates(**kwargs)
+
+
+class WriteBehindDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='swf_engine_')
+        transfer_dir = os.path.join(self.tmp_dir, 'transfered_files')
+        os.mkdir(transfer_dir)
+        self.database_server = CountingDatabaseServer(
+            os.path.join(self.tmp_dir, 'soma_workflow.db'), transfer_dir,
+            remove_orphan_files=False)
+        # no periodic flush during the tests
+        self.write_behind = WriteBehindDatabaseServer(self.database_server,
+                                                      flush_interval=3600)
+        self.scheduler = FakeScheduler()
+        self.engine = engine.WorkflowEngine(self.write_behind,
+                                            self.scheduler)
+
+    def tearDown(self):
+        self.engine.stop()
+        self.write_behind.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_flush_on_stop(self):
+        jobs = [Job(command=['true'], name='job %d' % i) for i in range(10)]
+        workflow = Workflow(jobs=jobs,
+                            dependencies=list(zip(jobs[:-1], jobs[1:])))
+        wf_id = self.engine.submit_workflow(workflow, None, 'chain', None)
+        self.engine.wait_workflow(wf_id, timeout=60)
+        user_id = self.engine._user_id
+        # the engine reads its own writes
+        self.assertEqual(
+            self.write_behind.get_workflow_status(wf_id, user_id)[0],
+            constants.WORKFLOW_DONE)
+        self.assertNotEqual(
+            self.database_server.get_workflow_status(wf_id, user_id)[0],
+            constants.WORKFLOW_DONE)
+        self.engine.stop()
+        self.assertEqual(
+            self.database_server.get_workflow_status(wf_id, user_id)[0],
+            constants.WORKFLOW_DONE)
+        for job_info \
+                in self.database_server.get_detailed_workflow_status(wf_id)[0]:
+            self.assertEqual(job_info[1], constants.DONE)
+            self.assertEqual(job_info[3][0], constants.FINISHED_REGULARLY)
+
+    def test_coalesced_updates(self):
+        self.scheduler.held_jobs.update(['job 0', 'job 1'])
+        jobs = [Job(command=['true'], name='job %d' % i) for i in range(2)]
+        wf_id = self.engine.submit_workflow(Workflow(jobs=jobs), None,
+                                            'held', None)
+        self.engine.engine_loop.wait_one_loop()
+        self.engine.engine_loop.wait_one_loop()
+        self.engine.stop()
+        user_id = self.engine._user_id
+        job_ids = [job_info[0] for job_info in
+                   self.database_server.get_detailed_workflow_status(
+                       wf_id)[0]]
+        nb_write_updates = self.database_server.nb_write_updates
+
+        for status in (constants.QUEUED_ACTIVE, constants.RUNNING,
+                       constants.DONE):
+            self.write_behind.set_jobs_status(
+                dict((job_id, status) for job_id in job_ids))
+        self.write_behind.set_job_exit_info(
+            job_ids[0], constants.FINISHED_REGULARLY, 0, None, None)
+        self.write_behind.set_workflow_status(wf_id,
+                                              constants.WORKFLOW_DONE)
+        self.assertEqual(
+            self.write_behind.get_job_status(job_ids[0], user_id)[0],
+            constants.DONE)
+        self.assertEqual(
+            self.write_behind.get_job_exit_info(job_ids[0], user_id)[:2],
+            (constants.FINISHED_REGULARLY, 0))
+        self.assertEqual(
+            self.database_server.get_job_status(job_ids[0], user_id)[0],
+            constants.RUNNING)
+        self.write_behind.flush()
+        # everything is written in one transaction
+        self.assertEqual(self.database_server.nb_write_updates,
+                         nb_write_updates + 1)
+        for job_id in job_ids:
+            self.assertEqual(
+                self.database_server.get_job_status(job_id, user_id)[0],
+                constants.DONE)
+        self.assertEqual(
+            self.database_server.get_workflow_status(wf_id, user_id)[0],
+            constants.WORKFLOW_DONE)
+        # nothing to write
+        self.write_behind.flush()
+        self.assertEqual(self.database_server.nb_write_updates,
+                         nb_write_updates + 1)
+
+    def test_wait_status_events(self):
+        self.scheduler.held_jobs.add('held')
+        wf_id = self.engine.submit_workflow(
+            Workflow(jobs=[Job(command=['true'], name='held')]), None,
+            'held', None)
+        self.engine.engine_loop.wait_one_loop()
+        self.engine.stop()
+        self.write_behind.flush()
+        nb_write_updates = self.database_server.nb_write_updates
+        event_id = self.write_behind.wait_status_events(timeout=0)[0]
+
+        # woken up by a buffered update, which is not written
+        timer = threading.Timer(
+            0.2, self.write_behind.set_workflow_status,
+            (wf_id, constants.WORKFLOW_DONE))
+        timer.start()
+        t0 = time.time()
+        result = self.write_behind.wait_status_events(event_id, wf_id,
+                                                      timeout=10)
+        self.assertTrue(time.time() - t0 < 5)
+        self.assertEqual(result[2], [])
+        self.assertEqual(self.database_server.nb_write_updates,
+                         nb_write_updates)
+
+        # the events are returned once written
+        self.write_behind.flush()
+        events = self.write_behind.wait_status_events(event_id, wf_id,
+                                                      timeout=10)[2]
+        self.assertEqual([event[3:] for event in events],
+                         [('workflow', wf_id, constants.WORKFLOW_DONE)])
+
+    def test_kill_pending(self):
+        self.scheduler.held_jobs.add('held')
+        wf_id = self.engine.submit_workflow(
+            Workflow(jobs=[Job(command=['true'], name='held')]), None,
+            'held', None)
+        self.engine.engine_loop.wait_one_loop()
+        self.engine.stop()
+        user_id = self.engine._user_id
+        self.write_behind.set_workflow_status(wf_id, constants.KILL_PENDING,
+                                              force=True)
+        # not forced: the kill request is kept
+        self.write_behind.set_workflow_status(
+            wf_id, constants.WORKFLOW_IN_PROGRESS)
+        self.assertEqual(
+            self.write_behind.get_workflow_status(wf_id, user_id)[0],
+            constants.KILL_PENDING)
+        self.assertEqual(
+            self.write_behind.workflows_to_delete_and_kill(user_id),
+            ([], [wf_id]))
+        self.write_behind.flush()
+        self.assertEqual(
+            self.database_server.workflows_to_delete_and_kill(user_id),
+            ([], [wf_id]))
+        self.write_behind.set_workflow_status(
+            wf_id, constants.WORKFLOW_DONE, force=True)
+        self.assertEqual(
+            self.write_behind.workflows_to_delete_and_kill(user_id),
+            ([], []))
+
+
+def test():
+    suite = unittest.TestLoader().loadTestsFromTestCase(EngineLoopTest)
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        WriteBehindDatabaseTest))
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+if __name__ == '__main__':
+    unittest.main()
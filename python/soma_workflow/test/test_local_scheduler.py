@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the LocalScheduler, running small python processes.
+'''
+from __future__ import print_function
+
+from __future__ import absolute_import
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from soma_workflow.client import Job
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.schedulers.local_scheduler import LocalScheduler, \
+    ProcessReaper, JobQueue, native_memory_request, CorePlacement, \
+    parse_cpu_list, WorkerPool, WorkerProcess
+from soma_workflow.schedulers.local_worker import python_command_supported
+import soma_workflow.constants as constants
+
+
+def python_job(job_id, code, **kwargs):
+    engine_job = EngineJob(Job(command=[sys.executable, '-c', code],
+                               name='job %d' % job_id, **kwargs), None)
+    engine_job.job_id = job_id
+    return engine_job
+
+
+class PollingLocalScheduler(LocalScheduler):
+
+    use_process_reaper = False
+
+
+class LocalSchedulerTest(unittest.TestCase):
+
+    scheduler_class = LocalScheduler
+    interval = 30
+    worker_pool = 0
+
+    def setUp(self):
+        if self.scheduler_class.use_process_reaper \
+                and not ProcessReaper.is_supported():
+            self.skipTest('pidfds are not supported')
+        if self.worker_pool and not WorkerPool.is_supported():
+            self.skipTest('worker pools are not supported')
+        self.scheduler = self.scheduler_class(proc_nb=2, max_proc_nb=2,
+                                              interval=self.interval,
+                                              worker_pool=self.worker_pool)
+        self.events = threading.Event()
+        self.scheduler.set_event_callback(self.events.set)
+
+    def tearDown(self):
+        self.scheduler.end_scheduler_thread()
+
+    def wait_status(self, drmaa_id, statuses, timeout=10):
+        start = time.time()
+        while time.time() - start < timeout:
+            status = self.scheduler.get_job_status(drmaa_id)
+            if status in statuses:
+                return status
+            self.events.wait(0.5)
+            self.events.clear()
+        self.fail('job %s still %s' % (drmaa_id, status))
+
+    def test_exit_info(self):
+        start = time.time()
+        drmaa_id = self.scheduler.job_submission(
+            python_job(1, 'sum(range(100000)); import sys; sys.exit(3)'))
+        self.wait_status(drmaa_id, (constants.DONE, ))
+        # the end of the job is seen without waiting for the scheduler loop
+        # interval
+        self.assertTrue(time.time() - start < 5)
+        exit_status, exit_value, term_sig, resource_usage \
+            = self.scheduler.get_job_exit_info(drmaa_id)
+        self.assertEqual(exit_status, constants.FINISHED_REGULARLY)
+        self.assertEqual(exit_value, 3)
+        if hasattr(os, 'wait4'):
+            resource_usage = dict(item.split('=')
+                                  for item in resource_usage.split())
+            self.assertEqual(sorted(resource_usage.keys()),
+                             ['cput', 'end_time', 'mem', 'start_time',
+                              'walltime'])
+            self.assertTrue(int(resource_usage['mem'][:-2]) > 0)
+            self.assertTrue(float(resource_usage['end_time'])
+                            >= float(resource_usage['start_time']))
+
+    def test_queued_jobs(self):
+        start = time.time()
+        drmaa_ids = [
+            self.scheduler.job_submission(
+                python_job(i, 'import time; time.sleep(0.2)'))
+            for i in range(1, 6)]
+        for drmaa_id in drmaa_ids:
+            self.wait_status(drmaa_id, (constants.DONE, ))
+            self.assertEqual(
+                self.scheduler.get_job_exit_info(drmaa_id)[:2],
+                (constants.FINISHED_REGULARLY, 0))
+        # the queued jobs are started as soon as a process ends
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(self.scheduler._running_cpus, 0)
+
+    def test_kill_job(self):
+        drmaa_id = self.scheduler.job_submission(
+            python_job(1, 'import time; time.sleep(60)'))
+        self.wait_status(drmaa_id, (constants.RUNNING, ))
+        self.scheduler.kill_job(drmaa_id)
+        self.assertEqual(self.scheduler.get_job_status(drmaa_id),
+                         constants.FAILED)
+        self.assertEqual(self.scheduler.get_job_exit_info(drmaa_id)[0],
+                         constants.USER_KILLED)
+        self.assertEqual(self.scheduler._running_cpus, 0)
+        # the next job runs normally
+        drmaa_id = self.scheduler.job_submission(python_job(2, 'pass'))
+        self.wait_status(drmaa_id, (constants.DONE, ))
+
+
+    def test_parallel_jobs(self):
+        # a job using the 2 CPUs waits for the running job, the next ones
+        # can run meanwhile
+        sleep = 'import time; time.sleep(0.5)'
+        first_id = self.scheduler.job_submission(python_job(1, sleep))
+        self.wait_status(first_id, (constants.RUNNING, ))
+        job = python_job(2, sleep)
+        job.parallel_job_info = {'config_name': 'native', 'nodes_number': 1,
+                                 'cpu_per_node': 2}
+        parallel_id = self.scheduler.job_submission(job)
+        last_id = self.scheduler.job_submission(python_job(3, sleep))
+        self.wait_status(last_id, (constants.RUNNING, ))
+        self.assertEqual(self.scheduler.get_job_status(parallel_id),
+                         constants.QUEUED_ACTIVE)
+        self.wait_status(parallel_id, (constants.RUNNING, ))
+        self.assertEqual(self.scheduler._running_cpus, 2)
+        self.wait_status(parallel_id, (constants.DONE, ))
+        self.assertEqual(self.scheduler._running_cpus, 0)
+
+    def test_memory_budget(self):
+        # the second job waits for the memory of the first one, the third
+        # one needs less memory and runs meanwhile
+        self.scheduler.change_max_memory(100)
+        sleep = 'import time; time.sleep(0.5)'
+        job = python_job(1, sleep)
+        job.memory = 60
+        first_id = self.scheduler.job_submission(job)
+        job = python_job(2, sleep)
+        job.native_specification = '-l walltime=10:00:00,mem=60mb'
+        second_id = self.scheduler.job_submission(job)
+        job = python_job(3, sleep)
+        job.memory = 30
+        third_id = self.scheduler.job_submission(job)
+        self.wait_status(third_id, (constants.RUNNING, ))
+        self.assertEqual(self.scheduler.get_job_status(first_id),
+                         constants.RUNNING)
+        self.assertEqual(self.scheduler.get_job_status(second_id),
+                         constants.QUEUED_ACTIVE)
+        self.assertEqual(self.scheduler._running_memory, 90)
+        self.wait_status(second_id, (constants.DONE, ))
+        self.assertEqual(self.scheduler._running_memory, 0)
+
+
+class PollingLocalSchedulerTest(LocalSchedulerTest):
+
+    '''
+    Same tests, without the process reaper: the processes are polled by the
+    scheduler loop
+    '''
+
+    scheduler_class = PollingLocalScheduler
+    interval = 0.05
+
+    def test_exit_info(self):
+        super(PollingLocalSchedulerTest, self).test_exit_info()
+        self.assertTrue(self.scheduler._reaper is None)
+
+
+class WorkerPoolLocalSchedulerTest(LocalSchedulerTest):
+
+    '''
+    Same tests, the jobs being run by the workers of a worker pool
+    '''
+
+    worker_pool = 2
+
+    def test_exit_info(self):
+        super(WorkerPoolLocalSchedulerTest, self).test_exit_info()
+        self.assertEqual(len(self.scheduler._worker_pool._workers), 1)
+
+    def test_python_jobs(self):
+        # python jobs run in the worker interpreter, each one in its own
+        # process, with its own working directory and environment
+        tmp_dir = tempfile.mkdtemp(prefix='swf_test_')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        code = 'import os, sys; print(os.getcwd()); ' \
+            'print(os.environ.get("SWF_TEST")); os.environ["SWF_TEST"] = "0"; ' \
+            'print(getattr(os, "swf_test", None)); os.swf_test = 1; ' \
+            'sys.exit(int(sys.argv[1]))'
+        drmaa_ids = []
+        for i, env in enumerate(({'SWF_TEST': 'a'}, None, None)):
+            job = EngineJob(Job(
+                command=[sys.executable, '-c', code, str(i + 1)],
+                name='job %d' % i, python_job=True, env=env,
+                working_directory=tmp_dir if env else None,
+                stdout_file=os.path.join(tmp_dir, 'out%d' % i)), None)
+            job.job_id = i + 1
+            drmaa_ids.append(self.scheduler.job_submission(job))
+            process = self.scheduler._processes.get(drmaa_ids[-1])
+            if process is not None:
+                self.assertTrue(isinstance(process, WorkerProcess))
+        outputs = []
+        for i, drmaa_id in enumerate(drmaa_ids):
+            self.wait_status(drmaa_id, (constants.DONE, ))
+            self.assertEqual(
+                self.scheduler.get_job_exit_info(drmaa_id)[:2],
+                (constants.FINISHED_REGULARLY, i + 1))
+            with open(os.path.join(tmp_dir, 'out%d' % i)) as f:
+                outputs.append(f.read().split())
+        self.assertEqual(outputs[0], [tmp_dir, 'a', 'None'])
+        for output in outputs[1:]:
+            self.assertEqual(output, [os.getcwd(), 'None', 'None'])
+        # jobs were run by the 2 workers
+        self.assertEqual(len(self.scheduler._worker_pool._workers), 2)
+
+    def test_python_command(self):
+        # only the commands of the worker interpreter run in the worker
+        # interpreter, other python commands are started as usual
+        tmp_dir = tempfile.mkdtemp(prefix='swf_test_')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        code = 'import sys; print("soma_workflow.schedulers.local_worker" ' \
+            'in sys.modules)'
+        commands = [
+            ([sys.executable, '-c', code], None),
+            (['env', sys.executable, '-c', code], None),
+            ([sys.executable, '-c', code], ['env'])]
+        drmaa_ids = []
+        for i, (command, container_command) in enumerate(commands):
+            job = EngineJob(Job(command=command, name='job %d' % i,
+                                python_job=True,
+                                stdout_file=os.path.join(tmp_dir,
+                                                         'out%d' % i)),
+                            None, container_command=container_command)
+            job.job_id = i + 1
+            drmaa_ids.append(self.scheduler.job_submission(job))
+        outputs = []
+        for i, drmaa_id in enumerate(drmaa_ids):
+            self.wait_status(drmaa_id, (constants.DONE, ))
+            with open(os.path.join(tmp_dir, 'out%d' % i)) as f:
+                outputs.append(f.read().strip())
+        self.assertEqual(outputs, ['True', 'False', 'False'])
+
+        self.assertTrue(python_command_supported(
+            [os.path.basename(sys.executable), 'x.py'],
+            os.path.dirname(sys.executable)))
+        for command in (
+                ['singularity', 'exec', 'img.sif', 'python', '-m', 'mod'],
+                ['bv', 'python', 'x.py'],
+                [os.path.join(tmp_dir, 'python2'), 'x.py'],
+                [sys.executable, '-u', 'x.py'],
+                [sys.executable]):
+            self.assertFalse(python_command_supported(command))
+
+    def test_worker_end(self):
+        # a job ending its worker is seen as killed, the next jobs use a
+        # new worker
+        drmaa_id = self.scheduler.job_submission(python_job(
+            1, 'import os; os.kill(os.getppid(), 9); import time; '
+            'time.sleep(60)', python_job=True))
+        self.wait_status(drmaa_id, (constants.DONE, ))
+        self.assertEqual(self.scheduler.get_job_exit_info(drmaa_id)[1], -9)
+        self.assertEqual(self.scheduler._worker_pool._workers, [])
+        drmaa_id = self.scheduler.job_submission(python_job(2, 'pass'))
+        self.wait_status(drmaa_id, (constants.DONE, ))
+        self.assertEqual(self.scheduler.get_job_exit_info(drmaa_id)[1], 0)
+
+
+class UnsupportedWorkerPoolTest(unittest.TestCase):
+
+    '''
+    A worker pool requested where it is not supported (python 2 without
+    subprocess32): the jobs are run by plain processes
+    '''
+
+    def setUp(self):
+        is_supported = WorkerPool.__dict__['is_supported']
+        self.addCleanup(setattr, WorkerPool, 'is_supported', is_supported)
+        WorkerPool.is_supported = staticmethod(lambda: False)
+        self.scheduler = LocalScheduler(proc_nb=2, max_proc_nb=2,
+                                        interval=0.05, worker_pool=2)
+        self.addCleanup(self.scheduler.end_scheduler_thread)
+
+    def test_shell_command(self):
+        self.assertTrue(self.scheduler._worker_pool is None)
+        tmp_dir = tempfile.mkdtemp(prefix='swf_test_')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        stdout = os.path.join(tmp_dir, 'out')
+        job = EngineJob(Job(command=['sh', '-c', 'echo ok; exit 4'],
+                            name='job 1', stdout_file=stdout), None)
+        job.job_id = 1
+        drmaa_id = self.scheduler.job_submission(job)
+        start = time.time()
+        while self.scheduler.get_job_status(drmaa_id) != constants.DONE:
+            self.assertTrue(time.time() - start < 10)
+            time.sleep(0.05)
+        self.assertEqual(self.scheduler.get_job_exit_info(drmaa_id)[:2],
+                         (constants.FINISHED_REGULARLY, 4))
+        with open(stdout) as f:
+            self.assertEqual(f.read().strip(), 'ok')
+        self.assertFalse(isinstance(self.scheduler._processes.get(drmaa_id),
+                                    WorkerProcess))
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        queue = JobQueue()
+        for job_id, priority, ncpu in (('1', 0, 1), ('2', 0, 2), ('3', 1, 1),
+                                       ('4', 0, 1), ('5', 1, 4)):
+            queue.append(job_id, priority, ncpu)
+        self.assertEqual(len(queue), 5)
+        queue.remove('4')
+        self.assertFalse('4' in queue)
+        # highest priority first, then submission order
+        self.assertEqual(queue.popleft(queue.first()), '3')
+        # skip the jobs using 4 CPUs
+        self.assertEqual(queue.popleft(queue.first((4, ))), '1')
+        self.assertEqual(queue.first((2, 4)), None)
+        self.assertEqual(queue.popleft(queue.first()), '5')
+        self.assertEqual(queue.popleft(queue.first()), '2')
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.first(), None)
+
+
+class CorePlacementTest(unittest.TestCase):
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(parse_cpu_list('0-3,8,10-11\n'),
+                         [0, 1, 2, 3, 8, 10, 11])
+
+    def test_allocate(self):
+        placement = CorePlacement([[0, 1, 2, 3], [4, 5, 6, 7]])
+        first = placement.allocate(3)
+        self.assertEqual(first, [0, 1, 2])
+        # the node with the fewest free cores which has enough
+        self.assertEqual(placement.allocate(1), [3])
+        second = placement.allocate(2)
+        self.assertEqual(second, [4, 5])
+        # not on a single node any longer
+        placement.release(first)
+        third = placement.allocate(5)
+        self.assertEqual(sorted(third), [0, 1, 2, 6, 7])
+        self.assertEqual(placement.allocate(1), None)
+        placement.release(second)
+        self.assertEqual(placement.free_cores_number(), 2)
+        self.assertEqual(placement.allocate(2), [4, 5])
+
+    def test_cpu_affinity(self):
+        if not CorePlacement.is_supported():
+            self.skipTest('CPU affinity is not supported')
+        tmp_dir = tempfile.mkdtemp(prefix='swf_test_')
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        scheduler = LocalScheduler(proc_nb=1, max_proc_nb=1, interval=0.05,
+                                   cpu_affinity=True)
+        self.addCleanup(scheduler.end_scheduler_thread)
+        out_file = os.path.join(tmp_dir, 'out.txt')
+        drmaa_id = scheduler.job_submission(python_job(
+            1, 'import os; open(%s, "w").write(repr((sorted('
+            'os.sched_getaffinity(0)), os.environ["OMP_NUM_THREADS"])))'
+            % repr(out_file)))
+        start = time.time()
+        while scheduler.get_job_status(drmaa_id) != constants.DONE:
+            self.assertTrue(time.time() - start < 10)
+            time.sleep(0.05)
+        with open(out_file) as f:
+            cores, threads = eval(f.read())
+        self.assertEqual(cores, [CorePlacement.numa_nodes()[0][0]])
+        self.assertEqual(threads, '1')
+        # the core is free again
+        self.assertEqual(scheduler._job_cores, {})
+        self.assertEqual(scheduler._placement.free_cores_number(),
+                         sum(len(node)
+                             for node in CorePlacement.numa_nodes()))
+
+
+class NativeMemoryRequestTest(unittest.TestCase):
+
+    def test_native_memory_request(self):
+        for native_specification, ncpu, memory in (
+                ('-l walltime=10:00:00,mem=4gb', 1, 4096.),
+                ('-l walltime=10:00:00,pmem=2gb', 4, 8192.),
+                ('-l mem=1073741824', 1, 1024.),
+                ('--mem=4G', 1, 4096.),
+                ('--mem=2000', 1, 2000.),
+                ('--mem-per-cpu=512M --cpus-per-task=2', 2, 1024.),
+                ('-l h_rt=10:00:00', 1, None),
+                (None, 1, None)):
+            self.assertEqual(native_memory_request(native_specification,
+                                                   ncpu),
+                             memory)
+
+
+def test():
+    suite = unittest.TestSuite()
+    for test_case in (LocalSchedulerTest, PollingLocalSchedulerTest,
+                      WorkerPoolLocalSchedulerTest, UnsupportedWorkerPoolTest,
+                      JobQueueTest, CorePlacementTest,
+                      NativeMemoryRequestTest):
+        suite.addTests(unittest.TestLoader().loadTestsFromTestCase(test_case))
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == '__main__':
+    test()
@@ -9,13 +9,15 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 import os
+import pickle
 import tempfile
 
 from soma_workflow.test.workflow_tests.workflow_examples import workflow_local
 from soma_workflow.test.workflow_tests.workflow_examples import workflow_shared
 from soma_workflow.test.workflow_tests.workflow_examples \
     import workflow_transfer
-from soma_workflow.client import Helper
+from soma_workflow.client import Helper, Job, Workflow, FileTransfer
+from soma_workflow.engine_types import EngineWorkflow
 import unittest
 import shutil
 
@@ -81,6 +83,60 @@ class SerializationTest(unittest.TestCase):
             except IOError:
                 pass
 
+    def test_compact_jobs(self):
+        # jobs do not store the attributes left to their default value, but
+        # still expose them, and pickle as before
+        stdin = FileTransfer(True, '/tmp/in.txt', name='in')
+        jobs = [Job(command=['echo', 'a'], name='a'),
+                Job(command=['cat'], name='b', stdin=stdin, priority=3,
+                    env={'A': '1'}, duration_hint=2., memory=512,
+                    python_job=True)]
+        workflow = Workflow(jobs=jobs,
+                            dependencies=[(jobs[0], jobs[1])])
+        self.assertFalse('stdin' in jobs[0].__dict__)
+        self.assertEqual(jobs[0].stdin, None)
+        self.assertEqual(jobs[0].has_outputs, False)
+        self.assertEqual(jobs[0].param_dict, {})
+        self.assertEqual(jobs[0].disposal_timeout, 168)
+        engine_workflow = EngineWorkflow(workflow, {}, None, None, 'wf')
+        engine_jobs = [engine_workflow.job_mapping[job] for job in jobs]
+        self.assertEqual(engine_jobs[0].path_mapping, None)
+        self.assertEqual(engine_jobs[0].exit_status, None)
+        self.assertFalse(engine_jobs[0].is_engine_execution)
+        # the client job referenced files are not modified by the engine
+        self.assertEqual(jobs[1].referenced_input_files, [])
+        self.assertEqual(engine_jobs[1].referenced_input_files, [stdin])
+        self.assertTrue(stdin in engine_jobs[1].path_mapping)
+
+        new_workflow = pickle.loads(pickle.dumps(engine_workflow))
+        self.assertTrue(new_workflow.attributs_equal(engine_workflow))
+        new_job = new_workflow.job_mapping[new_workflow.jobs[1]]
+        self.assertEqual(new_job.priority, 3)
+        self.assertEqual(new_job.env, {'A': '1'})
+        self.assertEqual(new_job.duration_hint, 2.)
+        self.assertEqual(new_job.memory, 512)
+        self.assertTrue(new_job.python_job)
+        self.assertEqual(new_job.status, engine_jobs[1].status)
+
+        # pickles of former versions hold all the attributes
+        job = Job(command=['echo', 'a'])
+        state = dict((name, getattr(job, name))
+                     for name in ('stdin', 'stdout_file', 'env',
+                                  'has_outputs', 'configuration'))
+        state.update(job.__dict__)
+        old_job = Job.__new__(Job)
+        old_job.__dict__.update(state)
+        self.assertTrue(pickle.loads(pickle.dumps(old_job)).attributs_equal(
+            job))
+
+        file_path = tempfile.mkstemp(prefix="json_", suffix="compact.wf")
+        os.close(file_path[0])
+        file_path = file_path[1]
+        self.temporaries.append(file_path)
+        Helper.serialize(file_path, workflow)
+        self.assertTrue(Helper.unserialize(file_path).attributs_equal(
+            workflow))
+
 
 def test():
     suite = unittest.TestLoader().loadTestsFromTestCase(SerializationTest)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+'''
+Property-based tests of EngineWorkflow.find_out_jobs_to_process: the
+incremental (cached) implementation is checked against the reference
+implementation, find_out_jobs_to_process_nocache, on random workflows and
+random executions.
+'''
+from __future__ import print_function
+
+from __future__ import absolute_import
+import random
+import unittest
+
+from soma_workflow.client import Job, Workflow
+from soma_workflow.engine_types import EngineWorkflow, WorkflowGraph
+import soma_workflow.constants as constants
+
+
+def random_workflow(rng, max_jobs=40):
+    '''
+    Random DAG: dependencies always go from a job to a later one in the list.
+    '''
+    nb_jobs = rng.randint(1, max_jobs)
+    density = rng.uniform(0., 0.3)
+    jobs = [Job(command=['true'], name='job %d' % i) for i in range(nb_jobs)]
+    dependencies = [(jobs[i], jobs[j]) for j in range(nb_jobs)
+                    for i in range(j) if rng.random() < density]
+    return Workflow(jobs=jobs, dependencies=dependencies)
+
+
+def engine_workflow(workflow, use_cache):
+    engine_wf = EngineWorkflow(workflow, {}, None, None, 'random')
+    engine_wf.use_cache = use_cache
+    for i, client_job in enumerate(workflow.jobs):
+        engine_wf.job_mapping[client_job].job_id = i + 1
+    return engine_wf
+
+
+def copy_jobs_state(src_wf, dst_wf):
+    for client_job, job in src_wf.job_mapping.items():
+        dst_job = dst_wf.job_mapping[client_job]
+        dst_job.status = job.status
+        dst_job.exit_status = job.exit_status
+        dst_job.exit_value = job.exit_value
+        dst_job.terminating_signal = job.terminating_signal
+
+
+def set_ended(job, success):
+    if success:
+        job.status = constants.DONE
+        job.exit_status = constants.FINISHED_REGULARLY
+        job.exit_value = 0
+    else:
+        job.status = constants.FAILED
+        job.exit_status = constants.FINISHED_REGULARLY
+        job.exit_value = 1
+
+
+class WorkflowReadinessTest(unittest.TestCase):
+
+    nb_workflows = 300
+
+    def check_same_result(self, cached_wf, ref_wf):
+        copy_jobs_state(cached_wf, ref_wf)
+        to_run, ended, status = cached_wf.find_out_jobs_to_process()
+        ref_to_run, ref_ended, ref_status \
+            = ref_wf.find_out_jobs_to_process_nocache()
+        self.assertEqual(sorted(job.job_id for job in to_run),
+                         sorted(job.job_id for job in ref_to_run))
+        self.assertEqual(sorted(ended), sorted(ref_ended))
+        self.assertEqual(status, ref_status)
+        return to_run, status
+
+    def test_random_executions(self):
+        rng = random.Random(1234)
+        for n in range(self.nb_workflows):
+            workflow = random_workflow(rng)
+            cached_wf = engine_workflow(workflow, True)
+            ref_wf = engine_workflow(workflow, False)
+            failure_rate = rng.choice([0., 0.05, 0.3])
+            running = []
+            status = None
+            while status != constants.WORKFLOW_DONE:
+                to_run, status = self.check_same_result(cached_wf, ref_wf)
+                # submit some of the ready jobs
+                for job in to_run:
+                    if rng.random() < 0.7:
+                        job.status = rng.choice([
+                            constants.SUBMISSION_PENDING,
+                            constants.QUEUED_ACTIVE, constants.RUNNING])
+                        running.append(job)
+                # end some of the running ones
+                rng.shuffle(running)
+                for i in range(rng.randint(0, len(running))):
+                    set_ended(running.pop(), rng.random() >= failure_rate)
+                # sometimes kill a job which is not ready, as the engine
+                # does, which resets the cache
+                if rng.random() < 0.05:
+                    waiting = [job for job in cached_wf.job_mapping.values()
+                               if job.status == constants.NOT_SUBMITTED]
+                    if waiting:
+                        job = rng.choice(waiting)
+                        job.status = constants.FAILED
+                        job.exit_status = constants.EXIT_NOTRUN
+                        cached_wf.cache = None
+            for job in cached_wf.job_mapping.values():
+                self.assertTrue(job.is_done())
+
+    def test_failure_aborts_branch(self):
+        jobs = [Job(command=['true'], name='job %d' % i) for i in range(4)]
+        # 0 -> 1 -> 2, 3 independent
+        workflow = engine_workflow(
+            Workflow(jobs=jobs, dependencies=[(jobs[0], jobs[1]),
+                                              (jobs[1], jobs[2])]), True)
+        to_run, ended, status = workflow.find_out_jobs_to_process()
+        self.assertEqual(sorted(job.name for job in to_run),
+                         ['job 0', 'job 3'])
+        for job in to_run:
+            job.status = constants.RUNNING
+        set_ended(workflow.job_mapping[jobs[0]], False)
+        to_run, ended, status = workflow.find_out_jobs_to_process()
+        self.assertEqual(to_run, [])
+        self.assertEqual(sorted(job.name for job in ended.values()),
+                         ['job 1', 'job 2'])
+        self.assertEqual(status, constants.WORKFLOW_IN_PROGRESS)
+        set_ended(workflow.job_mapping[jobs[3]], True)
+        to_run, ended, status = workflow.find_out_jobs_to_process()
+        self.assertEqual(status, constants.WORKFLOW_DONE)
+
+    def test_graph(self):
+        rng = random.Random(4321)
+        for n in range(50):
+            workflow = random_workflow(rng)
+            graph = WorkflowGraph(workflow.jobs, workflow.dependencies)
+            index = dict((job, i) for i, job in enumerate(workflow.jobs))
+            successors = [[] for job in workflow.jobs]
+            predecessors = [[] for job in workflow.jobs]
+            for dep in workflow.dependencies:
+                successors[index[dep[0]]].append(index[dep[1]])
+                predecessors[index[dep[1]]].append(index[dep[0]])
+            for i in range(len(workflow.jobs)):
+                self.assertEqual(list(graph.successors(i)), successors[i])
+                self.assertEqual(list(graph.predecessors(i)),
+                                 predecessors[i])
+                self.assertEqual(graph.nb_predecessors(i),
+                                 len(predecessors[i]))
+            # descendants: transitive closure
+            starts = rng.sample(range(len(workflow.jobs)),
+                                min(3, len(workflow.jobs)))
+            closure = set()
+            to_visit = [s for i in starts for s in successors[i]]
+            while to_visit:
+                i = to_visit.pop()
+                if i not in closure:
+                    closure.add(i)
+                    to_visit += successors[i]
+            self.assertEqual(sorted(graph.descendants(starts)),
+                             sorted(closure))
+            # each job comes after its successors
+            order = graph.reverse_topological_order()
+            self.assertEqual(sorted(order), list(range(len(workflow.jobs))))
+            position = dict((i, p) for p, i in enumerate(order))
+            for i, succ in enumerate(successors):
+                for j in succ:
+                    self.assertTrue(position[j] < position[i])
+
+    def test_jobs_which_can_rerun(self):
+        jobs = [Job(command=['true'], name='job %d' % i) for i in range(6)]
+        # 0 -> 1 -> 2, 3 -> 2, 2 -> 4, 5 independent
+        workflow = engine_workflow(
+            Workflow(jobs=jobs, dependencies=[(jobs[0], jobs[1]),
+                                              (jobs[1], jobs[2]),
+                                              (jobs[3], jobs[2]),
+                                              (jobs[2], jobs[4])]), True)
+        ejobs = [workflow.job_mapping[job] for job in jobs]
+        for job in ejobs:
+            job.status = constants.FAILED
+        ejobs[3].status = constants.DONE
+        self.assertEqual(workflow.job_ids_which_can_rerun([1]),
+                         set([1, 2, 3, 5]))
+        # job 2 also depends on job 3, which has failed
+        ejobs[3].status = constants.FAILED
+        self.assertEqual(workflow.job_ids_which_can_rerun([1]), set([1, 2]))
+        self.assertEqual(workflow.job_ids_which_can_rerun([1, 4]),
+                         set([1, 2, 3, 4, 5]))
+
+
+
+def test():
+    suite = unittest.TestLoader().loadTestsFromTestCase(
+        WorkflowReadinessTest)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+if __name__ == '__main__':
+    unittest.main()